@@ -30,6 +30,11 @@ API_SERVICE_OPTS = [
                default='0.0.0.0',
                help='The listen IP for the ceilometer API server',
                ),
+    cfg.IntOpt('max_limit',
+               default=1000,
+               help='Maximum number of samples returned by a request, the '
+               'next ones are paged through with the marker, unlimited if 0',
+               ),
 ]
 
 CONF = cfg.CONF
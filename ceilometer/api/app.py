@@ -27,6 +27,8 @@ from ceilometer.api import hooks
 from ceilometer.api import middleware
 from ceilometer import service
 from ceilometer import storage
+from ceilometer.storage import cache as storage_cache
+from ceilometer.storage import tiered as storage_tiered
 from ceilometer.openstack.common import log
 from wsgiref import simple_server
 
@@ -57,7 +59,10 @@ def setup_app(pecan_config=None, extra_hooks=None):
     app_hooks = [hooks.ConfigHook(),
                  hooks.DBHook(
                      storage_engine,
-                     storage_engine.get_connection(cfg.CONF),
+                     storage_cache.get_cached_connection(
+                         storage_tiered.get_tiered_connection(
+                             storage.get_connection(cfg.CONF), cfg.CONF),
+                         cfg.CONF),
                  ),
                  hooks.PipelineHook(),
                  hooks.TranslationHook()]
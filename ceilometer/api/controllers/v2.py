@@ -469,11 +469,20 @@ class MeterController(rest.RestController):
     def get_all(self, q=[], limit=None):
         """Return samples for the meter.
 
+        The samples are returned from the most recent one, at most
+        api.max_limit of them. To get the next page, filter on the
+        marker_timestamp and marker_message_id fields with the timestamp
+        and message_id of the last sample returned.
+
         :param q: Filter rules for the data to be returned.
         :param limit: Maximum number of samples to return.
         """
         if limit and limit < 0:
             raise ValueError("Limit must be positive")
+        # The response is built in memory, so its size is bounded.
+        max_limit = pecan.request.cfg.api.max_limit
+        if max_limit:
+            limit = min(limit or max_limit, max_limit)
         kwargs = _query_to_kwargs(q, storage.SampleFilter.__init__)
         kwargs['meter'] = self._id
         f = storage.SampleFilter(**kwargs)
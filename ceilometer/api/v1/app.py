@@ -53,8 +53,7 @@ def make_app(conf, enable_acl=True, attach_storage=True,
         def attach_storage():
             storage_engine = storage.get_engine(conf)
             flask.request.storage_engine = storage_engine
-            flask.request.storage_conn = \
-                storage_engine.get_connection(conf)
+            flask.request.storage_conn = storage.get_connection(conf)
 
     # Install the middleware wrapper
     if enable_acl:
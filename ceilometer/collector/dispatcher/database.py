@@ -46,6 +46,7 @@ class DatabaseDispatcher(dispatcher.Base):
         if not isinstance(data, list):
             data = [data]
 
+        meters = []
         for meter in data:
             LOG.debug('metering data %s for %s @ %s: %s',
                       meter['counter_name'],
@@ -62,11 +63,30 @@ class DatabaseDispatcher(dispatcher.Base):
                     if meter.get('timestamp'):
                         ts = timeutils.parse_isotime(meter['timestamp'])
                         meter['timestamp'] = timeutils.normalize_time(ts)
-                    self.storage_conn.record_metering_data(meter)
                 except Exception as err:
                     LOG.error('Failed to record metering data: %s', err)
                     LOG.exception(err)
+                else:
+                    meters.append(meter)
             else:
                 LOG.warning(
                     'message signature invalid, discarding message: %r',
                     meter)
+
+        # The meters received together are written as one batch, which
+        # the storage driver may coalesce.
+        if len(meters) > 1:
+            try:
+                self.storage_conn.record_metering_data_batch(meters)
+                return
+            except Exception as err:
+                LOG.error('Failed to record metering data batch, '
+                          'recording each sample: %s', err)
+                LOG.exception(err)
+        # A failing sample does not prevent the others from being recorded.
+        for meter in meters:
+            try:
+                self.storage_conn.record_metering_data(meter)
+            except Exception as err:
+                LOG.error('Failed to record metering data: %s', err)
+                LOG.exception(err)
@@ -0,0 +1,172 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Run each collector dispatcher behind its own bounded queue.
+"""
+
+import collections
+import time
+
+import eventlet
+from eventlet import queue
+from oslo.config import cfg
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+
+OPTS = [
+    cfg.IntOpt('dispatcher_workers',
+               default=0,
+               help='Number of green threads consuming the queue of each '
+               'dispatcher, 0 calls the dispatchers inline one after '
+               'another'),
+    cfg.IntOpt('dispatcher_queue_size',
+               default=1000,
+               help='Maximum number of metering messages waiting in the '
+               'queue of each dispatcher, 0 means unbounded'),
+    cfg.StrOpt('dispatcher_overflow',
+               default='block',
+               help='What to do when a dispatcher queue is full: "block" '
+               'the consumer until there is room or "drop" the message'),
+    cfg.IntOpt('dispatcher_stats_interval',
+               default=300,
+               help='Number of seconds between two logs of the dispatcher '
+               'latency and backlog statistics, 0 disables them'),
+]
+
+cfg.CONF.register_opts(OPTS, group="collector")
+
+LOG = log.getLogger(__name__)
+
+
+class DispatcherStats(object):
+    """Latency and backlog counters of a queued dispatcher."""
+
+    # Number of latency samples kept to compute the percentiles.
+    WINDOW = 1024
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_backlog = 0
+        self.latencies = collections.deque(maxlen=self.WINDOW)
+
+    def record(self, latency, success=True):
+        if success:
+            self.processed += 1
+        else:
+            self.failed += 1
+        self.latencies.append(latency)
+
+    @staticmethod
+    def _percentile(values, percent):
+        if not values:
+            return None
+        index = int(round((len(values) - 1) * percent / 100.0))
+        return values[index]
+
+    def as_dict(self, backlog=0):
+        latencies = sorted(self.latencies)
+        return {'processed': self.processed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'backlog': backlog,
+                'max_backlog': self.max_backlog,
+                'latency_p50': self._percentile(latencies, 50),
+                'latency_p95': self._percentile(latencies, 95),
+                'latency_p99': self._percentile(latencies, 99),
+                }
+
+
+class QueuedDispatcher(object):
+    """Feed a dispatcher from a bounded queue consumed by green threads.
+
+    Each dispatcher gets its own queue so a slow one only delays its own
+    messages instead of every other dispatcher configured in the collector.
+    When the queue is full, the caller is either blocked, which pushes the
+    backpressure back to the message broker, or the message is dropped.
+    """
+
+    def __init__(self, dispatcher, workers=1, queue_size=0,
+                 overflow='block'):
+        if overflow not in ('block', 'drop'):
+            raise ValueError(_('Invalid dispatcher overflow policy %s')
+                             % overflow)
+        self.dispatcher = dispatcher
+        self.name = dispatcher.__class__.__name__
+        self.overflow = overflow
+        self.stats = DispatcherStats()
+        # NOTE: eventlet queues use None for unbounded, 0 would turn the
+        # queue into a rendezvous channel.
+        self.queue = queue.LightQueue(queue_size or None)
+        self.workers = [eventlet.spawn(self._run) for i in range(workers)]
+
+    @property
+    def backlog(self):
+        return self.queue.qsize()
+
+    def record_metering_data(self, context, data):
+        item = (context, data, time.time())
+        if self.overflow == 'drop':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.stats.dropped += 1
+                LOG.warning(_('Queue of dispatcher %s is full, '
+                              'dropping metering data'), self.name)
+                return
+        else:
+            self.queue.put(item)
+        self.stats.max_backlog = max(self.stats.max_backlog, self.backlog)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            context, data, enqueued_at = item
+            try:
+                self.dispatcher.record_metering_data(context, data)
+            except Exception as err:
+                LOG.error(_('Dispatcher %(name)s failed to record metering '
+                            'data: %(err)s'), {'name': self.name,
+                                               'err': err})
+                LOG.exception(err)
+                self.stats.record(time.time() - enqueued_at, success=False)
+            else:
+                self.stats.record(time.time() - enqueued_at)
+
+    def get_stats(self):
+        return self.stats.as_dict(backlog=self.backlog)
+
+    def stop(self):
+        """Let the workers drain the queue, then wait for them to exit."""
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.wait()
+        self.workers = []
+
+
+def setup_dispatchers(dispatchers, conf):
+    """Wrap each dispatcher into a QueuedDispatcher according to the
+    configuration, or return them untouched if queueing is disabled.
+    """
+    if conf.collector.dispatcher_workers <= 0:
+        return dispatchers
+    return [QueuedDispatcher(d,
+                             workers=conf.collector.dispatcher_workers,
+                             queue_size=conf.collector.dispatcher_queue_size,
+                             overflow=conf.collector.dispatcher_overflow)
+            for d in dispatchers]
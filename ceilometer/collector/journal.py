@@ -0,0 +1,267 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Append-only journal of the raw metering messages received by the
+collector, and the tool replaying it into a storage driver.
+
+The journal is a directory of segment files. Each segment is a sequence of
+records made of a header holding the payload length and its CRC32 checksum,
+followed by the JSON encoded metering message.
+"""
+
+import os
+import struct
+import zlib
+
+import eventlet
+from oslo.config import cfg
+
+from ceilometer.openstack.common import fileutils
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import timeutils
+from ceilometer.publisher import rpc as publisher_rpc
+from ceilometer import service
+from ceilometer import storage
+
+OPTS = [
+    cfg.StrOpt('journal_path',
+               default=None,
+               help='Directory where the raw metering messages are '
+               'journaled before being dispatched, disabled if not set'),
+    cfg.IntOpt('journal_segment_size',
+               default=64 * 1024 * 1024,
+               help='Size in bytes after which a new journal segment '
+               'is started'),
+    cfg.IntOpt('journal_retention_size',
+               default=1024 * 1024 * 1024,
+               help='Total size in bytes of the journal segments to keep, '
+               'the oldest ones are deleted first, 0 means keep everything'),
+    cfg.BoolOpt('journal_fsync',
+                default=False,
+                help='fsync the journal after each message'),
+    cfg.IntOpt('replay_workers',
+               default=4,
+               help='Number of journal segments replayed in parallel by '
+               'ceilometer-replay'),
+    cfg.IntOpt('replay_checkpoint_interval',
+               default=1000,
+               help='Number of messages replayed between two updates of '
+               'the resume marker of a journal segment'),
+]
+
+cfg.CONF.register_opts(OPTS, group="collector")
+
+LOG = log.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.journal'
+MARKER_SUFFIX = '.replayed'
+
+# Payload length and CRC32 of the payload.
+HEADER = struct.Struct('>II')
+
+
+class CorruptedRecord(Exception):
+    """Error raised when a journal record does not match its checksum."""
+
+
+def list_segments(path):
+    """Return the journal segment file names in path, oldest first."""
+    return sorted(os.path.join(path, f) for f in os.listdir(path)
+                  if f.endswith(SEGMENT_SUFFIX))
+
+
+def read_segment(filename, offset=0):
+    """Yield (offset after the record, message) from a segment file.
+
+    A truncated record at the end of the segment, as left by a collector
+    killed in the middle of a write, stops the iteration silently. A
+    record whose checksum is wrong raises CorruptedRecord.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, checksum = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if zlib.crc32(payload) & 0xffffffff != checksum:
+                raise CorruptedRecord(
+                    _('Bad checksum in %(file)s at offset %(offset)d') %
+                    {'file': filename, 'offset': offset})
+            offset += HEADER.size + length
+            yield offset, jsonutils.loads(payload)
+
+
+class Journal(object):
+    """Segmented, append-only journal of raw metering messages."""
+
+    def __init__(self, path, segment_size, retention_size=0, fsync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.retention_size = retention_size
+        self.fsync = fsync
+        fileutils.ensure_tree(path)
+        segments = list_segments(path)
+        # Always start a new segment so we never append after a record
+        # that might have been left truncated by a previous run.
+        if segments:
+            last = os.path.basename(segments[-1])
+            self._index = int(last[:-len(SEGMENT_SUFFIX)]) + 1
+        else:
+            self._index = 0
+        self._file = None
+        self._size = 0
+
+    def _segment_name(self, index):
+        return os.path.join(self.path, '%020d%s' % (index, SEGMENT_SUFFIX))
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+            self._index += 1
+        self._file = open(self._segment_name(self._index), 'ab')
+        self._size = 0
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        if self.retention_size <= 0:
+            return
+        current = self._segment_name(self._index)
+        segments = [s for s in list_segments(self.path) if s != current]
+        total = sum(os.path.getsize(s) for s in segments)
+        for segment in segments:
+            if total <= self.retention_size:
+                break
+            total -= os.path.getsize(segment)
+            LOG.info(_('Removing journal segment %s'), segment)
+            fileutils.delete_if_exists(segment)
+            fileutils.delete_if_exists(segment + MARKER_SUFFIX)
+
+    def append(self, data):
+        """Write a raw metering message at the end of the journal."""
+        payload = jsonutils.dumps(data)
+        if self._file is None or self._size >= self.segment_size:
+            self._roll()
+        self._file.write(HEADER.pack(len(payload),
+                                     zlib.crc32(payload) & 0xffffffff))
+        self._file.write(payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._size += HEADER.size + len(payload)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def get_journal(conf):
+    """Return the Journal configured for the collector, or None."""
+    if not conf.collector.journal_path:
+        return None
+    return Journal(conf.collector.journal_path,
+                   conf.collector.journal_segment_size,
+                   conf.collector.journal_retention_size,
+                   conf.collector.journal_fsync)
+
+
+class Replayer(object):
+    """Load journal segments into a storage driver.
+
+    Each segment is replayed by its own green thread, through the shared
+    storage connection of the process. Progress is saved in a marker file
+    next to the segment every checkpoint_interval messages, so an
+    interrupted replay resumes where it stopped; messages replayed after the
+    last checkpoint are stored again.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.path = conf.collector.journal_path
+        self.workers = conf.collector.replay_workers
+        self.checkpoint_interval = conf.collector.replay_checkpoint_interval
+        self.secret = conf.publisher_rpc.metering_secret
+
+    @staticmethod
+    def _load_marker(segment):
+        try:
+            with open(segment + MARKER_SUFFIX) as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+    @staticmethod
+    def _save_marker(segment, offset):
+        # Write then rename, so the marker is never left half written.
+        tmp = segment + MARKER_SUFFIX + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.rename(tmp, segment + MARKER_SUFFIX)
+
+    def _record(self, storage_conn, meter):
+        if not publisher_rpc.verify_signature(meter, self.secret):
+            LOG.warning(_('message signature invalid, discarding message: '
+                          '%r'), meter)
+            return
+        if meter.get('timestamp'):
+            ts = timeutils.parse_isotime(meter['timestamp'])
+            meter['timestamp'] = timeutils.normalize_time(ts)
+        storage_conn.record_metering_data(meter)
+
+    def replay_segment(self, segment):
+        """Replay one segment from its resume marker, return the number of
+        messages stored.
+        """
+        offset = self._load_marker(segment)
+        if offset >= os.path.getsize(segment):
+            LOG.debug(_('Journal segment %s already replayed'), segment)
+            return 0
+        storage_conn = storage.get_connection(self.conf)
+        count = 0
+        for records, (offset, data) in enumerate(read_segment(segment,
+                                                              offset), 1):
+            # We may have received only one sample on the wire
+            if not isinstance(data, list):
+                data = [data]
+            for meter in data:
+                self._record(storage_conn, meter)
+                count += 1
+            if records % self.checkpoint_interval == 0:
+                self._save_marker(segment, offset)
+        self._save_marker(segment, offset)
+        LOG.info(_('Replayed %(count)d messages from %(segment)s'),
+                 {'count': count, 'segment': segment})
+        return count
+
+    def replay(self):
+        """Replay every segment of the journal, return the number of
+        messages stored.
+        """
+        pool = eventlet.GreenPool(max(self.workers, 1))
+        return sum(pool.imap(self.replay_segment, list_segments(self.path)))
+
+
+def replay():
+    service.prepare_service()
+    if not cfg.CONF.collector.journal_path:
+        LOG.error(_('No journal to replay, collector.journal_path '
+                    'is not set'))
+        return 1
+    count = Replayer(cfg.CONF).replay()
+    LOG.info(_('Replayed %d messages'), count)
@@ -31,6 +31,8 @@ from ceilometer.openstack.common.rpc import dispatcher as rpc_dispatcher
 from ceilometer.openstack.common.rpc import service as rpc_service
 
 from ceilometer.openstack.common import timeutils
+from ceilometer.collector import fanout
+from ceilometer.collector import journal
 from ceilometer import pipeline
 from ceilometer import storage
 from ceilometer.storage import models
@@ -53,6 +55,21 @@ OPTS = [
     cfg.MultiStrOpt('dispatcher',
                     default=['database'],
                     help='dispatcher to process metering data'),
+    cfg.IntOpt('metering_prefetch_count',
+               default=100,
+               help='Maximum number of unacknowledged metering messages the '
+               'broker delivers to the collector, 0 means unlimited'),
+    cfg.IntOpt('metering_ack_batch_size',
+               default=10,
+               help='Number of metering messages acknowledged at once'),
+    cfg.IntOpt('notification_prefetch_count',
+               default=100,
+               help='Maximum number of unacknowledged notifications the '
+               'broker delivers to each consumer pool of the collector, '
+               '0 means unlimited'),
+    cfg.IntOpt('notification_ack_batch_size',
+               default=10,
+               help='Number of notifications acknowledged at once'),
 ]
 
 cfg.CONF.register_opts(OPTS, group="collector")
@@ -115,11 +132,24 @@ class CollectorService(rpc_service.Service):
     def __init__(self, host, topic, manager=None):
         super(CollectorService, self).__init__(host, topic, manager)
         self.storage_conn = storage.get_connection(cfg.CONF)
+        self.journal = journal.get_journal(cfg.CONF)
 
     def start(self):
         super(CollectorService, self).start()
         # Add a dummy thread to have wait() working
         self.tg.add_timer(604800, lambda: None)
+        interval = cfg.CONF.collector.dispatcher_stats_interval
+        if interval > 0:
+            self.tg.add_timer(interval, self._log_dispatcher_stats,
+                              interval)
+
+    def stop(self):
+        super(CollectorService, self).stop()
+        for dispatcher in getattr(self, 'dispatchers', []):
+            if hasattr(dispatcher, 'stop'):
+                dispatcher.stop()
+        if self.journal:
+            self.journal.close()
 
     def initialize_service_hook(self, service):
         '''Consumers must be declared before consume_thread start.'''
@@ -144,16 +174,20 @@ class CollectorService(rpc_service.Service):
         self.notification_manager.map(self._setup_subscription)
 
         # Load all configured dispatchers
-        self.dispatchers = []
+        dispatchers = []
         for dispatcher in named.NamedExtensionManager(
                 namespace=self.DISPATCHER_NAMESPACE,
                 names=cfg.CONF.collector.dispatcher,
                 invoke_on_load=True,
                 invoke_args=[cfg.CONF]):
             if dispatcher.obj:
-                self.dispatchers.append(dispatcher.obj)
+                dispatchers.append(dispatcher.obj)
+
+        LOG.info('dispatchers loaded %s' % str(dispatchers))
 
-        LOG.info('dispatchers loaded %s' % str(self.dispatchers))
+        # Each dispatcher gets its own queue and workers so their
+        # latencies do not add up.
+        self.dispatchers = fanout.setup_dispatchers(dispatchers, cfg.CONF)
 
         # Set ourselves up as a separate worker for the metering data,
         # since the default for service is to use create_consumer().
@@ -161,6 +195,8 @@ class CollectorService(rpc_service.Service):
             cfg.CONF.publisher_rpc.metering_topic,
             rpc_dispatcher.RpcDispatcher([self]),
             'ceilometer.collector.' + cfg.CONF.publisher_rpc.metering_topic,
+            prefetch_count=cfg.CONF.collector.metering_prefetch_count,
+            ack_batch_size=cfg.CONF.collector.metering_ack_batch_size,
         )
 
     def _setup_subscription(self, ext, *args, **kwds):
@@ -178,15 +214,30 @@ class CollectorService(rpc_service.Service):
                         pool_name=topic,
                         topic=topic,
                         exchange_name=exchange_topic.exchange,
-                        ack_on_error=ack_on_error)
+                        ack_on_error=ack_on_error,
+                        prefetch_count=(
+                            cfg.CONF.collector.notification_prefetch_count),
+                        ack_batch_size=(
+                            cfg.CONF.collector.notification_ack_batch_size))
                 except Exception:
                     LOG.exception('Could not join consumer pool %s/%s' %
                                   (topic, exchange_topic.exchange))
 
     def record_metering_data(self, context, data):
+        # Journal the raw message first so it can be replayed into the
+        # storage with ceilometer-replay if a dispatcher loses it.
+        if self.journal:
+            self.journal.append(data)
         for dispatcher in self.dispatchers:
             dispatcher.record_metering_data(context, data)
 
+    def _log_dispatcher_stats(self):
+        for dispatcher in self.dispatchers:
+            if hasattr(dispatcher, 'get_stats'):
+                LOG.info(_('Dispatcher %(name)s statistics: %(stats)s'),
+                         {'name': dispatcher.name,
+                          'stats': dispatcher.get_stats()})
+
     def process_notification(self, notification):
         """Make a notification processed by an handler."""
         LOG.debug('notification %r', notification.get('event_type'))
@@ -516,6 +516,14 @@ def _raise_if_deadlock_error(operational_error, engine_name):
     raise exception.DBDeadlock(operational_error)
 
 
+def _get_engine_name(args):
+    """Return the name of the engine of the session whose wrapped method
+    was called with args.
+    """
+    bind = getattr(args[0], 'bind', None) if args else None
+    return (bind or get_engine()).name
+
+
 def _wrap_db_error(f):
     def _wrap(*args, **kwargs):
         try:
@@ -526,7 +534,7 @@ def _wrap_db_error(f):
         # wrap it by our own DBDuplicateEntry exception. Unique constraint
         # violation is wrapped by IntegrityError.
         except sqla_exc.OperationalError as e:
-            _raise_if_deadlock_error(e, get_engine().name)
+            _raise_if_deadlock_error(e, _get_engine_name(args))
             # NOTE(comstud): A lot of code is checking for OperationalError
             # so let's not wrap it for now.
             raise
@@ -536,7 +544,7 @@ def _wrap_db_error(f):
             # instance_types) there are more than one unique constraint. This
             # means we should get names of columns, which values violate
             # unique constraint, from error message.
-            _raise_if_duplicate_entry_error(e, get_engine().name)
+            _raise_if_duplicate_entry_error(e, _get_engine_name(args))
             raise exception.DBError(e)
         except Exception as e:
             LOG.exception(_('DB exception wrapped.'))
@@ -162,16 +162,17 @@ class ConnectionContext(rpc_common.Connection):
     def create_consumer(self, topic, proxy, fanout=False):
         self.connection.create_consumer(topic, proxy, fanout)
 
-    def create_worker(self, topic, proxy, pool_name):
-        self.connection.create_worker(topic, proxy, pool_name)
+    def create_worker(self, topic, proxy, pool_name, **kwargs):
+        self.connection.create_worker(topic, proxy, pool_name, **kwargs)
 
     def join_consumer_pool(self, callback, pool_name, topic, exchange_name,
-                           ack_on_error=True):
+                           ack_on_error=True, **kwargs):
         self.connection.join_consumer_pool(callback,
                                            pool_name,
                                            topic,
                                            exchange_name,
-                                           ack_on_error)
+                                           ack_on_error,
+                                           **kwargs)
 
     def consume_in_thread(self):
         self.connection.consume_in_thread()
@@ -205,7 +205,8 @@ class Connection(object):
         """
         raise NotImplementedError()
 
-    def create_worker(self, topic, proxy, pool_name):
+    def create_worker(self, topic, proxy, pool_name, prefetch_count=None,
+                      ack_batch_size=None):
         """Create a worker on this connection.
 
         A worker is like a regular consumer of messages directed to a
@@ -220,10 +221,16 @@ class Connection(object):
                       topic.
         :param proxy: The object that will handle all incoming messages.
         :param pool_name: String containing the name of the pool of workers
+        :param prefetch_count: Maximum number of unacknowledged messages
+                               delivered to the worker, if supported
+        :param ack_batch_size: Number of messages acknowledged at once, if
+                               supported
         """
         raise NotImplementedError()
 
-    def join_consumer_pool(self, callback, pool_name, topic, exchange_name):
+    def join_consumer_pool(self, callback, pool_name, topic, exchange_name,
+                           ack_on_error=True, prefetch_count=None,
+                           ack_batch_size=None):
         """Register as a member of a group of consumers.
 
         Uses given topic from the specified exchange.
@@ -242,6 +249,15 @@ class Connection(object):
                               the client should attach. Defaults to
                               the configured exchange.
         :type exchange_name: str
+        :param ack_on_error: Whether to acknowledge the messages whose
+                             processing failed instead of requeuing them.
+        :type ack_on_error: bool
+        :param prefetch_count: Maximum number of unacknowledged messages
+                               delivered to the pool member, if supported.
+        :type prefetch_count: int
+        :param ack_batch_size: Number of messages acknowledged at once, if
+                               supported.
+        :type ack_batch_size: int
         """
         raise NotImplementedError()
 
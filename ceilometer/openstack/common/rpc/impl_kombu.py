@@ -113,6 +113,40 @@ def _get_queue_arguments(conf):
     return {'x-ha-policy': 'all'} if conf.rabbit_ha_queues else {}
 
 
+class AckBatch(object):
+    """Acknowledge the messages received on a channel by batches.
+
+    Delivery tags are per channel and increase monotonically, so acking
+    the last processed message with multiple=True also acks every message
+    received before it on the channel. This is only valid because the
+    consumers of a channel process their messages one after another, in
+    the order they are delivered.
+    """
+
+    # Seconds without any message after which the pending acks are sent.
+    flush_interval = 1.0
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, channel):
+        """Forget the pending acks, their tags are not valid on channel."""
+        self.channel = channel
+        self.delivery_tag = None
+
+    @property
+    def pending(self):
+        return self.delivery_tag is not None
+
+    def add(self, message):
+        self.delivery_tag = message.delivery_tag
+
+    def flush(self):
+        if self.delivery_tag is not None:
+            self.channel.basic_ack(self.delivery_tag, multiple=True)
+            self.delivery_tag = None
+
+
 class ConsumerBase(object):
     """Consumer base class."""
 
@@ -125,9 +159,23 @@ class ConsumerBase(object):
 
         queue name, exchange name, and other kombu options are
         passed in here as a dictionary.
+
+        'prefetch_count' limits the number of unacknowledged messages the
+        broker sends to the consumer, and 'ack_batch_size' messages are
+        acknowledged at once through 'ack_batch' when it is greater than 1.
         """
         self.callback = callback
         self.tag = str(tag)
+        self.prefetch_count = kwargs.pop('prefetch_count', None)
+        self.ack_batch = kwargs.pop('ack_batch', None)
+        self.ack_batch_size = kwargs.pop('ack_batch_size', None) or 1
+        if self.prefetch_count:
+            # The broker would stop delivering before the batch is full.
+            self.ack_batch_size = min(self.ack_batch_size,
+                                      self.prefetch_count)
+        if self.ack_batch is None:
+            self.ack_batch_size = 1
+        self.unacked = 0
         self.kwargs = kwargs
         self.queue = None
         self.ack_on_error = kwargs.get('ack_on_error', True)
@@ -136,10 +184,21 @@ class ConsumerBase(object):
     def reconnect(self, channel):
         """Re-declare the queue after a rabbit reconnect."""
         self.channel = channel
+        self.unacked = 0
         self.kwargs['channel'] = channel
         self.queue = kombu.entity.Queue(**self.kwargs)
         self.queue.declare()
 
+    def _ack(self, message):
+        if self.ack_batch_size <= 1:
+            message.ack()
+            return
+        self.ack_batch.add(message)
+        self.unacked += 1
+        if self.unacked >= self.ack_batch_size:
+            self.ack_batch.flush()
+            self.unacked = 0
+
     def _callback_handler(self, message, callback):
         """Call callback with deserialized message.
 
@@ -166,7 +225,7 @@ class ConsumerBase(object):
                                 " ... will requeue."))
         finally:
             if ack_msg:
-                message.ack()
+                self._ack(message)
             else:
                 message.reject()
 
@@ -194,6 +253,10 @@ class ConsumerBase(object):
             message = self.channel.message_to_python(raw_message)
             self._callback_handler(message, callback)
 
+        # Without the global flag, the QoS applies to the consumers started
+        # on the channel after this call, so consumers without a
+        # prefetch_count reset it rather than inherit the previous one.
+        self.channel.basic_qos(0, self.prefetch_count or 0, False)
         self.queue.consume(*args, callback=_callback, **options)
 
     def cancel(self):
@@ -420,6 +483,7 @@ class Connection(object):
 
     def __init__(self, conf, server_params=None):
         self.consumers = []
+        self.ack_batch = AckBatch()
         self.consumer_thread = None
         self.proxy_callbacks = []
         self.conf = conf
@@ -516,6 +580,7 @@ class Connection(object):
         self.consumer_num = itertools.count(1)
         self.connection.connect()
         self.channel = self.connection.channel()
+        self.ack_batch.reset(self.channel)
         # work around 'memory' transport bug in 1.1.3
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
@@ -614,6 +679,7 @@ class Connection(object):
         self.wait_on_proxy_callbacks()
         self.channel.close()
         self.channel = self.connection.channel()
+        self.ack_batch.reset(self.channel)
         # work around 'memory' transport bug in 1.1.3
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
@@ -660,6 +726,15 @@ class Connection(object):
                     queue.consume(nowait=True)
                 queues_tail.consume(nowait=False)
                 info['do_consume'] = False
+            if self.ack_batch.pending and timeout is None:
+                # Do not keep the messages of an incomplete batch unacked
+                # while the queues are idle.
+                try:
+                    return self.connection.drain_events(
+                        timeout=self.ack_batch.flush_interval)
+                except socket.timeout:
+                    self.ack_batch.flush()
+                    return
             return self.connection.drain_events(timeout=timeout)
 
         for iteration in itertools.count(0):
@@ -704,12 +779,16 @@ class Connection(object):
         self.declare_consumer(DirectConsumer, topic, callback)
 
     def declare_topic_consumer(self, topic, callback=None, queue_name=None,
-                               exchange_name=None, ack_on_error=True):
+                               exchange_name=None, ack_on_error=True,
+                               prefetch_count=None, ack_batch_size=None):
         """Create a 'topic' consumer."""
         self.declare_consumer(functools.partial(TopicConsumer,
                                                 name=queue_name,
                                                 exchange_name=exchange_name,
                                                 ack_on_error=ack_on_error,
+                                                prefetch_count=prefetch_count,
+                                                ack_batch=self.ack_batch,
+                                                ack_batch_size=ack_batch_size,
                                                 ),
                               topic, callback)
 
@@ -766,16 +845,20 @@ class Connection(object):
         else:
             self.declare_topic_consumer(topic, proxy_cb)
 
-    def create_worker(self, topic, proxy, pool_name):
+    def create_worker(self, topic, proxy, pool_name, prefetch_count=None,
+                      ack_batch_size=None):
         """Create a worker that calls a method in a proxy object."""
         proxy_cb = rpc_amqp.ProxyCallback(
             self.conf, proxy,
             rpc_amqp.get_connection_pool(self.conf, Connection))
         self.proxy_callbacks.append(proxy_cb)
-        self.declare_topic_consumer(topic, proxy_cb, pool_name)
+        self.declare_topic_consumer(topic, proxy_cb, pool_name,
+                                    prefetch_count=prefetch_count,
+                                    ack_batch_size=ack_batch_size)
 
     def join_consumer_pool(self, callback, pool_name, topic,
-                           exchange_name=None, ack_on_error=True):
+                           exchange_name=None, ack_on_error=True,
+                           prefetch_count=None, ack_batch_size=None):
         """Register as a member of a group of consumers for a given topic from
         the specified exchange.
 
@@ -783,6 +866,9 @@ class Connection(object):
 
         A message will be delivered to multiple pools, if more than
         one is created.
+
+        At most prefetch_count messages are sent by the broker before they
+        are acknowledged, and they are acknowledged by ack_batch_size.
         """
         callback_wrapper = rpc_amqp.CallbackWrapper(
             conf=self.conf,
@@ -797,6 +883,8 @@ class Connection(object):
             exchange_name=exchange_name,
             callback=callback_wrapper,
             ack_on_error=ack_on_error,
+            prefetch_count=prefetch_count,
+            ack_batch_size=ack_batch_size,
         )
 
 
@@ -636,7 +636,8 @@ class Connection(object):
 
         return consumer
 
-    def create_worker(self, topic, proxy, pool_name):
+    def create_worker(self, topic, proxy, pool_name, prefetch_count=None,
+                      ack_batch_size=None):
         """Create a worker that calls a method in a proxy object."""
         proxy_cb = rpc_amqp.ProxyCallback(
             self.conf, proxy,
@@ -651,7 +652,8 @@ class Connection(object):
         return consumer
 
     def join_consumer_pool(self, callback, pool_name, topic,
-                           exchange_name=None, ack_on_error=True):
+                           exchange_name=None, ack_on_error=True,
+                           prefetch_count=None, ack_batch_size=None):
         """Register as a member of a group of consumers for a given topic from
         the specified exchange.
 
@@ -659,6 +661,9 @@ class Connection(object):
 
         A message will be delivered to multiple pools, if more than
         one is created.
+
+        prefetch_count and ack_batch_size are ignored, the receivers
+        already have a capacity of one message.
         """
         callback_wrapper = rpc_amqp.CallbackWrapper(
             conf=self.conf,
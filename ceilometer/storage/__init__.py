@@ -19,6 +19,7 @@
 """
 
 
+import threading
 import urlparse
 
 from oslo.config import cfg
@@ -49,6 +50,50 @@ STORAGE_OPTS = [
                default=-1,
                help="""number of seconds that samples are kept
 in the database for (<= 0 means forever)"""),
+    cfg.IntOpt('expirer_batch_size',
+               default=10000,
+               help='Number of rows the expirer deletes at a time'),
+    cfg.FloatOpt('expirer_batch_delay',
+                 default=0.1,
+                 help='Number of seconds the expirer sleeps between two '
+                 'batches of rows, to leave room for the other queries'),
+    cfg.StrOpt('meter_partition_period',
+               default=None,
+               help='Partition the meter table of the SQL driver by "day" or '
+               '"week", the expirer then drops the partitions of expired '
+               'samples. Only supported by MySQL'),
+    cfg.IntOpt('sample_fetch_size',
+               default=1000,
+               help='Number of samples fetched at a time from the database '
+               'while iterating over the results of a query'),
+    cfg.ListOpt('metadata_index_keys',
+                default=['*'],
+                help='Shell-style patterns of the flattened metadata keys '
+                'indexed by the SQL driver, like "image.*". The metadata '
+                'queries are only supported on these keys'),
+    cfg.IntOpt('tsdb_chunk_size',
+               default=120,
+               help='Number of samples of a series sealed into a chunk by '
+               'the time series driver'),
+    cfg.IntOpt('tsdb_wal_size',
+               default=10000,
+               help='Number of samples written to the write-ahead log of '
+               'the time series driver before it is checkpointed'),
+    cfg.IntOpt('slave_max_lag',
+               default=30,
+               help='Maximum number of seconds the database set by '
+               'slave_connection may lag behind the primary to be sent the '
+               'read queries of the SQL driver'),
+    cfg.IntOpt('dimension_cache_size',
+               default=10000,
+               help='Number of sources, users, projects and resources the '
+               'SQL driver remembers as recorded, to skip their lookups '
+               'when recording a sample, disabled if 0'),
+    cfg.StrOpt('mongodb_write_concern',
+               default='1',
+               help='Write concern of the samples recorded by the MongoDB '
+               'driver: the number of replica set members acknowledging '
+               'the writes, 0 not to wait for any, or "majority"'),
 ]
 
 cfg.CONF.register_opts(STORAGE_OPTS, group='database')
@@ -62,23 +107,55 @@ class StorageBadVersion(Exception):
     """Error raised when the storage backend version is not good enough."""
 
 
+# Process-wide registry of the loaded engines, by driver name, and of the
+# open connections, by database URL. The drivers pool their own database
+# connections, so a storage Connection can be shared by every green thread.
+_ENGINES = {}
+_CONNECTIONS = {}
+# Reentrant, the sharded driver opens the connections of its shards while
+# its own connection is being opened.
+_REGISTRY_LOCK = threading.RLock()
+
+
 def get_engine(conf):
-    """Load the configured engine and return an instance."""
+    """Load the configured engine and return an instance.
+
+    The engine of each driver is only loaded once per process.
+    """
     if conf.database_connection:
         conf.set_override('connection', conf.database_connection,
                           group='database')
     engine_name = urlparse.urlparse(conf.database.connection).scheme
-    LOG.debug('looking for %r driver in %r',
-              engine_name, STORAGE_ENGINE_NAMESPACE)
-    mgr = driver.DriverManager(STORAGE_ENGINE_NAMESPACE,
-                               engine_name,
-                               invoke_on_load=True)
-    return mgr.driver
+    engine = _ENGINES.get(engine_name)
+    if engine is None:
+        LOG.debug('looking for %r driver in %r',
+                  engine_name, STORAGE_ENGINE_NAMESPACE)
+        mgr = driver.DriverManager(STORAGE_ENGINE_NAMESPACE,
+                                   engine_name,
+                                   invoke_on_load=True)
+        engine = _ENGINES.setdefault(engine_name, mgr.driver)
+    return engine
 
 
 def get_connection(conf):
-    """Return an open connection to the database."""
-    return get_engine(conf).get_connection(conf)
+    """Return an open connection to the database.
+
+    The connection is shared by all the callers of the process using the
+    same database URL.
+    """
+    engine = get_engine(conf)
+    url = conf.database.connection
+    with _REGISTRY_LOCK:
+        conn = _CONNECTIONS.get(url)
+        if conn is None:
+            conn = _CONNECTIONS[url] = engine.get_connection(conf)
+    return conn
+
+
+def reset_connections():
+    """Forget the shared connections, the next callers open new ones."""
+    with _REGISTRY_LOCK:
+        _CONNECTIONS.clear()
 
 
 class SampleFilter(object):
@@ -94,12 +171,19 @@ class SampleFilter(object):
     :param meter: Optional filter for meter type using the meter name.
     :param source: Optional source filter.
     :param metaquery: Optional filter on the metadata
+    :param marker_timestamp: Optional timestamp of the last sample of the
+                             previous page, only the samples coming after it
+                             in the (timestamp, message_id) descending order
+                             are returned.
+    :param marker_message_id: Optional message id of the last sample of the
+                              previous page, used with marker_timestamp.
     """
     def __init__(self, user=None, project=None,
                  start=None, start_timestamp_op=None,
                  end=None, end_timestamp_op=None,
                  resource=None, meter=None,
-                 source=None, metaquery={}):
+                 source=None, metaquery={},
+                 marker_timestamp=None, marker_message_id=None):
         self.user = user
         self.project = project
         self.start = utils.sanitize_timestamp(start)
@@ -110,6 +194,8 @@ class SampleFilter(object):
         self.meter = meter
         self.source = source
         self.metaquery = metaquery
+        self.marker_timestamp = utils.sanitize_timestamp(marker_timestamp)
+        self.marker_message_id = marker_message_id
 
 
 class EventFilter(object):
@@ -20,10 +20,15 @@
 
 import abc
 import datetime
+import hashlib
 import math
 
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common import log
 from ceilometer.openstack.common import timeutils
 
+LOG = log.getLogger(__name__)
+
 
 def iter_period(start, end, period):
     """Split a time from start to end in periods of a number of seconds. This
@@ -45,6 +50,35 @@ def iter_period(start, end, period):
         period_start = next_start
 
 
+def hash_metadata(metadata):
+    """Return the hash identifying a resource metadata.
+
+    The drivers store each distinct metadata once, under this hash of its
+    canonical JSON form.
+    """
+    return hashlib.md5(jsonutils.dumps(metadata, sort_keys=True)).hexdigest()
+
+
+def match_metaquery(metadata, metaquery):
+    """Return whether a resource metadata matches the metaquery.
+
+    :param metadata: The resource metadata, or None.
+    :param metaquery: Dictionary of the expected values, by their dotted
+                      paths in the metadata prefixed with 'metadata.'.
+    """
+    for k, v in metaquery.iteritems():
+        value = metadata or {}
+        # Support the dictionary type of metadata
+        for key in k.split('.')[1:]:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+            else:
+                return False
+        if value != v:
+            return False
+    return True
+
+
 def _handle_sort_key(model_name, sort_key=None):
     """Generate sort keys according to the passed in sort key from user.
 
@@ -112,6 +146,24 @@ class Connection(object):
         All timestamps must be naive utc datetime object.
         """
 
+    def record_metering_data_batch(self, samples):
+        """Write a batch of samples to the backend storage system.
+
+        The drivers able to coalesce the writes of a batch override it.
+        Here the samples are written one by one, a sample which fails to
+        be written is logged and does not prevent the others from being
+        written.
+
+        :param samples: a list of dictionaries such as returned by
+                        ceilometer.meter.meter_message_from_counter
+        """
+        for data in samples:
+            try:
+                self.record_metering_data(data)
+            except Exception as err:
+                LOG.error('Failed to record metering data: %s', err)
+                LOG.exception(err)
+
     @abc.abstractmethod
     def clear_expired_metering_data(self, ttl):
         """Clear expired data from the backend storage system according to the
@@ -171,10 +223,22 @@ class Connection(object):
     def get_samples(self, sample_filter, limit=None):
         """Return an iterable of model.Sample instances.
 
+        The samples are returned from the most recent one, by descending
+        sample_order_key(), and are fetched from the database as they are
+        iterated over. The marker of the filter allows to page through
+        them.
+
         :param sample_filter: Filter.
         :param limit: Maximum number of results to return.
         """
 
+    @staticmethod
+    def sample_order_key(sample):
+        """Return the key of a sample in the order of get_samples(), the
+        samples sharing a timestamp being ordered by message id.
+        """
+        return sample.timestamp, sample.message_id
+
     @abc.abstractmethod
     def get_meter_statistics(self, sample_filter, period=None):
         """Return an iterable of model.Statistics instances.
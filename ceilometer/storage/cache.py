@@ -0,0 +1,237 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Read-through cache of the storage query results
+"""
+
+import collections
+import datetime
+import hashlib
+import itertools
+import threading
+import time
+
+from oslo.config import cfg
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import importutils
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import timeutils
+from ceilometer import storage
+
+OPTS = [
+    cfg.StrOpt('query_cache_backend',
+               default=None,
+               help='Backend caching the results of the storage queries '
+               'made by the API, "memory" or "memcached", disabled if not '
+               'set'),
+    cfg.IntOpt('query_cache_size',
+               default=1000,
+               help='Maximum number of query results kept by the memory '
+               'cache backend'),
+    cfg.IntOpt('query_cache_ttl',
+               default=60,
+               help='Number of seconds a query result is cached'),
+    cfg.IntOpt('query_cache_closed_period_delay',
+               default=3600,
+               help='Number of seconds after which a time range is '
+               'considered closed: the statistics of a closed time range '
+               'do not expire from the cache'),
+    cfg.ListOpt('query_cache_memcached_servers',
+                default=[],
+                help='Memcached servers used by the memcached cache backend, '
+                'the memory backend is used if empty'),
+]
+
+cfg.CONF.register_opts(OPTS, group='database')
+
+LOG = log.getLogger(__name__)
+
+# memcached reads expiration times longer than 30 days as timestamps.
+MAX_TTL = 30 * 24 * 3600
+
+
+def _now():
+    return time.time()
+
+
+class MemoryCache(object):
+    """Bounded LRU cache whose entries expire after their TTL.
+
+    It implements the part of the memcache client API used by
+    CachedConnection, and stands in for it when no memcached server is
+    configured.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # key -> [expires_at, value, stamp of the last use]
+        self._entries = {}
+        # (stamp, key) of the uses of the entries, the least recent first.
+        # The ones whose stamp is not the last one of their key are stale.
+        self._uses = collections.deque()
+        self._stamps = itertools.count()
+        self._lock = threading.Lock()
+
+    def _use(self, key, entry):
+        entry[2] = next(self._stamps)
+        self._uses.append((entry[2], key))
+        if len(self._uses) > 2 * len(self._entries) + 16:
+            # Drop the stale uses.
+            self._uses = collections.deque(sorted(
+                (e[2], k) for k, e in self._entries.iteritems()))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] and entry[0] <= _now():
+                del self._entries[key]
+                return None
+            # Mark it as the most recently used entry
+            self._use(key, entry)
+            return entry[1]
+
+    def set(self, key, value, time=0):
+        """Store value under key, for time seconds or forever if it is 0."""
+        expires_at = time and _now() + time
+        with self._lock:
+            entry = self._entries[key] = [expires_at, value, None]
+            self._use(key, entry)
+            while len(self._entries) > self.size:
+                stamp, old = self._uses.popleft()
+                if self._entries.get(old, (None, None, None))[2] == stamp:
+                    del self._entries[old]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def _normalize(value):
+    """Turn a query argument into a hashable value that does not depend on
+    the order the caller built it in.
+    """
+    if isinstance(value, storage.SampleFilter):
+        value = vars(value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _normalize(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_normalize(v) for v in value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def make_key(method, **kwargs):
+    """Return the cache key of a call to a storage Connection method."""
+    # memcached keys are limited in size and characters, so hash them.
+    return 'ceilometer-query-' + hashlib.sha1(
+        repr((method, _normalize(kwargs)))).hexdigest()
+
+
+class CachedConnection(object):
+    """Storage Connection caching the results of the read queries of
+    another one.
+
+    The listing and statistics queries are answered from the cache for ttl
+    seconds. The statistics of a time range ending more than
+    closed_period_delay seconds ago are cached until they are evicted, as no
+    sample should be recorded in it anymore. Every other attribute is the
+    one of the wrapped connection.
+    """
+
+    def __init__(self, conn, cache, ttl, closed_period_delay=None,
+                 closed_period_ttl=0):
+        self.conn = conn
+        self.cache = cache
+        self.ttl = ttl
+        self.closed_period_delay = closed_period_delay
+        self.closed_period_ttl = closed_period_ttl
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def _is_closed(self, end):
+        if end is None or self.closed_period_delay is None:
+            return False
+        return end < (timeutils.utcnow() -
+                      datetime.timedelta(seconds=self.closed_period_delay))
+
+    def _cached(self, method, ttl, **kwargs):
+        key = make_key(method, **kwargs)
+        result = self.cache.get(key)
+        if result is None:
+            # The drivers may return generators, store what they yield.
+            result = list(getattr(self.conn, method)(**kwargs))
+            self.cache.set(key, result, min(ttl, MAX_TTL))
+        return result
+
+    def get_users(self, source=None):
+        return self._cached('get_users', self.ttl, source=source)
+
+    def get_projects(self, source=None):
+        return self._cached('get_projects', self.ttl, source=source)
+
+    def get_resources(self, user=None, project=None, source=None,
+                      start_timestamp=None, start_timestamp_op=None,
+                      end_timestamp=None, end_timestamp_op=None,
+                      metaquery={}, resource=None):
+        return self._cached('get_resources', self.ttl,
+                            user=user, project=project, source=source,
+                            start_timestamp=start_timestamp,
+                            start_timestamp_op=start_timestamp_op,
+                            end_timestamp=end_timestamp,
+                            end_timestamp_op=end_timestamp_op,
+                            metaquery=metaquery, resource=resource)
+
+    def get_meters(self, user=None, project=None, resource=None, source=None,
+                   metaquery={}):
+        return self._cached('get_meters', self.ttl,
+                            user=user, project=project, resource=resource,
+                            source=source, metaquery=metaquery)
+
+    def get_meter_statistics(self, sample_filter, period=None):
+        if self._is_closed(sample_filter.end):
+            ttl = self.closed_period_ttl
+        else:
+            ttl = self.ttl
+        return self._cached('get_meter_statistics', ttl,
+                            sample_filter=sample_filter, period=period)
+
+
+def get_cache(conf):
+    """Return the cache client configured for the query results."""
+    backend = conf.database.query_cache_backend
+    if backend == 'memcached' and conf.database.query_cache_memcached_servers:
+        memcache = importutils.import_module('memcache')
+        return memcache.Client(conf.database.query_cache_memcached_servers)
+    if backend not in ('memory', 'memcached'):
+        raise ValueError(_('Unknown query cache backend %s') % backend)
+    return MemoryCache(conf.database.query_cache_size)
+
+
+def get_cached_connection(conn, conf):
+    """Wrap conn into a CachedConnection if the query cache is enabled."""
+    if not conf.database.query_cache_backend:
+        return conn
+    LOG.info(_('Caching the storage queries with the %s backend'),
+             conf.database.query_cache_backend)
+    # Closed time ranges are cached forever, unless their samples expire.
+    closed_period_ttl = max(conf.database.time_to_live, 0)
+    return CachedConnection(conn,
+                            get_cache(conf),
+                            conf.database.query_cache_ttl,
+                            conf.database.query_cache_closed_period_delay,
+                            closed_period_ttl)
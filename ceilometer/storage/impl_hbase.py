@@ -21,6 +21,8 @@
 import json
 import hashlib
 import itertools
+import operator
+import contextlib
 import copy
 import datetime
 import happybase
@@ -32,10 +34,22 @@ from ceilometer.openstack.common import log
 from ceilometer.openstack.common import timeutils
 from ceilometer.openstack.common import network_utils
 from ceilometer.storage import base
+from ceilometer.storage import cache
 from ceilometer.storage import models
 
 LOG = log.getLogger(__name__)
 
+# Number of resource metadata hashes kept in memory, the metadata known to
+# be stored is not written again.
+METADATA_CACHE_SIZE = 10000
+
+# Columns of the meter rows read to compute the statistics. HBase only
+# applies a SingleColumnValueFilter to the columns which are read, so the
+# columns filtered on are read too.
+STATISTICS_COLUMNS = ['f:timestamp', 'f:counter_volume', 'f:counter_unit',
+                      'f:counter_name', 'f:user_id', 'f:project_id',
+                      'f:resource_id', 'f:source']
+
 
 class HBaseStorage(base.StorageEngine):
     """Put the data into a HBase database
@@ -51,7 +65,9 @@ class HBaseStorage(base.StorageEngine):
           source: [ array of source ids reporting for the project ]
           }
     - meter
-      - the raw incoming data
+      - the raw incoming data, referring to its resource metadata by hash
+    - metadata
+      - the distinct resource metadata of the samples, by hash
     - resource
       - the metadata for resources
       - { _id: uuid of resource,
@@ -76,65 +92,83 @@ class Connection(base.Connection):
 
     _memory_instance = None
 
+    # Default number of Thrift connections kept open by each pool.
+    POOL_SIZE = 10
+
     PROJECT_TABLE = "project"
     USER_TABLE = "user"
     RESOURCE_TABLE = "resource"
     METER_TABLE = "meter"
+    METADATA_TABLE = "metadata"
 
     def __init__(self, conf):
         """Hbase Connection Initialization."""
         opts = self._parse_connection_url(conf.database.connection)
+        opts['pool_size'] = conf.database.max_pool_size or self.POOL_SIZE
+        self.sample_fetch_size = conf.database.sample_fetch_size
+        self.metadata_hashes = cache.MemoryCache(METADATA_CACHE_SIZE)
 
         if opts['host'] == '__test__':
             url = os.environ.get('CEILOMETER_TEST_HBASE_URL')
             if url:
                 # Reparse URL, but from the env variable now
-                opts = self._parse_connection_url(url)
-                self.conn = self._get_connection(opts)
+                opts.update(self._parse_connection_url(url))
+                self.conn_pool = self._get_connection_pool(opts)
             else:
                 # This is a in-memory usage for unit tests
                 if Connection._memory_instance is None:
                     LOG.debug('Creating a new in-memory HBase '
                               'Connection object')
-                    Connection._memory_instance = MConnection()
-                self.conn = Connection._memory_instance
+                    Connection._memory_instance = MConnectionPool()
+                self.conn_pool = Connection._memory_instance
         else:
-            self.conn = self._get_connection(opts)
-        self.conn.open()
+            self.conn_pool = self._get_connection_pool(opts)
 
     def upgrade(self):
-        self.conn.create_table(self.PROJECT_TABLE, {'f': dict()})
-        self.conn.create_table(self.USER_TABLE, {'f': dict()})
-        self.conn.create_table(self.RESOURCE_TABLE, {'f': dict()})
-        self.conn.create_table(self.METER_TABLE, {'f': dict()})
+        with self.conn_pool.connection() as conn:
+            conn.create_table(self.PROJECT_TABLE, {'f': dict()})
+            conn.create_table(self.USER_TABLE, {'f': dict()})
+            conn.create_table(self.RESOURCE_TABLE, {'f': dict()})
+            conn.create_table(self.METER_TABLE, {'f': dict()})
+            conn.create_table(self.METADATA_TABLE, {'f': dict()})
 
     def clear(self):
         LOG.debug('Dropping HBase schema...')
-        for table in [self.PROJECT_TABLE,
-                      self.USER_TABLE,
-                      self.RESOURCE_TABLE,
-                      self.METER_TABLE]:
-            try:
-                self.conn.disable_table(table)
-            except Exception:
-                LOG.debug('Cannot disable table but ignoring error')
-            try:
-                self.conn.delete_table(table)
-            except Exception:
-                LOG.debug('Cannot delete table but ignoring error')
+        self.metadata_hashes = cache.MemoryCache(METADATA_CACHE_SIZE)
+        with self.conn_pool.connection() as conn:
+            for table in [self.PROJECT_TABLE,
+                          self.USER_TABLE,
+                          self.RESOURCE_TABLE,
+                          self.METER_TABLE,
+                          self.METADATA_TABLE]:
+                try:
+                    conn.disable_table(table)
+                except Exception:
+                    LOG.debug('Cannot disable table but ignoring error')
+                try:
+                    conn.delete_table(table)
+                except Exception:
+                    LOG.debug('Cannot delete table but ignoring error')
 
     @staticmethod
-    def _get_connection(conf):
-        """Return a connection to the database.
+    def _get_connection_pool(conf):
+        """Return a connection pool to the database.
+
+        happybase reopens the connections of the pool that failed with a
+        Thrift or socket error, and the pool blocks the green threads
+        asking for a connection until one is available.
 
         .. note::
 
           The tests use a subclass to override this and return an
-          in-memory connection.
+          in-memory connection pool.
         """
-        LOG.debug('connecting to HBase on %s:%s', conf['host'], conf['port'])
-        return happybase.Connection(host=conf['host'], port=conf['port'],
-                                    table_prefix=conf['table_prefix'])
+        LOG.debug('connecting to HBase on %s:%s with a pool of %s',
+                  conf['host'], conf['port'], conf['pool_size'])
+        return happybase.ConnectionPool(size=conf['pool_size'],
+                                        host=conf['host'],
+                                        port=conf['port'],
+                                        table_prefix=conf['table_prefix'])
 
     @staticmethod
     def _parse_connection_url(url):
@@ -164,87 +198,101 @@ class Connection(base.Connection):
         :param data: a dictionary such as returned by
                      ceilometer.meter.meter_message_from_counter
         """
-        project_table = self.conn.table(self.PROJECT_TABLE)
-        user_table = self.conn.table(self.USER_TABLE)
-        resource_table = self.conn.table(self.RESOURCE_TABLE)
-        meter_table = self.conn.table(self.METER_TABLE)
-        # Make sure we know about the user and project
-        if data['user_id']:
-            user = user_table.row(data['user_id'])
-            sources = _load_hbase_list(user, 's')
+        with self.conn_pool.connection() as conn:
+            project_table = conn.table(self.PROJECT_TABLE)
+            user_table = conn.table(self.USER_TABLE)
+            resource_table = conn.table(self.RESOURCE_TABLE)
+            meter_table = conn.table(self.METER_TABLE)
+            metadata_table = conn.table(self.METADATA_TABLE)
+            # Make sure we know about the user and project
+            if data['user_id']:
+                user = user_table.row(data['user_id'])
+                sources = _load_hbase_list(user, 's')
+                # Update if source is new
+                if data['source'] not in sources:
+                    user['f:s_%s' % data['source']] = "1"
+                    user_table.put(data['user_id'], user)
+
+            project = project_table.row(data['project_id'])
+            sources = _load_hbase_list(project, 's')
             # Update if source is new
             if data['source'] not in sources:
-                user['f:s_%s' % data['source']] = "1"
-                user_table.put(data['user_id'], user)
-
-        project = project_table.row(data['project_id'])
-        sources = _load_hbase_list(project, 's')
-        # Update if source is new
-        if data['source'] not in sources:
-            project['f:s_%s' % data['source']] = "1"
-            project_table.put(data['project_id'], project)
-
-        rts = reverse_timestamp(data['timestamp'])
-
-        resource = resource_table.row(data['resource_id'])
-        new_meter = "%s!%s!%s" % (
-            data['counter_name'], data['counter_type'], data['counter_unit'])
-        new_resource = {'f:resource_id': data['resource_id'],
-                        'f:project_id': data['project_id'],
-                        'f:user_id': data['user_id'],
-                        'f:source': data["source"],
-                        # store meters with prefix "m_"
-                        'f:m_%s' % new_meter: "1"
-                        }
-        # store metadata fields with prefix "r_"
-        if data['resource_metadata']:
-            resource_metadata = dict(('f:r_%s' % k, v)
-                                     for (k, v)
-                                     in data['resource_metadata'].iteritems())
-            new_resource.update(resource_metadata)
-
-        # Update if resource has new information
-        if new_resource != resource:
-            meters = _load_hbase_list(resource, 'm')
-            if new_meter not in meters:
-                new_resource['f:m_%s' % new_meter] = "1"
-
-            resource_table.put(data['resource_id'], new_resource)
-
-        # Rowkey consists of reversed timestamp, meter and an md5 of
-        # user+resource+project for purposes of uniqueness
-        m = hashlib.md5()
-        m.update("%s%s%s" % (data['user_id'], data['resource_id'],
-                             data['project_id']))
-
-        # We use reverse timestamps in rowkeys as they are sorted
-        # alphabetically.
-        row = "%s_%d_%s" % (data['counter_name'], rts, m.hexdigest())
-
-        # Convert timestamp to string as json.dumps won't
-        ts = timeutils.strtime(data['timestamp'])
-
-        record = {'f:timestamp': ts,
-                  'f:counter_name': data['counter_name'],
-                  'f:counter_type': data['counter_type'],
-                  'f:counter_volume': str(data['counter_volume']),
-                  'f:counter_unit': data['counter_unit'],
-                  # TODO(shengjie) consider using QualifierFilter
-                  # keep dimensions as column qualifier for quicker look up
-                  # TODO(shengjie) extra dimensions need to be added as CQ
-                  'f:user_id': data['user_id'],
-                  'f:project_id': data['project_id'],
-                  'f:resource_id': data['resource_id'],
-                  'f:source': data['source'],
-                  # add in reversed_ts here for time range scan
-                  'f:rts': str(rts)
-                  }
-        # Don't want to be changing the original data object.
-        data = copy.copy(data)
-        data['timestamp'] = ts
-        # Save original meter.
-        record['f:message'] = json.dumps(data)
-        meter_table.put(row, record)
+                project['f:s_%s' % data['source']] = "1"
+                project_table.put(data['project_id'], project)
+
+            rts = reverse_timestamp(data['timestamp'])
+
+            resource = resource_table.row(data['resource_id'])
+            new_meter = "%s!%s!%s" % (
+                data['counter_name'], data['counter_type'],
+                data['counter_unit'])
+            new_resource = {'f:resource_id': data['resource_id'],
+                            'f:project_id': data['project_id'],
+                            'f:user_id': data['user_id'],
+                            'f:source': data["source"],
+                            # store meters with prefix "m_"
+                            'f:m_%s' % new_meter: "1"
+                            }
+            # store metadata fields with prefix "r_"
+            if data['resource_metadata']:
+                resource_metadata = dict(
+                    ('f:r_%s' % k, v)
+                    for (k, v) in data['resource_metadata'].iteritems())
+                new_resource.update(resource_metadata)
+
+            # Update if resource has new information
+            if new_resource != resource:
+                meters = _load_hbase_list(resource, 'm')
+                if new_meter not in meters:
+                    new_resource['f:m_%s' % new_meter] = "1"
+
+                resource_table.put(data['resource_id'], new_resource)
+
+            # Rowkey consists of reversed timestamp, meter and an md5 of
+            # user+resource+project for purposes of uniqueness
+            m = hashlib.md5()
+            m.update("%s%s%s" % (data['user_id'], data['resource_id'],
+                                 data['project_id']))
+
+            # We use reverse timestamps in rowkeys as they are sorted
+            # alphabetically.
+            row = "%s_%d_%s" % (data['counter_name'], rts, m.hexdigest())
+
+            # Convert timestamp to string as json.dumps won't
+            ts = timeutils.strtime(data['timestamp'])
+
+            record = {'f:timestamp': ts,
+                      'f:counter_name': data['counter_name'],
+                      'f:counter_type': data['counter_type'],
+                      'f:counter_volume': str(data['counter_volume']),
+                      'f:counter_unit': data['counter_unit'],
+                      # TODO(shengjie) consider using QualifierFilter
+                      # keep dimensions as column qualifier for quicker look up
+                      # TODO(shengjie) extra dimensions need to be added as CQ
+                      'f:user_id': data['user_id'],
+                      'f:project_id': data['project_id'],
+                      'f:resource_id': data['resource_id'],
+                      'f:source': data['source'],
+                      # add in reversed_ts here for time range scan
+                      'f:rts': str(rts)
+                      }
+
+            # Store each distinct resource metadata once, the sample
+            # refers to it by hash.
+            metadata_hash = base.hash_metadata(data['resource_metadata'])
+            if self.metadata_hashes.get(metadata_hash) is None:
+                metadata_table.put(metadata_hash, {
+                    'f:metadata': json.dumps(data['resource_metadata'])})
+                self.metadata_hashes.set(metadata_hash, True)
+            record['f:metadata_hash'] = metadata_hash
+
+            # Don't want to be changing the original data object.
+            data = copy.copy(data)
+            data['timestamp'] = ts
+            del data['resource_metadata']
+            # Save original meter.
+            record['f:message'] = json.dumps(data)
+            meter_table.put(row, record)
 
     def clear_expired_metering_data(self, ttl):
         """Clear expired data from the backend storage system according to the
@@ -260,24 +308,28 @@ class Connection(base.Connection):
 
         :param source: Optional source filter.
         """
-        user_table = self.conn.table(self.USER_TABLE)
-        LOG.debug("source: %s" % source)
-        scan_args = {}
-        if source:
-            scan_args['columns'] = ['f:s_%s' % source]
-        return sorted(key for key, ignored in user_table.scan(**scan_args))
+        with self.conn_pool.connection() as conn:
+            user_table = conn.table(self.USER_TABLE)
+            LOG.debug("source: %s" % source)
+            scan_args = {}
+            if source:
+                scan_args['columns'] = ['f:s_%s' % source]
+            return sorted(key for key, ignored in
+                          user_table.scan(**scan_args))
 
     def get_projects(self, source=None):
         """Return an iterable of project id strings.
 
         :param source: Optional source filter.
         """
-        project_table = self.conn.table(self.PROJECT_TABLE)
-        LOG.debug("source: %s" % source)
-        scan_args = {}
-        if source:
-            scan_args['columns'] = ['f:s_%s' % source]
-        return (key for key, ignored in project_table.scan(**scan_args))
+        with self.conn_pool.connection() as conn:
+            project_table = conn.table(self.PROJECT_TABLE)
+            LOG.debug("source: %s" % source)
+            scan_args = {}
+            if source:
+                scan_args['columns'] = ['f:s_%s' % source]
+            return sorted(key for key, ignored in
+                          project_table.scan(**scan_args))
 
     def get_resources(self, user=None, project=None, source=None,
                       start_timestamp=None, start_timestamp_op=None,
@@ -318,49 +370,54 @@ class Connection(base.Connection):
                 ],
             )
 
-        resource_table = self.conn.table(self.RESOURCE_TABLE)
-        meter_table = self.conn.table(self.METER_TABLE)
-
-        q, start_row, stop_row = make_query(user=user,
-                                            project=project,
-                                            source=source,
-                                            resource=resource,
-                                            start=start_timestamp,
-                                            start_op=start_timestamp_op,
-                                            end=end_timestamp,
-                                            end_op=end_timestamp_op,
-                                            require_meter=False,
-                                            query_only=False)
-        LOG.debug("Query Meter table: %s" % q)
-        meters = meter_table.scan(filter=q, row_start=start_row,
-                                  row_stop=stop_row)
-
-        resources = {}
-        for resource_id, r_meters in itertools.groupby(
-                meters, key=lambda x: x[1]['f:resource_id']):
-            timestamps = tuple(timeutils.parse_strtime(m[1]['f:timestamp'])
-                               for m in r_meters)
-            resources[resource_id] = (min(timestamps), max(timestamps))
-
-        # handle metaquery
-        if len(metaquery) > 0:
-            for ignored, data in resource_table.rows(resources.iterkeys()):
-                for k, v in metaquery.iteritems():
-                    # if metaquery matches, yield the resource model
-                    # e.g. metaquery: metadata.display_name
-                    #      equals
-                    #      HBase: f:r_display_name
-                    if data['f:r_' + k.split('.', 1)[1]] == v:
-                        yield make_resource(
-                            data,
-                            resources[data['f:resource_id']][0],
-                            resources[data['f:resource_id']][1])
-        else:
-            for ignored, data in resource_table.rows(resources.iterkeys()):
-                yield make_resource(
-                    data,
-                    resources[data['f:resource_id']][0],
-                    resources[data['f:resource_id']][1])
+        with self.conn_pool.connection() as conn:
+            resource_table = conn.table(self.RESOURCE_TABLE)
+            meter_table = conn.table(self.METER_TABLE)
+
+            q, start_row, stop_row = make_query(user=user,
+                                                project=project,
+                                                source=source,
+                                                resource=resource,
+                                                start=start_timestamp,
+                                                start_op=start_timestamp_op,
+                                                end=end_timestamp,
+                                                end_op=end_timestamp_op,
+                                                require_meter=False,
+                                                query_only=False)
+            LOG.debug("Query Meter table: %s" % q)
+            meters = meter_table.scan(filter=q, row_start=start_row,
+                                      row_stop=stop_row)
+
+            resources = {}
+            for resource_id, r_meters in itertools.groupby(
+                    meters, key=lambda x: x[1]['f:resource_id']):
+                timestamps = tuple(timeutils.parse_strtime(m[1]['f:timestamp'])
+                                   for m in r_meters)
+                resources[resource_id] = (min(timestamps), max(timestamps))
+
+            # The resources are read before the connection is given back
+            # to the pool, not while the caller iterates over them.
+            results = []
+            # handle metaquery
+            if len(metaquery) > 0:
+                for ignored, data in resource_table.rows(resources.iterkeys()):
+                    for k, v in metaquery.iteritems():
+                        # if metaquery matches, add the resource model
+                        # e.g. metaquery: metadata.display_name
+                        #      equals
+                        #      HBase: f:r_display_name
+                        if data['f:r_' + k.split('.', 1)[1]] == v:
+                            results.append(make_resource(
+                                data,
+                                resources[data['f:resource_id']][0],
+                                resources[data['f:resource_id']][1]))
+            else:
+                for ignored, data in resource_table.rows(resources.iterkeys()):
+                    results.append(make_resource(
+                        data,
+                        resources[data['f:resource_id']][0],
+                        resources[data['f:resource_id']][1]))
+            return results
 
     def get_meters(self, user=None, project=None, resource=None, source=None,
                    metaquery={}):
@@ -373,126 +430,149 @@ class Connection(base.Connection):
         :param metaquery: Optional dict with metadata to match on.
         """
 
-        resource_table = self.conn.table(self.RESOURCE_TABLE)
-        q = make_query(user=user, project=project, resource=resource,
-                       source=source, require_meter=False, query_only=True)
-        LOG.debug("Query Resource table: %s" % q)
-
-        # handle metaquery
-        if len(metaquery) > 0:
-            meta_q = []
-            for k, v in metaquery.iteritems():
-                meta_q.append(
-                    "SingleColumnValueFilter ('f', '%s', =, 'binary:%s')"
-                    % ('r_' + k.split('.', 1)[1], v))
-            meta_q = " AND ".join(meta_q)
-            # join query and metaquery
-            if q is not None:
-                q += " AND " + meta_q
-            else:
-                q = meta_q   # metaquery only
-
-        gen = resource_table.scan(filter=q)
-
-        for ignored, data in gen:
-            # Meter columns are stored like this:
-            # "m_{counter_name}|{counter_type}|{counter_unit}" => "1"
-            # where 'm' is a prefix (m for meter), value is always set to 1
-            meter = None
-            for m in data:
-                if m.startswith('f:m_'):
-                    meter = m
-                    break
-            if meter is None:
-                continue
-            name, type, unit = meter[4:].split("!")
-            yield models.Meter(
-                name=name,
-                type=type,
-                unit=unit,
-                resource_id=data['f:resource_id'],
-                project_id=data['f:project_id'],
-                source=data['f:source'],
-                user_id=data['f:user_id'],
-            )
+        with self.conn_pool.connection() as conn:
+            resource_table = conn.table(self.RESOURCE_TABLE)
+            q = make_query(user=user, project=project, resource=resource,
+                           source=source, require_meter=False, query_only=True)
+            LOG.debug("Query Resource table: %s" % q)
+
+            # handle metaquery
+            if len(metaquery) > 0:
+                meta_q = []
+                for k, v in metaquery.iteritems():
+                    meta_q.append(
+                        "SingleColumnValueFilter ('f', '%s', =, 'binary:%s')"
+                        % ('r_' + k.split('.', 1)[1], v))
+                meta_q = " AND ".join(meta_q)
+                # join query and metaquery
+                if q is not None:
+                    q += " AND " + meta_q
+                else:
+                    q = meta_q   # metaquery only
+
+            gen = resource_table.scan(filter=q)
+
+            # The meters are read before the connection is given back to
+            # the pool, not while the caller iterates over them.
+            results = []
+            for ignored, data in gen:
+                # Meter columns are stored like this:
+                # "m_{counter_name}|{counter_type}|{counter_unit}" => "1"
+                # where 'm' is a prefix (m for meter), value is always set to 1
+                meter = None
+                for m in data:
+                    if m.startswith('f:m_'):
+                        meter = m
+                        break
+                if meter is None:
+                    continue
+                name, type, unit = meter[4:].split("!")
+                results.append(models.Meter(
+                    name=name,
+                    type=type,
+                    unit=unit,
+                    resource_id=data['f:resource_id'],
+                    project_id=data['f:project_id'],
+                    source=data['f:source'],
+                    user_id=data['f:user_id'],
+                ))
+            return results
 
     def get_samples(self, sample_filter, limit=None):
         """Return an iterable of models.Sample instances.
 
+        The rowkeys start with the meter name, so the samples are only
+        returned from the most recent one, and can only be paged through
+        with a marker, when the filter has a meter.
+
         :param sample_filter: Filter.
         :param limit: Maximum number of results to return.
         """
         def make_sample(data):
-            """Transform HBase fields to Sample model."""
-            data = json.loads(data['f:message'])
+            """Transform a meter message to Sample model."""
             data['timestamp'] = timeutils.parse_strtime(data['timestamp'])
             return models.Sample(**data)
 
-        meter_table = self.conn.table(self.METER_TABLE)
+        if limit == 0:
+            return
+
+        marker_ts = sample_filter.marker_timestamp
+        if marker_ts and (not sample_filter.end or
+                          marker_ts < sample_filter.end):
+            # Scan from the marker, the samples sharing its timestamp up to
+            # the marker are skipped below.
+            sample_filter = copy.copy(sample_filter)
+            sample_filter.end = marker_ts
+            sample_filter.end_timestamp_op = 'le'
 
         q, start, stop = make_query_from_filter(sample_filter,
                                                 require_meter=False)
         LOG.debug("Query Meter Table: %s" % q)
 
-        gen = meter_table.scan(filter=q, row_start=start, row_stop=stop)
+        gen = self._scan_by_batches(self.METER_TABLE, filter=q,
+                                    row_start=start, row_stop=stop)
+
+        messages = _load_messages(self._read_metadata,
+                                  (meter for ignored, meter in gen),
+                                  self.sample_fetch_size)
+        samples = (make_sample(message) for message in messages
+                   if base.match_metaquery(message['resource_metadata'],
+                                           sample_filter.metaquery))
+        for s in _sort_by_message_id(samples):
+            if marker_ts and s.timestamp == marker_ts and (
+                    not sample_filter.marker_message_id or
+                    s.message_id >= sample_filter.marker_message_id):
+                continue
+            yield s
+            if limit:
+                limit -= 1
+                if not limit:
+                    break
 
-        for ignored, meter in gen:
-            # TODO(shengjie) put this implementation here because it's failing
-            # the test. bp hbase-meter-table-enhancement will address this
-            # properly.
-            # handle metaquery
-            metaquery = sample_filter.metaquery
-            # TODO(jd) implements using HBase capabilities
-            if limit == 0:
+    def _scan_by_batches(self, table_name, row_start=None, **kwargs):
+        """Yield the rows of a scan of a table, read by batches of
+        sample_fetch_size rows.
+
+        A connection is only taken from the pool while a batch is read, so
+        a caller consuming the rows slowly does not hold it.
+        """
+        while True:
+            with self.conn_pool.connection() as conn:
+                rows = list(conn.table(table_name).scan(
+                    row_start=row_start, limit=self.sample_fetch_size,
+                    batch_size=self.sample_fetch_size, **kwargs))
+            for row in rows:
+                yield row
+            if len(rows) < self.sample_fetch_size:
                 break
-            if len(metaquery) > 0:
-                for k, v in metaquery.iteritems():
-                    message = json.loads(meter['f:message'])
-                    metadata = message['resource_metadata']
-                    keys = k.split('.')
-                    # Support the dictionary type of metadata
-                    for key in keys[1:]:
-                        if key in metadata:
-                            metadata = metadata[key]
-                        else:
-                            break
-                    # NOTE (flwang) For multiple level searching, the matadata
-                    # object will be drilled down to check if it's matched
-                    # with the searched value.
-                    if metadata != v:
-                        break
-                else:
-                    if limit:
-                        limit -= 1
-                    yield make_sample(meter)
-            else:
-                if limit:
-                    limit -= 1
-                yield make_sample(meter)
+            # The next batch starts right after the last row key.
+            row_start = rows[-1][0] + '\0'
+
+    def _read_metadata(self, metadata_hashes):
+        """Return the (hash, row) pairs of the metadata table rows."""
+        with self.conn_pool.connection() as conn:
+            return list(conn.table(self.METADATA_TABLE).rows(
+                metadata_hashes))
 
     @staticmethod
-    def _update_meter_stats(stat, meter):
-        """Do the stats calculation on a requested time bucket in stats dict
+    def _update_meter_stats(stat, ts, meter):
+        """Add a meter row to the aggregated stats of its period.
 
-        :param stats: dict where aggregated stats are kept
-        :param index: time bucket index in stats
+        :param stat: dict where the aggregated stats of the period are kept
+        :param ts: timestamp of the row, as stored
         :param meter: meter record as returned from HBase
-        :param start_time: query start time
-        :param period: length of the time bucket
         """
-        vol = int(meter['f:counter_volume'])
-        ts = timeutils.parse_strtime(meter['f:timestamp'])
-        stat.unit = meter['f:counter_unit']
-        stat.min = min(vol, stat.min or vol)
-        stat.max = max(vol, stat.max)
-        stat.sum = vol + (stat.sum or 0)
-        stat.count += 1
-        stat.avg = (stat.sum / float(stat.count))
-        stat.duration_start = min(ts, stat.duration_start or ts)
-        stat.duration_end = max(ts, stat.duration_end or ts)
-        stat.duration = \
-            timeutils.delta_seconds(stat.duration_start,
-                                    stat.duration_end)
+        vol = float(meter['f:counter_volume'])
+        if not stat['count']:
+            stat.update(unit=meter['f:counter_unit'], min=vol, max=vol,
+                        first=ts, last=ts)
+        stat['min'] = min(vol, stat['min'])
+        stat['max'] = max(vol, stat['max'])
+        stat['sum'] += vol
+        stat['count'] += 1
+        # The stored timestamps have a fixed width and sort as strings.
+        stat['first'] = min(ts, stat['first'])
+        stat['last'] = max(ts, stat['last'])
 
     def get_meter_statistics(self, sample_filter, period=None):
         """Return an iterable of models.Statistics instances containing meter
@@ -504,68 +584,75 @@ class Connection(base.Connection):
 
            Due to HBase limitations the aggregations are implemented
            in the driver itself, therefore this method will be quite slow
-           because of all the Thrift traffic it is going to create.
+           because of all the Thrift traffic it is going to create. The
+           rows are scanned by batches and aggregated as they are read.
 
         """
-        meter_table = self.conn.table(self.METER_TABLE)
-
         q, start, stop = make_query_from_filter(sample_filter)
 
-        meters = list(meter for (ignored, meter) in
-                      meter_table.scan(filter=q, row_start=start,
-                                       row_stop=stop)
-                      )
+        with self.conn_pool.connection() as conn:
+            meter_table = conn.table(self.METER_TABLE)
 
-        if sample_filter.start:
-            start_time = sample_filter.start
-        elif meters:
-            start_time = timeutils.parse_strtime(meters[-1]['f:timestamp'])
-        else:
-            start_time = None
+            def scan():
+                for ignored, meter in meter_table.scan(
+                        filter=q, row_start=start, row_stop=stop,
+                        columns=STATISTICS_COLUMNS,
+                        batch_size=self.sample_fetch_size):
+                    yield meter['f:timestamp'], meter
 
-        if sample_filter.end:
-            end_time = sample_filter.end
-        elif meters:
-            end_time = timeutils.parse_strtime(meters[0]['f:timestamp'])
-        else:
-            end_time = None
+            start_time = sample_filter.start
+            if period and not start_time:
+                # The periods start at the first sample, which has to be
+                # found before the rows are put in their periods.
+                first = None
+                for ts, ignored in scan():
+                    first = min(ts, first or ts)
+                if first is None:
+                    return []
+                start_time = timeutils.parse_strtime(first)
+
+            stats = {}
+            bounds = None
+            for ts, meter in scan():
+                # The rows of a period mostly follow each other, the period
+                # is only computed again when a row is out of the bounds of
+                # the previous one.
+                if period and not (bounds and bounds[0] <= ts < bounds[1]):
+                    offset = int(timeutils.delta_seconds(
+                        start_time, timeutils.parse_strtime(ts)) /
+                        period) * period
+                    period_start = start_time + datetime.timedelta(0, offset)
+                    bounds = (timeutils.strtime(period_start),
+                              timeutils.strtime(period_start +
+                                                datetime.timedelta(0, period)))
+                elif not period:
+                    period_start = None
+                stat = stats.setdefault(period_start, {'count': 0, 'sum': 0})
+                self._update_meter_stats(stat, ts, meter)
 
         results = []
-
-        if not period:
-            period = 0
-            period_start = start_time
-            period_end = end_time
-
-        # As our HBase meters are stored as newest-first, we need to iterate
-        # in the reverse order
-        for meter in meters[::-1]:
-            ts = timeutils.parse_strtime(meter['f:timestamp'])
+        for period_start, stat in sorted(stats.iteritems()):
+            duration_start = timeutils.parse_strtime(stat['first'])
+            duration_end = timeutils.parse_strtime(stat['last'])
             if period:
-                offset = int(timeutils.delta_seconds(
-                    start_time, ts) / period) * period
-                period_start = start_time + datetime.timedelta(0, offset)
-
-            if not len(results) or not results[-1].period_start == \
-                    period_start:
-                if period:
-                    period_end = period_start + datetime.timedelta(
-                        0, period)
-                results.append(
-                    models.Statistics(unit='',
-                                      count=0,
-                                      min=0,
-                                      max=0,
-                                      avg=0,
-                                      sum=0,
-                                      period=period,
-                                      period_start=period_start,
-                                      period_end=period_end,
-                                      duration=None,
-                                      duration_start=None,
-                                      duration_end=None)
-                )
-            self._update_meter_stats(results[-1], meter)
+                period_end = period_start + datetime.timedelta(0, period)
+            else:
+                period_start = sample_filter.start or duration_start
+                period_end = sample_filter.end or duration_end
+            results.append(models.Statistics(
+                unit=stat['unit'],
+                count=stat['count'],
+                min=stat['min'],
+                max=stat['max'],
+                avg=stat['sum'] / stat['count'],
+                sum=stat['sum'],
+                period=period or 0,
+                period_start=period_start,
+                period_end=period_end,
+                duration=timeutils.delta_seconds(duration_start,
+                                                 duration_end),
+                duration_start=duration_start,
+                duration_end=duration_end))
         return results
 
     def get_alarms(self, name=None, user=None,
@@ -621,7 +708,8 @@ class MTable(object):
     def put(self, key, data):
         self._rows[key] = data
 
-    def scan(self, filter=None, columns=[], row_start=None, row_stop=None):
+    def scan(self, filter=None, columns=[], row_start=None, row_stop=None,
+             batch_size=None, limit=None):
         sorted_keys = sorted(self._rows)
         # copy data between row_start and row_stop into a dict
         rows = {}
@@ -631,15 +719,7 @@ class MTable(object):
             if row_stop and row > row_stop:
                 break
             rows[row] = copy.copy(self._rows[row])
-        if columns:
-            ret = {}
-            for row in rows.keys():
-                data = rows[row]
-                for key in data:
-                    if key in columns:
-                        ret[row] = data
-            rows = ret
-        elif filter:
+        if filter:
             # TODO(jdanjou): we should really parse this properly,
             # but at the moment we are only going to support AND here
             filters = filter.split('AND')
@@ -657,7 +737,15 @@ class MTable(object):
                 else:
                     raise NotImplementedError("%s filter is not implemented, "
                                               "you may want to add it!")
-        for k in sorted(rows):
+        if columns:
+            ret = {}
+            for row, data in rows.iteritems():
+                data = dict((key, value) for key, value in data.iteritems()
+                            if key in columns)
+                if data:
+                    ret[row] = data
+            rows = ret
+        for k in sorted(rows)[:limit]:
             yield k, rows[k]
 
     @staticmethod
@@ -714,6 +802,18 @@ class MConnection(object):
         return self.create_table(name)
 
 
+class MConnectionPool(object):
+    """HappyBase.ConnectionPool mock, sharing a single in-memory connection
+    """
+    def __init__(self):
+        self.conn = MConnection()
+        self.conn.open()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        yield self.conn
+
+
 #################################################
 # Here be various HBase helpers
 def reverse_timestamp(dt):
@@ -834,6 +934,44 @@ def _make_rowkey_scan(meter, rts_start=None, rts_end=None):
     return start_row, end_row
 
 
+def _load_messages(read_metadata, meters, batch_size):
+    """Yield the messages of the meter rows with their resource metadata,
+    which is read from the metadata table once per batch of rows.
+
+    :param read_metadata: Function returning the (hash, row) pairs of the
+                          metadata table rows of a list of hashes.
+    """
+    known = cache.MemoryCache(METADATA_CACHE_SIZE)
+    while True:
+        batch = list(itertools.islice(meters, batch_size))
+        if not batch:
+            break
+        missing = set(meter['f:metadata_hash'] for meter in batch
+                      if 'f:metadata_hash' in meter and
+                      known.get(meter['f:metadata_hash']) is None)
+        for metadata_hash, data in read_metadata(list(missing)):
+            known.set(metadata_hash, json.loads(data['f:metadata']))
+        for meter in batch:
+            message = json.loads(meter['f:message'])
+            # The rows recorded before the metadata table embed their
+            # metadata in the message.
+            if 'f:metadata_hash' in meter:
+                message['resource_metadata'] = known.get(
+                    meter['f:metadata_hash'])
+            yield message
+
+
+def _sort_by_message_id(samples):
+    """Order the consecutive samples sharing a timestamp by descending
+    message id, as the rowkeys do not.
+    """
+    for ignored, group in itertools.groupby(
+            samples, key=operator.attrgetter('timestamp')):
+        for s in sorted(group, key=operator.attrgetter('message_id'),
+                        reverse=True):
+            yield s
+
+
 def _load_hbase_list(d, prefix):
     """Deserialise dict stored as HBase column family
     """
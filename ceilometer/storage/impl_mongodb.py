@@ -21,8 +21,12 @@
 """
 
 import calendar
+import collections
 import copy
+import datetime
+import itertools
 import operator
+import time
 import uuid
 import weakref
 
@@ -32,16 +36,35 @@ import pymongo
 
 from oslo.config import cfg
 
+from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
+from ceilometer.openstack.common import timeutils
 from ceilometer import storage
 from ceilometer.storage import base
+from ceilometer.storage import cache
 from ceilometer.storage import models
 
 cfg.CONF.import_opt('time_to_live', 'ceilometer.storage',
                     group="database")
+cfg.CONF.import_opt('mongodb_write_concern', 'ceilometer.storage',
+                    group="database")
 
 LOG = log.getLogger(__name__)
 
+# Number of resource metadata hashes kept in memory per connection, the
+# metadata known to be stored is not written again.
+METADATA_CACHE_SIZE = 10000
+
+# The timestamp of the last sample of a metadata is only updated by the
+# samples newer than it by this delay, the metadata expires that much later
+# than its samples.
+METADATA_TIMESTAMP_SLACK = datetime.timedelta(minutes=10)
+
+# Number of (user or project, source) pairs remembered as recorded, and
+# for how many seconds, as the expirer may remove them.
+KNOWN_SOURCES_CACHE_SIZE = 10000
+KNOWN_SOURCES_TTL = 300
+
 
 class MongoDBStorage(base.StorageEngine):
     """Put the data into a MongoDB database
@@ -130,28 +153,46 @@ def make_query_from_filter(sample_filter, require_meter=True):
     if sample_filter.source:
         q['source'] = sample_filter.source
 
-    # so the samples call metadata resource_metadata, so we convert
-    # to that.
-    q.update(dict(('resource_%s' % k, v)
-                  for (k, v) in sample_filter.metaquery.iteritems()))
+    # The metaquery is resolved against the metadata collection by the
+    # connection, see Connection._match_metadata.
     return q
 
 
+def make_marker_query(sample_filter):
+    """Return a query dictionary matching the samples after the marker of the
+    filter, in the (timestamp, message_id) descending order.
+
+    :param sample_filter: SampleFilter instance with a marker_timestamp.
+    """
+    ts = sample_filter.marker_timestamp
+    if not sample_filter.marker_message_id:
+        return {'timestamp': {'$lt': ts}}
+    return {'$or': [
+        {'timestamp': {'$lt': ts}},
+        {'timestamp': ts,
+         'message_id': {'$lt': sample_filter.marker_message_id}},
+    ]}
+
+
 class ConnectionPool(object):
 
     def __init__(self):
         self._pool = {}
 
-    def connect(self, url):
+    def connect(self, url, max_pool_size=None):
         if url in self._pool:
             client = self._pool.get(url)()
             if client:
                 return client
         LOG.info('connecting to MongoDB on %s', url)
+        kwargs = {}
+        if max_pool_size:
+            kwargs['max_pool_size'] = max_pool_size
         client = pymongo.MongoClient(
             url,
             use_greenlets=True,
-            safe=True)
+            safe=True,
+            **kwargs)
         self._pool[url] = weakref.ref(client)
         return client
 
@@ -162,17 +203,6 @@ class Connection(base.Connection):
 
     CONNECTION_POOL = ConnectionPool()
 
-    REDUCE_GROUP_CLEAN = bson.code.Code("""
-    function ( curr, result ) {
-        if (result.resources.indexOf(curr.resource_id) < 0)
-            result.resources.push(curr.resource_id);
-        if (result.users.indexOf(curr.user_id) < 0)
-            result.users.push(curr.user_id);
-        if (result.projects.indexOf(curr.project_id) < 0)
-            result.projects.push(curr.project_id);
-    }
-    """)
-
     MAP_STATS = bson.code.Code("""
     function () {
         emit('statistics', { unit: this.counter_unit,
@@ -251,21 +281,39 @@ class Connection(base.Connection):
         # We need that otherwise we overflow the MongoDB instance with new
         # connection since we instanciate a Pymongo client each time someone
         # requires a new storage connection.
-        self.conn = self.CONNECTION_POOL.connect(url)
+        self.conn = self.CONNECTION_POOL.connect(
+            url, conf.database.max_pool_size)
+
+        self.server_version = self.conn.server_info()['versionArray']
 
         # Require MongoDB 2.2 to use aggregate() and TTL
-        if self.conn.server_info()['versionArray'] < [2, 2]:
+        if self.server_version < [2, 2]:
             raise storage.StorageBadVersion("Need at least MongoDB 2.2")
 
         connection_options = pymongo.uri_parser.parse_uri(url)
         self.db = getattr(self.conn, connection_options['database'])
 
-        # NOTE(jd) Upgrading is just about creating index, so let's do this
-        # on connection to be sure at least the TTL is correcly updated if
-        # needed.
-        self.upgrade()
+        self._reset_caches()
+
+        w = conf.database.mongodb_write_concern
+        self.write_concern = {'w': int(w) if w.isdigit() else w}
+
+        # NOTE(jd) Upgrading is mostly about creating index, so let's do
+        # this on connection to be sure at least the TTL is correcly updated
+        # if needed.
+        self._ensure_indexes()
 
     def upgrade(self):
+        self._ensure_indexes()
+
+        # The resources recorded before they kept the range of timestamps
+        # and the users, projects and sources of their samples. This is
+        # only done by an explicit upgrade, as it reads all their samples.
+        for r in self.db.resource.find({'first_sample_timestamp': None},
+                                       fields=[]):
+            self._refresh_resource(r['_id'], ['last_sample_timestamp'])
+
+    def _ensure_indexes(self):
         # Establish indexes
         #
         # We need variations for user_id vs. project_id because of the
@@ -285,34 +333,73 @@ class Connection(base.Connection):
                 ('timestamp', pymongo.ASCENDING),
                 ('source', pymongo.ASCENDING),
             ], name='meter_idx')
+        for field in ['users', 'projects']:
+            self.db.resource.ensure_index([(field, pymongo.ASCENDING)],
+                                          name='resource_%s_idx' % field)
+        # Index of the resources to update when their first samples expire
+        # or which are missing their timestamps.
+        self.db.resource.ensure_index([('first_sample_timestamp',
+                                        pymongo.ASCENDING)],
+                                      name='resource_first_sample_idx')
         self.db.meter.ensure_index([('timestamp', pymongo.DESCENDING)],
                                    name='timestamp_idx')
-
-        indexes = self.db.meter.index_information()
+        # Indexes of the samples of a user or project, which the expirer
+        # looks up for each of them.
+        self.db.meter.ensure_index([('user_id', pymongo.ASCENDING),
+                                    ('timestamp', pymongo.DESCENDING)],
+                                   name='user_timestamp_idx')
+        self.db.meter.ensure_index([('project_id', pymongo.ASCENDING),
+                                    ('timestamp', pymongo.DESCENDING)],
+                                   name='project_timestamp_idx')
+        # Index matching the sort order of get_samples, so the samples can
+        # be streamed from a marker without sorting them in memory.
+        self.db.meter.ensure_index([('timestamp', pymongo.DESCENDING),
+                                    ('message_id', pymongo.DESCENDING)],
+                                   name='timestamp_message_idx')
 
         ttl = cfg.CONF.database.time_to_live
+        self._ensure_ttl_index(self.db.meter, 'meter_ttl', ttl)
+        # The metadata timestamps lag behind the samples by up to the slack.
+        if ttl > 0:
+            ttl += (METADATA_TIMESTAMP_SLACK.days * 86400 +
+                    METADATA_TIMESTAMP_SLACK.seconds)
+        self._ensure_ttl_index(self.db.metadata, 'metadata_ttl', ttl)
+
+    @staticmethod
+    def _ensure_ttl_index(collection, name, ttl):
+        """Expire the documents of the collection ttl seconds after their
+        timestamp, or never if ttl is not positive.
+        """
+        indexes = collection.index_information()
 
         if ttl <= 0:
-            if 'meter_ttl' in indexes:
-                self.db.meter.drop_index('meter_ttl')
+            if name in indexes:
+                collection.drop_index(name)
             return
 
-        if 'meter_ttl' in indexes:
+        if name in indexes:
             # NOTE(sileht): manually check expireAfterSeconds because
             # ensure_index doesn't update index options if the index already
             # exists
-            if ttl == indexes['meter_ttl'].get('expireAfterSeconds', -1):
+            if ttl == indexes[name].get('expireAfterSeconds', -1):
                 return
 
-            self.db.meter.drop_index('meter_ttl')
+            collection.drop_index(name)
 
-        self.db.meter.create_index(
+        collection.create_index(
             [('timestamp', pymongo.ASCENDING)],
             expireAfterSeconds=ttl,
-            name='meter_ttl'
+            name=name
         )
 
+    def _reset_caches(self):
+        # Timestamp of the last sample recorded for the known metadata,
+        # by hash.
+        self.metadata_timestamps = cache.MemoryCache(METADATA_CACHE_SIZE)
+        self.known_sources = cache.MemoryCache(KNOWN_SOURCES_CACHE_SIZE)
+
     def clear(self):
+        self._reset_caches()
         self.conn.drop_database(self.db)
         # Connection will be reopened automatically if needed
         self.conn.close()
@@ -323,66 +410,245 @@ class Connection(base.Connection):
         :param data: a dictionary such as returned by
                      ceilometer.meter.meter_message_from_counter
         """
-        # Make sure we know about the user and project
-        self.db.user.update(
-            {'_id': data['user_id']},
-            {'$addToSet': {'source': data['source'],
-                           },
-             },
-            upsert=True,
-        )
-        self.db.project.update(
-            {'_id': data['project_id']},
-            {'$addToSet': {'source': data['source'],
-                           },
-             },
-            upsert=True,
-        )
+        self.record_metering_data_batch([data])
 
-        # Record the updated resource metadata
-        self.db.resource.update(
-            {'_id': data['resource_id']},
-            {'$set': {'project_id': data['project_id'],
-                      'user_id': data['user_id'],
-                      'metadata': data['resource_metadata'],
-                      'source': data['source'],
-                      },
-             '$addToSet': {'meter': {'counter_name': data['counter_name'],
-                                     'counter_type': data['counter_type'],
-                                     'counter_unit': data['counter_unit'],
-                                     },
-                           },
-             },
-            upsert=True,
-        )
+    def record_metering_data_batch(self, samples):
+        """Write a batch of samples to the backend storage system.
+
+        The users, projects and resources are updated once per batch, and
+        the samples are inserted at once, with the write concern set by
+        [database]mongodb_write_concern.
+
+        :param samples: a list of dictionaries such as returned by
+                        ceilometer.meter.meter_message_from_counter
+        """
+        if not samples:
+            return
+
+        # Make sure we know about the users and projects
+        for collection, key in ((self.db.user, 'user_id'),
+                                (self.db.project, 'project_id')):
+            sources = collections.defaultdict(set)
+            for data in samples:
+                known = (collection.name, data[key], data['source'])
+                if self.known_sources.get(known) is None:
+                    sources[data[key]].add(data['source'])
+            for _id, new_sources in sources.iteritems():
+                self._upsert(collection, _id,
+                             {'source': sorted(new_sources)})
+                for source in new_sources:
+                    self.known_sources.set((collection.name, _id, source),
+                                           True, KNOWN_SOURCES_TTL)
+
+        # Record the updated resource metadata, the last sample of the
+        # batch sets it. The resource also keeps the range of timestamps
+        # and the meters, users, projects and sources of its samples.
+        resources = {}
+        for data in samples:
+            r = resources.setdefault(data['resource_id'], {
+                'first': data['timestamp'],
+                'last': data['timestamp'],
+                'additions': dict((field, []) for field in
+                                  ('meter', 'users', 'projects', 'sources')),
+            })
+            r['data'] = data
+            r['first'] = min(r['first'], data['timestamp'])
+            r['last'] = max(r['last'], data['timestamp'])
+            for field, value in (
+                    ('meter', {'counter_name': data['counter_name'],
+                               'counter_type': data['counter_type'],
+                               'counter_unit': data['counter_unit'],
+                               }),
+                    ('users', data['user_id']),
+                    ('projects', data['project_id']),
+                    ('sources', data['source'])):
+                if value not in r['additions'][field]:
+                    r['additions'][field].append(value)
+        for resource_id, r in resources.iteritems():
+            data = r['data']
+            update = {'$set': {'project_id': data['project_id'],
+                               'user_id': data['user_id'],
+                               'metadata': data['resource_metadata'],
+                               'source': data['source'],
+                               },
+                      }
+            # MongoDB 2.6 keeps the range of timestamps with the update.
+            if self.server_version >= [2, 6]:
+                update['$min'] = {'first_sample_timestamp': r['first']}
+                update['$max'] = {'last_sample_timestamp': r['last']}
+            self._upsert(self.db.resource, resource_id, r['additions'],
+                         update)
+            if self.server_version < [2, 6]:
+                self._extend_timestamps(resource_id, r['first'], r['last'])
 
         # Record the raw data for the meter. Use a copy so we do not
         # modify a data structure owned by our caller (the driver adds
-        # a new key '_id').
-        record = copy.copy(data)
-        self.db.meter.insert(record)
+        # a new key '_id'). The resource metadata is stored once in the
+        # metadata collection, the sample refers to it by hash.
+        records = []
+        for data in samples:
+            record = copy.copy(data)
+            record['metadata_hash'] = self._record_metadata(
+                record.pop('resource_metadata'), data['timestamp'])
+            records.append(record)
+        self.db.meter.insert(records, **self.write_concern)
+
+    def _upsert(self, collection, _id, additions, update={}):
+        """Update or create the document _id of the collection, adding the
+        lists of values of additions to the sets of their fields.
+
+        MongoDB before 2.4 adds a single value to a set per update.
+        """
+        if self.server_version >= [2, 4]:
+            documents = [{'$addToSet': dict(
+                (field, {'$each': values})
+                for field, values in additions.iteritems())}]
+        else:
+            documents = [{'$addToSet': {field: value}}
+                         for field, values in additions.iteritems()
+                         for value in values]
+        for document in documents:
+            document.update(update)
+            collection.update({'_id': _id}, document, upsert=True,
+                              **self.write_concern)
+
+    def _extend_timestamps(self, resource_id, first, last):
+        """Extend the range of sample timestamps of a resource to first and
+        last, for the servers without the $min and $max updates.
+        """
+        for field, value, op in (('first_sample_timestamp', first, '$gt'),
+                                 ('last_sample_timestamp', last, '$lt')):
+            self.db.resource.update(
+                {'_id': resource_id,
+                 '$or': [{field: {op: value}}, {field: None}]},
+                {'$set': {field: value}},
+                **self.write_concern)
+
+    def _record_metadata(self, metadata, timestamp):
+        """Store a resource metadata unless it is known, return its hash.
+
+        The metadata documents hold the timestamp of their last sample, so
+        they expire with it.
+        """
+        metadata_hash = base.hash_metadata(metadata)
+        last = self.metadata_timestamps.get(metadata_hash)
+        if last is not None and timestamp <= last + METADATA_TIMESTAMP_SLACK:
+            return metadata_hash
+        if last is None:
+            try:
+                self.db.metadata.insert({'_id': metadata_hash,
+                                         'metadata': metadata,
+                                         'timestamp': timestamp})
+            except pymongo.errors.DuplicateKeyError:
+                pass
+            else:
+                self.metadata_timestamps.set(metadata_hash, timestamp)
+                return metadata_hash
+        self.db.metadata.update({'_id': metadata_hash,
+                                 'timestamp': {'$lt': timestamp}},
+                                {'$set': {'timestamp': timestamp}})
+        self.metadata_timestamps.set(metadata_hash, timestamp)
+        return metadata_hash
+
+    def _get_metadata(self, hashes):
+        """Return the resource metadata of the given hashes, by hash."""
+        return dict((m['_id'], m['metadata'])
+                    for m in self.db.metadata.find({'_id': {'$in': hashes}}))
+
+    def _match_metadata(self, q, metaquery):
+        """Restrict the sample query q to the samples whose resource
+        metadata matches the metaquery.
+        """
+        if not metaquery:
+            return q
+        hashes = [m['_id'] for m in self.db.metadata.find(metaquery,
+                                                          fields=[])]
+        q['$or'] = [
+            {'metadata_hash': {'$in': hashes}},
+            # The samples recorded before the metadata collection embed
+            # their metadata.
+            dict(('resource_' + k, v) for (k, v) in metaquery.iteritems()),
+        ]
+        return q
 
     def clear_expired_metering_data(self, ttl):
         """Clear expired data from the backend storage system according to the
         time-to-live.
 
+        The samples and their metadata are expired by MongoDB. The users,
+        projects and resources left without samples are removed by batches,
+        see [database]expirer_batch_size and expirer_batch_delay, and the
+        resources whose first samples expired are updated.
+
         :param ttl: Number of seconds to keep records for.
 
         """
-        results = self.db.meter.group(
-            key={},
-            condition={},
-            reduce=self.REDUCE_GROUP_CLEAN,
-            initial={
-                'resources': [],
-                'users': [],
-                'projects': [],
-            }
-        )[0]
-
-        self.db.user.remove({'_id': {'$nin': results['users']}})
-        self.db.project.remove({'_id': {'$nin': results['projects']}})
-        self.db.resource.remove({'_id': {'$nin': results['resources']}})
+        batch_size = cfg.CONF.database.expirer_batch_size
+        delay = cfg.CONF.database.expirer_batch_delay
+        for collection, field in ((self.db.user, 'user_id'),
+                                  (self.db.project, 'project_id'),
+                                  (self.db.resource, 'resource_id')):
+            removed = self._remove_orphans(collection, field, batch_size,
+                                           delay)
+            LOG.info(_('%(count)d orphans removed from %(collection)s'),
+                     {'count': removed, 'collection': collection.name})
+
+        end = timeutils.utcnow() - datetime.timedelta(seconds=ttl)
+        for r in self.db.resource.find(
+                {'first_sample_timestamp': {'$lt': end}}, fields=[]):
+            self._refresh_resource(r['_id'])
+
+    def _refresh_resource(self, resource_id, fields=[]):
+        """Set the first sample timestamp and the users, projects and
+        sources of a resource, and the other given fields, from its
+        samples.
+        """
+        fields = ['first_sample_timestamp', 'users', 'projects',
+                  'sources'] + fields
+        group = {'_id': None,
+                 'first_sample_timestamp': {'$min': '$timestamp'},
+                 'last_sample_timestamp': {'$max': '$timestamp'},
+                 'users': {'$addToSet': '$user_id'},
+                 'projects': {'$addToSet': '$project_id'},
+                 'sources': {'$addToSet': '$source'},
+                 }
+        results = self.db.meter.aggregate([
+            {'$match': {'resource_id': resource_id}},
+            {'$group': dict((k, v) for k, v in group.iteritems()
+                            if k == '_id' or k in fields)},
+        ])['result']
+        if results:
+            del results[0]['_id']
+            self.db.resource.update({'_id': resource_id},
+                                    {'$set': results[0]})
+
+    def _remove_orphans(self, collection, field, batch_size, delay):
+        """Remove the documents of the collection whose id is the field of
+        no sample, return how many.
+
+        The documents are walked in batches of batch_size ids, each id is
+        looked up in the index of the field, and the orphans of a batch are
+        removed at once.
+        """
+        removed = 0
+        q = {}
+        while True:
+            ids = [d['_id'] for d in collection.find(
+                q, fields=[], limit=batch_size,
+                sort=[('_id', pymongo.ASCENDING)])]
+            if not ids:
+                break
+            orphans = [_id for _id in ids
+                       if self.db.meter.find_one({field: _id},
+                                                 fields=[]) is None]
+            if orphans:
+                collection.remove({'_id': {'$in': orphans}})
+                removed += len(orphans)
+            if len(ids) < batch_size:
+                break
+            q = {'_id': {'$gt': ids[-1]}}
+            time.sleep(delay)
+        return removed
 
     @staticmethod
     def _get_marker(db_collection, marker_pairs):
@@ -538,6 +804,62 @@ class Connection(base.Connection):
             raise NotImplementedError(
                 "Cannot use marker pairs in resource listing, not implemented")
 
+        sort_keys = base._handle_sort_key('resource', sort_key)
+        if start_timestamp or end_timestamp:
+            results = self._get_resources_from_samples(
+                user, project, source, resource, metaquery,
+                make_timestamp_range(start_timestamp, end_timestamp,
+                                     start_timestamp_op, end_timestamp_op),
+                sort_keys, sort_dir)
+            if limit is not None:
+                results = results[:limit]
+        else:
+            # The resources keep the users, projects and sources of their
+            # samples, and the range of their timestamps.
+            q = {}
+            if user is not None:
+                q['users'] = user
+            if project is not None:
+                q['projects'] = project
+            if source is not None:
+                q['sources'] = source
+            if resource is not None:
+                q['_id'] = resource
+            q.update(metaquery)
+            results = self.paginate_query(q, self.db.resource, limit=limit,
+                                          sort_keys=sort_keys,
+                                          sort_dir=sort_dir)
+
+        for r in results:
+            yield models.Resource(
+                resource_id=r['_id'],
+                # The listing of a user, project or source shows it as
+                # the one of the resource, as do the samples it matches.
+                user_id=r['user_id'] if user is None else user,
+                project_id=r['project_id'] if project is None else project,
+                first_sample_timestamp=r.get('first_sample_timestamp'),
+                last_sample_timestamp=r.get('last_sample_timestamp'),
+                source=r['source'] if source is None else source,
+                metadata=r['metadata'],
+                meter=[
+                    models.ResourceMeter(
+                        counter_name=m['counter_name'],
+                        counter_type=m['counter_type'],
+                        # Return empty string if 'counter_unit' is not
+                        # valid for backward compatibility.
+                        counter_unit=m.get('counter_unit', ''),
+                    )
+                    for m in r['meter']
+                ],
+            )
+
+    def _get_resources_from_samples(self, user, project, source, resource,
+                                    metaquery, ts_range, sort_keys,
+                                    sort_dir):
+        """Return the resources with samples in the timestamp range, as
+        resource documents sorted by sort_keys, with the range of
+        timestamps and the meters of these samples.
+        """
         q = {}
         if user is not None:
             q['user_id'] = user
@@ -547,33 +869,12 @@ class Connection(base.Connection):
             q['source'] = source
         if resource is not None:
             q['resource_id'] = resource
-        # Add resource_ prefix so it matches the field in the db
-        q.update(dict(('resource_' + k, v)
-                      for (k, v) in metaquery.iteritems()))
-
-        # FIXME(dhellmann): This may not perform very well,
-        # but doing any better will require changing the database
-        # schema and that will need more thought than I have time
-        # to put into it today.
-        if start_timestamp or end_timestamp:
-            # Look for resources matching the above criteria and with
-            # samples in the time range we care about, then change the
-            # resource query to return just those resources by id.
-            ts_range = make_timestamp_range(start_timestamp, end_timestamp,
-                                            start_timestamp_op,
-                                            end_timestamp_op)
-            if ts_range:
-                q['timestamp'] = ts_range
-
-        sort_keys = base._handle_sort_key('resource', sort_key)
-        sort_instruction, query = self._build_paginate_query(None,
-                                                             sort_keys,
-                                                             sort_dir)
-        q.update(query)
+        if ts_range:
+            q['timestamp'] = ts_range
+        self._match_metadata(q, metaquery)
 
-        aggregate = self.db.meter.aggregate([
+        results = self.db.meter.aggregate([
             {"$match": q},
-            {"$sort": dict(sort_instruction)},
             {"$group": {
                 "_id": "$resource_id",
                 "user_id": {"$first": "$user_id"},
@@ -581,37 +882,24 @@ class Connection(base.Connection):
                 "source": {"$first": "$source"},
                 "first_sample_timestamp": {"$min": "$timestamp"},
                 "last_sample_timestamp": {"$max": "$timestamp"},
-                "metadata": {"$first": "$resource_metadata"},
-                "meters_name": {"$push": "$counter_name"},
-                "meters_type": {"$push": "$counter_type"},
-                "meters_unit": {"$push": "$counter_unit"},
+                "meter": {"$addToSet": {
+                    "counter_name": "$counter_name",
+                    "counter_type": "$counter_type",
+                    "counter_unit": "$counter_unit",
+                }},
             }},
-        ])
-
-        for result in aggregate['result']:
-            if limit is not None:
-                if limit == 0:
-                    break
-                limit -= 1
-            yield models.Resource(
-                resource_id=result['_id'],
-                user_id=result['user_id'],
-                project_id=result['project_id'],
-                first_sample_timestamp=result['first_sample_timestamp'],
-                last_sample_timestamp=result['last_sample_timestamp'],
-                source=result['source'],
-                metadata=result['metadata'],
-                meter=[
-                    models.ResourceMeter(
-                        counter_name=m_n,
-                        counter_type=m_t,
-                        counter_unit=m_u,
-                    )
-                    for m_n, m_u, m_t in zip(result['meters_name'],
-                                             result['meters_unit'],
-                                             result['meters_type'])
-                ],
-            )
+        ])['result']
+
+        # The metadata is the current one of the resources.
+        ids = [r['_id'] for r in results]
+        metadata = dict((r['_id'], r.get('metadata'))
+                        for r in self.db.resource.find({'_id': {'$in': ids}},
+                                                       fields=['metadata']))
+        for r in results:
+            r['metadata'] = metadata.get(r['_id'])
+        return sorted(results,
+                      key=lambda r: tuple(r.get(k) for k in sort_keys),
+                      reverse=sort_dir != 'asc')
 
     def get_meters(self, user=None, project=None, resource=None, source=None,
                    metaquery={}, limit=None, marker_pairs=None, sort_key=None,
@@ -668,21 +956,43 @@ class Connection(base.Connection):
         if limit == 0:
             return
         q = make_query_from_filter(sample_filter, require_meter=False)
-        if limit:
-            samples = self.db.meter.find(
-                q, limit=limit, sort=[("timestamp", pymongo.DESCENDING)])
-        else:
-            samples = self.db.meter.find(
-                q, sort=[("timestamp", pymongo.DESCENDING)])
-
-        for s in samples:
-            # Remove the ObjectId generated by the database when
-            # the sample was inserted. It is an implementation
-            # detail that should not leak outside of the driver.
-            del s['_id']
-            # Backward compatibility for samples without units
-            s['counter_unit'] = s.get('counter_unit', '')
-            yield models.Sample(**s)
+        self._match_metadata(q, sample_filter.metaquery)
+        if sample_filter.marker_timestamp:
+            q = {'$and': [q, make_marker_query(sample_filter)]}
+        fetch_size = cfg.CONF.database.sample_fetch_size
+        samples = self.db.meter.find(
+            q,
+            limit=limit or 0,
+            sort=[("timestamp", pymongo.DESCENDING),
+                  ("message_id", pymongo.DESCENDING)],
+        ).batch_size(fetch_size)
+
+        # The metadata is looked up once per batch of samples, and kept
+        # for the next ones.
+        metadata = cache.MemoryCache(METADATA_CACHE_SIZE)
+        while True:
+            batch = list(itertools.islice(samples, fetch_size))
+            if not batch:
+                break
+            missing = set(s['metadata_hash'] for s in batch
+                          if 'metadata_hash' in s and
+                          metadata.get(s['metadata_hash']) is None)
+            for metadata_hash, m in self._get_metadata(
+                    list(missing)).iteritems():
+                metadata.set(metadata_hash, m)
+            for s in batch:
+                # Remove the ObjectId generated by the database when
+                # the sample was inserted. It is an implementation
+                # detail that should not leak outside of the driver.
+                del s['_id']
+                # Backward compatibility for samples without units
+                s['counter_unit'] = s.get('counter_unit', '')
+                # Backward compatibility for samples embedding their
+                # metadata
+                if 'metadata_hash' in s:
+                    s['resource_metadata'] = metadata.get(
+                        s.pop('metadata_hash'))
+                yield models.Sample(**s)
 
     def get_meter_statistics(self, sample_filter, period=None):
         """Return an iterable of models.Statistics instance containing meter
@@ -692,14 +1002,81 @@ class Connection(base.Connection):
 
         """
         q = make_query_from_filter(sample_filter)
+        self._match_metadata(q, sample_filter.metaquery)
 
+        period_start = None
         if period:
             if sample_filter.start:
                 period_start = sample_filter.start
             else:
-                period_start = self.db.meter.find(
-                    limit=1, sort=[('timestamp',
-                                    pymongo.ASCENDING)])[0]['timestamp']
+                # The periods start with the first matching sample.
+                first = list(self.db.meter.find(
+                    q, fields=['timestamp'], limit=1,
+                    sort=[('timestamp', pymongo.ASCENDING)]))
+                if not first:
+                    return []
+                period_start = first[0]['timestamp']
+
+        # The date arithmetic of the aggregation framework needs MongoDB
+        # 2.4, older servers compute the statistics in JavaScript.
+        if self.server_version < [2, 4]:
+            return self._get_meter_statistics_map_reduce(q, period,
+                                                         period_start)
+
+        if period:
+            # Offset of the period of the sample from the first period, in
+            # milliseconds.
+            offset = {'$subtract': ['$timestamp', period_start]}
+            group_id = {'$subtract': [offset,
+                                      {'$mod': [offset, period * 1000]}]}
+        else:
+            group_id = None
+
+        results = self.db.meter.aggregate([
+            {'$match': q},
+            {'$group': {
+                '_id': group_id,
+                'unit': {'$first': '$counter_unit'},
+                'min': {'$min': '$counter_volume'},
+                'max': {'$max': '$counter_volume'},
+                'sum': {'$sum': '$counter_volume'},
+                'count': {'$sum': 1},
+                'duration_start': {'$min': '$timestamp'},
+                'duration_end': {'$max': '$timestamp'},
+            }},
+            {'$sort': {'_id': pymongo.ASCENDING}},
+        ])
+
+        statistics = []
+        for r in results['result']:
+            if period:
+                start = period_start + datetime.timedelta(
+                    milliseconds=r['_id'])
+                end = start + datetime.timedelta(seconds=period)
+            else:
+                start, end = r['duration_start'], r['duration_end']
+            statistics.append(models.Statistics(
+                unit=r['unit'],
+                min=r['min'],
+                max=r['max'],
+                avg=r['sum'] / float(r['count']),
+                sum=r['sum'],
+                count=r['count'],
+                period=period or 0,
+                period_start=start,
+                period_end=end,
+                duration=timeutils.delta_seconds(r['duration_start'],
+                                                 r['duration_end']),
+                duration_start=r['duration_start'],
+                duration_end=r['duration_end'],
+            ))
+        return statistics
+
+    def _get_meter_statistics_map_reduce(self, q, period, period_start):
+        """Return the statistics of the samples matching the query q,
+        computed by map/reduce.
+        """
+        if period:
             period_start = int(calendar.timegm(period_start.utctimetuple()))
             map_stats = self.MAP_STATS_PERIOD % (period, period_start)
         else:
@@ -0,0 +1,483 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Storage backend spreading the data over several databases
+"""
+
+import bisect
+import collections
+import copy
+import datetime
+import hashlib
+import heapq
+import itertools
+import urlparse
+
+import eventlet
+from oslo.config import cfg
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import timeutils
+from ceilometer import service
+from ceilometer import storage
+from ceilometer.storage import base
+from ceilometer.storage import tiered
+
+OPTS = [
+    cfg.ListOpt('shard_connections',
+                default=[],
+                help='Database URLs of the shards of the sharded:// storage '
+                'driver'),
+    cfg.StrOpt('shard_key',
+               default='resource_id',
+               help='Sample field whose consistent hash selects the shard '
+               'of a sample, "resource_id" or "project_id"'),
+    cfg.ListOpt('rebalance_connections',
+                default=[],
+                help='Database URLs of the shards the data of the '
+                'shard_connections are copied to by ceilometer-rebalance'),
+    cfg.StrOpt('rebalance_since',
+               default=None,
+               help='ISO 8601 UTC time from which ceilometer-rebalance '
+               'copies the samples and events missing from the '
+               'rebalance_connections, instead of copying everything'),
+]
+
+cfg.CONF.register_opts(OPTS, group='database')
+
+LOG = log.getLogger(__name__)
+
+# Number of points of each shard on the hash ring.
+RING_REPLICAS = 100
+
+# A sharded database can't be the shard of another one.
+UNSUPPORTED_SCHEMES = ('sharded',)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class ShardedStorage(base.StorageEngine):
+    """Spread the samples over the databases of the shard_connections
+    option, given as sharded://
+
+    The shard of a sample is chosen on a consistent hash ring of the
+    shard URLs, by its shard_key field, resource_id or project_id. The
+    queries are sent to all the shards at once, and their results merged.
+    The alarms are kept in the first shard.
+
+    Any driver keeping its data in the database of its URL can be a shard,
+    except an in-memory SQLite database, which each SQL connection would
+    open empty.
+    """
+
+    @staticmethod
+    def get_connection(conf):
+        """Return a Connection instance based on the configuration settings.
+        """
+        return Connection(conf)
+
+
+class HashRing(object):
+    """Consistent hash ring of nodes.
+
+    Adding a node only moves to it the keys of the nodes it takes the
+    place of on the ring, about 1/N of the keys.
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted((self._hash('%s-%d' % (node, i)), node)
+                        for node in self.nodes
+                        for i in range(replicas))
+        self._hashes = [h for h, node in points]
+        self._nodes = [node for h, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest(), 16)
+
+    def get_node(self, key):
+        """Return the node of key."""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        i = bisect.bisect(self._hashes, self._hash(str(key)))
+        return self._nodes[i % len(self._nodes)]
+
+
+class Overlay(object):
+    """Object whose attributes are the given values, and the ones of obj
+    for the others.
+    """
+
+    def __init__(self, obj, **values):
+        self.__dict__.update(values)
+        self._obj = obj
+
+    def __getattr__(self, name):
+        return getattr(self._obj, name)
+
+
+def shard_conf(conf, url):
+    """Return the configuration of the shard at url."""
+    return Overlay(conf,
+                   database_connection=None,
+                   database=Overlay(conf.database, connection=url))
+
+
+def open_shards(conf, urls):
+    """Return the connections to the shards at urls, by URL."""
+    if not urls:
+        raise RuntimeError('No shard set by the shard_connections option')
+    connections = {}
+    for url in urls:
+        scheme = urlparse.urlparse(url).scheme
+        if scheme in UNSUPPORTED_SCHEMES:
+            raise RuntimeError('The %s driver can not be a shard' % scheme)
+        if url == 'sqlite://':
+            raise RuntimeError('An in-memory SQLite database can not be a '
+                               'shard')
+        # The connections are shared by URL, so each shard has a single
+        # connection, and database engine, in the process.
+        connections[url] = storage.get_connection(shard_conf(conf, url))
+    return connections
+
+
+def event_key(event):
+    """Return the key of the shard of an event."""
+    return '%s %s' % (event.event_name, event.generated)
+
+
+class _Descending(object):
+    """Wrapper sorting keys in descending order."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+def merge_samples(results, limit=None,
+                  key=base.Connection.sample_order_key):
+    """Merge the samples of the shards, each sorted by descending key."""
+    heap = []
+    for i, samples in enumerate(results):
+        samples = iter(samples)
+        for s in samples:
+            heap.append((_Descending(key(s)), i, s, samples))
+            break
+    heapq.heapify(heap)
+    count = 0
+    while heap and (limit is None or count < limit):
+        ignored, i, s, samples = heap[0]
+        yield s
+        count += 1
+        for s in samples:
+            heapq.heapreplace(heap, (_Descending(key(s)), i, s, samples))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class Connection(base.Connection):
+    """Sharded storage connection.
+    """
+
+    def __init__(self, conf):
+        urls = conf.database.shard_connections
+        self.shards = open_shards(conf, urls)
+        self.ring = HashRing(urls)
+        self.key = conf.database.shard_key
+        self.alarms = self.shards[urls[0]]
+        self.pool = eventlet.GreenPool(len(urls))
+        # The samples are merged in the order of the shards, which is the
+        # same for shards using the same driver.
+        keys = set(conn.sample_order_key for conn in self.shards.values())
+        if len(keys) == 1:
+            self.sample_order_key = keys.pop()
+
+    def _map(self, func):
+        """Call func with every shard at once, return their results."""
+        return list(self.pool.imap(func, self.shards.values()))
+
+    def upgrade(self):
+        # One shard at a time, the SQL migration scripts bind the module
+        # level metadata of their tables to the database they migrate.
+        for conn in self.shards.values():
+            conn.upgrade()
+
+    def clear(self):
+        self._map(lambda conn: conn.clear())
+
+    def record_metering_data(self, data):
+        """Write the data to the backend storage system.
+
+        :param data: a dictionary such as returned by
+                     ceilometer.meter.meter_message_from_counter
+        """
+        url = self.ring.get_node(data[self.key])
+        self.shards[url].record_metering_data(data)
+
+    def record_metering_data_batch(self, samples):
+        """Write a batch of samples to the backend storage system, one
+        batch per shard.
+
+        :param samples: a list of dictionaries such as returned by
+                        ceilometer.meter.meter_message_from_counter
+        """
+        batches = collections.defaultdict(list)
+        for data in samples:
+            batches[self.ring.get_node(data[self.key])].append(data)
+        for url, batch in batches.iteritems():
+            try:
+                self.shards[url].record_metering_data_batch(batch)
+            except Exception as err:
+                # The batches of the other shards are written anyway, and
+                # the samples of this one are retried one by one.
+                LOG.error(_('Failed to record a batch in shard %(url)s, '
+                            'recording each sample: %(err)s'),
+                          {'url': url, 'err': err})
+                base.Connection.record_metering_data_batch(
+                    self.shards[url], batch)
+
+    def clear_expired_metering_data(self, ttl):
+        """Clear expired data from the backend storage system according to
+        the time-to-live.
+
+        :param ttl: Number of seconds to keep records for.
+        """
+        self._map(lambda conn: conn.clear_expired_metering_data(ttl))
+
+    def get_users(self, source=None):
+        """Return an iterable of user id strings.
+
+        :param source: Optional source filter.
+        """
+        users = set()
+        for result in self._map(lambda conn: list(conn.get_users(source))):
+            users.update(result)
+        return sorted(users)
+
+    def get_projects(self, source=None):
+        """Return an iterable of project id strings.
+
+        :param source: Optional source filter.
+        """
+        projects = set()
+        for result in self._map(
+                lambda conn: list(conn.get_projects(source))):
+            projects.update(result)
+        return sorted(projects)
+
+    def get_resources(self, user=None, project=None, source=None,
+                      start_timestamp=None, start_timestamp_op=None,
+                      end_timestamp=None, end_timestamp_op=None,
+                      metaquery={}, resource=None):
+        """Return an iterable of models.Resource instances
+
+        A resource sampled in several shards, after it moved to another
+        project, is the one of its latest sample.
+        """
+        resources = {}
+        for result in self._map(lambda conn: list(conn.get_resources(
+                user=user, project=project, source=source,
+                start_timestamp=start_timestamp,
+                start_timestamp_op=start_timestamp_op,
+                end_timestamp=end_timestamp,
+                end_timestamp_op=end_timestamp_op,
+                metaquery=metaquery, resource=resource))):
+            for r in result:
+                other = resources.get(r.resource_id)
+                if (other is None or
+                        r.last_sample_timestamp > other.last_sample_timestamp):
+                    resources[r.resource_id] = r
+        return resources.values()
+
+    def get_meters(self, user=None, project=None, resource=None, source=None,
+                   metaquery={}):
+        """Return an iterable of models.Meter instances
+        """
+        meters = {}
+        for result in self._map(lambda conn: list(conn.get_meters(
+                user=user, project=project, resource=resource,
+                source=source, metaquery=metaquery))):
+            for m in result:
+                meters.setdefault(tuple(sorted(m.as_dict().items())), m)
+        return meters.values()
+
+    def get_samples(self, sample_filter, limit=None):
+        """Return an iterable of models.Sample instances, the latest first.
+
+        :param sample_filter: Filter.
+        :param limit: Maximum number of results to return.
+        """
+        if limit == 0:
+            return []
+        fetch_size = cfg.CONF.database.sample_fetch_size
+
+        def first_batch(conn):
+            # Only the first batch of each shard is read at once, the rest
+            # is read as the merged samples are consumed.
+            samples = iter(conn.get_samples(sample_filter, limit=limit))
+            return list(itertools.islice(samples, fetch_size)), samples
+
+        return merge_samples((itertools.chain(batch, samples)
+                              for batch, samples in self._map(first_batch)),
+                             limit, self.sample_order_key)
+
+    def get_meter_statistics(self, sample_filter, period=None):
+        """Return an iterable of models.Statistics instances, the ones of
+        the same period in several shards being merged.
+        """
+        if not sample_filter.meter:
+            raise RuntimeError('Missing required meter specifier')
+        if period and not sample_filter.start:
+            # The periods start with the first sample of any shard.
+            stats = self.get_meter_statistics(sample_filter)
+            if not stats:
+                return []
+            sample_filter = copy.copy(sample_filter)
+            sample_filter.start = stats[0].duration_start
+            sample_filter.start_timestamp_op = 'ge'
+
+        results = {}
+        for result in self._map(lambda conn: list(
+                conn.get_meter_statistics(sample_filter, period))):
+            for s in result:
+                key = s.period_start if period else None
+                if key in results:
+                    s = tiered.merge_statistics(results[key], s)
+                results[key] = s
+        return [stat for k, stat in sorted(results.iteritems())]
+
+    def get_alarms(self, name=None, user=None,
+                   project=None, enabled=True, alarm_id=None):
+        """Yields a lists of alarms that match filters
+        """
+        return self.alarms.get_alarms(name=name, user=user, project=project,
+                                      enabled=enabled, alarm_id=alarm_id)
+
+    def update_alarm(self, alarm):
+        """update alarm
+        """
+        return self.alarms.update_alarm(alarm)
+
+    def delete_alarm(self, alarm_id):
+        """Delete a alarm
+        """
+        self.alarms.delete_alarm(alarm_id)
+
+    def record_events(self, events):
+        """Write the events, each to the shard of its name and time.
+
+        :param events: a list of model.Event objects.
+        """
+        by_shard = {}
+        for event in events:
+            url = self.ring.get_node(event_key(event))
+            by_shard.setdefault(url, []).append(event)
+        for url, shard_events in by_shard.iteritems():
+            self.shards[url].record_events(shard_events)
+
+    def get_events(self, event_filter):
+        """Return an iterable of model.Event objects.
+
+        :param event_filter: EventFilter instance
+        """
+        events = []
+        for result in self._map(
+                lambda conn: list(conn.get_events(event_filter))):
+            events.extend(result)
+        return sorted(events, key=lambda e: e.generated)
+
+
+def _event_identity(event):
+    return (event.event_name, event.generated,
+            tuple(sorted((t.name, t.dtype, t.value) for t in event.traits)))
+
+
+def copy_shards(conf, sources, targets, since=None):
+    """Copy the data of the shards at the sources URLs to the ones at the
+    targets URLs, return the number of samples copied.
+
+    The samples and events are sent to the target shards selected by
+    their consistent hash, and the alarms to the first one. With since,
+    only the samples and events generated since then which are not in
+    the targets yet are copied, to catch up with the ones recorded while
+    a previous copy ran.
+    """
+    source = open_shards(conf, sources)
+    target = open_shards(conf, targets)
+    for conn in target.itervalues():
+        conn.upgrade()
+    ring = HashRing(targets)
+    key = conf.database.shard_key
+    now = timeutils.utcnow()
+    sample_filter = storage.SampleFilter(start=since)
+    event_filter = storage.EventFilter(since or EPOCH, now)
+    copied_samples = set()
+    copied_events = set()
+    if since:
+        for conn in target.itervalues():
+            copied_samples.update(
+                s.message_id for s in conn.get_samples(sample_filter))
+            copied_events.update(
+                _event_identity(e) for e in conn.get_events(event_filter))
+    count = 0
+    for url in sources:
+        LOG.info(_('Copying the data of %s'), url)
+        conn = source[url]
+        for s in conn.get_samples(sample_filter):
+            if s.message_id in copied_samples:
+                continue
+            data = s.as_dict()
+            target[ring.get_node(data[key])].record_metering_data(data)
+            count += 1
+        for event in conn.get_events(event_filter):
+            if _event_identity(event) in copied_events:
+                continue
+            target[ring.get_node(event_key(event))].record_events([event])
+    for alarm in source[sources[0]].get_alarms(enabled=None):
+        target[targets[0]].update_alarm(alarm)
+    return count
+
+
+def rebalance():
+    service.prepare_service()
+    sources = cfg.CONF.database.shard_connections
+    targets = cfg.CONF.database.rebalance_connections
+    if not targets or set(sources) & set(targets):
+        LOG.error(_('database.rebalance_connections must be set to the URLs '
+                    'of new databases, not part of shard_connections'))
+        return 1
+    since = cfg.CONF.database.rebalance_since
+    if since:
+        since = timeutils.normalize_time(timeutils.parse_isotime(since))
+    started = timeutils.utcnow()
+    count = copy_shards(cfg.CONF, sources, targets, since)
+    if since:
+        LOG.info(_('Copied %(count)d samples, shard_connections can be set '
+                   'to %(targets)s'),
+                 {'count': count, 'targets': ','.join(targets)})
+    else:
+        # The samples recorded during the copy may be missing.
+        LOG.info(_('Copied %(count)d samples. Stop the collectors and run '
+                   'again with rebalance_since set to %(since)s, or earlier '
+                   'if samples are recorded late, to copy the samples '
+                   'recorded meanwhile, then set shard_connections to '
+                   '%(targets)s'),
+                 {'count': count, 'since': timeutils.isotime(started),
+                  'targets': ','.join(targets)})
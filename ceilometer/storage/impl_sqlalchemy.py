@@ -19,27 +19,63 @@
 
 from __future__ import absolute_import
 
+import bisect
+import copy
 import datetime
+import fnmatch
+import hashlib
+import itertools
 import operator
 import os
+import time
 import uuid
+from oslo.config import cfg
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import case
+from sqlalchemy import cast
 from sqlalchemy import func
 from sqlalchemy import desc
+from sqlalchemy import exists
+from sqlalchemy import extract
+from sqlalchemy import Integer
+from sqlalchemy import literal_column
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import union
 from sqlalchemy.orm import aliased
 
+from ceilometer.openstack.common.db import exception as db_exception
+from ceilometer.openstack.common.gettextutils import _
 from ceilometer.openstack.common import log
 from ceilometer.openstack.common import timeutils
 import ceilometer.openstack.common.db.sqlalchemy.session as sqlalchemy_session
 from ceilometer.storage import base
+from ceilometer.storage import cache
 from ceilometer.storage import models as api_models
+from ceilometer.storage import rollup
 from ceilometer.storage.sqlalchemy import migration
+from ceilometer.storage.sqlalchemy import partition
+from ceilometer.storage.sqlalchemy import replica
 from ceilometer.storage.sqlalchemy.models import Alarm
 from ceilometer.storage.sqlalchemy.models import Base
 from ceilometer.storage.sqlalchemy.models import Event
+from ceilometer.storage.sqlalchemy.models import ExpirerCheckpoint
+from ceilometer.storage.sqlalchemy.models import MetaBigInt
+from ceilometer.storage.sqlalchemy.models import MetaBool
+from ceilometer.storage.sqlalchemy.models import MetaFloat
+from ceilometer.storage.sqlalchemy.models import MetaText
 from ceilometer.storage.sqlalchemy.models import Meter
+from ceilometer.storage.sqlalchemy.models import MeterDefinition
+from ceilometer.storage.sqlalchemy.models import MeterMetadata
+from ceilometer.storage.sqlalchemy.models import MeterRollup
+from ceilometer.storage.sqlalchemy.models import MeterRollupWatermark
+from ceilometer.storage.sqlalchemy.models import MeterSource
+from ceilometer.storage.sqlalchemy.models import MeterSummary
 from ceilometer.storage.sqlalchemy.models import Project
 from ceilometer.storage.sqlalchemy.models import Resource
 from ceilometer.storage.sqlalchemy.models import Source
+from ceilometer.storage.sqlalchemy.models import sourceassoc
 from ceilometer.storage.sqlalchemy.models import Trait
 from ceilometer.storage.sqlalchemy.models import UniqueName
 from ceilometer.storage.sqlalchemy.models import User
@@ -48,6 +84,28 @@ from ceilometer import utils
 
 LOG = log.getLogger(__name__)
 
+META_TYPES = (MetaText, MetaBool, MetaBigInt, MetaFloat)
+
+META_TYPE_MAP = {bool: MetaBool,
+                 str: MetaText,
+                 unicode: MetaText,
+                 int: MetaBigInt,
+                 long: MetaBigInt,
+                 float: MetaFloat}
+
+# Number of raw sample queries of a statistics request above which its
+# periods are computed by a single grouped query.
+MAX_RAW_QUERIES = 10
+
+# The last_sample_timestamp of the users, projects, resources and metadata
+# known to the dimension caches is only updated once it is this much behind,
+# it just needs to be recent enough for the expirer not to check them.
+LAST_SAMPLE_TIMESTAMP_SLACK = datetime.timedelta(minutes=10)
+
+# Number of resources whose meters are looked up by a single query, below
+# the bound parameters limit of SQLite.
+RESOURCE_BATCH_SIZE = 500
+
 
 class SQLAlchemyStorage(base.StorageEngine):
     """Put the data into a SQLAlchemy database.
@@ -55,25 +113,50 @@ class SQLAlchemyStorage(base.StorageEngine):
     Tables::
 
         - user
-          - { id: user uuid }
+          - { id: user uuid
+              last_sample_timestamp: datetime of the latest sample
+              }
         - source
           - { id: source id }
         - project
-          - { id: project uuid }
+          - { id: project uuid
+              last_sample_timestamp: datetime of the latest sample
+              }
+        - meter_definition
+          - the dictionary of the meters
+          - { id: meter definition id
+              counter_name: counter name
+              counter_type: counter type
+              counter_unit: counter unit
+              }
+        - meter_source
+          - the dictionary of the sources of the samples
+          - { id: meter source id
+              name: source id
+              }
+        - meter_metadata
+          - the distinct resource metadata of the samples
+          - { id: metadata id
+              metadata_hash: hash of the metadata
+              resource_metadata: metadata dictionaries
+              last_sample_timestamp: datetime of the latest sample
+              }
         - meter
           - the raw incoming data
           - { id: meter id
-              counter_name: counter name
+              meter_definition_id: (->meter_definition.id)
+              meter_source_id: (->meter_source.id)
               user_id: user uuid            (->user.id)
               project_id: project uuid      (->project.id)
               resource_id: resource uuid    (->resource.id)
-              resource_metadata: metadata dictionaries
-              counter_type: counter type
-              counter_unit: counter unit
+              metadata_id: (->meter_metadata.id)
               counter_volume: counter volume
               timestamp: datetime
-              message_signature: message signature
-              message_id: message uuid
+              message_signature: message signature, as 32 bytes
+              message_signature_text: message signature, when it is
+                                      not a hexadecimal digest
+              message_id: message uuid, as 16 bytes
+              message_id_text: message id, when it is not a uuid
               }
         - resource
           - the metadata for resources
@@ -81,15 +164,67 @@ class SQLAlchemyStorage(base.StorageEngine):
               resource_metadata: metadata dictionaries
               project_id: project uuid      (->project.id)
               user_id: user uuid            (->user.id)
+              last_sample_timestamp: datetime of the latest sample
               }
         - sourceassoc
           - the relationships
-          - { meter_id: meter id            (->meter.id)
-              project_id: project uuid      (->project.id)
+          - { project_id: project uuid      (->project.id)
               resource_id: resource uuid    (->resource.id)
               user_id: user uuid            (->user.id)
               source_id: source id          (->source.id)
               }
+        - metadata_text, metadata_bool, metadata_int, metadata_float
+          - the indexed resource metadata, by type of value
+          - { id: metadata id               (->meter_metadata.id)
+              meta_key: flattened metadata key, like 'image.name'
+              value: metadata value
+              }
+        - meter_rollup
+          - the aggregates of the samples, by bucket of time
+          - { id: rollup id
+              resolution: bucket size in seconds
+              bucket_start: datetime
+              rollup_key: hash of the dimensions
+              counter_name: counter name
+              resource_id: resource uuid
+              project_id: project uuid
+              user_id: user uuid
+              source_id: source id
+              counter_unit: counter unit
+              count: number of samples
+              sum: sum of the counter volumes
+              min: minimum counter volume
+              max: maximum counter volume
+              first_timestamp: datetime of the first sample
+              last_timestamp: datetime of the last sample
+              }
+        - meter_rollup_watermark
+          - { id: 1
+              timestamp: datetime from which every sample is rolled up
+              }
+        - meter_summary
+          - the first and latest samples of each meter of a resource, by
+            owner
+          - { id: summary id
+              summary_key: hash of the dimensions
+              resource_id: resource uuid
+              counter_name: counter name
+              counter_type: counter type
+              counter_unit: counter unit
+              user_id: user uuid
+              project_id: project uuid
+              source_id: source id of the first sample
+              metadata_id: metadata of the latest sample
+                           (->meter_metadata.id)
+              first_timestamp: datetime of the first sample
+              last_timestamp: datetime of the latest sample
+              last_meter_id: meter id of the latest sample
+              }
+        - expirer_checkpoint
+          - the progress of an interrupted expirer run
+          - { table_name: name of the table being expired
+              last_id: id before which the rows have been expired
+              }
     """
 
     @staticmethod
@@ -108,11 +243,16 @@ def make_query_from_filter(query, sample_filter, require_meter=True):
     """
 
     if sample_filter.meter:
-        query = query.filter(Meter.counter_name == sample_filter.meter)
+        query = query.filter(Meter.meter_definition_id.in_(
+            select([MeterDefinition.id]).where(
+                MeterDefinition.counter_name == sample_filter.meter)))
     elif require_meter:
         raise RuntimeError('Missing required meter specifier')
     if sample_filter.source:
-        query = query.filter(Meter.sources.any(id=sample_filter.source))
+        query = query.filter(
+            Meter.meter_source_id == _source_id(sample_filter.source))
+    # The time bounds are set on the timestamp column itself, so the
+    # database only reads the meter partitions they overlap.
     if sample_filter.start:
         ts_start = sample_filter.start
         if sample_filter.start_timestamp_op == 'gt':
@@ -126,18 +266,582 @@ def make_query_from_filter(query, sample_filter, require_meter=True):
         else:
             query = query.filter(Meter.timestamp < ts_end)
     if sample_filter.user:
-        query = query.filter_by(user_id=sample_filter.user)
+        query = query.filter(Meter.user_id == sample_filter.user)
     if sample_filter.project:
-        query = query.filter_by(project_id=sample_filter.project)
+        query = query.filter(Meter.project_id == sample_filter.project)
     if sample_filter.resource:
-        query = query.filter_by(resource_id=sample_filter.resource)
+        query = query.filter(Meter.resource_id == sample_filter.resource)
 
     if sample_filter.metaquery:
-        raise NotImplementedError('metaquery not implemented')
+        query = apply_metaquery_filter(query, sample_filter.metaquery,
+                                       Meter.metadata_id)
+
+    return query
+
+
+def _period_bucket(dialect, period_start, period):
+    """Return the expression of the index of the period of period seconds
+    from period_start holding a sample, for the dialect, or None if it is
+    not supported.
+    """
+    if dialect == 'mysql':
+        return func.floor(func.timestampdiff(literal_column('MICROSECOND'),
+                                             period_start, Meter.timestamp)
+                          / int(period * 1000000))
+    if dialect == 'postgresql':
+        return func.floor(extract('epoch', Meter.timestamp - period_start)
+                          / period)
+    if dialect == 'sqlite':
+        # The timestamps are stored as text, with microseconds.
+        microseconds = (
+            cast(func.strftime('%s', Meter.timestamp), Integer) * 1000000 +
+            cast(func.substr(Meter.timestamp, 21, 6), Integer))
+        origin = utils.dt_to_decimal(period_start) * 1000000
+        return (microseconds - int(origin)) / int(period * 1000000)
+    return None
+
+
+def _is_indexed_key(key):
+    return any(fnmatch.fnmatch(key, pattern)
+               for pattern in cfg.CONF.database.metadata_index_keys)
+
+
+def _flatten_metadata(metadata, prefix=''):
+    """Yield the (key, value) of the metadata, the keys of the nested
+    dictionaries being joined with dots.
+    """
+    for key, value in metadata.iteritems():
+        if isinstance(value, dict):
+            for item in _flatten_metadata(value, '%s%s.' % (prefix, key)):
+                yield item
+        else:
+            yield prefix + key, value
+
+
+def index_metadata(session, metadata_id, metadata):
+    """Record the indexed keys of a resource metadata, by type."""
+    rows = {}
+    for key, value in _flatten_metadata(metadata or {}):
+        model = META_TYPE_MAP.get(type(value))
+        if (model is None or len(key) > 255 or
+                (model is MetaText and len(value) > 255) or
+                not _is_indexed_key(key)):
+            continue
+        rows.setdefault(model, []).append(dict(id=metadata_id,
+                                               meta_key=key, value=value))
+    for model, values in rows.iteritems():
+        session.execute(model.__table__.insert(), values)
+
+
+def _metadata_candidates(value):
+    """Yield the (model, value) the metadata matching value may be stored
+    as. The API passes every value as a string, which may stand for a
+    boolean or a number.
+    """
+    model = META_TYPE_MAP.get(type(value))
+    if model is not MetaText:
+        if model is not None:
+            yield model, value
+        return
+    yield MetaText, value
+    if value.lower() in ('true', 'false'):
+        yield MetaBool, value.lower() == 'true'
+    try:
+        number = float(value)
+    except ValueError:
+        return
+    yield MetaFloat, number
+    try:
+        yield MetaBigInt, int(value)
+    except ValueError:
+        # Like "2.0", which matches an integer too.
+        if number.is_integer():
+            yield MetaBigInt, int(number)
+
+
+def apply_metaquery_filter(query, metaquery, id_column):
+    """Restrict a query to the rows whose metadata match the metaquery.
+
+    :param metaquery: Dict of the metadata values to match, on keys like
+                      'metadata.display_name'.
+    :param id_column: The column of the query holding the metadata id.
+    """
+    for field, value in metaquery.iteritems():
+        key = field[len('metadata.'):] if field.startswith('metadata.') \
+            else field
+        if not _is_indexed_key(key):
+            raise NotImplementedError('metadata key %s is not indexed' % key)
+        candidates = list(_metadata_candidates(value))
+        if not candidates:
+            raise NotImplementedError('metadata value %r is not indexed'
+                                      % value)
+        if len(candidates) == 1:
+            # Join on the index of the (key, value) pair.
+            model, typed_value = candidates[0]
+            meta = aliased(model)
+            query = query.join(meta, and_(meta.id == id_column,
+                                          meta.meta_key == key,
+                                          meta.value == typed_value))
+        else:
+            query = query.filter(id_column.in_(union(*[
+                select([model.id]).where(and_(model.meta_key == key,
+                                              model.value == typed_value))
+                for model, typed_value in candidates])))
+    return query
+
+
+def _source_id(source):
+    """Return the subquery of the id of a source in the dictionary."""
+    return select([MeterSource.id]).where(
+        MeterSource.name == source).as_scalar()
+
+
+def make_rollup_query_from_filter(query, sample_filter):
+    """Return a query on the rollups matching the dimensions of the filter.
+
+    :param sample_filter: SampleFilter instance, which must have a meter.
+    """
+    query = query.filter(MeterRollup.counter_name == sample_filter.meter)
+    if sample_filter.source:
+        query = query.filter(MeterRollup.source_id == sample_filter.source)
+    if sample_filter.user:
+        query = query.filter(MeterRollup.user_id == sample_filter.user)
+    if sample_filter.project:
+        query = query.filter(MeterRollup.project_id == sample_filter.project)
+    if sample_filter.resource:
+        query = query.filter(MeterRollup.resource_id ==
+                             sample_filter.resource)
+    return query
+
+
+def _update_rollups(session, samples):
+    """Add samples to the rollups of every resolution.
+
+    The samples are aggregated by bucket first, then the existing rollups
+    are updated and the missing ones inserted by one statement each, so
+    the cost does not grow with the number of samples of a batch.
+    """
+    buckets = {}
+    for data in samples:
+        key = rollup.make_key(data['counter_name'], data['resource_id'],
+                              data['project_id'], data['user_id'],
+                              data['source'])
+        volume = data['counter_volume']
+        timestamp = data['timestamp']
+        for resolution in rollup.RESOLUTIONS:
+            bucket_start = rollup.floor(timestamp, resolution)
+            bucket = buckets.get((resolution, bucket_start, key))
+            if bucket is None:
+                buckets[resolution, bucket_start, key] = dict(
+                    resolution=resolution,
+                    bucket_start=bucket_start,
+                    rollup_key=key,
+                    counter_name=data['counter_name'],
+                    resource_id=data['resource_id'],
+                    project_id=data['project_id'],
+                    user_id=data['user_id'],
+                    source_id=data['source'],
+                    counter_unit=data['counter_unit'],
+                    count=1,
+                    sum=volume,
+                    min=volume,
+                    max=volume,
+                    first_timestamp=timestamp,
+                    last_timestamp=timestamp)
+            else:
+                bucket['count'] += 1
+                bucket['sum'] += volume
+                bucket['min'] = min(bucket['min'], volume)
+                bucket['max'] = max(bucket['max'], volume)
+                bucket['first_timestamp'] = min(bucket['first_timestamp'],
+                                                timestamp)
+                bucket['last_timestamp'] = max(bucket['last_timestamp'],
+                                               timestamp)
+
+    existing = set(session.query(
+        MeterRollup.resolution,
+        MeterRollup.bucket_start,
+        MeterRollup.rollup_key,
+    ).filter(
+        MeterRollup.rollup_key.in_(set(b[2] for b in buckets)),
+        MeterRollup.bucket_start.in_(set(b[1] for b in buckets)),
+    ).all())
+    table = MeterRollup.__table__
+    updates = [dict(('b_' + name, value) for name, value in bucket.items())
+               for b, bucket in buckets.iteritems() if b in existing]
+    if updates:
+        def bound(column):
+            return bindparam('b_' + column.name, type_=column.type)
+
+        c = table.c
+        # Update the aggregates in the database, so concurrent collectors
+        # do not lose each other's samples.
+        session.execute(table.update().where(and_(
+            c.resolution == bound(c.resolution),
+            c.bucket_start == bound(c.bucket_start),
+            c.rollup_key == bound(c.rollup_key),
+        )).values(
+            count=c.count + bound(c.count),
+            sum=c.sum + bound(c.sum),
+            min=case([(c.min > bound(c.min), bound(c.min))], else_=c.min),
+            max=case([(c.max < bound(c.max), bound(c.max))], else_=c.max),
+            first_timestamp=case(
+                [(c.first_timestamp > bound(c.first_timestamp),
+                  bound(c.first_timestamp))],
+                else_=c.first_timestamp),
+            last_timestamp=case(
+                [(c.last_timestamp < bound(c.last_timestamp),
+                  bound(c.last_timestamp))],
+                else_=c.last_timestamp),
+        ), updates)
+    inserts = [bucket for b, bucket in buckets.iteritems()
+               if b not in existing]
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+def make_summary_key(resource_id, counter_name, counter_type, counter_unit,
+                     user_id, project_id):
+    """Return the hash identifying the summary of a meter of a resource
+    for an owner.
+    """
+    return hashlib.sha1('\0'.join(
+        (v or '').encode('utf-8')
+        for v in (resource_id, counter_name, counter_type, counter_unit,
+                  user_id, project_id)
+    )).hexdigest()
 
+
+def make_summary_query(query, user, project, resource, source):
+    """Return a query on the meter summaries matching the filters.
+
+    :param user: Optional ID of the user owning the samples.
+    :param project: Optional ID of the project owning the samples.
+    :param resource: Optional ID of the resource.
+    :param source: Optional source of any sample of the resource.
+    """
+    if user is not None:
+        query = query.filter(MeterSummary.user_id == user)
+    if project is not None:
+        query = query.filter(MeterSummary.project_id == project)
+    if resource is not None:
+        query = query.filter(MeterSummary.resource_id == resource)
+    if source is not None:
+        query = query.filter(MeterSummary.resource_id.in_(
+            select([sourceassoc.c.resource_id]).where(
+                sourceassoc.c.source_id == source)))
     return query
 
 
+def _update_meter_summaries(session, samples):
+    """Add samples to the summaries of their meter and owner.
+
+    Like the rollups, the summaries are updated by one statement and the
+    missing ones inserted by another one per batch.
+
+    :param samples: a list of (data, meter_id, metadata_id) tuples, the
+                    sample and the ids of its meter and meter_metadata rows.
+    """
+    summaries = {}
+    for data, meter_id, metadata_id in samples:
+        timestamp = data['timestamp']
+        user_id = data['user_id'] and str(data['user_id'])
+        project_id = data['project_id'] and str(data['project_id'])
+        key = make_summary_key(str(data['resource_id']),
+                               data['counter_name'], data['counter_type'],
+                               data['counter_unit'], user_id, project_id)
+        summary = summaries.get(key)
+        if summary is None:
+            summaries[key] = dict(
+                summary_key=key,
+                resource_id=str(data['resource_id']),
+                counter_name=data['counter_name'],
+                counter_type=data['counter_type'],
+                counter_unit=data['counter_unit'],
+                user_id=user_id,
+                project_id=project_id,
+                source_id=data['source'],
+                metadata_id=metadata_id,
+                first_timestamp=timestamp,
+                last_timestamp=timestamp,
+                last_meter_id=meter_id,
+            )
+            continue
+        summary['first_timestamp'] = min(summary['first_timestamp'],
+                                         timestamp)
+        # The samples are recorded in order, a later one sharing the
+        # timestamp of the latest one replaces it.
+        if timestamp >= summary['last_timestamp']:
+            summary.update(metadata_id=metadata_id,
+                           last_timestamp=timestamp,
+                           last_meter_id=meter_id)
+
+    existing = set(row[0] for row in session.query(
+        MeterSummary.summary_key,
+    ).filter(MeterSummary.summary_key.in_(summaries.keys())).all())
+    table = MeterSummary.__table__
+    updates = [dict(('b_' + name, summary[name])
+                    for name in ('summary_key', 'metadata_id',
+                                 'first_timestamp', 'last_timestamp',
+                                 'last_meter_id'))
+               for key, summary in summaries.iteritems() if key in existing]
+    if updates:
+        c = table.c
+
+        def bound(column):
+            return bindparam('b_' + column.name, type_=column.type)
+
+        def if_latest(column):
+            # The sample is compared to the summary in the database, so
+            # the latest of concurrently recorded samples wins.
+            return case([(c.last_timestamp <= bound(c.last_timestamp),
+                          bound(column))], else_=column)
+
+        session.execute(table.update().where(
+            c.summary_key == bound(c.summary_key),
+        ).values(
+            metadata_id=if_latest(c.metadata_id),
+            last_meter_id=if_latest(c.last_meter_id),
+            last_timestamp=if_latest(c.last_timestamp),
+            first_timestamp=case(
+                [(c.first_timestamp > bound(c.first_timestamp),
+                  bound(c.first_timestamp))],
+                else_=c.first_timestamp),
+        ), updates)
+    inserts = [summary for key, summary in summaries.iteritems()
+               if key not in existing]
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+def _message_column(name, value):
+    """Return the name of the Meter column holding a message id or
+    signature: the packed one when the value has its canonical form, the
+    text one otherwise.
+    """
+    if Meter.__table__.c[name].type.is_canonical(value):
+        return name
+    return name + '_text'
+
+
+def make_marker_query(query, sample_filter):
+    """Restrict a query on the samples to the ones after the marker of the
+    filter, in the order of Connection.sample_order_key().
+
+    The condition does not depend on the marker sample itself, so it
+    applies to the databases not holding it, like the other shards.
+
+    :param sample_filter: SampleFilter instance with a marker_timestamp.
+    """
+    ts = sample_filter.marker_timestamp
+    after = Meter.timestamp < ts
+    message_id = sample_filter.marker_message_id
+    if message_id:
+        if _message_column('message_id', message_id) == 'message_id':
+            # The packed message ids come first, then the text ones.
+            tie = or_(Meter.message_id < message_id,
+                      Meter.message_id_text.isnot(None))
+        else:
+            tie = Meter.message_id_text < message_id
+        after = or_(after, and_(Meter.timestamp == ts, tie))
+    return query.filter(after)
+
+
+def _update_last_sample_timestamp(row, timestamp):
+    """Keep the timestamp of the most recent sample of a user, project or
+    resource, so the expirer can find them when their samples are gone.
+    """
+    if row.last_sample_timestamp is None or \
+            row.last_sample_timestamp < timestamp:
+        row.last_sample_timestamp = timestamp
+
+
+def _process_by_id_range(session, model, condition, batch_size, delay,
+                         process, name=None):
+    """Process the rows of model matching condition, batch_size ids at a
+    time, so no statement locks a large part of the table.
+
+    The progress is saved in the expirer_checkpoint table with each batch,
+    so an interrupted run resumes where it stopped. The rows before the
+    checkpoint matching condition only because it changed since then are
+    left for the next run.
+
+    :param process: Function called in the transaction of each batch with
+                    the session and the condition selecting the rows of
+                    the batch, returning the number of rows processed.
+    :param name: Name of the checkpoint, the name of the table by default.
+    :return: The number of rows processed.
+    """
+    name = name or model.__tablename__
+    checkpoint = session.query(ExpirerCheckpoint).get(name)
+    if checkpoint is not None:
+        LOG.info(_('Resuming the expiration of %(table)s from id %(id)d'),
+                 {'table': name, 'id': checkpoint.last_id})
+        low = checkpoint.last_id
+    else:
+        low = session.query(func.min(model.id)).scalar()
+    # Stop after the last row to delete rather than go through the whole
+    # table, the condition should be served by an index.
+    last = session.query(func.max(model.id)).filter(condition).scalar()
+    processed = 0
+    while low is not None and last is not None and low <= last:
+        high = low + batch_size
+        in_batch = and_(model.id >= low, model.id < high, condition)
+        with session.begin():
+            processed += process(session, in_batch)
+            session.merge(ExpirerCheckpoint(table_name=name, last_id=high))
+        # Jump over the ids that have already been deleted.
+        low = session.query(func.min(model.id)).filter(
+            model.id >= high).scalar()
+        if delay and low is not None and low <= last:
+            time.sleep(delay)
+    with session.begin():
+        session.query(ExpirerCheckpoint).filter(
+            ExpirerCheckpoint.table_name == name).delete()
+    return processed
+
+
+def _delete_by_id_range(session, model, condition, batch_size, delay,
+                        before_delete=None):
+    """Delete the rows of model matching condition, batch_size ids at a
+    time, see _process_by_id_range().
+
+    :param before_delete: Optional function called with the session and
+                          the condition selecting the rows of a batch,
+                          before they are deleted.
+    :return: The number of rows deleted.
+    """
+    def delete(session, in_batch):
+        if before_delete is not None:
+            before_delete(session, in_batch)
+        return session.query(model).filter(in_batch).delete(
+            synchronize_session=False)
+    return _process_by_id_range(session, model, condition, batch_size,
+                                delay, delete)
+
+
+def _delete_orphans(session, model, references, end, batch_size, delay,
+                    before_delete=None):
+    """Delete the rows of model having no sample left, batch_size at a time.
+
+    Only the rows whose most recent sample is before end, or unknown, are
+    checked for remaining references, in the order of their ids.
+
+    :param references: The columns referencing model.
+    :param before_delete: Optional function called with the session and
+                          the ids of the rows of a batch, before they are
+                          deleted.
+    """
+    condition = or_(model.last_sample_timestamp < end,
+                    model.last_sample_timestamp.is_(None))
+    for reference in references:
+        condition = and_(condition, ~exists().where(reference == model.id))
+    deleted = 0
+    marker = None
+    while True:
+        query = session.query(model.id).filter(condition)
+        if marker is not None:
+            query = query.filter(model.id > marker)
+        ids = [row[0] for row in
+               query.order_by(model.id).limit(batch_size).all()]
+        if not ids:
+            break
+        marker = ids[-1]
+        with session.begin():
+            # Check the condition again, a sample may have been recorded
+            # since.
+            ids = [row[0] for row in session.query(model.id).filter(
+                model.id.in_(ids), condition).all()]
+            if ids:
+                if before_delete is not None:
+                    before_delete(session, ids)
+                deleted += session.query(model).filter(
+                    model.id.in_(ids)).delete(synchronize_session=False)
+        if delay:
+            time.sleep(delay)
+    return deleted
+
+
+def _delete_metadata_index(session, ids):
+    for model in META_TYPES:
+        session.query(model).filter(model.id.in_(ids)).delete(
+            synchronize_session=False)
+
+
+def _dimension_keys(data):
+    """Return the dimension cache keys of the source, user, project and
+    resource rows of a sample, None for the missing ones.
+
+    The keys of the users, projects and resources include the source, so
+    the new associations to a source are not missed.
+    """
+    source = data['source']
+    user_id = data['user_id'] and str(data['user_id'])
+    project_id = data['project_id'] and str(data['project_id'])
+    return (source and ('source', source),
+            user_id and ('user', user_id, source),
+            project_id and ('project', project_id, source),
+            ('resource', str(data['resource_id']), source))
+
+
+def _add_source(row, source):
+    if source is not None and source not in row.sources:
+        row.sources.append(source)
+
+
+def _record_dimensions(session, data):
+    """Create or update the source, user, project and resource rows of a
+    sample, return their dimension cache entries.
+    """
+    timestamp = data['timestamp']
+    if data['source']:
+        source = session.query(Source).get(data['source'])
+        if not source:
+            source = Source(id=data['source'])
+            session.add(source)
+    else:
+        source = None
+
+    # create/update user && project, add/update their sources list
+    if data['user_id']:
+        user = session.merge(User(id=str(data['user_id'])))
+        _add_source(user, source)
+        _update_last_sample_timestamp(user, timestamp)
+    else:
+        user = None
+
+    if data['project_id']:
+        project = session.merge(Project(id=str(data['project_id'])))
+        _add_source(project, source)
+        _update_last_sample_timestamp(project, timestamp)
+    else:
+        project = None
+
+    # Record the updated resource metadata
+    rmetadata = data['resource_metadata']
+
+    resource = session.merge(Resource(id=str(data['resource_id'])))
+    _add_source(resource, source)
+    resource.project = project
+    resource.user = user
+    _update_last_sample_timestamp(resource, timestamp)
+    # Current metadata being used and when it was last updated.
+    resource.resource_metadata = rmetadata
+
+    keys = _dimension_keys(data)
+    known = {}
+    if source is not None:
+        known[keys[0]] = True
+    if user is not None:
+        known[keys[1]] = user.last_sample_timestamp
+    if project is not None:
+        known[keys[2]] = project.last_sample_timestamp
+    known[keys[3]] = (user and user.id, project and project.id,
+                      base.hash_metadata(rmetadata),
+                      resource.last_sample_timestamp)
+    return known
+
+
 class Connection(base.Connection):
     """SqlAlchemy connection."""
 
@@ -146,131 +850,360 @@ class Connection(base.Connection):
         if url == 'sqlite://':
             conf.database.connection = \
                 os.environ.get('CEILOMETER_TEST_SQL_URL', url)
+        self._reset_dimensions()
+        self.replica = None
+        self._maker = None
+        if conf.database.connection != cfg.CONF.database.connection:
+            # Another database than the one of the [database] options, like
+            # a shard of the sharded driver, has its own engine. There is
+            # one Connection per database URL in the process.
+            engine = sqlalchemy_session.create_engine(
+                conf.database.connection)
+            self._maker = sqlalchemy_session.get_maker(engine)
+        elif conf.database.slave_connection:
+            self.replica = replica.Replica(conf.database.slave_max_lag)
+
+    def _session(self):
+        """Return a session on the database of the connection."""
+        if self._maker is not None:
+            return self._maker()
+        return sqlalchemy_session.get_session()
+
+    def _read_session(self):
+        """Return a session on the replica if it is usable, on the
+        primary database otherwise.
+        """
+        if self.replica is not None and self.replica.is_usable():
+            return sqlalchemy_session.get_session(slave_session=True)
+        return self._session()
 
     def upgrade(self):
-        session = sqlalchemy_session.get_session()
+        session = self._session()
         migration.db_sync(session.get_bind())
+        partitioner = partition.get_partitioner(
+            session.get_bind(), cfg.CONF.database.meter_partition_period)
+        if partitioner is not None:
+            partitioner.setup(timeutils.utcnow())
 
     def clear(self):
-        session = sqlalchemy_session.get_session()
+        session = self._session()
         engine = session.get_bind()
         for table in reversed(Base.metadata.sorted_tables):
             engine.execute(table.delete())
+        self._reset_dimensions()
 
-    @staticmethod
-    def record_metering_data(data):
+    def record_metering_data(self, data):
         """Write the data to the backend storage system.
 
         :param data: a dictionary such as returned by
                      ceilometer.meter.meter_message_from_counter
         """
-        session = sqlalchemy_session.get_session()
-        with session.begin():
-            if data['source']:
-                source = session.query(Source).get(data['source'])
-                if not source:
-                    source = Source(id=data['source'])
-                    session.add(source)
-            else:
-                source = None
+        self._record_samples([data])
 
-            # create/update user && project, add/update their sources list
-            if data['user_id']:
-                user = session.merge(User(id=str(data['user_id'])))
-                if not filter(lambda x: x.id == source.id, user.sources):
-                    user.sources.append(source)
-            else:
-                user = None
+    def record_metering_data_batch(self, samples):
+        """Write a batch of samples to the backend storage system.
 
-            if data['project_id']:
-                project = session.merge(Project(id=str(data['project_id'])))
-                if not filter(lambda x: x.id == source.id, project.sources):
-                    project.sources.append(source)
-            else:
-                project = None
-
-            # Record the updated resource metadata
-            rmetadata = data['resource_metadata']
-
-            resource = session.merge(Resource(id=str(data['resource_id'])))
-            if not filter(lambda x: x.id == source.id, resource.sources):
-                resource.sources.append(source)
-            resource.project = project
-            resource.user = user
-            # Current metadata being used and when it was last updated.
-            resource.resource_metadata = rmetadata
-
-            # Record the raw data for the meter.
-            meter = Meter(counter_type=data['counter_type'],
-                          counter_unit=data['counter_unit'],
-                          counter_name=data['counter_name'], resource=resource)
-            session.add(meter)
-            if not filter(lambda x: x.id == source.id, meter.sources):
-                meter.sources.append(source)
-            meter.project = project
-            meter.user = user
-            meter.timestamp = data['timestamp']
-            meter.resource_metadata = rmetadata
-            meter.counter_volume = data['counter_volume']
-            meter.message_signature = data['message_signature']
-            meter.message_id = data['message_id']
-            session.flush()
+        The samples are written in one transaction, updating each rollup
+        and meter summary once. If the batch fails, its samples are
+        written one by one.
 
-    @staticmethod
-    def clear_expired_metering_data(ttl):
+        :param samples: a list of dictionaries such as returned by
+                        ceilometer.meter.meter_message_from_counter
+        """
+        if not samples:
+            return
+        try:
+            self._record_samples(samples)
+        except Exception as err:
+            LOG.warning(_('Failed to record a batch of %(count)d samples, '
+                          'recording them one by one: %(err)s'),
+                        {'count': len(samples), 'err': err})
+            super(Connection, self).record_metering_data_batch(samples)
+
+    def _record_samples(self, samples):
+        try:
+            self._record_metering_data(samples)
+        except db_exception.DBDuplicateEntry:
+            # Another collector created one of the dictionary entries, the
+            # rollups or the meter summaries of the samples first, this
+            # time they are going to be found.
+            self._record_metering_data(samples)
+        except db_exception.DBError:
+            # A row known to the dimension caches may have been deleted by
+            # the expirer, look them up again.
+            self._reset_dimensions()
+            self._record_metering_data(samples)
+
+    def _reset_dimensions(self):
+        self.dimensions = cache.MemoryCache(
+            cfg.CONF.database.dimension_cache_size)
+
+    def _get_known(self, known, key):
+        """Return the dimension cache entry of key, the entries set in
+        known by the transaction in progress first.
+        """
+        if key in known:
+            return known[key]
+        return self.dimensions.get(key)
+
+    def _record_metering_data(self, samples):
+        session = self._session()
+        known = {}
+        recorded = []
+        with session.begin():
+            for data in samples:
+                if not self._update_dimensions(session, known, data):
+                    known.update(_record_dimensions(session, data))
+                    session.flush()
+
+                definition_id = self._get_dictionary_id(
+                    session, known, MeterDefinition,
+                    counter_name=data['counter_name'],
+                    counter_type=data['counter_type'],
+                    counter_unit=data['counter_unit'])
+                source_id = data['source'] and self._get_dictionary_id(
+                    session, known, MeterSource, name=data['source'])
+                metadata_id = self._get_metadata_id(session, known, data)
+
+                # Record the raw data for the meter.
+                values = dict((_message_column(name, data[name]),
+                               data[name])
+                              for name in ('message_id', 'message_signature'))
+                result = session.execute(Meter.__table__.insert(), dict(
+                    values,
+                    meter_definition_id=definition_id,
+                    meter_source_id=source_id,
+                    resource_id=str(data['resource_id']),
+                    project_id=data['project_id'] and
+                    str(data['project_id']),
+                    user_id=data['user_id'] and str(data['user_id']),
+                    timestamp=data['timestamp'],
+                    metadata_id=metadata_id,
+                    counter_volume=data['counter_volume'],
+                ))
+                recorded.append((data, result.inserted_primary_key[0],
+                                 metadata_id))
+            _update_rollups(session, samples)
+            _update_meter_summaries(session, recorded)
+        # Only remember the rows once they are committed.
+        for key, value in known.iteritems():
+            self.dimensions.set(key, value)
+
+    def _get_dictionary_id(self, session, known, model, **values):
+        """Return the id of the row of the model dictionary holding values,
+        adding it if needed, and set its dimension cache entry in known.
+        """
+        key = (model.__tablename__,) + tuple(sorted(values.iteritems()))
+        row_id = self._get_known(known, key)
+        if row_id is None:
+            row_id = session.query(model.id).filter_by(**values).scalar()
+        if row_id is None:
+            row_id = session.execute(model.__table__.insert(),
+                                     values).inserted_primary_key[0]
+        known[key] = row_id
+        return row_id
+
+    def _get_metadata_id(self, session, known, data):
+        """Return the id of the meter_metadata row of the resource metadata
+        of a sample, adding and indexing it if needed, and set its
+        dimension cache entry in known.
+
+        The samples sharing a metadata only write it once, its row keeping
+        the timestamp of their latest one for the expirer.
+        """
+        metadata = data['resource_metadata']
+        timestamp = data['timestamp']
+        key = ('metadata', base.hash_metadata(metadata))
+        cached = self._get_known(known, key)
+        if cached is None:
+            cached = session.query(
+                MeterMetadata.id,
+                MeterMetadata.last_sample_timestamp,
+            ).filter(MeterMetadata.metadata_hash == key[1]).first()
+        if cached is None:
+            result = session.execute(MeterMetadata.__table__.insert(), dict(
+                metadata_hash=key[1],
+                resource_metadata=metadata,
+                last_sample_timestamp=timestamp,
+            ))
+            cached = (result.inserted_primary_key[0], timestamp)
+            index_metadata(session, cached[0], metadata)
+        metadata_id, last = cached
+        if last is None or \
+                timestamp > last + LAST_SAMPLE_TIMESTAMP_SLACK:
+            session.query(MeterMetadata).filter(
+                MeterMetadata.id == metadata_id,
+                or_(MeterMetadata.last_sample_timestamp < timestamp,
+                    MeterMetadata.last_sample_timestamp.is_(None)),
+            ).update({MeterMetadata.last_sample_timestamp: timestamp},
+                     synchronize_session=False)
+            last = timestamp
+        known[key] = (metadata_id, last)
+        return metadata_id
+
+    def _update_dimensions(self, session, known, data):
+        """Update the source, user, project and resource rows of a sample
+        from what the dimension caches know of them, only writing the
+        changes.
+
+        Set the new cache entries in known and return True, or return
+        False if a row is not cached.
+        """
+        keys = _dimension_keys(data)
+        entries = dict((key, self._get_known(known, key))
+                       for key in keys if key is not None)
+        if None in entries.values():
+            return False
+
+        timestamp = data['timestamp']
+        for model, key in ((User, keys[1]), (Project, keys[2])):
+            if key is not None and \
+                    timestamp > entries[key] + LAST_SAMPLE_TIMESTAMP_SLACK:
+                session.query(model).filter(
+                    model.id == key[1],
+                    or_(model.last_sample_timestamp < timestamp,
+                        model.last_sample_timestamp.is_(None)),
+                ).update({model.last_sample_timestamp: timestamp},
+                         synchronize_session=False)
+                entries[key] = timestamp
+
+        key = keys[3]
+        state = (keys[1] and keys[1][1], keys[2] and keys[2][1],
+                 base.hash_metadata(data['resource_metadata']))
+        last = entries[key][3]
+        values = {}
+        if state != entries[key][:3]:
+            values = {Resource.user_id: state[0],
+                      Resource.project_id: state[1],
+                      Resource.resource_metadata: data['resource_metadata']}
+        if timestamp > last + LAST_SAMPLE_TIMESTAMP_SLACK or \
+                values and timestamp > last:
+            values[Resource.last_sample_timestamp] = timestamp
+            last = timestamp
+        if values:
+            session.query(Resource).filter(Resource.id == key[1]).update(
+                values, synchronize_session=False)
+        entries[key] = state + (last,)
+        known.update(entries)
+        return True
+
+    def clear_expired_metering_data(self, ttl):
         """Clear expired data from the backend storage system according to the
         time-to-live.
 
+        The rows are deleted by batches of ids, see
+        [database]expirer_batch_size and expirer_batch_delay. If the meter
+        table is partitioned, see [database]meter_partition_period, the
+        partitions holding only expired samples are dropped first.
+
         :param ttl: Number of seconds to keep records for.
 
         """
-        session = sqlalchemy_session.get_session()
-        query = session.query(Meter.id)
-        end = timeutils.utcnow() - datetime.timedelta(seconds=ttl)
-        query = query.filter(Meter.timestamp < end)
-        query.delete()
-
-        query = session.query(User.id).filter(~User.id.in_(
-            session.query(Meter.user_id).group_by(Meter.user_id)
-        ))
-        query.delete(synchronize_session='fetch')
-
-        query = session.query(Project.id).filter(~Project.id.in_(
-            session.query(Meter.project_id).group_by(Meter.project_id)
-        ))
-        query.delete(synchronize_session='fetch')
-
-        query = session.query(Resource.id).filter(~Resource.id.in_(
-            session.query(Meter.resource_id).group_by(Meter.resource_id)
-        ))
-        query.delete(synchronize_session='fetch')
-
-    @staticmethod
-    def get_users(source=None):
+        batch_size = cfg.CONF.database.expirer_batch_size
+        delay = cfg.CONF.database.expirer_batch_delay
+        session = self._session()
+        now = timeutils.utcnow()
+        end = now - datetime.timedelta(seconds=ttl)
+
+        partitioner = partition.get_partitioner(
+            session.get_bind(), cfg.CONF.database.meter_partition_period)
+        if partitioner is not None:
+            partitioner.drop_before(end)
+            partitioner.extend(now)
+
+        # Without partitions, or in the partition holding end, the samples
+        # are deleted by rows.
+        deleted = _delete_by_id_range(session, Meter, Meter.timestamp < end,
+                                      batch_size, delay)
+        LOG.info(_('%d samples expired'), deleted)
+
+        # The rollups of the buckets holding expired samples do not match
+        # the raw data anymore, so stop using them.
+        watermark = rollup.ceil(end, rollup.RESOLUTIONS[0])
+        with session.begin():
+            row = session.query(MeterRollupWatermark).get(1)
+            if row is None:
+                session.add(MeterRollupWatermark(id=1, timestamp=watermark))
+            elif row.timestamp < watermark:
+                row.timestamp = watermark
+        _delete_by_id_range(session, MeterRollup,
+                            MeterRollup.bucket_start < watermark,
+                            batch_size, delay)
+
+        # The meters whose latest sample expired are gone. The others
+        # whose first sample expired, and only them, start later now.
+        _delete_by_id_range(session, MeterSummary,
+                            MeterSummary.last_timestamp < end,
+                            batch_size, delay)
+        first_timestamp = select([func.min(Meter.timestamp)]).where(and_(
+            Meter.resource_id == MeterSummary.resource_id,
+            Meter.meter_definition_id == MeterDefinition.id,
+            MeterDefinition.counter_name == MeterSummary.counter_name,
+            MeterDefinition.counter_type == MeterSummary.counter_type,
+            MeterDefinition.counter_unit == MeterSummary.counter_unit,
+            func.coalesce(Meter.user_id, '') ==
+            func.coalesce(MeterSummary.user_id, ''),
+            func.coalesce(Meter.project_id, '') ==
+            func.coalesce(MeterSummary.project_id, ''),
+        )).as_scalar()
+
+        def update_first_timestamp(session, in_batch):
+            return session.query(MeterSummary).filter(in_batch).update(
+                {MeterSummary.first_timestamp: first_timestamp},
+                synchronize_session=False)
+        _process_by_id_range(session, MeterSummary,
+                             MeterSummary.first_timestamp < end,
+                             batch_size, delay, update_first_timestamp,
+                             name='meter_summary.first_timestamp')
+
+        # The resources reference the users and projects, so they go first.
+        for model, column in ((Resource, 'resource_id'),
+                              (User, 'user_id'),
+                              (Project, 'project_id')):
+            references = [getattr(Meter, column)]
+            if model is not Resource:
+                references.append(getattr(Resource, column))
+
+            def delete_associations(session, ids, column=column):
+                session.execute(sourceassoc.delete().where(
+                    sourceassoc.c[column].in_(ids)))
+            deleted = _delete_orphans(session, model, references, end,
+                                      batch_size, delay,
+                                      before_delete=delete_associations)
+            LOG.info(_('%(count)d expired rows deleted from %(table)s'),
+                     {'count': deleted, 'table': model.__tablename__})
+        deleted = _delete_orphans(session, MeterMetadata,
+                                  [Meter.metadata_id,
+                                   MeterSummary.metadata_id],
+                                  end, batch_size, delay,
+                                  before_delete=_delete_metadata_index)
+        LOG.info(_('%(count)d expired rows deleted from %(table)s'),
+                 {'count': deleted, 'table': MeterMetadata.__tablename__})
+        self._reset_dimensions()
+
+    def get_users(self, source=None):
         """Return an iterable of user id strings.
 
         :param source: Optional source filter.
         """
-        session = sqlalchemy_session.get_session()
+        session = self._read_session()
         query = session.query(User.id)
         if source is not None:
             query = query.filter(User.sources.any(id=source))
         return (x[0] for x in query.all())
 
-    @staticmethod
-    def get_projects(source=None):
+    def get_projects(self, source=None):
         """Return an iterable of project id strings.
 
         :param source: Optional source filter.
         """
-        session = sqlalchemy_session.get_session()
+        session = self._read_session()
         query = session.query(Project.id)
         if source:
             query = query.filter(Project.sources.any(id=source))
         return (x[0] for x in query.all())
 
-    @staticmethod
-    def get_resources(user=None, project=None, source=None,
+    def get_resources(self, user=None, project=None, source=None,
                       start_timestamp=None, start_timestamp_op=None,
                       end_timestamp=None, end_timestamp_op=None,
                       metaquery={}, resource=None):
@@ -286,16 +1219,75 @@ class Connection(base.Connection):
         :param metaquery: Optional dict with metadata to match on.
         :param resource: Optional resource filter.
         """
-        session = sqlalchemy_session.get_session()
+        if start_timestamp or end_timestamp or metaquery:
+            return self._get_resources_from_samples(
+                user, project, source, start_timestamp, start_timestamp_op,
+                end_timestamp, end_timestamp_op, metaquery, resource)
+        return self._get_resources_from_summary(user, project, source,
+                                                resource)
+
+    def _get_resources_from_summary(self, user, project, source, resource):
+        """Return the resources from the summaries of their meters."""
+        session = self._read_session()
+        query = session.query(
+            MeterSummary,
+            MeterMetadata,
+        ).outerjoin(MeterMetadata,
+                    MeterMetadata.id == MeterSummary.metadata_id)
+        query = make_summary_query(query, user, project, resource, source)
+        query = query.order_by(MeterSummary.resource_id)
+        for resource_id, rows in itertools.groupby(
+                query.all(), lambda row: row[0].resource_id):
+            rows = list(rows)
+            summaries = [summary for summary, metadata in rows]
+            latest, metadata = max(rows, key=lambda row: (
+                row[0].last_timestamp, row[0].last_meter_id))
+            metadata = metadata and metadata.resource_metadata
+            yield api_models.Resource(
+                resource_id=resource_id,
+                project_id=latest.project_id,
+                first_sample_timestamp=min(s.first_timestamp
+                                           for s in summaries),
+                last_sample_timestamp=latest.last_timestamp,
+                source=source or latest.source_id,
+                user_id=latest.user_id,
+                metadata=metadata,
+                meter=[
+                    api_models.ResourceMeter(
+                        counter_name=name,
+                        counter_type=type,
+                        counter_unit=unit,
+                    )
+                    # The meters of several owners are listed once.
+                    for name, type, unit in sorted(set(
+                        (s.counter_name, s.counter_type, s.counter_unit)
+                        for s in summaries))
+                ],
+            )
+
+    def _get_resources_from_samples(self, user, project, source,
+                                    start_timestamp, start_timestamp_op,
+                                    end_timestamp, end_timestamp_op,
+                                    metaquery, resource):
+        """Return the resources having samples in a time range or
+        matching a metadata query.
+        """
+        session = self._read_session()
         query = session.query(
             Meter,
             func.min(Meter.timestamp),
             func.max(Meter.timestamp),
+            MeterSource.name,
+            MeterMetadata,
+        ).outerjoin(
+            MeterSource, MeterSource.id == Meter.meter_source_id,
+        ).outerjoin(
+            MeterMetadata, MeterMetadata.id == Meter.metadata_id,
         ).group_by(Meter.resource_id)
         if user is not None:
             query = query.filter(Meter.user_id == user)
         if source is not None:
-            query = query.filter(Meter.sources.any(id=source))
+            query = query.filter(Meter.meter_source_id == _source_id(source))
         if start_timestamp:
             if start_timestamp_op == 'gt':
                 query = query.filter(Meter.timestamp > start_timestamp)
@@ -311,29 +1303,46 @@ class Connection(base.Connection):
         if resource is not None:
             query = query.filter(Meter.resource_id == resource)
         if metaquery:
-            raise NotImplementedError('metaquery not implemented')
+            query = apply_metaquery_filter(query, metaquery,
+                                           Meter.metadata_id)
 
-        for meter, first_ts, last_ts in query.all():
+        results = query.all()
+        meters = self._get_resource_meters(
+            session, [r[0].resource_id for r in results])
+        for meter, first_ts, last_ts, source_name, metadata in results:
             yield api_models.Resource(
                 resource_id=meter.resource_id,
                 project_id=meter.project_id,
                 first_sample_timestamp=first_ts,
                 last_sample_timestamp=last_ts,
-                source=meter.sources[0].id,
+                source=source_name,
                 user_id=meter.user_id,
-                metadata=meter.resource_metadata,
-                meter=[
-                    api_models.ResourceMeter(
-                        counter_name=m.counter_name,
-                        counter_type=m.counter_type,
-                        counter_unit=m.counter_unit,
-                    )
-                    for m in meter.resource.meters
-                ],
+                metadata=metadata and metadata.resource_metadata,
+                meter=meters.get(meter.resource_id, []),
             )
 
     @staticmethod
-    def get_meters(user=None, project=None, resource=None, source=None,
+    def _get_resource_meters(session, resource_ids):
+        """Return the api_models.ResourceMeter list of each resource, by
+        resource id.
+        """
+        meters = {}
+        for i in range(0, len(resource_ids), RESOURCE_BATCH_SIZE):
+            query = session.query(
+                MeterSummary.resource_id,
+                MeterSummary.counter_name,
+                MeterSummary.counter_type,
+                MeterSummary.counter_unit,
+            ).filter(MeterSummary.resource_id.in_(
+                resource_ids[i:i + RESOURCE_BATCH_SIZE])).distinct()
+            for resource_id, name, type, unit in query.all():
+                meters.setdefault(resource_id, []).append(
+                    api_models.ResourceMeter(counter_name=name,
+                                             counter_type=type,
+                                             counter_unit=unit))
+        return meters
+
+    def get_meters(self, user=None, project=None, resource=None, source=None,
                    metaquery={}):
         """Return an iterable of api_models.Meter instances
 
@@ -343,55 +1352,53 @@ class Connection(base.Connection):
         :param source: Optional source filter.
         :param metaquery: Optional dict with metadata to match on.
         """
-        session = sqlalchemy_session.get_session()
-
-        # Meter table will store large records and join with resource
-        # will be very slow.
-        # subquery_meter is used to reduce meter records
-        # by selecting a record for each (resource_id, counter_name).
-        # max() is used to choice a meter record, so the latest record
-        # is selected for each (resource_id, counter_name).
-        #
-        subquery_meter = session.query(func.max(Meter.id).label('id')).\
-            group_by(Meter.resource_id, Meter.counter_name).subquery()
-
-        # The SQL of query_meter is essentially:
-        #
-        # SELECT meter.* FROM meter INNER JOIN
-        #  (SELECT max(meter.id) AS id FROM meter
-        #   GROUP BY meter.resource_id, meter.counter_name) AS anon_2
-        # ON meter.id = anon_2.id
-        #
-        query_meter = session.query(Meter).\
-            join(subquery_meter, Meter.id == subquery_meter.c.id)
-
-        alias_meter = aliased(Meter, query_meter.subquery())
-        query = session.query(Resource, alias_meter).join(
-            alias_meter, Resource.id == alias_meter.resource_id)
-
-        if user is not None:
-            query = query.filter(Resource.user_id == user)
-        if source is not None:
-            query = query.filter(Resource.sources.any(id=source))
-        if resource:
-            query = query.filter(Resource.id == resource)
-        if project is not None:
-            query = query.filter(Resource.project_id == project)
+        session = self._read_session()
+        query = session.query(
+            MeterSummary.counter_name,
+            MeterSummary.counter_type,
+            MeterSummary.counter_unit,
+            MeterSummary.resource_id,
+            MeterSummary.project_id,
+            MeterSummary.source_id,
+            MeterSummary.user_id,
+        )
+        # A meter belongs to the owner of its latest sample.
+        newer = aliased(MeterSummary)
+        query = query.filter(~exists().where(and_(
+            newer.resource_id == MeterSummary.resource_id,
+            newer.counter_name == MeterSummary.counter_name,
+            newer.counter_type == MeterSummary.counter_type,
+            newer.counter_unit == MeterSummary.counter_unit,
+            or_(newer.last_timestamp > MeterSummary.last_timestamp,
+                and_(newer.last_timestamp == MeterSummary.last_timestamp,
+                     newer.last_meter_id > MeterSummary.last_meter_id)))))
+        query = make_summary_query(query, user, project, resource or None,
+                                   source)
         if metaquery:
-            raise NotImplementedError('metaquery not implemented')
+            # Match the metadata of the latest sample of each meter.
+            query = apply_metaquery_filter(query, metaquery,
+                                           MeterSummary.metadata_id)
 
-        for resource, meter in query.all():
+        for name, type, unit, resource_id, project_id, source_id, user_id \
+                in query.all():
             yield api_models.Meter(
-                name=meter.counter_name,
-                type=meter.counter_type,
-                unit=meter.counter_unit,
-                resource_id=resource.id,
-                project_id=resource.project_id,
-                source=resource.sources[0].id,
-                user_id=resource.user_id)
+                name=name,
+                type=type,
+                unit=unit,
+                resource_id=resource_id,
+                project_id=project_id,
+                source=source_id,
+                user_id=user_id)
 
     @staticmethod
-    def get_samples(sample_filter, limit=None):
+    def sample_order_key(sample):
+        """The samples sharing a timestamp are ordered by message id, the
+        ones packed in the message_id column before the text ones.
+        """
+        packed = _message_column('message_id', sample.message_id)
+        return sample.timestamp, packed == 'message_id', sample.message_id
+
+    def get_samples(self, sample_filter, limit=None):
         """Return an iterable of api_models.Samples.
 
         :param sample_filter: Filter.
@@ -400,48 +1407,65 @@ class Connection(base.Connection):
         if limit == 0:
             return
 
-        session = sqlalchemy_session.get_session()
-        query = session.query(Meter)
+        session = self._read_session()
+        query = session.query(
+            Meter,
+            MeterDefinition,
+            MeterSource.name,
+            MeterMetadata,
+        ).join(
+            MeterDefinition, MeterDefinition.id == Meter.meter_definition_id,
+        ).outerjoin(
+            MeterSource, MeterSource.id == Meter.meter_source_id,
+        ).outerjoin(
+            MeterMetadata, MeterMetadata.id == Meter.metadata_id,
+        )
         query = make_query_from_filter(query, sample_filter,
                                        require_meter=False)
+        if sample_filter.marker_timestamp:
+            query = make_marker_query(query, sample_filter)
+        query = query.order_by(desc(Meter.timestamp),
+                               desc(Meter.message_id_text.is_(None)),
+                               desc(Meter.message_id),
+                               desc(Meter.message_id_text))
         if limit:
             query = query.limit(limit)
-        samples = query.from_self().order_by(desc(Meter.timestamp)).all()
+        # Stream the rows instead of loading them all before the first one
+        # is returned.
+        samples = query.yield_per(cfg.CONF.database.sample_fetch_size)
 
-        for s in samples:
+        for s, definition, source, metadata in samples:
             # Remove the id generated by the database when
             # the sample was inserted. It is an implementation
             # detail that should not leak outside of the driver.
             yield api_models.Sample(
-                # Replace 'sources' with 'source' to meet the caller's
-                # expectation, Meter.sources contains one and only one
-                # source in the current implementation.
-                source=s.sources[0].id,
-                counter_name=s.counter_name,
-                counter_type=s.counter_type,
-                counter_unit=s.counter_unit,
+                source=source,
+                counter_name=definition.counter_name,
+                counter_type=definition.counter_type,
+                counter_unit=definition.counter_unit,
                 counter_volume=s.counter_volume,
                 user_id=s.user_id,
                 project_id=s.project_id,
                 resource_id=s.resource_id,
                 timestamp=s.timestamp,
-                resource_metadata=s.resource_metadata,
-                message_id=s.message_id,
-                message_signature=s.message_signature,
+                resource_metadata=metadata and metadata.resource_metadata,
+                message_id=s.message_id or s.message_id_text,
+                message_signature=(s.message_signature or
+                                   s.message_signature_text),
             )
 
-    @staticmethod
-    def _make_stats_query(sample_filter):
-        session = sqlalchemy_session.get_session()
+    def _make_stats_query(self, sample_filter):
+        session = self._read_session()
         query = session.query(
-            Meter.counter_unit.label('unit'),
+            MeterDefinition.counter_unit.label('unit'),
             func.min(Meter.timestamp).label('tsmin'),
             func.max(Meter.timestamp).label('tsmax'),
             func.avg(Meter.counter_volume).label('avg'),
             func.sum(Meter.counter_volume).label('sum'),
             func.min(Meter.counter_volume).label('min'),
             func.max(Meter.counter_volume).label('max'),
-            func.count(Meter.counter_volume).label('count'))
+            func.count(Meter.counter_volume).label('count'),
+        ).filter(MeterDefinition.id == Meter.meter_definition_id)
 
         return make_query_from_filter(query, sample_filter)
 
@@ -465,34 +1489,187 @@ class Connection(base.Connection):
             period_end=period_end,
         )
 
+    @staticmethod
+    def _get_rollup_watermark(session):
+        row = session.query(MeterRollupWatermark).get(1)
+        # No watermark means every sample has been rolled up.
+        return row.timestamp if row is not None else rollup.EPOCH
+
+    def _get_raw_aggregate(self, sample_filter, raw_range):
+        sample_filter = copy.copy(sample_filter)
+        sample_filter.start = raw_range.start
+        sample_filter.start_timestamp_op = raw_range.start_op
+        sample_filter.end = raw_range.end
+        sample_filter.end_timestamp_op = raw_range.end_op
+        r = self._make_stats_query(sample_filter).all()[0]
+        return rollup.Aggregate(unit=r.unit, count=r.count, sum=r.sum,
+                                min=r.min, max=r.max,
+                                tsmin=r.tsmin, tsmax=r.tsmax)
+
+    @staticmethod
+    def _get_rollup_buckets(session, sample_filter, resolution, start, end):
+        """Return the sorted bucket starts and their Aggregates."""
+        query = session.query(
+            MeterRollup.bucket_start,
+            func.min(MeterRollup.counter_unit).label('unit'),
+            func.min(MeterRollup.first_timestamp).label('tsmin'),
+            func.max(MeterRollup.last_timestamp).label('tsmax'),
+            func.sum(MeterRollup.sum).label('sum'),
+            func.min(MeterRollup.min).label('min'),
+            func.max(MeterRollup.max).label('max'),
+            func.sum(MeterRollup.count).label('count'))
+        query = make_rollup_query_from_filter(query, sample_filter)
+        query = query.filter(MeterRollup.resolution == resolution)
+        query = query.filter(MeterRollup.bucket_start >= start)
+        if end is not None:
+            query = query.filter(MeterRollup.bucket_start < end)
+        query = query.group_by(MeterRollup.bucket_start)
+        query = query.order_by(MeterRollup.bucket_start)
+        starts = []
+        aggregates = []
+        for r in query.all():
+            starts.append(r.bucket_start)
+            aggregates.append(rollup.Aggregate(
+                unit=r.unit, count=r.count, sum=r.sum, min=r.min, max=r.max,
+                tsmin=r.tsmin, tsmax=r.tsmax))
+        return starts, aggregates
+
+    @staticmethod
+    def _get_period_aggregates(session, sample_filter, period_start, period,
+                               count):
+        """Return the Aggregates of the samples matching the filter in each
+        of the count periods from period_start, with a single query, or
+        None if the database has no period bucketing.
+        """
+        bucket = _period_bucket(session.get_bind().name, period_start,
+                                period)
+        if bucket is None:
+            return None
+        query = session.query(
+            bucket.label('bucket'),
+            func.max(MeterDefinition.counter_unit).label('unit'),
+            func.min(Meter.timestamp).label('tsmin'),
+            func.max(Meter.timestamp).label('tsmax'),
+            func.sum(Meter.counter_volume).label('sum'),
+            func.min(Meter.counter_volume).label('min'),
+            func.max(Meter.counter_volume).label('max'),
+            func.count(Meter.counter_volume).label('count'),
+        ).filter(MeterDefinition.id == Meter.meter_definition_id)
+        query = make_query_from_filter(query, sample_filter)
+        aggregates = [rollup.Aggregate() for i in range(count)]
+        for r in query.group_by(bucket).all():
+            i = int(r.bucket)
+            if 0 <= i < count:
+                aggregates[i] = rollup.Aggregate(
+                    unit=r.unit, count=r.count, sum=r.sum, min=r.min,
+                    max=r.max, tsmin=r.tsmin, tsmax=r.tsmax)
+        return aggregates
+
+    def _get_aggregates(self, sample_filter, time_ranges, period=None):
+        """Return an Aggregate of the samples matching the filter for each
+        (start, start_op, end, end_op) time range.
+
+        Each time range is planned into ranges of complete rollup buckets
+        and ranges of raw samples at its edges. The buckets are fetched
+        with one query by resolution for all the time ranges.
+
+        If the time ranges are consecutive periods of period seconds and
+        more than MAX_RAW_QUERIES raw ranges are needed, the periods are
+        all computed from the raw samples by a single grouped query
+        instead, where the database supports it.
+        """
+        session = self._read_session()
+        if sample_filter.metaquery:
+            # The rollups don't keep the metadata of the samples.
+            watermark = None
+        else:
+            watermark = self._get_rollup_watermark(session)
+        plans = [rollup.plan(start, start_op, end, end_op, watermark)
+                 for start, start_op, end, end_op in time_ranges]
+
+        raw_ranges = sum(1 for p in plans for r in p
+                         if isinstance(r, rollup.RawRange))
+        if period and raw_ranges > MAX_RAW_QUERIES:
+            aggregates = self._get_period_aggregates(
+                session, sample_filter, time_ranges[0][0], period,
+                len(time_ranges))
+            if aggregates is not None:
+                for aggregate in aggregates:
+                    yield aggregate
+                return
+
+        bounds = {}
+        for r in (r for p in plans for r in p
+                  if isinstance(r, rollup.RollupRange)):
+            start, end = bounds.get(r.resolution, (r.start, r.end))
+            bounds[r.resolution] = (
+                min(start, r.start),
+                None if end is None or r.end is None else max(end, r.end))
+        buckets = dict(
+            (resolution, self._get_rollup_buckets(session, sample_filter,
+                                                  resolution, start, end))
+            for resolution, (start, end) in bounds.iteritems())
+
+        for p in plans:
+            aggregate = rollup.Aggregate()
+            for r in p:
+                if isinstance(r, rollup.RawRange):
+                    aggregate.merge(self._get_raw_aggregate(sample_filter, r))
+                    continue
+                starts, aggregates = buckets[r.resolution]
+                first = bisect.bisect_left(starts, r.start)
+                last = (len(starts) if r.end is None
+                        else bisect.bisect_left(starts, r.end))
+                for bucket in aggregates[first:last]:
+                    aggregate.merge(bucket)
+            yield aggregate
+
     def get_meter_statistics(self, sample_filter, period=None):
         """Return an iterable of api_models.Statistics instances containing
         meter statistics described by the query parameters.
 
         The filter must have a meter value set.
 
+        The statistics are computed from the rollups where they cover whole
+        buckets of the requested time ranges, and from the raw samples
+        elsewhere.
         """
+        if not sample_filter.meter:
+            raise RuntimeError('Missing required meter specifier')
+
         if not period or not sample_filter.start or not sample_filter.end:
-            res = self._make_stats_query(sample_filter).all()[0]
+            res = list(self._get_aggregates(
+                sample_filter,
+                [(sample_filter.start, sample_filter.start_timestamp_op,
+                  sample_filter.end, sample_filter.end_timestamp_op)]))[0]
+            if not res.count:
+                # No statistics, and no time range to split in periods.
+                return
 
         if not period:
-            if res.count:
-                yield self._stats_result_to_model(res, 0, res.tsmin, res.tsmax)
+            yield self._stats_result_to_model(res, 0, res.tsmin, res.tsmax)
             return
 
-        query = self._make_stats_query(sample_filter)
-        # HACK(jd) This is an awful method to compute stats by period, but
-        # since we're trying to be SQL agnostic we have to write portable
-        # code, so here it is, admire! We're going to do one request to get
-        # stats by period. We would like to use GROUP BY, but there's no
-        # portable way to manipulate timestamp in SQL, so we can't.
-        for period_start, period_end in base.iter_period(
-                sample_filter.start or res.tsmin,
-                sample_filter.end or res.tsmax,
-                period):
-            q = query.filter(Meter.timestamp >= period_start)
-            q = q.filter(Meter.timestamp < period_end)
-            r = q.all()[0]
+        periods = list(base.iter_period(
+            sample_filter.start or res.tsmin,
+            sample_filter.end or res.tsmax,
+            period))
+        time_ranges = []
+        for period_start, period_end in periods:
+            # Restrict each period to the time range of the filter.
+            start, start_op = period_start, 'ge'
+            if sample_filter.start and sample_filter.start >= period_start:
+                start = sample_filter.start
+                start_op = sample_filter.start_timestamp_op
+            end, end_op = period_end, 'lt'
+            if sample_filter.end and sample_filter.end < period_end:
+                end = sample_filter.end
+                end_op = sample_filter.end_timestamp_op
+            time_ranges.append((start, start_op, end, end_op))
+
+        for (period_start, period_end), r in zip(
+                periods, self._get_aggregates(sample_filter, time_ranges,
+                                              period)):
             # Don't return results that didn't have any data.
             if r.count:
                 yield self._stats_result_to_model(
@@ -542,7 +1719,7 @@ class Connection(base.Connection):
         :param enabled: Optional boolean to list disable alarm.
         :param alarm_id: Optional alarm_id to return one alarm.
         """
-        session = sqlalchemy_session.get_session()
+        session = self._session()
         query = session.query(Alarm)
         if name is not None:
             query = query.filter(Alarm.name == name)
@@ -562,7 +1739,7 @@ class Connection(base.Connection):
 
         :param alarm: the new Alarm to update
         """
-        session = sqlalchemy_session.get_session()
+        session = self._session()
         with session.begin():
             if alarm.alarm_id:
                 alarm_row = session.merge(Alarm(id=alarm.alarm_id))
@@ -577,13 +1754,12 @@ class Connection(base.Connection):
             session.flush()
         return self._row_to_alarm_model(alarm_row)
 
-    @staticmethod
-    def delete_alarm(alarm_id):
+    def delete_alarm(self, alarm_id):
         """Delete a alarm
 
         :param alarm_id: ID of the alarm to delete
         """
-        session = sqlalchemy_session.get_session()
+        session = self._session()
         with session.begin():
             session.query(Alarm).filter(Alarm.id == alarm_id).delete()
             session.flush()
@@ -599,7 +1775,7 @@ class Connection(base.Connection):
            This may result in a flush.
         """
         if session is None:
-            session = sqlalchemy_session.get_session()
+            session = self._session()
         with session.begin(subtransactions=True):
             unique = self._get_unique(session, key)
             if not unique:
@@ -654,7 +1830,7 @@ class Connection(base.Connection):
         Flush when they're all added, unless new UniqueNames are
         added along the way.
         """
-        session = sqlalchemy_session.get_session()
+        session = self._session()
         with session.begin():
             events = [self._record_event(session, event_model)
                       for event_model in event_models]
@@ -676,7 +1852,7 @@ class Connection(base.Connection):
 
         start = utils.dt_to_decimal(event_filter.start)
         end = utils.dt_to_decimal(event_filter.end)
-        session = sqlalchemy_session.get_session()
+        session = self._read_session()
         with session.begin():
             sub_query = session.query(Event.id)\
                 .join(Trait, Trait.event_id == Event.id)\
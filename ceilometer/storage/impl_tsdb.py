@@ -0,0 +1,592 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Embedded time series storage backend
+"""
+
+import calendar
+import datetime
+import heapq
+import os
+import urlparse
+import uuid
+
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import timeutils
+from ceilometer.storage import base
+from ceilometer.storage import models
+from ceilometer.storage import rollup
+from ceilometer.storage.tsdb import store
+
+LOG = log.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+ALARMS = 'alarms'
+EVENTS = 'events'
+
+
+class TSDBStorage(base.StorageEngine):
+    """Put the data into columnar time series files, in a local directory
+    given as tsdb:///path/to/directory.
+
+    Files:
+
+    - chunks
+      - the samples of a (meter, resource) series, column by column:
+        timestamps as delta-of-deltas, volumes XORed with the previous one,
+        dictionary ids of the type, unit, user, project and source, and
+        metadata version, run-length encoded, and message ids and
+        signatures
+    - index
+      - { meter id, resource id, project id, unit id,
+          first and last timestamps, location in the chunks file,
+          count, sum, min and max of the volumes
+          }
+    - dictionary
+      - the strings of the ids
+    - metadata
+      - { version, resource id, metadata dictionary }
+    - wal
+      - the samples not sealed into chunks yet
+    - alarms, events
+
+    See ceilometer.storage.tsdb.store for the details.
+    """
+
+    @staticmethod
+    def get_connection(conf):
+        """Return a Connection instance based on the configuration settings.
+        """
+        return Connection(conf)
+
+
+def to_microseconds(timestamp):
+    return (calendar.timegm(timestamp.utctimetuple()) * 1000000 +
+            timestamp.microsecond)
+
+
+def from_microseconds(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def make_bounds(start=None, start_op=None, end=None, end_op=None):
+    """Return the inclusive bounds of a time range, in microseconds."""
+    lower = upper = None
+    if start:
+        lower = to_microseconds(start)
+        if start_op == 'gt':
+            lower += 1
+    if end:
+        upper = to_microseconds(end)
+        if end_op != 'le':
+            upper -= 1
+    return lower, upper
+
+
+class Connection(base.Connection):
+    """Time series store connection.
+    """
+
+    def __init__(self, conf):
+        url = urlparse.urlparse(conf.database.connection)
+        self.store = store.Store(url.netloc + url.path,
+                                 conf.database.tsdb_chunk_size,
+                                 conf.database.tsdb_wal_size)
+
+    def upgrade(self):
+        self.store.create()
+
+    def clear(self):
+        self.store.destroy()
+
+    def record_metering_data(self, data):
+        """Write the data to the backend storage system.
+
+        :param data: a dictionary such as returned by
+                     ceilometer.meter.meter_message_from_counter
+        """
+        self.store.append(data['counter_name'], data['resource_id'],
+                          store.Row(
+                              timestamp=to_microseconds(data['timestamp']),
+                              volume=float(data['counter_volume']),
+                              type=data['counter_type'],
+                              unit=data['counter_unit'],
+                              user=data['user_id'],
+                              project=data['project_id'],
+                              source=data['source'],
+                              metadata=data['resource_metadata'],
+                              message_id=data['message_id'],
+                              signature=data['message_signature']))
+
+    def clear_expired_metering_data(self, ttl):
+        """Clear expired data from the backend storage system according to the
+        time-to-live.
+
+        The chunks holding only expired samples are dropped, the others are
+        copied to a new generation of the files.
+
+        :param ttl: Number of seconds to keep records for.
+
+        """
+        end = timeutils.utcnow() - datetime.timedelta(seconds=ttl)
+        deleted = self.store.expire(to_microseconds(end))
+        LOG.info('%d samples older than %s deleted', deleted, end)
+
+    def _select(self, view, user=None, project=None, source=None,
+                bounds=(None, None), metaquery=None):
+        """Return the positions of the samples of a view matching the
+        filters.
+        """
+        positions = xrange(view.count)
+        lower, upper = bounds
+        if (lower is not None and view.tmin < lower or
+                upper is not None and view.tmax > upper):
+            timestamps = view.column('timestamp')
+            positions = [i for i in positions
+                         if (lower is None or timestamps[i] >= lower) and
+                         (upper is None or timestamps[i] <= upper)]
+        for name, value in (('user', user), ('project', project),
+                            ('source', source)):
+            if value is not None:
+                values = view.column(name)
+                positions = [i for i in positions if values[i] == value]
+        if metaquery:
+            versions = view.column('metadata')
+            matches = {}
+            for v in set(versions[i] for i in positions):
+                matches[v] = base.match_metaquery(
+                    self.store.metadata.get(v), metaquery)
+            positions = [i for i in positions if matches[versions[i]]]
+        return list(positions)
+
+    def _latest(self, views, **filters):
+        """Return the (view, position) of the latest sample of each series
+        or resource, by (meter, resource) or resource, matching the filters.
+
+        On a tie the sample written last wins, like an update would.
+        """
+        key = filters.pop('key')
+        latest = {}
+        for view in views:
+            positions = self._select(view, **filters)
+            if not positions:
+                continue
+            timestamps = view.column('timestamp')
+            i = max(reversed(positions), key=lambda i: timestamps[i])
+            k = key(view)
+            current = latest.get(k)
+            if current is None or timestamps[i] >= current[2]:
+                latest[k] = (view, i, timestamps[i])
+        return dict((k, v[:2]) for k, v in latest.iteritems())
+
+    def get_users(self, source=None):
+        """Return an iterable of user id strings.
+
+        :param source: Optional source filter.
+        """
+        users = set()
+        for view in self.store.scan():
+            positions = self._select(view, source=source)
+            values = view.column('user')
+            users.update(values[i] for i in positions)
+        users.discard(None)
+        return sorted(users)
+
+    def get_projects(self, source=None):
+        """Return an iterable of project id strings.
+
+        :param source: Optional source filter.
+        """
+        projects = set()
+        for view in self.store.scan():
+            positions = self._select(view, source=source)
+            values = view.column('project')
+            projects.update(values[i] for i in positions)
+        projects.discard(None)
+        return sorted(projects)
+
+    def get_resources(self, user=None, project=None, source=None,
+                      start_timestamp=None, start_timestamp_op=None,
+                      end_timestamp=None, end_timestamp_op=None,
+                      metaquery={}, resource=None):
+        """Return an iterable of models.Resource instances
+
+        :param user: Optional ID for user that owns the resource.
+        :param project: Optional ID for project that owns the resource.
+        :param source: Optional source filter.
+        :param start_timestamp: Optional modified timestamp start range.
+        :param start_timestamp_op: Optional start time operator, like ge, gt.
+        :param end_timestamp: Optional modified timestamp end range.
+        :param end_timestamp_op: Optional end time operator, like lt, le.
+        :param metaquery: Optional dict with metadata to match on.
+        :param resource: Optional resource filter.
+        """
+        bounds = make_bounds(start_timestamp, start_timestamp_op,
+                             end_timestamp, end_timestamp_op)
+        views = self.store.scan(resource=resource, project=project,
+                                start=bounds[0], end=bounds[1])
+        first = {}
+        for view in views:
+            positions = self._select(view, user, project, source, bounds,
+                                     metaquery)
+            if positions:
+                timestamps = view.column('timestamp')
+                ts = min(timestamps[i] for i in positions)
+                first[view.resource] = min(first.get(view.resource, ts), ts)
+        latest = self._latest(views, key=lambda v: v.resource, user=user,
+                              project=project, source=source, bounds=bounds,
+                              metaquery=metaquery)
+
+        # The meters of the resources, over all their samples.
+        meters = {}
+        for view in self.store.scan(resource=resource):
+            if view.resource in latest:
+                meters.setdefault(view.resource, set()).update(
+                    (view.meter, t, u)
+                    for t, u in zip(view.column('type'), view.column('unit')))
+
+        for resource_id, (view, i) in latest.iteritems():
+            version = view.column('metadata')[i]
+            yield models.Resource(
+                resource_id=resource_id,
+                first_sample_timestamp=from_microseconds(first[resource_id]),
+                last_sample_timestamp=from_microseconds(
+                    view.column('timestamp')[i]),
+                project_id=view.column('project')[i],
+                source=view.column('source')[i],
+                user_id=view.column('user')[i],
+                metadata=self.store.metadata.get(version, {}),
+                meter=[models.ResourceMeter(*m)
+                       for m in sorted(meters[resource_id])],
+            )
+
+    def get_meters(self, user=None, project=None, resource=None, source=None,
+                   metaquery={}):
+        """Return an iterable of models.Meter instances
+
+        The meters are described by the latest sample of their series, to
+        which the filters apply.
+
+        :param user: Optional ID for user that owns the resource.
+        :param project: Optional ID for project that owns the resource.
+        :param resource: Optional resource filter.
+        :param source: Optional source filter.
+        :param metaquery: Optional dict with metadata to match on.
+        """
+        latest = self._latest(self.store.scan(resource=resource),
+                              key=lambda v: (v.meter, v.resource))
+        for (meter, resource_id), (view, i) in sorted(latest.iteritems()):
+            values = dict((name, view.column(name)[i])
+                          for name in ('type', 'unit', 'user', 'project',
+                                       'source', 'metadata'))
+            if (user is not None and values['user'] != user or
+                    project is not None and values['project'] != project or
+                    source is not None and values['source'] != source or
+                    metaquery and not base.match_metaquery(
+                        self.store.metadata.get(values['metadata'], {}),
+                        metaquery)):
+                continue
+            yield models.Meter(
+                name=meter,
+                type=values['type'],
+                unit=values['unit'],
+                resource_id=resource_id,
+                project_id=values['project'],
+                source=values['source'],
+                user_id=values['user'],
+            )
+
+    def _make_sample(self, view, i):
+        return models.Sample(
+            source=view.column('source')[i],
+            counter_name=view.meter,
+            counter_type=view.column('type')[i],
+            counter_unit=view.column('unit')[i],
+            counter_volume=view.column('volume')[i],
+            user_id=view.column('user')[i],
+            project_id=view.column('project')[i],
+            resource_id=view.resource,
+            timestamp=from_microseconds(view.column('timestamp')[i]),
+            resource_metadata=self.store.metadata.get(
+                view.column('metadata')[i], {}),
+            message_id=view.column('message_id')[i],
+            message_signature=view.column('signature')[i],
+        )
+
+    def get_samples(self, sample_filter, limit=None):
+        """Return an iterable of models.Sample instances.
+
+        The positions of the matching samples are sorted, and the samples
+        are only built as they are iterated over.
+
+        :param sample_filter: Filter.
+        :param limit: Maximum number of results to return.
+        """
+        if limit == 0:
+            return
+        f = sample_filter
+        lower, upper = make_bounds(f.start, f.start_timestamp_op,
+                                   f.end, f.end_timestamp_op)
+        marker = None
+        if f.marker_timestamp:
+            marker = to_microseconds(f.marker_timestamp)
+            upper = marker if upper is None else min(upper, marker)
+        views = self.store.scan(meter=f.meter, resource=f.resource,
+                                project=f.project, start=lower, end=upper)
+
+        candidates = []
+        for view in views:
+            positions = self._select(view, f.user, f.project, f.source,
+                                     (lower, upper), f.metaquery)
+            if not positions:
+                continue
+            timestamps = view.column('timestamp')
+            message_ids = view.column('message_id')
+            for i in positions:
+                if timestamps[i] == marker and (
+                        not f.marker_message_id or
+                        message_ids[i] >= f.marker_message_id):
+                    continue
+                candidates.append((timestamps[i], message_ids[i], view, i))
+
+        def key(candidate):
+            return candidate[:2]
+
+        if limit:
+            candidates = heapq.nlargest(limit, candidates, key=key)
+        else:
+            candidates.sort(key=key, reverse=True)
+        for ignored, ignored, view, i in candidates:
+            yield self._make_sample(view, i)
+
+    def get_meter_statistics(self, sample_filter, period=None):
+        """Return an iterable of models.Statistics instances containing meter
+        statistics described by the query parameters.
+
+        The filter must have a meter value set.
+
+        The chunks lying within the time range and a single period are
+        aggregated from the index when the filter does not need their
+        columns, the other ones only have their timestamps, volumes and
+        filtered columns decoded.
+        """
+        f = sample_filter
+        if not f.meter:
+            raise RuntimeError('Missing required meter specifier')
+
+        start = f.start
+        if period and not start:
+            # The periods start with the first sample.
+            stats = list(self.get_meter_statistics(f))
+            if not stats:
+                return
+            start = stats[0].duration_start
+
+        lower, upper = make_bounds(f.start, f.start_timestamp_op,
+                                   f.end, f.end_timestamp_op)
+        origin = to_microseconds(start) if period else 0
+        width = period * 1000000 if period else None
+        project_id = self.store.dictionary.get(f.project)
+
+        def bucket(ts):
+            return (ts - origin) // width if period else 0
+
+        aggregates = {}
+        for view in self.store.scan(meter=f.meter, resource=f.resource,
+                                    project=f.project, start=lower,
+                                    end=upper):
+            entry = view.entry
+            if (entry is not None and entry.unit != store.MIXED and
+                    f.user is None and f.source is None and
+                    not f.metaquery and
+                    (f.project is None or entry.project == project_id) and
+                    (lower is None or entry.tmin >= lower) and
+                    (upper is None or entry.tmax <= upper) and
+                    bucket(entry.tmin) == bucket(entry.tmax)):
+                aggregates.setdefault(
+                    bucket(entry.tmin), rollup.Aggregate()).merge(
+                        rollup.Aggregate(
+                            self.store.dictionary.strings[entry.unit],
+                            entry.count, entry.sum, entry.min, entry.max,
+                            entry.tmin, entry.tmax))
+                continue
+
+            positions = self._select(view, f.user, f.project, f.source,
+                                     (lower, upper), f.metaquery)
+            timestamps = view.column('timestamp')
+            volumes = view.column('volume')
+            units = view.column('unit')
+            for i in positions:
+                ts = timestamps[i]
+                volume = volumes[i]
+                a = aggregates.get(bucket(ts))
+                if a is None:
+                    a = aggregates[bucket(ts)] = rollup.Aggregate(
+                        units[i], 1, volume, volume, volume, ts, ts)
+                    continue
+                a.count += 1
+                a.sum += volume
+                if volume < a.min:
+                    a.min = volume
+                if volume > a.max:
+                    a.max = volume
+                if ts < a.tsmin:
+                    a.tsmin = ts
+                if ts > a.tsmax:
+                    a.tsmax = ts
+
+        for b, a in sorted(aggregates.iteritems()):
+            duration_start = from_microseconds(a.tsmin)
+            duration_end = from_microseconds(a.tsmax)
+            if period:
+                period_start = start + datetime.timedelta(seconds=b * period)
+                period_end = period_start + datetime.timedelta(seconds=period)
+            else:
+                period_start, period_end = duration_start, duration_end
+            yield models.Statistics(
+                unit=a.unit,
+                count=a.count,
+                min=a.min,
+                max=a.max,
+                avg=a.avg,
+                sum=a.sum,
+                period=int(period or 0),
+                period_start=period_start,
+                period_end=period_end,
+                duration=timeutils.delta_seconds(duration_start,
+                                                 duration_end),
+                duration_start=duration_start,
+                duration_end=duration_end,
+            )
+
+    def _load_alarms(self):
+        try:
+            with open(os.path.join(self.store.path, ALARMS)) as f:
+                alarms = jsonutils.loads(f.read())
+        except IOError:
+            return {}
+        for alarm in alarms.itervalues():
+            for name in ('timestamp', 'state_timestamp'):
+                if alarm[name] is not None:
+                    alarm[name] = timeutils.parse_strtime(alarm[name])
+        return alarms
+
+    def get_alarms(self, name=None, user=None,
+                   project=None, enabled=True, alarm_id=None):
+        """Yields a lists of alarms that match filters
+        :param user: Optional ID for user that owns the resource.
+        :param project: Optional ID for project that owns the resource.
+        :param enabled: Optional boolean to list disable alarm.
+        :param alarm_id: Optional alarm_id to return one alarm.
+        """
+        for alarm in self._load_alarms().itervalues():
+            if (name is not None and alarm['name'] != name or
+                    user is not None and alarm['user_id'] != user or
+                    project is not None and alarm['project_id'] != project or
+                    enabled is not None and alarm['enabled'] != enabled or
+                    alarm_id is not None and alarm['alarm_id'] != alarm_id):
+                continue
+            yield models.Alarm(**alarm)
+
+    def update_alarm(self, alarm):
+        """update alarm
+        """
+        if alarm.alarm_id is None:
+            # This is an insert, generate an id
+            alarm.alarm_id = str(uuid.uuid1())
+        with self.store.lock():
+            alarms = self._load_alarms()
+            alarms[alarm.alarm_id] = alarm.as_dict()
+            store.replace_file(os.path.join(self.store.path, ALARMS),
+                               jsonutils.dumps(alarms))
+        return models.Alarm(**alarm.as_dict())
+
+    def delete_alarm(self, alarm_id):
+        """Delete a alarm
+        """
+        with self.store.lock():
+            alarms = self._load_alarms()
+            if alarms.pop(alarm_id, None) is not None:
+                store.replace_file(os.path.join(self.store.path, ALARMS),
+                                   jsonutils.dumps(alarms))
+
+    def record_events(self, events):
+        """Write the events.
+
+        The id of an event is the offset of its record in the events file.
+
+        :param events: a list of model.Event objects.
+        """
+        filename = os.path.join(self.store.path, EVENTS)
+        with self.store.lock():
+            offset = os.path.getsize(filename) \
+                if os.path.exists(filename) else 0
+            for event in events:
+                traits = [[t.name, t.dtype,
+                           to_microseconds(t.value)
+                           if t.dtype == models.Trait.DATETIME_TYPE
+                           else t.value]
+                          for t in event.traits or []]
+                event.id = offset
+                offset = store.append_records(filename, [jsonutils.dumps(
+                    [event.event_name, to_microseconds(event.generated),
+                     traits])])
+
+    def get_events(self, event_filter):
+        """Return an iterable of model.Event objects.
+
+        :param event_filter: EventFilter instance
+        """
+        filename = os.path.join(self.store.path, EVENTS)
+        if not os.path.exists(filename):
+            return []
+        lower, upper = make_bounds(event_filter.start, 'ge',
+                                   event_filter.end, 'le')
+        conditions = []
+        for key, value in (event_filter.traits or {}).iteritems():
+            if key == 'key':
+                conditions.append((0, value))
+            elif key == 't_string':
+                conditions.append((1, models.Trait.TEXT_TYPE))
+                conditions.append((2, value))
+            elif key == 't_int':
+                conditions.append((1, models.Trait.INT_TYPE))
+                conditions.append((2, value))
+            elif key == 't_float':
+                conditions.append((1, models.Trait.FLOAT_TYPE))
+                conditions.append((2, value))
+            elif key == 't_datetime':
+                conditions.append((1, models.Trait.DATETIME_TYPE))
+                conditions.append((2, to_microseconds(value)))
+
+        events = []
+        for ignored, payload in store.read_records(filename):
+            name, generated, traits = jsonutils.loads(payload)
+            if (lower is not None and generated < lower or
+                    upper is not None and generated > upper or
+                    event_filter.event_name and
+                    name != event_filter.event_name):
+                continue
+            # All the conditions apply to the same trait.
+            if conditions and not any(all(t[i] == v for i, v in conditions)
+                                      for t in traits):
+                continue
+            events.append(models.Event(
+                name, from_microseconds(generated),
+                [models.Trait(n, dtype, from_microseconds(value)
+                              if dtype == models.Trait.DATETIME_TYPE
+                              else value)
+                 for n, dtype, value in traits]))
+        return sorted(events, key=lambda e: e.generated)
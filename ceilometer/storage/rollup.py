@@ -0,0 +1,159 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Helpers for the storage drivers maintaining pre-aggregated rollups of the
+samples.
+
+A rollup holds the count, sum, minimum and maximum of the samples of a
+meter, for a resource, project, user and source, over an aligned bucket of
+time of one of the RESOLUTIONS. A statistics query is split with plan() into
+ranges of complete buckets, answered from the rollups, and ranges of raw
+samples at its ragged edges, and the partial Aggregates are merged.
+
+Only the SQL driver maintains rollups so far, the MongoDB and HBase drivers
+still compute the statistics from the raw samples.
+"""
+
+import collections
+import datetime
+import hashlib
+import math
+
+from ceilometer.openstack.common import timeutils
+
+# Bucket sizes in seconds, from the coarsest to the finest. Each one is a
+# multiple of the next one.
+RESOLUTIONS = (86400, 3600, 60)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Range of raw samples, the ops are the ones of SampleFilter.
+RawRange = collections.namedtuple('RawRange',
+                                  ['start', 'start_op', 'end', 'end_op'])
+
+# Range of complete buckets of a resolution, the end may be None.
+RollupRange = collections.namedtuple('RollupRange',
+                                     ['resolution', 'start', 'end'])
+
+
+def floor(timestamp, resolution):
+    """Return the start of the bucket of resolution holding timestamp."""
+    seconds = timeutils.delta_seconds(EPOCH, timestamp)
+    return EPOCH + datetime.timedelta(
+        seconds=int(math.floor(seconds / resolution)) * resolution)
+
+
+def ceil(timestamp, resolution):
+    """Return the first bucket boundary of resolution not before timestamp.
+    """
+    start = floor(timestamp, resolution)
+    if start == timestamp:
+        return start
+    return start + datetime.timedelta(seconds=resolution)
+
+
+def make_key(counter_name, resource_id, project_id, user_id, source):
+    """Return the hash identifying the rollups of a sample's dimensions."""
+    return hashlib.sha1('\0'.join(
+        (v or '').encode('utf-8')
+        for v in (counter_name, resource_id, project_id, user_id, source)
+    )).hexdigest()
+
+
+def _split(start, end):
+    """Cover [start, end) with the coarsest complete buckets possible.
+
+    Both ends must be aligned on the finest resolution, end may be None.
+    """
+    for resolution in RESOLUTIONS:
+        first = ceil(start, resolution)
+        last = end and floor(end, resolution)
+        if last is None or first < last:
+            ranges = _split(start, first)
+            ranges.append(RollupRange(resolution, first, last))
+            if last is not None:
+                ranges.extend(_split(last, end))
+            return ranges
+    return []
+
+
+def plan(start, start_op, end, end_op, watermark):
+    """Split a time range into RawRange and RollupRange.
+
+    :param start: Start of the range, None if unbounded.
+    :param start_op: 'gt' if start is excluded from the range.
+    :param end: End of the range, None if unbounded.
+    :param end_op: 'le' if end is included in the range.
+    :param watermark: Time from which the rollups hold every sample, None
+                      if there is no rollup.
+    """
+    if watermark is None or (end is not None and end <= watermark):
+        return [RawRange(start, start_op, end, end_op)]
+    ranges = []
+    if start is None or start < watermark:
+        ranges.append(RawRange(start, start_op, watermark, 'lt'))
+        start, start_op = watermark, 'ge'
+    finest = RESOLUTIONS[-1]
+    first = ceil(start, finest)
+    if first == start and start_op == 'gt':
+        first += datetime.timedelta(seconds=finest)
+    last = end and floor(end, finest)
+    if last is not None and first >= last:
+        ranges.append(RawRange(start, start_op, end, end_op))
+        return ranges
+    if first > start:
+        ranges.append(RawRange(start, start_op, first, 'lt'))
+    ranges.extend(_split(first, last))
+    if last is not None and (end > last or end_op == 'le'):
+        ranges.append(RawRange(last, 'ge', end, end_op))
+    return ranges
+
+
+class Aggregate(object):
+    """Partial statistics of a set of samples, which can be merged."""
+
+    def __init__(self, unit=None, count=0, sum=None, min=None, max=None,
+                 tsmin=None, tsmax=None):
+        self.unit = unit
+        self.count = int(count or 0)
+        self.sum = sum
+        self.min = min
+        self.max = max
+        self.tsmin = tsmin
+        self.tsmax = tsmax
+
+    @property
+    def avg(self):
+        if not self.count:
+            return None
+        return self.sum / float(self.count)
+
+    def merge(self, other):
+        """Add the samples aggregated by other to this one."""
+        if not other.count:
+            return self
+        if not self.count:
+            self.unit = other.unit
+            self.sum = other.sum
+            self.min = other.min
+            self.max = other.max
+            self.tsmin = other.tsmin
+            self.tsmax = other.tsmax
+        else:
+            self.sum += other.sum
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.tsmin = min(self.tsmin, other.tsmin)
+            self.tsmax = max(self.tsmax, other.tsmax)
+        self.count += other.count
+        return self
@@ -62,7 +62,11 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
-    engine = sqlalchemy_session.get_session().get_bind()
+    # The database of the [database] options, unless db_sync was given
+    # another engine.
+    engine = getattr(config, 'attributes', {}).get('engine')
+    if engine is None:
+        engine = sqlalchemy_session.get_session().get_bind()
 
     connection = engine.connect()
     context.configure(connection=connection, target_metadata=target_metadata)
@@ -0,0 +1,52 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Add expirer reference data and checkpoints
+
+Revision ID: 3a7c7b1e5d92
+Revises: 9199cda71c05
+Create Date: 2013-08-22 15:04:12.583190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a7c7b1e5d92'
+down_revision = '9199cda71c05'
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = ('user', 'project', 'resource')
+
+
+def upgrade():
+    # The existing rows are left NULL, the expirer checks whether they still
+    # have samples instead.
+    for table in TABLES:
+        op.add_column(table, sa.Column('last_sample_timestamp', sa.DateTime))
+        op.create_index('ix_%s_last_sample_timestamp' % table, table,
+                        ['last_sample_timestamp'])
+    op.create_table(
+        'expirer_checkpoint',
+        sa.Column('table_name', sa.String(255), primary_key=True),
+        sa.Column('last_id', sa.Integer),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+
+
+def downgrade():
+    op.drop_table('expirer_checkpoint')
+    for table in TABLES:
+        op.drop_index('ix_%s_last_sample_timestamp' % table, table)
+        op.drop_column(table, 'last_sample_timestamp')
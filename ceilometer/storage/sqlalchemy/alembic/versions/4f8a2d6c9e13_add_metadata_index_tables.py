@@ -0,0 +1,54 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Add metadata index tables
+
+Revision ID: 4f8a2d6c9e13
+Revises: c1e3f8a2d4b6
+Create Date: 2013-08-29 14:18:03.772604
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4f8a2d6c9e13'
+down_revision = 'c1e3f8a2d4b6'
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = [
+    ('metadata_text', 'ix_meta_text_key_value', sa.String(255)),
+    ('metadata_bool', 'ix_meta_bool_key_value', sa.Boolean),
+    ('metadata_int', 'ix_meta_int_key_value', sa.BigInteger),
+    ('metadata_float', 'ix_meta_float_key_value', sa.Float(53)),
+]
+
+
+def upgrade():
+    # The metadata of the existing samples is not indexed.
+    for table, index, value_type in TABLES:
+        op.create_table(
+            table,
+            sa.Column('id', sa.Integer, primary_key=True,
+                      autoincrement=False),
+            sa.Column('meta_key', sa.String(255), primary_key=True),
+            sa.Column('value', value_type),
+            mysql_engine='InnoDB',
+            mysql_charset='utf8',
+        )
+        op.create_index(index, table, ['meta_key', 'value'])
+
+
+def downgrade():
+    for table, index, value_type in TABLES:
+        op.drop_table(table)
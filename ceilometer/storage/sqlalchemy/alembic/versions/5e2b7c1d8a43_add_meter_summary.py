@@ -0,0 +1,114 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Add meter summary
+
+Revision ID: 5e2b7c1d8a43
+Revises: 4f8a2d6c9e13
+Create Date: 2013-09-03 11:26:48.190375
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2b7c1d8a43'
+down_revision = '4f8a2d6c9e13'
+
+from alembic import op
+import sqlalchemy as sa
+
+from ceilometer.storage import impl_sqlalchemy
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.create_table(
+        'meter_summary',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('summary_key', sa.String(40)),
+        sa.Column('resource_id', sa.String(255)),
+        sa.Column('counter_name', sa.String(255)),
+        sa.Column('counter_type', sa.String(255)),
+        sa.Column('counter_unit', sa.String(255)),
+        sa.Column('user_id', sa.String(255)),
+        sa.Column('project_id', sa.String(255)),
+        sa.Column('source_id', sa.String(255)),
+        sa.Column('resource_metadata', sa.String(5000)),
+        sa.Column('first_timestamp', sa.DateTime),
+        sa.Column('last_timestamp', sa.DateTime),
+        sa.Column('last_meter_id', sa.Integer),
+        sa.UniqueConstraint('summary_key', name='uniq_meter_summary0key'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+    op.create_index('ix_meter_summary_meter', 'meter_summary',
+                    ['resource_id', 'counter_name'])
+    op.create_index('ix_meter_summary_user_id', 'meter_summary',
+                    ['user_id'])
+    op.create_index('ix_meter_summary_project_id', 'meter_summary',
+                    ['project_id'])
+    op.create_index('ix_meter_summary_last_timestamp', 'meter_summary',
+                    ['last_timestamp'])
+
+    # Summarize the existing samples. The last recorded sample of each
+    # meter stands for its latest one, and gives its source.
+    meta = sa.MetaData(op.get_bind())
+    meter = sa.Table('meter', meta, autoload=True)
+    sourceassoc = sa.Table('sourceassoc', meta, autoload=True)
+    key = (meter.c.resource_id, meter.c.counter_name,
+           meter.c.counter_type, meter.c.counter_unit,
+           meter.c.user_id, meter.c.project_id)
+    summary = sa.select(key + (
+        sa.func.min(meter.c.timestamp).label('first_timestamp'),
+        sa.func.max(meter.c.timestamp).label('last_timestamp'),
+        sa.func.max(meter.c.id).label('last_meter_id'),
+    )).group_by(*key).alias()
+    latest = sa.select([
+        summary,
+        meter.c.resource_metadata,
+        sourceassoc.c.source_id,
+    ]).select_from(
+        summary.join(meter, meter.c.id == summary.c.last_meter_id).outerjoin(
+            sourceassoc, sourceassoc.c.meter_id == meter.c.id))
+
+    table = sa.sql.table(
+        'meter_summary',
+        sa.sql.column('summary_key', sa.String),
+        sa.sql.column('resource_id', sa.String),
+        sa.sql.column('counter_name', sa.String),
+        sa.sql.column('counter_type', sa.String),
+        sa.sql.column('counter_unit', sa.String),
+        sa.sql.column('user_id', sa.String),
+        sa.sql.column('project_id', sa.String),
+        sa.sql.column('source_id', sa.String),
+        sa.sql.column('resource_metadata', sa.String),
+        sa.sql.column('first_timestamp', sa.DateTime),
+        sa.sql.column('last_timestamp', sa.DateTime),
+        sa.sql.column('last_meter_id', sa.Integer),
+    )
+    rows = []
+    for row in op.get_bind().execute(latest):
+        row = dict(row)
+        row['summary_key'] = impl_sqlalchemy.make_summary_key(
+            row['resource_id'], row['counter_name'], row['counter_type'],
+            row['counter_unit'], row['user_id'], row['project_id'])
+        rows.append(row)
+        if len(rows) == BATCH_SIZE:
+            op.bulk_insert(table, rows)
+            rows = []
+    if rows:
+        op.bulk_insert(table, rows)
+
+
+def downgrade():
+    op.drop_table('meter_summary')
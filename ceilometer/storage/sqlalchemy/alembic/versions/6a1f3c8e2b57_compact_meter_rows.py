@@ -0,0 +1,277 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Compact meter rows
+
+Revision ID: 6a1f3c8e2b57
+Revises: 5e2b7c1d8a43
+Create Date: 2013-09-05 16:42:11.503218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a1f3c8e2b57'
+down_revision = '5e2b7c1d8a43'
+
+import binascii
+import uuid
+
+from alembic import op
+import sqlalchemy as sa
+
+BATCH_SIZE = 1000
+
+DEFINITION = ('counter_name', 'counter_type', 'counter_unit')
+
+MESSAGE_COLUMNS = ('message_id', 'message_signature')
+
+
+def _insert_from_select(table, query):
+    rows = [dict(row) for row in op.get_bind().execute(query)]
+    if rows:
+        op.get_bind().execute(table.insert(), rows)
+
+
+def _binary(length):
+    if op.get_bind().engine.name == 'mysql':
+        return sa.types.BINARY(length)
+    return sa.LargeBinary(length)
+
+
+def _pack_uuid(value):
+    try:
+        if str(uuid.UUID(value)) == value:
+            return uuid.UUID(value).bytes
+    except (TypeError, ValueError, AttributeError):
+        pass
+
+
+def _pack_digest(value):
+    try:
+        packed = binascii.unhexlify(value)
+    except (TypeError, ValueError):
+        return None
+    if len(packed) == 32 and binascii.hexlify(packed) == value:
+        return packed
+
+
+def _execute_by_id_range(statement, column):
+    """Execute the statement on the rows whose column, a sample id, is in
+    each range of BATCH_SIZE ids in turn, so a single statement does not
+    lock the whole table nor grow the undo log with it.
+    """
+    bind = op.get_bind()
+    low, high = bind.execute(
+        sa.select([sa.func.min(column), sa.func.max(column)])).first()
+    if low is None:
+        return
+    while low <= high:
+        bind.execute(statement.where(sa.and_(column >= low,
+                                             column < low + BATCH_SIZE)))
+        low += BATCH_SIZE
+
+
+def _update_messages(meter, sources, columns, convert):
+    """Set the given columns of the samples to the values returned by
+    convert for the values of their sources columns, in batches of
+    samples.
+    """
+    bind = op.get_bind()
+    update = meter.update().where(
+        meter.c.id == sa.bindparam('_id'),
+    ).values(**dict((name, sa.bindparam('_' + name, type_=meter.c[name].type))
+                    for name in columns))
+    marker = None
+    while True:
+        query = sa.select([meter.c.id] + [meter.c[name] for name in sources])
+        if marker is not None:
+            query = query.where(meter.c.id > marker)
+        rows = bind.execute(
+            query.order_by(meter.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        marker = rows[-1][0]
+        values = []
+        for row in rows:
+            value = dict(('_' + name, v)
+                         for name, v in convert(*row[1:]).iteritems())
+            value['_id'] = row[0]
+            values.append(value)
+        bind.execute(update, values)
+
+
+def _pack_messages(message_id, message_signature):
+    # The values which do not have their canonical form are kept as text.
+    packed_id = _pack_uuid(message_id)
+    packed_signature = _pack_digest(message_signature)
+    return {
+        'message_id_new': packed_id,
+        'message_id': None if packed_id else message_id,
+        'message_signature_new': packed_signature,
+        'message_signature': (None if packed_signature
+                              else message_signature),
+    }
+
+
+def _unpack_messages(message_id, message_id_text, message_signature,
+                     message_signature_text):
+    if message_id is not None:
+        message_id_text = str(uuid.UUID(bytes=str(message_id)))
+    if message_signature is not None:
+        message_signature_text = binascii.hexlify(str(message_signature))
+    return {
+        'message_id_text': message_id_text,
+        'message_signature_text': message_signature_text,
+    }
+
+
+def _drop_index(name, table):
+    # The sqlite tables rebuilt by earlier migrations lost their indexes.
+    inspector = sa.engine.reflection.Inspector.from_engine(op.get_bind())
+    if name in [index['name'] for index in inspector.get_indexes(table)]:
+        op.drop_index(name, table)
+
+
+def _drop_meter_id_foreign_key():
+    # The foreign key is already gone when the meter table is partitioned,
+    # and sqlite cannot drop it.
+    bind = op.get_bind()
+    if bind.engine.name == 'sqlite':
+        return
+    inspector = sa.engine.reflection.Inspector.from_engine(bind)
+    for fk in inspector.get_foreign_keys('sourceassoc'):
+        if fk['constrained_columns'] == ['meter_id']:
+            op.drop_constraint(fk['name'], 'sourceassoc', type_='foreignkey')
+
+
+def upgrade():
+    op.create_table(
+        'meter_definition',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('counter_name', sa.String(255)),
+        sa.Column('counter_type', sa.String(255)),
+        sa.Column('counter_unit', sa.String(255)),
+        sa.UniqueConstraint('counter_name', 'counter_type', 'counter_unit',
+                            name='uniq_meter_definition0name0type0unit'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+    op.create_table(
+        'meter_source',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(255)),
+        sa.UniqueConstraint('name', name='uniq_meter_source0name'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+
+    bind = op.get_bind()
+    meta = sa.MetaData(bind.engine)
+    meter = sa.Table('meter', meta, autoload=True)
+    sourceassoc = sa.Table('sourceassoc', meta, autoload=True)
+    definition = sa.Table('meter_definition', meta, autoload=True)
+    source = sa.Table('meter_source', meta, autoload=True)
+
+    # Fill the dictionaries from the existing samples.
+    _insert_from_select(definition, sa.select(
+        [meter.c[name] for name in DEFINITION]).distinct())
+    _insert_from_select(source, sa.select(
+        [sourceassoc.c.source_id.label('name')]).where(
+            sourceassoc.c.meter_id.isnot(None)).distinct())
+
+    sa.Column('meter_definition_id', sa.Integer).create(meter)
+    sa.Column('meter_source_id', sa.Integer).create(meter)
+    sa.Column('message_id_new', _binary(16)).create(meter)
+    sa.Column('message_signature_new', _binary(32)).create(meter)
+
+    _execute_by_id_range(meter.update().values(
+        meter_definition_id=sa.select([definition.c.id]).where(sa.and_(
+            *[definition.c[name] == meter.c[name] for name in DEFINITION]
+        )).as_scalar()), meter.c.id)
+    _execute_by_id_range(meter.update().values(
+        meter_source_id=sa.select([sa.func.min(source.c.id)]).where(sa.and_(
+            source.c.name == sourceassoc.c.source_id,
+            sourceassoc.c.meter_id == meter.c.id,
+        )).as_scalar()), meter.c.id)
+    _update_messages(meter, MESSAGE_COLUMNS,
+                     ('message_id_new', 'message_signature_new') +
+                     MESSAGE_COLUMNS, _pack_messages)
+
+    # The samples do not go through sourceassoc anymore.
+    _execute_by_id_range(sourceassoc.delete(), sourceassoc.c.meter_id)
+    _drop_index('idx_sm', 'sourceassoc')
+    _drop_index('idx_meter_rid_cname', 'meter')
+    _drop_meter_id_foreign_key()
+
+    # Reflect the tables again without the dropped indexes, which sqlite
+    # would recreate with the tables.
+    meta = sa.MetaData(bind.engine)
+    meter = sa.Table('meter', meta, autoload=True)
+    sourceassoc = sa.Table('sourceassoc', meta, autoload=True)
+    sourceassoc.c.meter_id.drop()
+    for name in DEFINITION:
+        meter.c[name].drop()
+    for name in MESSAGE_COLUMNS:
+        meter.c[name].alter(name=name + '_text')
+        meter.c[name + '_new'].alter(name=name)
+    op.create_index('idx_meter_rid_mdef', 'meter',
+                    ['resource_id', 'meter_definition_id'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    meta = sa.MetaData(bind.engine)
+    meter = sa.Table('meter', meta, autoload=True)
+    sourceassoc = sa.Table('sourceassoc', meta, autoload=True)
+    definition = sa.Table('meter_definition', meta, autoload=True)
+    source = sa.Table('meter_source', meta, autoload=True)
+
+    for name in DEFINITION:
+        sa.Column(name, sa.String(255)).create(meter)
+    sa.Column('meter_id', sa.Integer).create(sourceassoc)
+
+    _execute_by_id_range(meter.update().values(
+        **dict((name, sa.select([definition.c[name]]).where(
+            definition.c.id == meter.c.meter_definition_id).as_scalar())
+            for name in DEFINITION)), meter.c.id)
+    _insert_from_select(sourceassoc, sa.select([
+        meter.c.id.label('meter_id'),
+        source.c.name.label('source_id'),
+    ]).where(source.c.id == meter.c.meter_source_id))
+    # The packed values are unpacked into the text columns, which already
+    # hold the values which were not packed.
+    _update_messages(meter, ('message_id', 'message_id_text',
+                             'message_signature', 'message_signature_text'),
+                     ('message_id_text', 'message_signature_text'),
+                     _unpack_messages)
+
+    _drop_index('idx_meter_rid_mdef', 'meter')
+    meta = sa.MetaData(bind.engine)
+    meter = sa.Table('meter', meta, autoload=True)
+    meter.c.meter_definition_id.drop()
+    meter.c.meter_source_id.drop()
+    for name in MESSAGE_COLUMNS:
+        meter.c[name].drop()
+        meter.c[name + '_text'].alter(name=name)
+    op.create_index('idx_meter_rid_cname', 'meter',
+                    ['resource_id', 'counter_name'])
+    op.create_index('idx_sm', 'sourceassoc', ['source_id', 'meter_id'])
+    # A partitioned meter table has no foreign keys and cannot be
+    # referenced by one.
+    inspector = sa.engine.reflection.Inspector.from_engine(bind)
+    if bind.engine.name != 'sqlite' and inspector.get_foreign_keys('meter'):
+        op.create_foreign_key('fk_sourceassoc_meter_id', 'sourceassoc',
+                              'meter', ['meter_id'], ['id'])
+
+    op.drop_table('meter_source')
+    op.drop_table('meter_definition')
@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Deduplicate resource metadata
+
+Revision ID: 7b3e9d2f4c61
+Revises: 6a1f3c8e2b57
+Create Date: 2013-09-09 10:14:37.826105
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b3e9d2f4c61'
+down_revision = '6a1f3c8e2b57'
+
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+from ceilometer.storage import base
+from ceilometer.storage import cache
+from ceilometer.storage import impl_sqlalchemy
+
+BATCH_SIZE = 1000
+
+# Number of metadata ids kept by hash while the samples are converted.
+CACHE_SIZE = 10000
+
+META_TABLES = ['metadata_text', 'metadata_bool', 'metadata_int',
+               'metadata_float']
+
+
+def _load(data):
+    return json.loads(data) if data is not None else None
+
+
+def _meter_batches(bind, meter, columns):
+    """Yield the given columns of the samples, in batches of ids."""
+    marker = None
+    while True:
+        query = sa.select([meter.c.id] + columns)
+        if marker is not None:
+            query = query.where(meter.c.id > marker)
+        rows = bind.execute(
+            query.order_by(meter.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        marker = rows[-1][0]
+        yield rows
+
+
+def _clear_metadata_index(bind):
+    for name in META_TABLES:
+        bind.execute(sa.sql.table(name).delete())
+
+
+def upgrade():
+    op.create_table(
+        'meter_metadata',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('metadata_hash', sa.String(32)),
+        sa.Column('resource_metadata', sa.Text),
+        sa.Column('last_sample_timestamp', sa.DateTime),
+        sa.UniqueConstraint('metadata_hash', name='uniq_meter_metadata0hash'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+    op.create_index('ix_meter_metadata_last_sample_timestamp',
+                    'meter_metadata', ['last_sample_timestamp'])
+
+    bind = op.get_bind()
+    meta = sa.MetaData(bind.engine)
+    meter = sa.Table('meter', meta, autoload=True)
+    summary = sa.Table('meter_summary', meta, autoload=True)
+    metadata = sa.Table('meter_metadata', meta, autoload=True)
+    sa.Column('metadata_id', sa.Integer).create(meter)
+    sa.Column('metadata_id', sa.Integer).create(summary)
+
+    # The indexed metadata is keyed by sample, it is indexed again by
+    # distinct metadata.
+    _clear_metadata_index(bind)
+    ids = cache.MemoryCache(CACHE_SIZE)
+    update = meter.update().where(
+        meter.c.id == sa.bindparam('_id'),
+    ).values(metadata_id=sa.bindparam('_metadata_id'))
+    for rows in _meter_batches(bind, meter, [meter.c.resource_metadata]):
+        values = []
+        for meter_id, data in rows:
+            resource_metadata = _load(data)
+            metadata_hash = base.hash_metadata(resource_metadata)
+            metadata_id = ids.get(metadata_hash)
+            if metadata_id is None:
+                metadata_id = bind.execute(sa.select([metadata.c.id]).where(
+                    metadata.c.metadata_hash == metadata_hash)).scalar()
+            if metadata_id is None:
+                metadata_id = bind.execute(metadata.insert(), dict(
+                    metadata_hash=metadata_hash,
+                    resource_metadata=data,
+                )).inserted_primary_key[0]
+                impl_sqlalchemy.index_metadata(bind, metadata_id,
+                                               resource_metadata)
+            ids.set(metadata_hash, metadata_id)
+            values.append(dict(_id=meter_id, _metadata_id=metadata_id))
+        bind.execute(update, values)
+
+    last = sa.select([sa.func.max(meter.c.timestamp)]).where(
+        meter.c.metadata_id == metadata.c.id)
+    bind.execute(metadata.update().values(
+        last_sample_timestamp=last.as_scalar()))
+    bind.execute(summary.update().values(
+        metadata_id=sa.select([meter.c.metadata_id]).where(
+            meter.c.id == summary.c.last_meter_id).as_scalar()))
+
+    meter.c.resource_metadata.drop()
+    summary.c.resource_metadata.drop()
+    op.create_index('ix_meter_metadata_id', 'meter', ['metadata_id'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    meta = sa.MetaData(bind.engine)
+    meter = sa.Table('meter', meta, autoload=True)
+    summary = sa.Table('meter_summary', meta, autoload=True)
+    metadata = sa.Table('meter_metadata', meta, autoload=True)
+    sa.Column('resource_metadata', sa.Text).create(meter)
+    sa.Column('resource_metadata', sa.String(5000)).create(summary)
+
+    for table in (meter, summary):
+        resource_metadata = sa.select([metadata.c.resource_metadata]).where(
+            metadata.c.id == table.c.metadata_id)
+        bind.execute(table.update().values(
+            resource_metadata=resource_metadata.as_scalar()))
+
+    # Index the metadata by sample again.
+    _clear_metadata_index(bind)
+    meter = sa.Table('meter', sa.MetaData(bind.engine), autoload=True)
+    for rows in _meter_batches(bind, meter, [meter.c.resource_metadata]):
+        for meter_id, data in rows:
+            impl_sqlalchemy.index_metadata(bind, meter_id, _load(data))
+
+    op.drop_index('ix_meter_metadata_id', 'meter')
+    meta = sa.MetaData(bind.engine)
+    sa.Table('meter', meta, autoload=True).c.metadata_id.drop()
+    sa.Table('meter_summary', meta, autoload=True).c.metadata_id.drop()
+    op.drop_table('meter_metadata')
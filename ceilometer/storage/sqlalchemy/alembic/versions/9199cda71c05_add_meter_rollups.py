@@ -0,0 +1,85 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Add meter rollups
+
+Revision ID: 9199cda71c05
+Revises: 17738166b91
+Create Date: 2013-08-20 10:12:31.240917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9199cda71c05'
+down_revision = '17738166b91'
+
+from alembic import op
+import sqlalchemy as sa
+
+from ceilometer.openstack.common import timeutils
+from ceilometer.storage import rollup
+
+
+def upgrade():
+    op.create_table(
+        'meter_rollup',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('resolution', sa.Integer),
+        sa.Column('bucket_start', sa.DateTime),
+        sa.Column('rollup_key', sa.String(40)),
+        sa.Column('counter_name', sa.String(255)),
+        sa.Column('resource_id', sa.String(255)),
+        sa.Column('project_id', sa.String(255)),
+        sa.Column('user_id', sa.String(255)),
+        sa.Column('source_id', sa.String(255)),
+        sa.Column('counter_unit', sa.String(255)),
+        sa.Column('count', sa.Integer),
+        sa.Column('sum', sa.Float(53)),
+        sa.Column('min', sa.Float(53)),
+        sa.Column('max', sa.Float(53)),
+        sa.Column('first_timestamp', sa.DateTime),
+        sa.Column('last_timestamp', sa.DateTime),
+        sa.UniqueConstraint('resolution', 'bucket_start', 'rollup_key',
+                            name='uniq_meter_rollup0bucket'),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+    op.create_index('ix_meter_rollup_name_bucket', 'meter_rollup',
+                    ['counter_name', 'resolution', 'bucket_start'])
+    op.create_table(
+        'meter_rollup_watermark',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('timestamp', sa.DateTime),
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+
+    # The existing samples are not rolled up, so the rollups can only be
+    # used from the next day on. Without watermark they are used for any
+    # time, which is right if there is no sample yet.
+    meter = sa.Table('meter', sa.MetaData(op.get_bind()), autoload=True)
+    if op.get_bind().execute(
+            sa.select([sa.func.count(meter.c.id)])).scalar():
+        watermark = sa.sql.table('meter_rollup_watermark',
+                                 sa.sql.column('id', sa.Integer),
+                                 sa.sql.column('timestamp', sa.DateTime))
+        op.bulk_insert(watermark, [{
+            'id': 1,
+            'timestamp': rollup.ceil(timeutils.utcnow(),
+                                     rollup.RESOLUTIONS[0]),
+        }])
+
+
+def downgrade():
+    op.drop_table('meter_rollup_watermark')
+    op.drop_table('meter_rollup')
@@ -0,0 +1,36 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Add meter rollup bucket_start index
+
+Revision ID: c1e3f8a2d4b6
+Revises: 3a7c7b1e5d92
+Create Date: 2013-08-26 09:41:55.108342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c1e3f8a2d4b6'
+down_revision = '3a7c7b1e5d92'
+
+from alembic import op
+
+
+def upgrade():
+    # The expirer looks up the rollups before the watermark.
+    op.create_index('ix_meter_rollup_bucket_start', 'meter_rollup',
+                    ['bucket_start'])
+
+
+def downgrade():
+    op.drop_index('ix_meter_rollup_bucket_start', 'meter_rollup')
@@ -15,20 +15,20 @@
 
 from sqlalchemy import MetaData
 from sqlalchemy import Index
-from ceilometer.storage.sqlalchemy.models import Meter
-
-meta = MetaData()
+from sqlalchemy import Table
 
 
 def upgrade(migrate_engine):
-    meta.bind = migrate_engine
-    index = Index('idx_meter_rid_cname', Meter.resource_id,
-                  Meter.counter_name)
+    meta = MetaData(bind=migrate_engine)
+    meter = Table('meter', meta, autoload=True)
+    index = Index('idx_meter_rid_cname', meter.c.resource_id,
+                  meter.c.counter_name)
     index.create(bind=migrate_engine)
 
 
 def downgrade(migrate_engine):
-    meta.bind = migrate_engine
-    index = Index('idx_meter_rid_cname', Meter.resource_id,
-                  Meter.counter_name)
+    meta = MetaData(bind=migrate_engine)
+    meter = Table('meter', meta, autoload=True)
+    index = Index('idx_meter_rid_cname', meter.c.resource_id,
+                  meter.c.counter_name)
     index.drop(bind=migrate_engine)
@@ -66,12 +66,14 @@ def db_sync(engine):
     db_version(engine)  # This is needed to create a version stamp in empty DB
     repository = _find_migrate_repo()
     versioning_api.upgrade(engine, repository)
-    alembic.command.upgrade(_alembic_config(), "head")
+    alembic.command.upgrade(_alembic_config(engine), "head")
 
 
-def _alembic_config():
+def _alembic_config(engine=None):
     path = os.path.join(os.path.dirname(__file__), 'alembic/alembic.ini')
     config = alembic_config.Config(path)
+    # The engine of the database to migrate, read by env.py.
+    config.attributes = {'engine': engine}
     return config
 
 
@@ -18,16 +18,19 @@
 SQLAlchemy models for Ceilometer data.
 """
 
+import binascii
 import json
 import urlparse
+import uuid
 
 from oslo.config import cfg
 from sqlalchemy import Column, Integer, String, Table, ForeignKey, DateTime, \
-    Index
-from sqlalchemy import Float, Boolean, Text
+    Index, UniqueConstraint
+from sqlalchemy import Float, Boolean, Text, BigInteger
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import BINARY, LargeBinary
 from sqlalchemy.types import TypeDecorator
 
 from ceilometer.openstack.common import timeutils
@@ -67,6 +70,79 @@ class JSONEncodedDict(TypeDecorator):
         return value
 
 
+class FixedBinary(TypeDecorator):
+    """Represents fixed width binary values, as BINARY on MySQL and the
+    generic binary type of the other databases.
+    """
+
+    impl = LargeBinary
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(BINARY(self.impl.length))
+        return dialect.type_descriptor(self.impl)
+
+
+class PackedUUID(FixedBinary):
+    """Represents a UUID string as its 16 bytes.
+
+    Only the canonical form of a UUID can be stored, so it is read back
+    unchanged, see is_canonical().
+    """
+
+    def __init__(self):
+        super(PackedUUID, self).__init__(length=16)
+
+    @staticmethod
+    def is_canonical(value):
+        try:
+            return str(uuid.UUID(value)) == value
+        except (TypeError, ValueError, AttributeError):
+            return False
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            if not self.is_canonical(value):
+                raise ValueError('%r is not a canonical UUID' % (value,))
+            value = uuid.UUID(value).bytes
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = str(uuid.UUID(bytes=str(value)))
+        return value
+
+
+class PackedHex(FixedBinary):
+    """Represents a lower case hexadecimal digest string as its bytes.
+
+    Only the digests of the length of the column can be stored, so they
+    are read back unchanged, see is_canonical().
+    """
+
+    def __init__(self, length):
+        super(PackedHex, self).__init__(length=length)
+
+    def is_canonical(self, value):
+        try:
+            return (len(value) == 2 * self.impl.length and
+                    binascii.hexlify(binascii.unhexlify(value)) == value)
+        except (TypeError, ValueError):
+            return False
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            if not self.is_canonical(value):
+                raise ValueError('%r is not a canonical digest' % (value,))
+            value = binascii.unhexlify(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = binascii.hexlify(str(value))
+        return value
+
+
 class CeilometerBase(object):
     """Base class for Ceilometer Models."""
     __table_args__ = table_args()
@@ -88,8 +164,6 @@ Base = declarative_base(cls=CeilometerBase)
 
 
 sourceassoc = Table('sourceassoc', Base.metadata,
-                    Column('meter_id', Integer,
-                           ForeignKey("meter.id")),
                     Column('project_id', String(255),
                            ForeignKey("project.id")),
                     Column('resource_id', String(255),
@@ -102,7 +176,6 @@ sourceassoc = Table('sourceassoc', Base.metadata,
 Index('idx_su', sourceassoc.c['source_id'], sourceassoc.c['user_id']),
 Index('idx_sp', sourceassoc.c['source_id'], sourceassoc.c['project_id']),
 Index('idx_sr', sourceassoc.c['source_id'], sourceassoc.c['resource_id']),
-Index('idx_sm', sourceassoc.c['source_id'], sourceassoc.c['meter_id']),
 Index('ix_sourceassoc_source_id', sourceassoc.c['source_id'])
 
 
@@ -111,6 +184,50 @@ class Source(Base):
     id = Column(String(255), primary_key=True)
 
 
+class MeterDefinition(Base):
+    """Name, type and unit of the samples of a meter, referenced by
+    their id.
+    """
+
+    __tablename__ = 'meter_definition'
+    __table_args__ = (
+        UniqueConstraint('counter_name', 'counter_type', 'counter_unit',
+                         name='uniq_meter_definition0name0type0unit'),
+    )
+    id = Column(Integer, primary_key=True)
+    counter_name = Column(String(255))
+    counter_type = Column(String(255))
+    counter_unit = Column(String(255))
+
+
+class MeterSource(Base):
+    """Source of the samples, referenced by its id."""
+
+    __tablename__ = 'meter_source'
+    __table_args__ = (
+        UniqueConstraint('name', name='uniq_meter_source0name'),
+    )
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255))
+
+
+class MeterMetadata(Base):
+    """A distinct resource metadata of the samples, referenced by its id."""
+
+    __tablename__ = 'meter_metadata'
+    __table_args__ = (
+        UniqueConstraint('metadata_hash', name='uniq_meter_metadata0hash'),
+        Index('ix_meter_metadata_last_sample_timestamp',
+              'last_sample_timestamp'),
+    )
+    id = Column(Integer, primary_key=True)
+    # MD5 of the canonical JSON of the metadata, see
+    # ceilometer.storage.base.hash_metadata
+    metadata_hash = Column(String(32))
+    resource_metadata = Column(JSONEncodedDict())
+    last_sample_timestamp = Column(DateTime)
+
+
 class Meter(Base):
     """Metering data."""
 
@@ -119,37 +236,175 @@ class Meter(Base):
         Index('ix_meter_timestamp', 'timestamp'),
         Index('ix_meter_user_id', 'user_id'),
         Index('ix_meter_project_id', 'project_id'),
-        Index('idx_meter_rid_cname', 'resource_id', 'counter_name'),
+        Index('idx_meter_rid_mdef', 'resource_id', 'meter_definition_id'),
+        Index('ix_meter_metadata_id', 'metadata_id'),
     )
     id = Column(Integer, primary_key=True)
-    counter_name = Column(String(255))
-    sources = relationship("Source", secondary=lambda: sourceassoc)
+    # Ids in the meter_definition and meter_source dictionaries.
+    meter_definition_id = Column(Integer)
+    meter_source_id = Column(Integer)
     user_id = Column(String(255), ForeignKey('user.id'))
     project_id = Column(String(255), ForeignKey('project.id'))
     resource_id = Column(String(255), ForeignKey('resource.id'))
-    resource_metadata = Column(JSONEncodedDict())
-    counter_type = Column(String(255))
-    counter_unit = Column(String(255))
+    # Id in the meter_metadata table.
+    metadata_id = Column(Integer)
     counter_volume = Column(Float(53))
     timestamp = Column(DateTime, default=timeutils.utcnow)
-    message_signature = Column(String(1000))
-    message_id = Column(String(1000))
+    # HMAC-SHA256 of the sample and its message uuid, packed when they
+    # have their canonical form, kept as they are in the _text columns
+    # otherwise.
+    message_signature = Column(PackedHex(32))
+    message_signature_text = Column(String(1000))
+    message_id = Column(PackedUUID())
+    message_id_text = Column(String(1000))
+
+
+class MetaText(Base):
+    """Indexed string values of the resource metadata."""
+
+    __tablename__ = 'metadata_text'
+    __table_args__ = (
+        Index('ix_meta_text_key_value', 'meta_key', 'value'),
+    )
+    # The id of the metadata in the meter_metadata table.
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    meta_key = Column(String(255), primary_key=True)
+    value = Column(String(255))
+
+
+class MetaBool(Base):
+    """Indexed boolean values of the resource metadata."""
+
+    __tablename__ = 'metadata_bool'
+    __table_args__ = (
+        Index('ix_meta_bool_key_value', 'meta_key', 'value'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    meta_key = Column(String(255), primary_key=True)
+    value = Column(Boolean)
+
+
+class MetaBigInt(Base):
+    """Indexed integer values of the resource metadata."""
+
+    __tablename__ = 'metadata_int'
+    __table_args__ = (
+        Index('ix_meta_int_key_value', 'meta_key', 'value'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    meta_key = Column(String(255), primary_key=True)
+    value = Column(BigInteger)
+
+
+class MetaFloat(Base):
+    """Indexed floating point values of the resource metadata."""
+
+    __tablename__ = 'metadata_float'
+    __table_args__ = (
+        Index('ix_meta_float_key_value', 'meta_key', 'value'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    meta_key = Column(String(255), primary_key=True)
+    value = Column(Float(53))
+
+
+class MeterRollup(Base):
+    """Aggregates of the samples of a meter over a bucket of time."""
+
+    __tablename__ = 'meter_rollup'
+    __table_args__ = (
+        UniqueConstraint('resolution', 'bucket_start', 'rollup_key',
+                         name='uniq_meter_rollup0bucket'),
+        Index('ix_meter_rollup_name_bucket', 'counter_name', 'resolution',
+              'bucket_start'),
+        Index('ix_meter_rollup_bucket_start', 'bucket_start'),
+    )
+    id = Column(Integer, primary_key=True)
+    resolution = Column(Integer)
+    bucket_start = Column(DateTime)
+    # Hash of the dimensions below, see ceilometer.storage.rollup.make_key
+    rollup_key = Column(String(40))
+    counter_name = Column(String(255))
+    resource_id = Column(String(255))
+    project_id = Column(String(255))
+    user_id = Column(String(255))
+    source_id = Column(String(255))
+    counter_unit = Column(String(255))
+    count = Column(Integer)
+    sum = Column(Float(53))
+    min = Column(Float(53))
+    max = Column(Float(53))
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+
+
+class MeterRollupWatermark(Base):
+    """Time from which the meter rollups hold every sample."""
+
+    __tablename__ = 'meter_rollup_watermark'
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime)
+
+
+class MeterSummary(Base):
+    """The first and last samples of each meter of a resource, by owner,
+    maintained as the samples are recorded to list the meters and
+    resources.
+    """
+
+    __tablename__ = 'meter_summary'
+    __table_args__ = (
+        UniqueConstraint('summary_key', name='uniq_meter_summary0key'),
+        Index('ix_meter_summary_meter', 'resource_id', 'counter_name'),
+        Index('ix_meter_summary_user_id', 'user_id'),
+        Index('ix_meter_summary_project_id', 'project_id'),
+        Index('ix_meter_summary_last_timestamp', 'last_timestamp'),
+    )
+    id = Column(Integer, primary_key=True)
+    # Hash of the dimensions below, see
+    # ceilometer.storage.impl_sqlalchemy.make_summary_key
+    summary_key = Column(String(40))
+    resource_id = Column(String(255))
+    counter_name = Column(String(255))
+    counter_type = Column(String(255))
+    counter_unit = Column(String(255))
+    user_id = Column(String(255))
+    project_id = Column(String(255))
+    # Source of the first sample.
+    source_id = Column(String(255))
+    # Id in the meter_metadata table of the metadata of the latest sample.
+    metadata_id = Column(Integer)
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+    # The id of the latest sample in the meter table, ordering the samples
+    # sharing a timestamp.
+    last_meter_id = Column(Integer)
 
 
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (
+        Index('ix_user_last_sample_timestamp', 'last_sample_timestamp'),
+    )
     id = Column(String(255), primary_key=True)
     sources = relationship("Source", secondary=lambda: sourceassoc)
     resources = relationship("Resource", backref='user')
     meters = relationship("Meter", backref='user')
+    # Timestamp of the most recent sample, NULL if recorded before it was
+    # maintained.
+    last_sample_timestamp = Column(DateTime)
 
 
 class Project(Base):
     __tablename__ = 'project'
+    __table_args__ = (
+        Index('ix_project_last_sample_timestamp', 'last_sample_timestamp'),
+    )
     id = Column(String(255), primary_key=True)
     sources = relationship("Source", secondary=lambda: sourceassoc)
     resources = relationship("Resource", backref='project')
     meters = relationship("Meter", backref='project')
+    last_sample_timestamp = Column(DateTime)
 
 
 class Resource(Base):
@@ -157,6 +412,7 @@ class Resource(Base):
     __table_args__ = (
         Index('ix_resource_project_id', 'project_id'),
         Index('ix_resource_user_id', 'user_id'),
+        Index('ix_resource_last_sample_timestamp', 'last_sample_timestamp'),
     )
     id = Column(String(255), primary_key=True)
     sources = relationship("Source", secondary=lambda: sourceassoc)
@@ -164,6 +420,16 @@ class Resource(Base):
     user_id = Column(String(255), ForeignKey('user.id'))
     project_id = Column(String(255), ForeignKey('project.id'))
     meters = relationship("Meter", backref='resource')
+    last_sample_timestamp = Column(DateTime)
+
+
+class ExpirerCheckpoint(Base):
+    """Progress of an interrupted expiration of the rows of a table."""
+
+    __tablename__ = 'expirer_checkpoint'
+    table_name = Column(String(255), primary_key=True)
+    # The rows with a lower id have been expired.
+    last_id = Column(Integer)
 
 
 class Alarm(Base):
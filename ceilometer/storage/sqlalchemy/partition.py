@@ -0,0 +1,190 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Time partitioning of the meter table.
+
+The meter table is split into native range partitions of a day or a week
+of samples, on their timestamp. The time bounds of the queries let the
+database only read the partitions they overlap, and the expirer drops the
+partitions holding only expired samples instead of deleting their rows.
+
+Only MySQL is supported. A partitioned MySQL table can neither hold nor be
+referenced by foreign keys, and its primary key must include the
+partitioning column, so these constraints of the meter table are replaced
+when it is partitioned.
+"""
+
+import datetime
+
+from sqlalchemy import text
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+PERIODS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1),
+}
+
+# Number of partitions created in advance of the current one.
+PARTITIONS_AHEAD = 2
+
+MAXVALUE = 'MAXVALUE'
+
+
+def period_start(timestamp, period):
+    """Return the start of the partition period holding timestamp."""
+    start = datetime.datetime(timestamp.year, timestamp.month,
+                              timestamp.day)
+    if period == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+
+def make_bounds(start, end, period):
+    """Return the exclusive upper bounds of the partitions holding
+    [start, end].
+    """
+    bound = period_start(start, period) + PERIODS[period]
+    bounds = [bound]
+    while bound <= end:
+        bound += PERIODS[period]
+        bounds.append(bound)
+    return bounds
+
+
+def partition_name(bound):
+    """Return the name of the partition ending at bound."""
+    return bound.strftime('p%Y%m%d')
+
+
+def partition_definitions(bounds):
+    """Return the SQL definition of the partitions ending at bounds,
+    followed by the partition catching the samples after them.
+    """
+    return ', '.join(
+        ["PARTITION %s VALUES LESS THAN ('%s')" % (
+            partition_name(bound), bound.strftime('%Y-%m-%d %H:%M:%S'))
+         for bound in bounds] +
+        ['PARTITION pmax VALUES LESS THAN (MAXVALUE)'])
+
+
+class MySQLPartitioner(object):
+    """Maintain the range partitions of a MySQL table on its timestamp."""
+
+    def __init__(self, engine, period, table='meter'):
+        self.engine = engine
+        self.period = period
+        self.table = table
+
+    def get_partitions(self):
+        """Return the (name, upper bound) of the partitions, in order.
+
+        The bound of the last partition is None, as it holds every sample
+        after the others.
+        """
+        rows = self.engine.execute(text(
+            "SELECT partition_name, partition_description "
+            "FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = :table "
+            "AND partition_name IS NOT NULL "
+            "ORDER BY partition_ordinal_position"), table=self.table)
+        partitions = []
+        for name, description in rows:
+            if description == MAXVALUE:
+                bound = None
+            else:
+                bound = datetime.datetime.strptime(description.strip("'"),
+                                                   '%Y-%m-%d %H:%M:%S')
+            partitions.append((name, bound))
+        return partitions
+
+    def _drop_foreign_keys(self):
+        rows = self.engine.execute(text(
+            "SELECT DISTINCT table_name, constraint_name "
+            "FROM information_schema.key_column_usage "
+            "WHERE table_schema = DATABASE() "
+            "AND referenced_table_name IS NOT NULL "
+            "AND (table_name = :table OR referenced_table_name = :table)"),
+            table=self.table).fetchall()
+        for table, constraint in rows:
+            self.engine.execute('ALTER TABLE `%s` DROP FOREIGN KEY `%s`' %
+                                (table, constraint))
+
+    def setup(self, now):
+        """Partition the table if it is not yet, the existing samples all
+        going into a first partition ending with the current period.
+        """
+        if self.get_partitions():
+            return self.extend(now)
+        LOG.info(_('Partitioning the %(table)s table by %(period)s'),
+                 {'table': self.table, 'period': self.period})
+        self._drop_foreign_keys()
+        bounds = make_bounds(now, now, self.period)
+        bounds.extend(bounds[-1] + PERIODS[self.period] * i
+                      for i in range(1, PARTITIONS_AHEAD + 1))
+        self.engine.execute(
+            'ALTER TABLE `%s` '
+            'DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp) '
+            'PARTITION BY RANGE COLUMNS(timestamp) (%s)' %
+            (self.table, partition_definitions(bounds)))
+
+    def extend(self, now):
+        """Create the partitions of the next periods, in advance."""
+        partitions = self.get_partitions()
+        bounds = [bound for name, bound in partitions if bound is not None]
+        last = bounds[-1] if bounds else period_start(now, self.period)
+        until = period_start(now, self.period) + (
+            PERIODS[self.period] * (PARTITIONS_AHEAD + 1))
+        new_bounds = []
+        while last < until:
+            last += PERIODS[self.period]
+            new_bounds.append(last)
+        if new_bounds:
+            # The catch-all partition is split, which copies the samples it
+            # holds if the partitions were not created in advance.
+            self.engine.execute(
+                'ALTER TABLE `%s` REORGANIZE PARTITION pmax INTO (%s)' %
+                (self.table, partition_definitions(new_bounds)))
+
+    def drop_before(self, end):
+        """Drop the partitions holding only samples older than end.
+
+        :return: The names of the partitions dropped.
+        """
+        names = [name for name, bound in self.get_partitions()
+                 if bound is not None and bound <= end]
+        if names:
+            LOG.info(_('Dropping the partitions %(names)s of %(table)s'),
+                     {'names': ', '.join(names), 'table': self.table})
+            self.engine.execute('ALTER TABLE `%s` DROP PARTITION %s' %
+                                (self.table, ', '.join(names)))
+        return names
+
+
+def get_partitioner(engine, period):
+    """Return the partitioner of the meter table, None if it is not
+    partitioned.
+    """
+    if not period:
+        return None
+    if period not in PERIODS:
+        raise ValueError(_('Unknown meter partition period %s') % period)
+    if engine.name != 'mysql':
+        LOG.warn(_('The %s database does not support the partitioning of '
+                   'the meter table, the samples are expired by batches'),
+                 engine.name)
+        return None
+    return MySQLPartitioner(engine, period)
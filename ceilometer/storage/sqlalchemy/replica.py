@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Routing of the read queries to a replica database.
+
+The sample, meter, resource, statistics and event queries may be read from
+the replica set by the slave_connection option, as long as it is reachable
+and its replication lag is at most slave_max_lag seconds. They are read
+from the primary database otherwise. The writes and the alarms, whose
+evaluation must see the state it just updated, always use the primary.
+
+The lag is read from SHOW SLAVE STATUS on MySQL and from the replay
+timestamp of a hot standby on PostgreSQL. Any other database is assumed to
+be in sync.
+"""
+
+import time
+
+from sqlalchemy import text
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+import ceilometer.openstack.common.db.sqlalchemy.session as sqlalchemy_session
+
+LOG = log.getLogger(__name__)
+
+# Number of seconds the result of a replica check is reused.
+CHECK_INTERVAL = 10
+
+POSTGRESQL_LAG = text(
+    "SELECT CASE WHEN pg_last_xlog_receive_location() = "
+    "pg_last_xlog_replay_location() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+
+def _now():
+    return time.time()
+
+
+def get_replication_lag(engine):
+    """Return the number of seconds the replica is behind the primary, or
+    None if it is not replicating.
+    """
+    if engine.name == 'mysql':
+        row = engine.execute(text('SHOW SLAVE STATUS')).first()
+        if row is None:
+            # Not configured as a slave, the database is its own primary.
+            return 0
+        return row['Seconds_Behind_Master']
+    if engine.name == 'postgresql':
+        return engine.execute(POSTGRESQL_LAG).scalar()
+    return 0
+
+
+class Replica(object):
+    """Tells whether the read queries can be sent to the replica."""
+
+    def __init__(self, max_lag, check_interval=CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._usable = False
+        self._checked_at = None
+
+    def is_usable(self):
+        """Return whether the replica is reachable and lagging at most
+        max_lag seconds, as of the last check.
+        """
+        now = _now()
+        if (self._checked_at is None or
+                now - self._checked_at >= self.check_interval):
+            self._usable = self._check()
+            self._checked_at = now
+        return self._usable
+
+    def _check(self):
+        try:
+            engine = sqlalchemy_session.get_engine(slave_engine=True)
+            lag = get_replication_lag(engine)
+        except Exception as err:
+            LOG.warning(_('Reading from the primary database, the replica '
+                          'is unavailable: %s'), err)
+            return False
+        if lag is None:
+            LOG.warning(_('Reading from the primary database, the replica '
+                          'is not replicating'))
+            return False
+        if lag > self.max_lag:
+            LOG.warning(_('Reading from the primary database, the replica '
+                          'is lagging %s seconds behind'), lag)
+            return False
+        return True
@@ -0,0 +1,370 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""In-memory tier of the most recent samples in front of a storage driver
+"""
+
+import bisect
+import copy
+import datetime
+import threading
+
+from oslo.config import cfg
+
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import timeutils
+from ceilometer import storage
+from ceilometer.storage import base
+from ceilometer.storage import models
+
+OPTS = [
+    cfg.IntOpt('hot_window',
+               default=0,
+               help='Number of seconds of the most recent samples kept in '
+               'memory to answer the sample and statistics queries, '
+               'disabled if 0'),
+    cfg.IntOpt('hot_window_refresh_interval',
+               default=10,
+               help='Number of seconds between the reads of the samples '
+               'recorded by the other processes into the in-memory window, '
+               'never if 0'),
+    cfg.IntOpt('hot_window_late_arrival',
+               default=60,
+               help='Number of seconds before the previous read of the '
+               'samples recorded by the other processes the next read '
+               'starts at, the older samples are read from the database'),
+]
+
+cfg.CONF.register_opts(OPTS, group='database')
+
+LOG = log.getLogger(__name__)
+
+
+def match(data, sample_filter):
+    """Return whether a meter message matches the sample filter."""
+    f = sample_filter
+    ts = data['timestamp']
+    if f.start and (ts < f.start or
+                    f.start_timestamp_op == 'gt' and ts == f.start):
+        return False
+    if f.end and (ts > f.end or
+                  f.end_timestamp_op != 'le' and ts == f.end):
+        return False
+    if f.marker_timestamp and (ts, data['message_id']) >= (
+            f.marker_timestamp, f.marker_message_id or ''):
+        return False
+    for name, value in (('counter_name', f.meter),
+                        ('user_id', f.user),
+                        ('project_id', f.project),
+                        ('resource_id', f.resource),
+                        ('source', f.source)):
+        if value is not None and data[name] != value:
+            return False
+    return base.match_metaquery(data['resource_metadata'], f.metaquery)
+
+
+def make_sample(data):
+    return models.Sample(
+        source=data['source'],
+        counter_name=data['counter_name'],
+        counter_type=data['counter_type'],
+        counter_unit=data['counter_unit'],
+        counter_volume=data['counter_volume'],
+        user_id=data['user_id'],
+        project_id=data['project_id'],
+        resource_id=data['resource_id'],
+        timestamp=data['timestamp'],
+        resource_metadata=data['resource_metadata'],
+        message_id=data['message_id'],
+        message_signature=data['message_signature'],
+    )
+
+
+def merge_statistics(a, b):
+    """Return the statistics of the samples of both a and b."""
+    duration_start = min(a.duration_start, b.duration_start)
+    duration_end = max(a.duration_end, b.duration_end)
+    count = a.count + b.count
+    total = a.sum + b.sum
+    return models.Statistics(
+        unit=a.unit,
+        count=count,
+        min=min(a.min, b.min),
+        max=max(a.max, b.max),
+        avg=total / float(count),
+        sum=total,
+        period=a.period,
+        period_start=min(a.period_start, b.period_start),
+        period_end=max(a.period_end, b.period_end),
+        duration=timeutils.delta_seconds(duration_start, duration_end),
+        duration_start=duration_start,
+        duration_end=duration_end,
+    )
+
+
+class HotWindow(object):
+    """The samples recorded since a point in time, indexed by meter and
+    sorted by (timestamp, message_id) in each meter.
+    """
+
+    def __init__(self):
+        self._meters = {}
+        self._message_ids = set()
+
+    def __len__(self):
+        return len(self._message_ids)
+
+    def add(self, data):
+        """Add a meter message, unless it was already added."""
+        if data['message_id'] in self._message_ids:
+            return
+        self._message_ids.add(data['message_id'])
+        bisect.insort(self._meters.setdefault(data['counter_name'], []),
+                      (data['timestamp'], data['message_id'], data))
+
+    def evict(self, before):
+        """Drop the samples older than before."""
+        for meter, samples in self._meters.items():
+            i = bisect.bisect_left(samples, (before,))
+            for ts, message_id, data in samples[:i]:
+                self._message_ids.discard(message_id)
+            if i == len(samples):
+                del self._meters[meter]
+            elif i:
+                del samples[:i]
+
+    def find(self, sample_filter):
+        """Return the meter messages matching the filter, the latest first.
+        """
+        f = sample_filter
+        if f.meter is not None:
+            series = [self._meters.get(f.meter, [])]
+        else:
+            series = self._meters.values()
+        found = []
+        for samples in series:
+            lo = 0
+            if f.start:
+                lo = bisect.bisect_left(samples, (f.start,))
+            found.extend(s for s in samples[lo:] if match(s[2], f))
+        found.sort(reverse=True)
+        return [data for ts, message_id, data in found]
+
+
+class TieredConnection(object):
+    """Storage Connection answering the sample and statistics queries on
+    the last window seconds from memory, and from another Connection
+    before that.
+
+    The window is loaded from the other Connection on the first query, then
+    fed with the samples recorded through this Connection. The samples
+    recorded by other processes are read every refresh_interval seconds,
+    from late_arrival seconds before the previous read. A sample older
+    than that may have been recorded since the previous read without
+    being read, so the window then only answers from there, and the
+    other Connection before. Every other attribute is the one of the
+    wrapped connection.
+    """
+
+    def __init__(self, conn, window, refresh_interval=0, late_arrival=0):
+        self.conn = conn
+        self.window = datetime.timedelta(seconds=window)
+        self.refresh_interval = refresh_interval
+        self.late_arrival = datetime.timedelta(seconds=late_arrival)
+        self._lock = threading.RLock()
+        self._reset()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def _reset(self):
+        self.hot = HotWindow()
+        # Every sample more recent than the horizon is in memory, nothing
+        # is until the window is loaded.
+        self.horizon = None
+        self.refreshed_at = None
+
+    def _read(self, start):
+        for s in self.conn.get_samples(storage.SampleFilter(start=start)):
+            self.hot.add(s.as_dict())
+
+    def _advance(self):
+        """Load, refresh and slide the window, and return its horizon."""
+        now = timeutils.utcnow()
+        with self._lock:
+            horizon = now - self.window
+            if self.horizon is None:
+                self._read(horizon)
+                self.horizon = horizon
+                self.refreshed_at = now
+                LOG.info(_('Loaded %(count)d samples since %(horizon)s in '
+                           'memory'), {'count': len(self.hot),
+                                       'horizon': self.horizon})
+            elif (self.refresh_interval and
+                  timeutils.delta_seconds(self.refreshed_at, now) >=
+                  self.refresh_interval):
+                start = max(self.horizon,
+                            self.refreshed_at - self.late_arrival)
+                self._read(start)
+                self.refreshed_at = now
+                # The samples before start recorded since the previous
+                # read are only in the other Connection.
+                horizon = max(horizon, start)
+            if horizon > self.horizon:
+                self.horizon = horizon
+                self.hot.evict(self.horizon)
+            return self.horizon
+
+    def clear(self):
+        with self._lock:
+            self.conn.clear()
+            self._reset()
+
+    def record_metering_data(self, data):
+        self.conn.record_metering_data(data)
+        self._add_hot([data])
+
+    def record_metering_data_batch(self, samples):
+        self.conn.record_metering_data_batch(samples)
+        self._add_hot(samples)
+
+    def _add_hot(self, samples):
+        with self._lock:
+            for data in samples:
+                if (self.horizon is not None and data.get('timestamp') and
+                        data['timestamp'] >= self.horizon):
+                    self.hot.add(data)
+
+    def _split(self, sample_filter):
+        """Return the filters of the samples before the horizon, to query
+        the wrapped connection, and after it, to query the window. Either
+        is None if it can not match any sample.
+        """
+        horizon = self._advance()
+        f = sample_filter
+        if f.start and f.start >= horizon:
+            return None, f
+        if f.end and f.end <= horizon:
+            return f, None
+        before = copy.copy(f)
+        before.end = horizon
+        before.end_timestamp_op = 'lt'
+        after = copy.copy(f)
+        after.start = horizon
+        after.start_timestamp_op = 'ge'
+        return before, after
+
+    def get_samples(self, sample_filter, limit=None):
+        """Return an iterable of models.Sample instances, the ones of the
+        window first.
+        """
+        if limit == 0:
+            return
+        before, after = self._split(sample_filter)
+        if after is not None:
+            with self._lock:
+                found = self.hot.find(after)
+            if limit:
+                found = found[:limit]
+                limit -= len(found)
+            for data in found:
+                yield make_sample(data)
+            if limit == 0:
+                return
+        if before is not None:
+            for s in self.conn.get_samples(before, limit=limit):
+                yield s
+
+    def _window_statistics(self, sample_filter, period, period_origin):
+        with self._lock:
+            found = self.hot.find(sample_filter)
+        buckets = {}
+        for data in reversed(found):
+            if period:
+                i = int(timeutils.delta_seconds(period_origin,
+                                                data['timestamp']) // period)
+            else:
+                i = 0
+            buckets.setdefault(i, []).append(data)
+        for i, samples in sorted(buckets.iteritems()):
+            volumes = [s['counter_volume'] for s in samples]
+            duration_start = samples[0]['timestamp']
+            duration_end = samples[-1]['timestamp']
+            if period:
+                period_start = period_origin + datetime.timedelta(
+                    seconds=i * period)
+                period_end = period_start + datetime.timedelta(
+                    seconds=period)
+            else:
+                period_start, period_end = duration_start, duration_end
+            yield models.Statistics(
+                unit=samples[0]['counter_unit'],
+                count=len(volumes),
+                min=min(volumes),
+                max=max(volumes),
+                avg=sum(volumes) / float(len(volumes)),
+                sum=sum(volumes),
+                period=int(period or 0),
+                period_start=period_start,
+                period_end=period_end,
+                duration=timeutils.delta_seconds(duration_start,
+                                                 duration_end),
+                duration_start=duration_start,
+                duration_end=duration_end,
+            )
+
+    def get_meter_statistics(self, sample_filter, period=None):
+        """Return an iterable of models.Statistics instances, the ones of
+        the period spanning the horizon being merged from both tiers.
+        """
+        if not sample_filter.meter:
+            raise RuntimeError('Missing required meter specifier')
+        before, after = self._split(sample_filter)
+        origin = sample_filter.start
+        if period and not origin:
+            # The periods start with the first sample of either tier.
+            stats = list(self.get_meter_statistics(sample_filter))
+            if not stats:
+                return []
+            origin = stats[0].duration_start
+            if before is not None:
+                before = copy.copy(before)
+                before.start = origin
+                before.start_timestamp_op = 'ge'
+
+        results = {}
+        if before is not None:
+            for s in self.conn.get_meter_statistics(before, period):
+                results[s.period_start if period else None] = s
+        if after is not None:
+            for s in self._window_statistics(after, period, origin):
+                key = s.period_start if period else None
+                if key in results:
+                    s = merge_statistics(results[key], s)
+                results[key] = s
+        return [stat for k, stat in sorted(results.iteritems())]
+
+
+def get_tiered_connection(conn, conf):
+    """Wrap conn into a TieredConnection if the in-memory window is
+    enabled.
+    """
+    if not conf.database.hot_window:
+        return conn
+    LOG.info(_('Keeping the samples of the last %d seconds in memory'),
+             conf.database.hot_window)
+    return TieredConnection(conn,
+                            conf.database.hot_window,
+                            conf.database.hot_window_refresh_interval,
+                            conf.database.hot_window_late_arrival)
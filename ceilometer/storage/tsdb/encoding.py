@@ -0,0 +1,165 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Encodings of the columns of the time series chunks.
+
+Every encoder takes a list of values and returns a string, every decoder
+takes that string, as a bytearray, and the number of values, and returns
+the list of values.
+
+- the timestamps, in microseconds since the epoch, are stored as the zigzag
+  varint of their delta-of-delta, a regular series costs a byte per sample;
+- the volumes are XORed with the previous one and only the meaningful bytes
+  of the result are stored, a byte-aligned variant of the Gorilla float
+  compression, so a constant series costs a byte per sample;
+- the dictionary ids are run-length encoded varints;
+- the strings are length-prefixed UTF-8.
+"""
+
+import struct
+
+DOUBLE = struct.Struct('<d')
+UINT64 = struct.Struct('<Q')
+
+
+def write_varint(out, value):
+    """Append the unsigned varint of value to the bytearray out."""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    """Return the unsigned varint at pos in data, and the position after
+    it.
+    """
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode_timestamps(timestamps):
+    out = bytearray()
+    prev = prev_delta = 0
+    for i, ts in enumerate(timestamps):
+        delta = ts - prev
+        write_varint(out, zigzag(delta - prev_delta))
+        prev = ts
+        # The first timestamp is stored as is, not as a delta.
+        prev_delta = delta if i else 0
+    return str(out)
+
+
+def decode_timestamps(data, count):
+    timestamps = []
+    pos = prev = prev_delta = 0
+    for i in xrange(count):
+        value, pos = read_varint(data, pos)
+        delta = unzigzag(value) + prev_delta
+        prev += delta
+        timestamps.append(prev)
+        prev_delta = delta if i else 0
+    return timestamps
+
+
+def encode_floats(values):
+    out = bytearray()
+    prev = 0
+    for value in values:
+        bits = UINT64.unpack(DOUBLE.pack(value))[0]
+        xor = bits ^ prev
+        prev = bits
+        if not xor:
+            out.append(0)
+            continue
+        packed = struct.pack('>Q', xor)
+        leading = len(packed) - len(packed.lstrip('\0'))
+        meaningful = packed[leading:len(packed.rstrip('\0'))]
+        # The header can not be 0, as xor has at least a meaningful byte.
+        out.append(leading << 4 | len(meaningful))
+        out.extend(meaningful)
+    return str(out)
+
+
+def decode_floats(data, count):
+    values = []
+    pos = prev = 0
+    for i in xrange(count):
+        header = data[pos]
+        pos += 1
+        if header:
+            length = header & 0x0f
+            xor = 0
+            for byte in data[pos:pos + length]:
+                xor = xor << 8 | byte
+            pos += length
+            prev ^= xor << (8 * (8 - (header >> 4) - length))
+        values.append(DOUBLE.unpack(UINT64.pack(prev))[0])
+    return values
+
+
+def encode_runs(values):
+    out = bytearray()
+    i = 0
+    while i < len(values):
+        value = values[i]
+        run = 1
+        while i + run < len(values) and values[i + run] == value:
+            run += 1
+        write_varint(out, value)
+        write_varint(out, run)
+        i += run
+    return str(out)
+
+
+def decode_runs(data, count):
+    values = []
+    pos = 0
+    while len(values) < count:
+        value, pos = read_varint(data, pos)
+        run, pos = read_varint(data, pos)
+        values.extend([value] * run)
+    return values
+
+
+def encode_strings(values):
+    out = bytearray()
+    for value in values:
+        value = (value or '').encode('utf-8')
+        write_varint(out, len(value))
+        out.extend(value)
+    return str(out)
+
+
+def decode_strings(data, count):
+    values = []
+    pos = 0
+    for i in xrange(count):
+        length, pos = read_varint(data, pos)
+        values.append(str(data[pos:pos + length]).decode('utf-8'))
+        pos += length
+    return values
@@ -0,0 +1,698 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Files of the time series storage driver.
+
+A store is a directory holding:
+
+- MANIFEST: the names of the current files and the size of the index, as
+  JSON, replaced atomically;
+- dictionary: the strings referenced by id from the chunks and the index,
+  like the meter names and the resource ids, never rewritten;
+- chunks.N: the sealed chunks, each holding the columns of up to
+  chunk_size samples of a (meter, resource) series, in time order;
+- index.N: a fixed-size record per chunk with its series, project, unit,
+  time range, location and aggregates;
+- metadata.N: the versions of the metadata of the resources, a version is
+  only added when the metadata of a resource changes and the samples refer
+  to the version they were recorded with;
+- wal.N: the samples of the head, not sealed into chunks yet;
+- alarms and events, for the rest of the storage API.
+
+The files other than MANIFEST are only appended to, as sequences of records
+made of a header holding the payload length and its CRC32, followed by the
+payload, except the chunks and index files. Once the head holds wal_size
+samples, the series holding enough samples are sealed into chunks and a
+new WAL is started with the remaining ones. The expirer writes a new
+generation of the chunks, index, metadata and WAL files without the
+expired samples.
+
+The writers serialize on an exclusive lock of the directory. The readers do
+not lock: they load the files up to what the MANIFEST covers, the MANIFEST
+being replaced only once what it references is written, and then the
+records appended to the WAL since their last refresh.
+"""
+
+import collections
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+from ceilometer.openstack.common import fileutils
+from ceilometer.openstack.common.gettextutils import _
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common import log
+from ceilometer.storage.tsdb import encoding
+
+LOG = log.getLogger(__name__)
+
+MANIFEST = 'MANIFEST'
+DICTIONARY = 'dictionary'
+LOCK = 'lock'
+
+# Payload length and CRC32 of the payload.
+RECORD_HEADER = struct.Struct('>II')
+
+# Columns of a sample, in the order of the chunks.
+COLUMNS = ('timestamp', 'volume', 'type', 'unit', 'user', 'project',
+           'source', 'metadata', 'message_id', 'signature')
+
+# Columns holding dictionary ids in the chunks.
+DICTIONARY_COLUMNS = ('type', 'unit', 'user', 'project', 'source')
+
+Row = collections.namedtuple('Row', COLUMNS)
+
+IndexEntry = collections.namedtuple(
+    'IndexEntry', ['meter', 'resource', 'project', 'unit', 'tmin', 'tmax',
+                   'offset', 'length', 'count', 'sum', 'min', 'max'])
+
+INDEX_RECORD = struct.Struct('<IIIIqqQIIddd')
+
+# Dictionary id of the project or unit of a chunk holding several of them.
+MIXED = 0xffffffff
+
+
+class CorruptedRecord(Exception):
+    """Error raised when a record does not match its checksum."""
+
+
+def append_records(filename, payloads, fsync=False):
+    """Append the records of the payloads to a file, return its new size.
+    """
+    with open(filename, 'ab') as f:
+        for payload in payloads:
+            f.write(RECORD_HEADER.pack(len(payload),
+                                       zlib.crc32(payload) & 0xffffffff))
+            f.write(payload)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+        return f.tell()
+
+
+def read_records(filename, offset=0):
+    """Yield (offset after the record, payload) from a file.
+
+    A truncated record at the end of the file, being written by another
+    process or left by a killed one, stops the iteration silently.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if zlib.crc32(payload) & 0xffffffff != checksum:
+                raise CorruptedRecord(
+                    _('Bad checksum in %(file)s at offset %(offset)d') %
+                    {'file': filename, 'offset': offset})
+            offset += RECORD_HEADER.size + length
+            yield offset, payload
+
+
+def replace_file(filename, data):
+    """Write a file and fsync it, then rename it over filename."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+
+class Dictionary(object):
+    """Ids of the strings, the id 0 standing for None."""
+
+    def __init__(self):
+        self.strings = [None]
+        self.ids = {None: 0}
+        self.pending = []
+
+    def get(self, value):
+        """Return the id of value, None if it has none yet."""
+        return self.ids.get(value)
+
+    def intern(self, value):
+        """Return the id of value, giving it one if needed."""
+        id = self.ids.get(value)
+        if id is None:
+            id = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+            self.pending.append(value)
+        return id
+
+    def load(self, values):
+        for value in values:
+            self.ids[value] = len(self.strings)
+            self.strings.append(value)
+
+
+def encode_chunk(rows, dictionary):
+    """Return the chunk holding rows and its IndexEntry, without location.
+    """
+    columns = dict(zip(COLUMNS, zip(*rows)))
+    ids = dict((name, [dictionary.intern(v) for v in columns[name]])
+               for name in DICTIONARY_COLUMNS)
+    parts = [encoding.encode_timestamps(columns['timestamp']),
+             encoding.encode_floats(columns['volume'])]
+    parts.extend(encoding.encode_runs(ids[name])
+                 for name in DICTIONARY_COLUMNS)
+    parts.append(encoding.encode_runs(columns['metadata']))
+    parts.append(encoding.encode_strings(columns['message_id']))
+    parts.append(encoding.encode_strings(columns['signature']))
+    header = bytearray()
+    encoding.write_varint(header, len(rows))
+    for part in parts:
+        encoding.write_varint(header, len(part))
+    data = str(header) + ''.join(parts)
+
+    def uniform(values):
+        return values[0] if len(set(values)) == 1 else MIXED
+
+    volumes = columns['volume']
+    entry = IndexEntry(meter=None, resource=None,
+                       project=uniform(ids['project']),
+                       unit=uniform(ids['unit']),
+                       tmin=min(columns['timestamp']),
+                       tmax=max(columns['timestamp']),
+                       offset=None, length=len(data), count=len(rows),
+                       sum=sum(volumes), min=min(volumes), max=max(volumes))
+    return data, entry
+
+
+class ChunkView(object):
+    """Lazy access to the columns of a sealed chunk.
+
+    Only the bytes of the columns read are fetched from the mapped chunks
+    file.
+    """
+
+    def __init__(self, store, chunks, entry):
+        self.store = store
+        self.chunks = chunks
+        self.entry = entry
+        self.meter = store.dictionary.strings[entry.meter]
+        self.resource = store.dictionary.strings[entry.resource]
+        self.count = entry.count
+        self.tmin = entry.tmin
+        self.tmax = entry.tmax
+        self._columns = {}
+        self._offsets = None
+
+    def _read_header(self):
+        # The header is a varint per column, plus the count.
+        data = bytearray(self.chunks[self.entry.offset:self.entry.offset +
+                                     10 * (len(COLUMNS) + 1)])
+        count, pos = encoding.read_varint(data, 0)
+        lengths = []
+        for name in COLUMNS:
+            length, pos = encoding.read_varint(data, pos)
+            lengths.append(length)
+        self._offsets = {}
+        start = self.entry.offset + pos
+        for name, length in zip(COLUMNS, lengths):
+            self._offsets[name] = (start, start + length)
+            start += length
+
+    def column(self, name):
+        values = self._columns.get(name)
+        if values is not None:
+            return values
+        if self._offsets is None:
+            self._read_header()
+        start, end = self._offsets[name]
+        data = bytearray(self.chunks[start:end])
+        if name == 'timestamp':
+            values = encoding.decode_timestamps(data, self.count)
+        elif name == 'volume':
+            values = encoding.decode_floats(data, self.count)
+        elif name in ('message_id', 'signature'):
+            values = encoding.decode_strings(data, self.count)
+        else:
+            values = encoding.decode_runs(data, self.count)
+            if name in DICTIONARY_COLUMNS:
+                strings = self.store.dictionary.strings
+                values = [strings[v] for v in values]
+        self._columns[name] = values
+        return values
+
+    def rows(self):
+        return [Row(*r) for r in zip(*[self.column(name)
+                                       for name in COLUMNS])]
+
+
+class HeadView(object):
+    """Access to the columns of the samples of a series in the head."""
+
+    entry = None
+
+    def __init__(self, meter, resource, rows):
+        self.meter = meter
+        self.resource = resource
+        self._rows = rows
+        self.count = len(rows)
+        self.tmin = min(r.timestamp for r in rows)
+        self.tmax = max(r.timestamp for r in rows)
+        self._columns = {}
+
+    def column(self, name):
+        values = self._columns.get(name)
+        if values is None:
+            i = COLUMNS.index(name)
+            values = self._columns[name] = [r[i] for r in self._rows]
+        return values
+
+    def rows(self):
+        return list(self._rows)
+
+
+class Store(object):
+    """A time series store in a directory."""
+
+    def __init__(self, path, chunk_size, wal_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.wal_size = wal_size
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._reset()
+
+    def _reset(self):
+        self.manifest = {}
+        self._manifest_stat = None
+        self.dictionary = Dictionary()
+        self._dictionary_offset = 0
+        self._reset_chunks()
+        self._reset_metadata()
+        self._reset_head()
+
+    def _reset_chunks(self):
+        self.index = []
+        self.meter_index = collections.defaultdict(list)
+        self._index_offset = 0
+        self._chunks = None
+
+    def _reset_metadata(self):
+        # Metadata and resource by version, and latest (version, metadata)
+        # by resource.
+        self.metadata = {}
+        self.metadata_resource = {}
+        self.resource_metadata = {}
+        self._metadata_offset = 0
+        self.next_version = 0
+
+    def _reset_head(self):
+        self.head = {}
+        self._wal_offset = 0
+        self._wal_count = 0
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the exclusive write lock of the store."""
+        with self._lock:
+            if self._lock_file is None:
+                self._lock_file = open(self._file(LOCK), 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def create(self):
+        """Create the store if it does not exist yet."""
+        fileutils.ensure_tree(self.path)
+        with self.lock():
+            if not os.path.exists(self._file(MANIFEST)):
+                self._write_manifest({
+                    'uuid': str(uuid.uuid4()),
+                    'generation': 0,
+                    'chunks': 'chunks.0',
+                    'index': 'index.0',
+                    'index_size': 0,
+                    'metadata': 'metadata.0',
+                    'wal': 'wal.0',
+                    'next_version': 0,
+                })
+            self.refresh()
+
+    def destroy(self):
+        """Delete every file of the store."""
+        with self._lock:
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            if os.path.isdir(self.path):
+                for name in os.listdir(self.path):
+                    fileutils.delete_if_exists(self._file(name))
+            self._reset()
+
+    def _write_manifest(self, manifest):
+        for name in ('chunks', 'index', 'metadata', 'wal'):
+            open(self._file(manifest[name]), 'ab').close()
+        open(self._file(DICTIONARY), 'ab').close()
+        replace_file(self._file(MANIFEST), jsonutils.dumps(manifest))
+
+    def refresh(self):
+        """Load what was written to the store since the last refresh."""
+        with self._lock:
+            try:
+                self._refresh()
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # A file was replaced by the expirer while it was being
+                # loaded, the MANIFEST is now newer.
+                self._manifest_stat = None
+                self._refresh()
+
+    def _refresh(self):
+        try:
+            st = os.stat(self._file(MANIFEST))
+        except OSError:
+            # Not created yet, or cleared.
+            self._reset()
+            return
+        stat = (st.st_ino, st.st_mtime, st.st_size)
+        if stat != self._manifest_stat:
+            with open(self._file(MANIFEST)) as f:
+                manifest = jsonutils.loads(f.read())
+            old = self.manifest
+            if manifest['uuid'] != old.get('uuid'):
+                self._reset()
+            else:
+                if manifest['chunks'] != old['chunks']:
+                    self._reset_chunks()
+                if manifest['metadata'] != old['metadata']:
+                    self._reset_metadata()
+                if manifest['wal'] != old['wal']:
+                    self._reset_head()
+            self.manifest = manifest
+            self._manifest_stat = stat
+            self.next_version = max(self.next_version,
+                                    manifest['next_version'])
+        self._load_index()
+        self._load_wal()
+        # The dictionary and metadata records are written before the
+        # chunks and the WAL records referencing them.
+        self._load_dictionary()
+        self._load_metadata()
+
+    def _load_index(self):
+        size = self.manifest['index_size']
+        if self._index_offset >= size:
+            return
+        with open(self._file(self.manifest['index']), 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read(size - self._index_offset)
+        for pos in xrange(0, len(data), INDEX_RECORD.size):
+            self._add_entry(IndexEntry(*INDEX_RECORD.unpack_from(data, pos)))
+        self._index_offset = size
+
+    def _add_entry(self, entry):
+        self.index.append(entry)
+        self.meter_index[entry.meter].append(entry)
+
+    def _load_wal(self):
+        for self._wal_offset, payload in read_records(
+                self._file(self.manifest['wal']), self._wal_offset):
+            self._add_to_head(jsonutils.loads(payload))
+
+    def _add_to_head(self, record):
+        meter, resource = record[:2]
+        self.head.setdefault((meter, resource), []).append(Row(*record[2:]))
+        self._wal_count += 1
+
+    def _load_dictionary(self):
+        for self._dictionary_offset, payload in read_records(
+                self._file(DICTIONARY), self._dictionary_offset):
+            self.dictionary.load(jsonutils.loads(payload))
+
+    def _load_metadata(self):
+        for self._metadata_offset, payload in read_records(
+                self._file(self.manifest['metadata']), self._metadata_offset):
+            self._add_metadata(*jsonutils.loads(payload))
+
+    def _add_metadata(self, version, resource, metadata):
+        self.metadata[version] = metadata
+        self.metadata_resource[version] = resource
+        latest = self.resource_metadata.get(resource)
+        if latest is None or latest[0] < version:
+            self.resource_metadata[resource] = (version, metadata)
+        self.next_version = max(self.next_version, version + 1)
+
+    def append(self, meter, resource, row):
+        """Record a sample of a series, row.metadata being the metadata of
+        the resource.
+        """
+        with self.lock():
+            self.refresh()
+            latest = self.resource_metadata.get(resource)
+            if latest is None or latest[1] != row.metadata:
+                version = self.next_version
+                self._metadata_offset = append_records(
+                    self._file(self.manifest['metadata']),
+                    [jsonutils.dumps([version, resource, row.metadata])])
+                self._add_metadata(version, resource, row.metadata)
+            else:
+                version = latest[0]
+            record = [meter, resource] + list(row._replace(metadata=version))
+            self._wal_offset = append_records(
+                self._file(self.manifest['wal']), [jsonutils.dumps(record)])
+            self._add_to_head(record)
+            if self._wal_count >= self.wal_size:
+                self._checkpoint()
+
+    def _flush_dictionary(self):
+        if self.dictionary.pending:
+            self._dictionary_offset = append_records(
+                self._file(DICTIONARY),
+                [jsonutils.dumps(self.dictionary.pending)], fsync=True)
+            self.dictionary.pending = []
+
+    def _encode_series(self, meter, resource, rows):
+        """Return the chunks of rows, and their IndexEntries without
+        location.
+        """
+        rows = sorted(rows, key=lambda r: r.timestamp)
+        meter_id = self.dictionary.intern(meter)
+        resource_id = self.dictionary.intern(resource)
+        for i in xrange(0, len(rows), self.chunk_size):
+            data, entry = encode_chunk(rows[i:i + self.chunk_size],
+                                       self.dictionary)
+            yield data, entry._replace(meter=meter_id, resource=resource_id)
+
+    def _write_chunks(self, chunks_file, index_file, index_size, chunks):
+        """Append the chunks and their index records to the files, return
+        the IndexEntries and the new size of the index.
+        """
+        entries = []
+        with open(chunks_file, 'ab') as f:
+            offset = f.tell()
+            for data, entry in chunks:
+                f.write(data)
+                entries.append(entry._replace(offset=offset))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # The records after index_size were left by a writer killed before
+        # updating the MANIFEST.
+        with open(index_file, 'r+b') as f:
+            f.seek(index_size)
+            f.truncate()
+            for entry in entries:
+                f.write(INDEX_RECORD.pack(*entry))
+            f.flush()
+            os.fsync(f.fileno())
+            index_size = f.tell()
+        return entries, index_size
+
+    def _write_wal(self, filename, head):
+        records = [jsonutils.dumps([meter, resource] + list(row))
+                   for (meter, resource), rows in head.iteritems()
+                   for row in rows]
+        append_records(filename, records, fsync=True)
+
+    def _checkpoint(self):
+        """Seal the series of the head holding enough samples into chunks,
+        and start a new WAL with the remaining samples.
+        """
+        sealed = []
+        carried = {}
+        for (meter, resource), rows in self.head.iteritems():
+            rows = sorted(rows, key=lambda r: r.timestamp)
+            n = len(rows) - len(rows) % self.chunk_size
+            if n:
+                sealed.append((meter, resource, rows[:n]))
+            if n < len(rows):
+                carried[(meter, resource)] = rows[n:]
+        if sum(len(rows) for rows in carried.itervalues()) >= \
+                self.wal_size // 2:
+            # Too many slow series, seal everything.
+            sealed.extend((meter, resource, rows)
+                          for (meter, resource), rows in carried.iteritems())
+            carried = {}
+        LOG.debug(_('Sealing %(sealed)d series, %(carried)d are kept in the '
+                    'head'), {'sealed': len(sealed), 'carried': len(carried)})
+
+        chunks = [chunk for meter, resource, rows in sealed
+                  for chunk in self._encode_series(meter, resource, rows)]
+        self._flush_dictionary()
+        manifest = dict(self.manifest)
+        entries, manifest['index_size'] = self._write_chunks(
+            self._file(manifest['chunks']), self._file(manifest['index']),
+            manifest['index_size'], chunks)
+        manifest['generation'] += 1
+        manifest['wal'] = 'wal.%d' % manifest['generation']
+        manifest['next_version'] = self.next_version
+        self._write_wal(self._file(manifest['wal']), carried)
+        self._write_manifest(manifest)
+        fileutils.delete_if_exists(self._file(self.manifest['wal']))
+
+        for entry in entries:
+            self._add_entry(entry)
+        self._index_offset = manifest['index_size']
+        self._reset_head()
+        self.manifest = manifest
+        self._manifest_stat = None
+        self._load_wal()
+
+    def expire(self, end):
+        """Delete the samples older than end, in microseconds.
+
+        :return: The number of samples deleted.
+        """
+        with self.lock():
+            self.refresh()
+            manifest = dict(self.manifest)
+            generation = manifest['generation'] = manifest['generation'] + 1
+            for name in ('chunks', 'index', 'metadata', 'wal'):
+                manifest[name] = '%s.%d' % (name, generation)
+            manifest['index_size'] = 0
+            manifest['next_version'] = self.next_version
+            chunks_file = self._file(manifest['chunks'])
+            index_file = self._file(manifest['index'])
+            open(index_file, 'wb').close()
+
+            versions = set()
+            chunks = self._chunks_map()
+            counts = {'deleted': 0}
+
+            def kept_chunks():
+                for entry in self.index:
+                    if entry.tmax < end:
+                        counts['deleted'] += entry.count
+                        continue
+                    view = ChunkView(self, chunks, entry)
+                    if entry.tmin >= end:
+                        # Copied as is, without decoding its other columns.
+                        versions.update(view.column('metadata'))
+                        yield (chunks[entry.offset:
+                                      entry.offset + entry.length], entry)
+                        continue
+                    rows = [r for r in view.rows() if r.timestamp >= end]
+                    counts['deleted'] += entry.count - len(rows)
+                    versions.update(r.metadata for r in rows)
+                    for chunk in self._encode_series(view.meter,
+                                                     view.resource, rows):
+                        yield chunk
+
+            ignored, manifest['index_size'] = self._write_chunks(
+                chunks_file, index_file, 0, kept_chunks())
+            self._flush_dictionary()
+            deleted = counts['deleted']
+
+            head = {}
+            for key, rows in self.head.iteritems():
+                kept = [r for r in rows if r.timestamp >= end]
+                deleted += len(rows) - len(kept)
+                if kept:
+                    head[key] = kept
+                    versions.update(r.metadata for r in kept)
+            self._write_wal(self._file(manifest['wal']), head)
+            append_records(
+                self._file(manifest['metadata']),
+                [jsonutils.dumps([version, self.metadata_resource[version],
+                                  self.metadata[version]])
+                 for version in sorted(versions)],
+                fsync=True)
+
+            old = self.manifest
+            self._write_manifest(manifest)
+            for name in ('chunks', 'index', 'metadata', 'wal'):
+                fileutils.delete_if_exists(self._file(old[name]))
+            self._manifest_stat = None
+            self.refresh()
+            return deleted
+
+    def _chunks_map(self):
+        """Return the mapping of the chunks file, up to the last chunk."""
+        if not self.index:
+            return ''
+        last = self.index[-1]
+        if self._chunks is None or \
+                len(self._chunks) < last.offset + last.length:
+            with open(self._file(self.manifest['chunks']), 'rb') as f:
+                self._chunks = mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        return self._chunks
+
+    def scan(self, meter=None, resource=None, project=None, start=None,
+             end=None):
+        """Return views of the chunks and series of the head that may hold
+        samples of the meter, resource and project, between start and end
+        included, in microseconds. The chunks come in the order they were
+        written, then the series of the head.
+        """
+        with self._lock:
+            self.refresh()
+            ids = {}
+            for name, value in (('meter', meter), ('resource', resource),
+                                ('project', project)):
+                if value is not None:
+                    ids[name] = self.dictionary.get(value)
+            if None in ids.values():
+                entries = []
+            elif meter is not None:
+                entries = list(self.meter_index.get(ids['meter'], []))
+            else:
+                entries = list(self.index)
+            chunks = self._chunks_map()
+            head = [(key, list(rows)) for key, rows in self.head.iteritems()
+                    if (meter is None or key[0] == meter) and
+                    (resource is None or key[1] == resource)]
+
+        views = []
+        for entry in entries:
+            if ('resource' in ids and entry.resource != ids['resource'] or
+                    'project' in ids and entry.project not in (
+                        ids['project'], MIXED) or
+                    start is not None and entry.tmax < start or
+                    end is not None and entry.tmin > end):
+                continue
+            views.append(ChunkView(self, chunks, entry))
+        for (meter, resource), rows in head:
+            views.append(HeadView(meter, resource, rows))
+        return views
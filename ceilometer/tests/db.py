@@ -48,6 +48,7 @@ class TestBase(test_base.TestCase):
     def tearDown(self):
         self.conn.clear()
         self.conn = None
+        storage.reset_connections()
         super(TestBase, self).tearDown()
 
 
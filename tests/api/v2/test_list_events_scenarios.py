@@ -104,6 +104,23 @@ class TestListEvents(FunctionalTest,
         data = self.get_json('/meters/instance?limit=42')
         self.assertEqual(2, len(data))
 
+    def test_all_max_limit(self):
+        cfg.CONF.set_override('max_limit', 1, group='api')
+        self.assertEqual(1, len(self.get_json('/meters/instance')))
+        self.assertEqual(1, len(self.get_json('/meters/instance?limit=42')))
+
+    def test_all_marker(self):
+        first = self.get_json('/meters/instance?limit=1')
+        data = self.get_json('/meters/instance',
+                             q=[{'field': 'marker_timestamp',
+                                 'value': first[0]['timestamp'],
+                                 },
+                                {'field': 'marker_message_id',
+                                 'value': first[0]['message_id'],
+                                 }])
+        self.assertEqual(1, len(data))
+        self.assertEqual('resource-id', data[0]['resource_id'])
+
     def test_empty_project(self):
         data = self.get_json('/meters/instance',
                              q=[{'field': 'project_id',
@@ -50,6 +50,51 @@ class TestDispatcherDB(tests_base.TestCase):
         self.dispatcher.record_metering_data(self.ctx, msg)
         self.mox.VerifyAll()
 
+    def test_valid_messages_batch(self):
+        msgs = []
+        for i in range(2):
+            msg = {'counter_name': 'test',
+                   'resource_id': self.id(),
+                   'counter_volume': i,
+                   }
+            msg['message_signature'] = rpc.compute_signature(
+                msg,
+                cfg.CONF.publisher_rpc.metering_secret,
+            )
+            msgs.append(msg)
+
+        self.dispatcher.storage_conn = self.mox.CreateMock(base.Connection)
+        self.dispatcher.storage_conn.record_metering_data_batch(msgs)
+        self.mox.ReplayAll()
+
+        self.dispatcher.record_metering_data(self.ctx, msgs)
+        self.mox.VerifyAll()
+
+    def test_batch_failure_records_each_sample(self):
+        msgs = []
+        for i in range(3):
+            msg = {'counter_name': 'test',
+                   'resource_id': self.id(),
+                   'counter_volume': i,
+                   }
+            msg['message_signature'] = rpc.compute_signature(
+                msg,
+                cfg.CONF.publisher_rpc.metering_secret,
+            )
+            msgs.append(msg)
+
+        self.dispatcher.storage_conn = self.mox.CreateMock(base.Connection)
+        self.dispatcher.storage_conn.record_metering_data_batch(
+            msgs).AndRaise(Exception('boom'))
+        self.dispatcher.storage_conn.record_metering_data(msgs[0])
+        self.dispatcher.storage_conn.record_metering_data(
+            msgs[1]).AndRaise(Exception('bad sample'))
+        self.dispatcher.storage_conn.record_metering_data(msgs[2])
+        self.mox.ReplayAll()
+
+        self.dispatcher.record_metering_data(self.ctx, msgs)
+        self.mox.VerifyAll()
+
     def test_invalid_message(self):
         msg = {'counter_name': 'test',
                'resource_id': self.id(),
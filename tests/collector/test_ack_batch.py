@@ -0,0 +1,200 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the batched acknowledgement of the collector messages in
+ceilometer/openstack/common/rpc/impl_kombu.py
+"""
+
+import socket
+
+import fixtures
+import mock
+from oslo.config import cfg
+
+from ceilometer.openstack.common.rpc import common as rpc_common
+from ceilometer.openstack.common.rpc import impl_kombu
+from ceilometer.tests import base as tests_base
+
+
+class FakeChannel(object):
+    """Record the acknowledgements and QoS settings sent to the broker."""
+
+    def __init__(self):
+        self.calls = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.calls.append(('ack', delivery_tag, multiple))
+
+    def basic_reject(self, delivery_tag, requeue=False):
+        self.calls.append(('reject', delivery_tag, requeue))
+
+    def basic_qos(self, prefetch_size, prefetch_count, apply_global):
+        self.calls.append(('qos', prefetch_count, apply_global))
+
+    def message_to_python(self, raw_message):
+        return raw_message
+
+
+class FakeMessage(object):
+
+    def __init__(self, channel, delivery_tag, payload=None):
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        self.payload = payload or {}
+
+    def ack(self):
+        self.channel.basic_ack(self.delivery_tag)
+
+    def reject(self):
+        self.channel.basic_reject(self.delivery_tag, requeue=True)
+
+
+class TestAckBatch(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestAckBatch, self).setUp()
+        self.channel = FakeChannel()
+        self.useFixture(fixtures.MonkeyPatch('kombu.entity.Queue',
+                                             mock.MagicMock()))
+        self.ack_batch = impl_kombu.AckBatch()
+        self.ack_batch.reset(self.channel)
+        self.received = []
+
+    def _consumer(self, callback=None, **kwargs):
+        kwargs.setdefault('ack_batch', self.ack_batch)
+        return impl_kombu.ConsumerBase(self.channel,
+                                       callback or self.received.append,
+                                       1,
+                                       ack_on_error=False,
+                                       **kwargs)
+
+    def _deliver(self, consumer, *tags):
+        for tag in tags:
+            consumer._callback_handler(FakeMessage(self.channel, tag),
+                                       consumer.callback)
+
+    def test_flush_acks_multiple(self):
+        self.ack_batch.add(FakeMessage(self.channel, 1))
+        self.ack_batch.add(FakeMessage(self.channel, 2))
+        self.assertTrue(self.ack_batch.pending)
+        self.ack_batch.flush()
+        self.assertEqual([('ack', 2, True)], self.channel.calls)
+        self.assertFalse(self.ack_batch.pending)
+        self.ack_batch.flush()
+        self.assertEqual([('ack', 2, True)], self.channel.calls)
+
+    def test_full_batch_flushed(self):
+        consumer = self._consumer(ack_batch_size=3)
+        self._deliver(consumer, 1, 2)
+        self.assertEqual([], self.channel.calls)
+        self._deliver(consumer, 3, 4)
+        self.assertEqual([('ack', 3, True)], self.channel.calls)
+        self.assertTrue(self.ack_batch.pending)
+        self.assertEqual(4, len(self.received))
+
+    def test_batch_capped_by_prefetch(self):
+        consumer = self._consumer(ack_batch_size=10, prefetch_count=2)
+        self._deliver(consumer, 1, 2)
+        self.assertEqual([('ack', 2, True)], self.channel.calls)
+
+    def test_no_batch_acks_each_message(self):
+        consumer = self._consumer(ack_batch=None, ack_batch_size=10)
+        self._deliver(consumer, 1, 2)
+        self.assertEqual([('ack', 1, False), ('ack', 2, False)],
+                         self.channel.calls)
+
+    def test_reject_between_batched_acks(self):
+        def callback(msg):
+            if msg.get('fail'):
+                raise RuntimeError('boom')
+
+        consumer = self._consumer(callback=callback, ack_batch_size=3)
+        self._deliver(consumer, 1)
+        consumer._callback_handler(
+            FakeMessage(self.channel, 2, {'fail': True}), callback)
+        self._deliver(consumer, 3)
+        # The failed message is requeued at once and does not count in
+        # the batch, the messages processed around it are still pending.
+        self.assertEqual([('reject', 2, True)], self.channel.calls)
+        self.assertEqual(2, consumer.unacked)
+        self._deliver(consumer, 4)
+        self.assertEqual([('reject', 2, True), ('ack', 4, True)],
+                         self.channel.calls)
+
+    def test_reconnect_drops_pending(self):
+        consumer = self._consumer(ack_batch_size=3)
+        self._deliver(consumer, 1, 2)
+        new_channel = FakeChannel()
+        self.ack_batch.reset(new_channel)
+        consumer.reconnect(new_channel)
+        self.assertFalse(self.ack_batch.pending)
+        self.assertEqual(0, consumer.unacked)
+        # The tags of the old channel are never acked on the new one.
+        self.ack_batch.flush()
+        self.assertEqual([], self.channel.calls)
+        self.assertEqual([], new_channel.calls)
+
+    def test_consume_sets_prefetch(self):
+        consumer = self._consumer(prefetch_count=42)
+        consumer.consume()
+        self.assertEqual([('qos', 42, False)], self.channel.calls)
+
+    def test_consume_resets_prefetch(self):
+        self._consumer(prefetch_count=42).consume()
+        self._consumer().consume()
+        self.assertEqual([('qos', 42, False), ('qos', 0, False)],
+                         self.channel.calls)
+
+
+class TestConnectionAckBatch(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestConnectionAckBatch, self).setUp()
+        cfg.CONF.set_override('fake_rabbit', True)
+        self.conn = impl_kombu.Connection(cfg.CONF)
+        self.addCleanup(self.conn.close)
+        self.channel = FakeChannel()
+        self.conn.ack_batch.reset(self.channel)
+        self.conn.consumers = [mock.Mock()]
+
+    def test_idle_flush(self):
+        self.conn.ack_batch.add(FakeMessage(self.channel, 5))
+        with mock.patch.object(self.conn.connection, 'drain_events',
+                               side_effect=socket.timeout()) as drain:
+            self.conn.iterconsume(limit=1).next()
+        drain.assert_called_once_with(
+            timeout=impl_kombu.AckBatch.flush_interval)
+        self.assertEqual([('ack', 5, True)], self.channel.calls)
+        self.assertFalse(self.conn.ack_batch.pending)
+
+    def test_no_idle_flush_without_pending(self):
+        with mock.patch.object(self.conn.connection,
+                               'drain_events') as drain:
+            self.conn.iterconsume(limit=1).next()
+        drain.assert_called_once_with(timeout=None)
+        self.assertEqual([], self.channel.calls)
+
+    def test_timeout_without_pending(self):
+        with mock.patch.object(self.conn.connection, 'drain_events',
+                               side_effect=socket.timeout()):
+            self.assertRaises(rpc_common.Timeout,
+                              self.conn.iterconsume(limit=1,
+                                                    timeout=1).next)
+
+    def test_reconnect_resets_batch(self):
+        self.conn.ack_batch.add(FakeMessage(self.channel, 5))
+        self.conn.consumers = []
+        self.conn.reconnect()
+        self.assertFalse(self.conn.ack_batch.pending)
+        self.assertIs(self.conn.channel, self.conn.ack_batch.channel)
+        self.assertEqual([], self.channel.calls)
@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/collector/fanout.py
+"""
+
+from oslo.config import cfg
+
+from ceilometer.collector import dispatcher
+from ceilometer.collector import fanout
+from ceilometer.tests import base as tests_base
+
+
+class FakeDispatcher(dispatcher.Base):
+
+    def __init__(self, conf=None, fail=False):
+        super(FakeDispatcher, self).__init__(conf)
+        self.fail = fail
+        self.received = []
+
+    def record_metering_data(self, context, data):
+        if self.fail:
+            raise RuntimeError('boom')
+        self.received.append(data)
+
+
+class TestQueuedDispatcher(tests_base.TestCase):
+
+    def test_records_through_queue(self):
+        fake = FakeDispatcher()
+        queued = fanout.QueuedDispatcher(fake, workers=2, queue_size=10)
+        for i in range(5):
+            queued.record_metering_data(None, {'counter_volume': i})
+        queued.stop()
+        self.assertEqual([0, 1, 2, 3, 4],
+                         sorted(d['counter_volume'] for d in fake.received))
+        stats = queued.get_stats()
+        self.assertEqual(5, stats['processed'])
+        self.assertEqual(0, stats['failed'])
+        self.assertEqual(0, stats['backlog'])
+        self.assertIsNotNone(stats['latency_p99'])
+
+    def test_failure_is_counted(self):
+        queued = fanout.QueuedDispatcher(FakeDispatcher(fail=True))
+        queued.record_metering_data(None, {})
+        queued.stop()
+        stats = queued.get_stats()
+        self.assertEqual(0, stats['processed'])
+        self.assertEqual(1, stats['failed'])
+
+    def test_drop_when_full(self):
+        fake = FakeDispatcher()
+        queued = fanout.QueuedDispatcher(fake, queue_size=1,
+                                         overflow='drop')
+        # The workers do not get a chance to run until we yield, so the
+        # second message does not fit in the queue.
+        queued.record_metering_data(None, {'counter_volume': 1})
+        queued.record_metering_data(None, {'counter_volume': 2})
+        queued.stop()
+        self.assertEqual([{'counter_volume': 1}], fake.received)
+        self.assertEqual(1, queued.get_stats()['dropped'])
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, fanout.QueuedDispatcher,
+                          FakeDispatcher(), overflow='explode')
+
+    def test_setup_dispatchers_inline(self):
+        dispatchers = [FakeDispatcher()]
+        self.assertEqual(dispatchers,
+                         fanout.setup_dispatchers(dispatchers, cfg.CONF))
+
+    def test_setup_dispatchers_queued(self):
+        cfg.CONF.set_override('dispatcher_workers', 1, group='collector')
+        dispatchers = fanout.setup_dispatchers([FakeDispatcher()], cfg.CONF)
+        self.assertEqual(1, len(dispatchers))
+        self.assertIsInstance(dispatchers[0], fanout.QueuedDispatcher)
+        for d in dispatchers:
+            d.stop()
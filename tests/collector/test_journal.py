@@ -0,0 +1,169 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/collector/journal.py
+"""
+
+import datetime
+import os
+
+from mock import MagicMock
+from mock import patch
+from oslo.config import cfg
+
+from ceilometer.collector import journal
+from ceilometer.publisher import rpc
+from ceilometer.tests import base as tests_base
+
+
+class JournalTestBase(tests_base.TestCase):
+
+    def setUp(self):
+        super(JournalTestBase, self).setUp()
+        self.path = os.path.join(self.tempdir.path, 'journal')
+
+    def _messages(self, count):
+        msgs = []
+        for i in range(count):
+            msg = {'counter_name': 'test',
+                   'resource_id': 'resource-%d' % i,
+                   'counter_volume': i,
+                   'timestamp': '2012-07-02T13:53:40Z',
+                   }
+            msg['message_signature'] = rpc.compute_signature(
+                msg,
+                cfg.CONF.publisher_rpc.metering_secret,
+            )
+            msgs.append(msg)
+        return msgs
+
+    def _read_all(self):
+        return [data
+                for segment in journal.list_segments(self.path)
+                for offset, data in journal.read_segment(segment)]
+
+
+class TestJournal(JournalTestBase):
+
+    def test_append_and_read(self):
+        j = journal.Journal(self.path, 1024 * 1024)
+        msgs = self._messages(3)
+        for msg in msgs:
+            j.append(msg)
+        j.close()
+        self.assertEqual(1, len(journal.list_segments(self.path)))
+        self.assertEqual(msgs, self._read_all())
+
+    def test_segment_rolling(self):
+        j = journal.Journal(self.path, 1)
+        msgs = self._messages(3)
+        for msg in msgs:
+            j.append(msg)
+        j.close()
+        self.assertEqual(3, len(journal.list_segments(self.path)))
+        self.assertEqual(msgs, self._read_all())
+
+    def test_new_segment_on_open(self):
+        j = journal.Journal(self.path, 1024 * 1024)
+        j.append(self._messages(1)[0])
+        j.close()
+        j = journal.Journal(self.path, 1024 * 1024)
+        j.append(self._messages(1)[0])
+        j.close()
+        self.assertEqual(2, len(journal.list_segments(self.path)))
+
+    def test_retention(self):
+        j = journal.Journal(self.path, 1, retention_size=1)
+        for msg in self._messages(5):
+            j.append(msg)
+        j.close()
+        # Every segment but the one being written is over the retention
+        # size, so they have all been removed.
+        self.assertEqual(1, len(journal.list_segments(self.path)))
+        self.assertEqual([4], [m['counter_volume']
+                               for m in self._read_all()])
+
+    def test_truncated_record(self):
+        j = journal.Journal(self.path, 1024 * 1024)
+        for msg in self._messages(2):
+            j.append(msg)
+        j.close()
+        segment = journal.list_segments(self.path)[0]
+        with open(segment, 'rb+') as f:
+            f.truncate(os.path.getsize(segment) - 3)
+        self.assertEqual(1, len(self._read_all()))
+
+    def test_corrupted_record(self):
+        j = journal.Journal(self.path, 1024 * 1024)
+        j.append(self._messages(1)[0])
+        j.close()
+        segment = journal.list_segments(self.path)[0]
+        with open(segment, 'rb+') as f:
+            f.seek(journal.HEADER.size + 1)
+            f.write('X')
+        self.assertRaises(journal.CorruptedRecord, self._read_all)
+
+    def test_get_journal_disabled(self):
+        self.assertIsNone(journal.get_journal(cfg.CONF))
+
+
+class TestReplayer(JournalTestBase):
+
+    def setUp(self):
+        super(TestReplayer, self).setUp()
+        cfg.CONF.set_override('journal_path', self.path, group='collector')
+        self.storage_conn = MagicMock()
+        patcher = patch('ceilometer.storage.get_connection',
+                        return_value=self.storage_conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_replay(self):
+        j = journal.get_journal(cfg.CONF)
+        msgs = self._messages(3)
+        j.append(msgs[0])
+        # A list of samples on the wire
+        j.append(msgs[1:])
+        j.close()
+        self.assertEqual(3, journal.Replayer(cfg.CONF).replay())
+        calls = self.storage_conn.record_metering_data.call_args_list
+        recorded = [c[0][0] for c in calls]
+        self.assertEqual(['resource-0', 'resource-1', 'resource-2'],
+                         [m['resource_id'] for m in recorded])
+        self.assertEqual(datetime.datetime(2012, 7, 2, 13, 53, 40),
+                         recorded[0]['timestamp'])
+
+    def test_replay_resume(self):
+        j = journal.get_journal(cfg.CONF)
+        for msg in self._messages(2):
+            j.append(msg)
+        j.close()
+        replayer = journal.Replayer(cfg.CONF)
+        self.assertEqual(2, replayer.replay())
+        # Everything has been marked as replayed
+        self.assertEqual(0, replayer.replay())
+
+        # Append to the journal, only the new messages are replayed
+        j = journal.get_journal(cfg.CONF)
+        j.append(self._messages(1)[0])
+        j.close()
+        self.assertEqual(1, replayer.replay())
+
+    def test_replay_invalid_signature(self):
+        j = journal.get_journal(cfg.CONF)
+        msg = self._messages(1)[0]
+        msg['message_signature'] = 'invalid-signature'
+        j.append(msg)
+        j.close()
+        journal.Replayer(cfg.CONF).replay()
+        self.assertFalse(self.storage_conn.record_metering_data.called)
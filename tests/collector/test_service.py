@@ -192,6 +192,18 @@ class TestCollectorService(TestCollector):
         with patch('ceilometer.openstack.common.rpc.create_connection'):
             self.srv.start()
 
+    @patch('ceilometer.pipeline.setup_pipeline', MagicMock())
+    def test_init_host_prefetch(self):
+        cfg.CONF.set_override('metering_prefetch_count', 42,
+                              group='collector')
+        cfg.CONF.set_override('metering_ack_batch_size', 7,
+                              group='collector')
+        with patch('ceilometer.openstack.common.rpc.create_connection'):
+            self.srv.start()
+        kwargs = self.srv.conn.create_worker.call_args[1]
+        self.assertEqual(42, kwargs['prefetch_count'])
+        self.assertEqual(7, kwargs['ack_batch_size'])
+
     @patch('ceilometer.pipeline.setup_pipeline', MagicMock())
     def test_process_notification(self):
         # If we try to create a real RPC connection, init_host() never
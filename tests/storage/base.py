@@ -474,6 +474,30 @@ class RawSampleTest(DBTestBase):
                 self.assertTrue(prev_timestamp >= sample.timestamp)
             prev_timestamp = sample.timestamp
 
+    def test_get_samples_marker(self):
+        f = storage.SampleFilter()
+        expected = list(self.conn.get_samples(f))
+        results = []
+        while True:
+            page = list(self.conn.get_samples(f, limit=2))
+            if not page:
+                break
+            results.extend(page)
+            f = storage.SampleFilter(
+                marker_timestamp=page[-1].timestamp,
+                marker_message_id=page[-1].message_id)
+        self.assertEqual([s.message_id for s in expected],
+                         [s.message_id for s in results])
+
+    def test_get_samples_marker_timestamp_only(self):
+        f = storage.SampleFilter(
+            marker_timestamp=datetime.datetime(2012, 7, 2, 10, 41))
+        results = list(self.conn.get_samples(f))
+        self.assertTrue(results)
+        for s in results:
+            self.assertTrue(s.timestamp < datetime.datetime(2012, 7, 2,
+                                                            10, 41))
+
     def test_get_samples_by_user(self):
         f = storage.SampleFilter(user='user-id')
         results = list(self.conn.get_samples(f))
@@ -611,6 +635,33 @@ class RawSampleTest(DBTestBase):
         results = list(self.conn.get_samples(f))
         self.assertEqual(len(results), 2)
 
+    def test_record_metering_data_batch(self):
+        msgs = []
+        for i, name in enumerate(['cpu', 'cpu', 'memory']):
+            c = sample.Sample(
+                name,
+                sample.TYPE_GAUGE,
+                unit='',
+                volume=i,
+                user_id='user-batch',
+                project_id='project-batch',
+                resource_id='resource-batch',
+                timestamp=datetime.datetime(2012, 7, 2, 11, i),
+                resource_metadata={'display_name': 'server-%d' % i},
+                source='source-batch',
+            )
+            msgs.append(rpc.meter_message_from_counter(
+                c, cfg.CONF.publisher_rpc.metering_secret))
+        self.conn.record_metering_data_batch(msgs)
+
+        f = storage.SampleFilter(user='user-batch')
+        self.assertEqual([0, 1, 2], sorted(s.counter_volume
+                                           for s in self.conn.get_samples(f)))
+        self.assertIn('user-batch', list(self.conn.get_users()))
+        self.assertIn('project-batch', list(self.conn.get_projects()))
+        resource, = self.conn.get_resources(resource='resource-batch')
+        self.assertEqual(resource.metadata, {'display_name': 'server-2'})
+
     def test_clear_metering_data(self):
         timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2, 10, 45)
 
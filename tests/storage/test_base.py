@@ -18,6 +18,8 @@
 import datetime
 import math
 
+import mock
+
 from ceilometer.storage import base
 from ceilometer.tests import base as test_base
 
@@ -59,3 +61,24 @@ class BaseTest(test_base.TestCase):
 
         sort_keys_resource = base._handle_sort_key('resource', 'project_id')
         self.assertEqual(sort_keys_resource, ['project_id', 'user_id'])
+
+    def test_record_metering_data_batch_isolated(self):
+        conn = mock.Mock(spec=base.Connection)
+        conn.record_metering_data.side_effect = [Exception('boom'), None]
+        base.Connection.record_metering_data_batch(conn, ['bad', 'good'])
+        self.assertEqual([mock.call('bad'), mock.call('good')],
+                         conn.record_metering_data.call_args_list)
+
+    def test_match_metaquery(self):
+        metadata = {'display_name': 'test-server',
+                    'properties': {'tier': 'gold'}}
+        self.assertTrue(base.match_metaquery(metadata, {}))
+        self.assertTrue(base.match_metaquery(
+            metadata, {'metadata.display_name': 'test-server',
+                       'metadata.properties.tier': 'gold'}))
+        self.assertFalse(base.match_metaquery(
+            metadata, {'metadata.properties.tier': 'silver'}))
+        self.assertFalse(base.match_metaquery(
+            metadata, {'metadata.display_name.tier': 'gold'}))
+        self.assertFalse(base.match_metaquery(
+            None, {'metadata.display_name': 'test-server'}))
@@ -0,0 +1,139 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/cache.py
+"""
+
+import datetime
+
+from mock import MagicMock
+from mock import patch
+from oslo.config import cfg
+
+from ceilometer.openstack.common import timeutils
+from ceilometer import storage
+from ceilometer.storage import cache
+from ceilometer.tests import base as tests_base
+
+
+class TestMemoryCache(tests_base.TestCase):
+
+    def test_get_set(self):
+        c = cache.MemoryCache(10)
+        self.assertIsNone(c.get('foo'))
+        c.set('foo', [1])
+        self.assertEqual([1], c.get('foo'))
+        c.delete('foo')
+        self.assertIsNone(c.get('foo'))
+
+    def test_lru_eviction(self):
+        c = cache.MemoryCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        # Use a so b is the least recently used entry
+        c.get('a')
+        c.set('c', 3)
+        self.assertEqual(1, c.get('a'))
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(3, c.get('c'))
+
+    def test_lru_eviction_after_many_uses(self):
+        c = cache.MemoryCache(3)
+        for key in 'abc':
+            c.set(key, key)
+        for i in range(100):
+            c.get('a')
+            c.set('b', i)
+        c.set('d', 'd')
+        self.assertIsNone(c.get('c'))
+        self.assertEqual(['a', 99, 'd'], [c.get(k) for k in 'abd'])
+        self.assertTrue(len(c._uses) <= 2 * 3 + 16)
+
+    def test_ttl(self):
+        c = cache.MemoryCache(10)
+        with patch('ceilometer.storage.cache._now', return_value=1000):
+            c.set('foo', 'bar', 60)
+            c.set('forever', 'bar')
+        with patch('ceilometer.storage.cache._now', return_value=1059):
+            self.assertEqual('bar', c.get('foo'))
+        with patch('ceilometer.storage.cache._now', return_value=1060):
+            self.assertIsNone(c.get('foo'))
+            self.assertEqual('bar', c.get('forever'))
+
+
+class TestCachedConnection(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestCachedConnection, self).setUp()
+        self.conn = MagicMock()
+        self.conn.get_meters.return_value = iter(['meter'])
+        self.conn.get_meter_statistics.return_value = ['stats']
+        self.cache = MagicMock(wraps=cache.MemoryCache(10))
+        self.cached = cache.CachedConnection(self.conn, self.cache, 60,
+                                             closed_period_delay=3600)
+
+    def test_read_through(self):
+        self.assertEqual(['meter'], self.cached.get_meters(user='foo'))
+        self.assertEqual(['meter'], self.cached.get_meters(user='foo'))
+        self.conn.get_meters.assert_called_once_with(
+            user='foo', project=None, resource=None, source=None,
+            metaquery={})
+
+    def test_key_normalization(self):
+        self.cached.get_meters(metaquery={'metadata.a': 1,
+                                          'metadata.b': 2})
+        self.cached.get_meters(metaquery={'metadata.b': 2,
+                                          'metadata.a': 1})
+        self.assertEqual(1, self.conn.get_meters.call_count)
+
+    def test_other_attributes(self):
+        self.cached.record_metering_data({})
+        self.conn.record_metering_data.assert_called_once_with({})
+
+    def test_statistics_open_period(self):
+        f = storage.SampleFilter(meter='cpu', end=timeutils.utcnow())
+        self.cached.get_meter_statistics(f, period=60)
+        self.assertEqual(60, self.cache.set.call_args[0][2])
+
+    def test_statistics_closed_period(self):
+        f = storage.SampleFilter(
+            meter='cpu',
+            end=timeutils.utcnow() - datetime.timedelta(days=1))
+        self.assertEqual(['stats'], self.cached.get_meter_statistics(f))
+        self.assertEqual(['stats'], self.cached.get_meter_statistics(f))
+        self.assertEqual(1, self.conn.get_meter_statistics.call_count)
+        self.assertEqual(0, self.cache.set.call_args[0][2])
+
+
+class TestGetCachedConnection(tests_base.TestCase):
+
+    def test_disabled(self):
+        conn = MagicMock()
+        self.assertIs(conn, cache.get_cached_connection(conn, cfg.CONF))
+
+    def test_memory(self):
+        cfg.CONF.set_override('query_cache_backend', 'memory',
+                              group='database')
+        cached = cache.get_cached_connection(MagicMock(), cfg.CONF)
+        self.assertIsInstance(cached, cache.CachedConnection)
+        self.assertIsInstance(cached.cache, cache.MemoryCache)
+
+    def test_memcached_without_servers(self):
+        cfg.CONF.set_override('query_cache_backend', 'memcached',
+                              group='database')
+        self.assertIsInstance(cache.get_cache(cfg.CONF), cache.MemoryCache)
+
+    def test_unknown_backend(self):
+        cfg.CONF.set_override('query_cache_backend', 'nope',
+                              group='database')
+        self.assertRaises(ValueError, cache.get_cache, cfg.CONF)
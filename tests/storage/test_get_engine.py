@@ -19,10 +19,12 @@
 """
 
 import mox
+from oslo.config import cfg
 import testtools
 
 from ceilometer import storage
 from ceilometer.storage import impl_log
+from ceilometer.tests import base as test_base
 
 
 class EngineTest(testtools.TestCase):
@@ -42,3 +44,25 @@ class EngineTest(testtools.TestCase):
             storage.get_engine(conf)
         except RuntimeError as err:
             self.assertIn('no-such-engine', unicode(err))
+
+
+class ConnectionRegistryTest(test_base.TestCase):
+
+    def setUp(self):
+        super(ConnectionRegistryTest, self).setUp()
+        cfg.CONF.set_override('connection', 'log://localhost',
+                              group='database')
+        self.addCleanup(storage.reset_connections)
+
+    def test_engine_is_loaded_once(self):
+        self.assertIs(storage.get_engine(cfg.CONF),
+                      storage.get_engine(cfg.CONF))
+
+    def test_connection_is_shared(self):
+        conn = storage.get_connection(cfg.CONF)
+        self.assertIs(conn, storage.get_connection(cfg.CONF))
+
+    def test_reset_connections(self):
+        conn = storage.get_connection(cfg.CONF)
+        storage.reset_connections()
+        self.assertIsNot(conn, storage.get_connection(cfg.CONF))
@@ -24,10 +24,16 @@
   running the tests. Make sure the Thrift server is running on that server.
 
 """
+import contextlib
+import datetime
+
 from oslo.config import cfg
 
+from ceilometer.publisher import rpc
+from ceilometer import sample
+from ceilometer import storage
 from ceilometer.storage.impl_hbase import Connection
-from ceilometer.storage.impl_hbase import MConnection
+from ceilometer.storage.impl_hbase import MConnectionPool
 from tests.storage import base
 
 
@@ -40,20 +46,109 @@ class ConnectionTest(HBaseEngineTestBase):
     def test_hbase_connection(self):
         cfg.CONF.database.connection = self.database_connection
         conn = Connection(cfg.CONF)
-        self.assertIsInstance(conn.conn, MConnection)
+        self.assertIsInstance(conn.conn_pool, MConnectionPool)
 
-        class TestConn(object):
-            def __init__(self, host, port):
+        class TestConnPool(object):
+            def __init__(self, host, port, size):
                 self.netloc = '%s:%s' % (host, port)
+                self.size = size
 
-            def open(self):
-                pass
-
+        # set_override resets the groups, so do it before setting the URL.
+        cfg.CONF.set_override('max_pool_size', 42, group='database')
         cfg.CONF.database.connection = 'hbase://test_hbase:9090'
-        self.stubs.Set(Connection, '_get_connection',
-                       lambda self, x: TestConn(x['host'], x['port']))
+        self.stubs.Set(Connection, '_get_connection_pool',
+                       lambda self, x: TestConnPool(x['host'], x['port'],
+                                                    x['pool_size']))
         conn = Connection(cfg.CONF)
-        self.assertIsInstance(conn.conn, TestConn)
+        self.assertIsInstance(conn.conn_pool, TestConnPool)
+        self.assertEqual('test_hbase:9090', conn.conn_pool.netloc)
+        self.assertEqual(42, conn.conn_pool.size)
+
+
+class MetadataTest(HBaseEngineTestBase):
+
+    def _record(self, minutes=0, metadata={'display_name': 'test-server'}):
+        c = sample.Sample(
+            'cpu',
+            sample.TYPE_GAUGE,
+            unit='ns',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id='resource-metadata',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata=metadata,
+            source='test',
+        )
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def test_shared(self):
+        self._record()
+        self._record(minutes=1)
+        self._record(minutes=2, metadata={'display_name': 'renamed'})
+        with self.conn.conn_pool.connection() as conn:
+            meters = [meter for ignored, meter in conn.table(
+                Connection.METER_TABLE).scan()
+                if meter['f:resource_id'] == 'resource-metadata']
+        self.assertEqual(2, len(set(meter['f:metadata_hash']
+                                    for meter in meters)))
+        self.assertNotIn('test-server', meters[-1]['f:message'])
+        f = storage.SampleFilter(meter='cpu', resource='resource-metadata')
+        self.assertEqual(['renamed', 'test-server', 'test-server'],
+                         [x.resource_metadata['display_name']
+                          for x in self.conn.get_samples(f)])
+        f = storage.SampleFilter(
+            meter='cpu', resource='resource-metadata',
+            metaquery={'metadata.display_name': 'test-server'})
+        self.assertEqual(2, len(list(self.conn.get_samples(f))))
+
+
+class CountingPool(object):
+    """Connection pool counting the connections taken from it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.held = 0
+        self.taken = 0
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        self.held += 1
+        self.taken += 1
+        try:
+            with self.pool.connection(timeout) as conn:
+                yield conn
+        finally:
+            self.held -= 1
+
+
+class ConnectionPoolTest(HBaseEngineTestBase):
+
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        self.pool = CountingPool(self.conn.conn_pool)
+        self.conn.conn_pool = self.pool
+
+    def test_listings_release_connection(self):
+        for listing in (self.conn.get_users, self.conn.get_projects,
+                        self.conn.get_resources, self.conn.get_meters):
+            self.assertTrue(list(listing()))
+            self.assertEqual(0, self.pool.held)
+
+    def test_samples_read_by_batches(self):
+        f = storage.SampleFilter(meter='instance')
+        expected = [(s.timestamp, s.message_id)
+                    for s in self.conn.get_samples(f)]
+        self.conn.sample_fetch_size = 2
+        self.pool.taken = 0
+        samples = []
+        for s in self.conn.get_samples(f):
+            # The connection is given back between the batches.
+            self.assertEqual(0, self.pool.held)
+            samples.append((s.timestamp, s.message_id))
+        self.assertEqual(expected, samples)
+        self.assertTrue(self.pool.taken > len(expected) / 2)
 
 
 class UserTest(base.UserTest, HBaseEngineTestBase):
@@ -77,7 +172,30 @@ class RawSampleTest(base.RawSampleTest, HBaseEngineTestBase):
 
 
 class StatisticsTest(base.StatisticsTest, HBaseEngineTestBase):
-    pass
+
+    def test_float_volumes(self):
+        for minutes, volume in [(0, 0.5), (1, 1.25), (7, 2.0)]:
+            c = sample.Sample(
+                'cpu_util',
+                sample.TYPE_GAUGE,
+                unit='%',
+                volume=volume,
+                user_id='user-float',
+                project_id='project-float',
+                resource_id='resource-float',
+                timestamp=datetime.datetime(2012, 9, 25, 10, minutes),
+                resource_metadata={},
+                source='test',
+            )
+            self.conn.record_metering_data(rpc.meter_message_from_counter(
+                c, cfg.CONF.publisher_rpc.metering_secret))
+        f = storage.SampleFilter(meter='cpu_util', user='user-float')
+        results = self.conn.get_meter_statistics(f, period=300)
+        self.assertEqual([(0.5, 1.25, 1.75, 2), (2.0, 2.0, 2.0, 1)],
+                         [(r.min, r.max, r.sum, r.count) for r in results])
+        self.assertEqual(datetime.datetime(2012, 9, 25, 10, 5),
+                         results[1].period_start)
+        self.assertEqual(60, results[0].duration)
 
 
 class CounterDataTypeTest(base.CounterDataTypeTest, HBaseEngineTestBase):
@@ -34,6 +34,8 @@ from tests.storage import base
 
 from ceilometer.publisher import rpc
 from ceilometer import sample
+from ceilometer import storage
+from ceilometer.storage import cache
 from ceilometer.storage import impl_mongodb
 from ceilometer.storage import models
 from ceilometer.tests import db as tests_db
@@ -123,6 +125,64 @@ class IndexTest(MongoDBEngineTestBase):
         self.assertTrue(self.conn.db.meter.ensure_index('foo',
                                                         name='meter_ttl'))
 
+    def test_metadata_ttl_index(self):
+        cfg.CONF.set_override('time_to_live', 456789, group='database')
+        self.conn.upgrade()
+        # The metadata expires after the slack of its timestamp.
+        self.assertEqual(self.conn.db.metadata.index_information()[
+            'metadata_ttl']['expireAfterSeconds'], 456789 + 600)
+
+        cfg.CONF.set_override('time_to_live', -1, group='database')
+        self.conn.upgrade()
+        self.assertNotIn('metadata_ttl',
+                         self.conn.db.metadata.index_information())
+
+
+class MetadataTest(MongoDBEngineTestBase):
+
+    def _record(self, minutes=0, metadata={'display_name': 'test-server'}):
+        c = sample.Sample(
+            'cpu',
+            sample.TYPE_GAUGE,
+            unit='ns',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id='resource-metadata',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata=metadata,
+            source='test',
+        )
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def test_shared(self):
+        self._record()
+        self._record(minutes=1)
+        # The metadata missing from the cache is updated in place.
+        self.conn.metadata_timestamps = cache.MemoryCache(10)
+        self._record(minutes=20)
+        self._record(minutes=21, metadata={'display_name': 'renamed'})
+        metadata = self.conn.db.metadata.find_one(
+            {'metadata.display_name': 'test-server'})
+        self.assertEqual(metadata['timestamp'],
+                         datetime.datetime(2012, 7, 2, 11, 20))
+        self.assertEqual(self.conn.db.meter.find(
+            {'metadata_hash': metadata['_id']}).count(), 3)
+        self.assertEqual(self.conn.db.meter.find(
+            {'resource_metadata': {'$exists': True}}).count(), 0)
+        f = storage.SampleFilter(meter='cpu', resource='resource-metadata')
+        self.assertEqual([x.resource_metadata['display_name']
+                          for x in self.conn.get_samples(f)],
+                         ['renamed', 'test-server', 'test-server',
+                          'test-server'])
+        f = storage.SampleFilter(
+            meter='cpu', resource='resource-metadata',
+            metaquery={'metadata.display_name': 'test-server'})
+        self.assertEqual(len(list(self.conn.get_samples(f))), 3)
+        resource, = self.conn.get_resources(resource='resource-metadata')
+        self.assertEqual(resource.metadata, {'display_name': 'renamed'})
+
 
 class UserTest(base.UserTest, MongoDBEngineTestBase):
     pass
@@ -151,10 +211,143 @@ class RawSampleTest(base.RawSampleTest, MongoDBEngineTestBase):
         pass
 
 
+class BatchTest(MongoDBEngineTestBase):
+
+    def _msg(self, name, minutes, source='test'):
+        c = sample.Sample(
+            name,
+            sample.TYPE_GAUGE,
+            unit='',
+            volume=1,
+            user_id='user-batch',
+            project_id='project-batch',
+            resource_id='resource-batch',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata={'minutes': minutes},
+            source=source,
+        )
+        return rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret)
+
+    def test_coalesced(self):
+        self.conn.record_metering_data_batch([
+            self._msg('cpu', 0), self._msg('memory', 1, source='other'),
+            self._msg('cpu', 2)])
+        self.assertEqual(
+            self.conn.db.user.find_one('user-batch')['source'],
+            ['other', 'test'])
+        resource = self.conn.db.resource.find_one('resource-batch')
+        self.assertEqual(resource['metadata'], {'minutes': 2})
+        self.assertEqual([m['counter_name'] for m in resource['meter']],
+                         ['cpu', 'memory'])
+        self.assertEqual(self.conn.db.meter.find(
+            {'resource_id': 'resource-batch'}).count(), 3)
+
+    def test_known_sources_skipped(self):
+        self.conn.record_metering_data(self._msg('cpu', 0))
+        self.conn.db.project.remove('project-batch')
+        self.conn.record_metering_data(self._msg('cpu', 1))
+        self.assertIsNone(self.conn.db.project.find_one('project-batch'))
+        self.conn.record_metering_data(self._msg('cpu', 2, source='other'))
+        self.assertEqual(
+            self.conn.db.project.find_one('project-batch')['source'],
+            ['other'])
+
+    def test_resource_summary(self):
+        self.conn.record_metering_data_batch([
+            self._msg('cpu', 2), self._msg('memory', 1, source='other')])
+        self.conn.record_metering_data(self._msg('cpu', 0))
+        self.conn.record_metering_data(self._msg('cpu', 3))
+        resource = self.conn.db.resource.find_one('resource-batch')
+        self.assertEqual(resource['first_sample_timestamp'],
+                         datetime.datetime(2012, 7, 2, 11, 0))
+        self.assertEqual(resource['last_sample_timestamp'],
+                         datetime.datetime(2012, 7, 2, 11, 3))
+        self.assertEqual(sorted(resource['sources']), ['other', 'test'])
+        self.assertEqual(resource['users'], ['user-batch'])
+        self.assertEqual(len(resource['meter']), 2)
+
+    def test_resource_summary_before_2_6(self):
+        # The servers before 2.6 have no $min and $max update operators,
+        # and the servers before 2.4 no $each.
+        self.conn.server_version = [2, 2, 0]
+        self.test_resource_summary()
+
+    def test_resource_summary_upgrade(self):
+        self.conn.record_metering_data(self._msg('cpu', 1))
+        self.conn.record_metering_data(self._msg('cpu', 2))
+        self.conn.db.resource.update(
+            {'_id': 'resource-batch'},
+            {'$unset': {'first_sample_timestamp': 1,
+                        'last_sample_timestamp': 1,
+                        'users': 1}})
+        # Connecting only ensures the indexes.
+        impl_mongodb.Connection(cfg.CONF)
+        self.assertNotIn('users',
+                         self.conn.db.resource.find_one('resource-batch'))
+        self.conn.upgrade()
+        resource = self.conn.db.resource.find_one('resource-batch')
+        self.assertEqual(resource['first_sample_timestamp'],
+                         datetime.datetime(2012, 7, 2, 11, 1))
+        self.assertEqual(resource['last_sample_timestamp'],
+                         datetime.datetime(2012, 7, 2, 11, 2))
+        self.assertEqual(resource['users'], ['user-batch'])
+
+    def test_write_concern(self):
+        cfg.CONF.set_override('mongodb_write_concern', 'majority',
+                              group='database')
+        self.assertEqual(impl_mongodb.Connection(cfg.CONF).write_concern,
+                         {'w': 'majority'})
+        cfg.CONF.set_override('mongodb_write_concern', '0',
+                              group='database')
+        self.assertEqual(impl_mongodb.Connection(cfg.CONF).write_concern,
+                         {'w': 0})
+
+
+class ExpirerTest(MongoDBEngineTestBase):
+
+    def test_orphans_removed(self):
+        cfg.CONF.set_override('expirer_batch_size', 2, group='database')
+        cfg.CONF.set_override('expirer_batch_delay', 0, group='database')
+        for name in ['user', 'project', 'resource']:
+            getattr(self.conn.db, name).insert([{'_id': 'orphan-1'},
+                                                {'_id': 'orphan-2'}])
+        self.conn.clear_expired_metering_data(3600)
+        self.assertEqual(sorted(self.conn.get_users()),
+                         sorted(set(m['user_id'] for m in self.msgs)))
+        self.assertEqual(sorted(self.conn.get_projects()),
+                         sorted(set(m['project_id'] for m in self.msgs)))
+        self.assertEqual(self.conn.db.resource.find(
+            {'_id': {'$in': ['orphan-1', 'orphan-2']}}).count(), 0)
+        self.assertEqual(self.conn.db.resource.count(),
+                         len(set(m['resource_id'] for m in self.msgs)))
+
+    def test_first_sample_timestamp_refreshed(self):
+        resource_id = self.msgs[0]['resource_id']
+        first = min(m['timestamp'] for m in self.msgs
+                    if m['resource_id'] == resource_id)
+        self.conn.db.meter.remove({'resource_id': resource_id,
+                                   'timestamp': first})
+        self.conn.clear_expired_metering_data(3600)
+        remaining = self.conn.db.meter.find(
+            {'resource_id': resource_id}).sort('timestamp', 1).limit(1)
+        resource = self.conn.db.resource.find_one(resource_id)
+        self.assertEqual(resource['first_sample_timestamp'],
+                         remaining[0]['timestamp'])
+
+
 class StatisticsTest(base.StatisticsTest, MongoDBEngineTestBase):
     pass
 
 
+class MapReduceStatisticsTest(StatisticsTest):
+
+    def setUp(self):
+        super(MapReduceStatisticsTest, self).setUp()
+        # The servers before 2.4 compute the statistics with map/reduce.
+        self.conn.server_version = [2, 2, 0]
+
+
 class AlarmTest(base.AlarmTest, MongoDBEngineTestBase):
     def prepare_old_matching_metadata_alarm(self):
         alarm = models.Alarm('old-alert',
@@ -248,6 +441,16 @@ class CompatibilityTest(MongoDBEngineTestBase):
         meters = list(self.conn.get_meters())
         self.assertEqual(len(meters), 1)
 
+    def test_embedded_metadata(self):
+        f = storage.SampleFilter(
+            meter='volume.size',
+            metaquery={'metadata.display_name': 'test-volume'})
+        s, = self.conn.get_samples(f)
+        self.assertEqual(s.resource_metadata['tag'], 'self.counter')
+        resource, = self.conn.get_resources(
+            metaquery={'metadata.display_name': 'test-volume'})
+        self.assertEqual(resource.metadata['tag'], 'self.counter')
+
 
 class AlarmTestPagination(base.AlarmTestPagination, MongoDBEngineTestBase):
 
@@ -0,0 +1,334 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/impl_sharded.py
+
+The shards are time series driver databases in local directories, or
+SQLite databases in local files.
+"""
+
+import datetime
+import itertools
+
+import fixtures
+import mock
+from oslo.config import cfg
+
+from ceilometer.openstack.common import timeutils
+from ceilometer.publisher import rpc
+from ceilometer import sample
+from ceilometer import storage
+from ceilometer.storage import impl_sharded
+from ceilometer.tests import base as tests_base
+from tests.storage import base
+
+
+def make_shards(path, count, prefix='shard'):
+    return ['tsdb://%s/%s%d' % (path, prefix, i) for i in range(count)]
+
+
+def make_sql_shards(path, count, prefix='shard'):
+    return ['sqlite:///%s/%s%d.db' % (path, prefix, i) for i in range(count)]
+
+
+class ShardedEngineTestBase(base.DBTestBase):
+    database_connection = 'sharded://'
+    shard_count = 3
+
+    @staticmethod
+    def make_shards(path, count, prefix='shard'):
+        return make_shards(path, count, prefix)
+
+    def setUp(self):
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.shards = self.make_shards(self.path, self.shard_count)
+        cfg.CONF.set_override('shard_connections', self.shards,
+                              group='database')
+        super(ShardedEngineTestBase, self).setUp()
+
+
+class SQLShardedEngineTestBase(ShardedEngineTestBase):
+    shard_count = 2
+
+    @staticmethod
+    def make_shards(path, count, prefix='shard'):
+        return make_sql_shards(path, count, prefix)
+
+
+class UserTest(base.UserTest, ShardedEngineTestBase):
+    pass
+
+
+class ProjectTest(base.ProjectTest, ShardedEngineTestBase):
+    pass
+
+
+class ResourceTest(base.ResourceTest, ShardedEngineTestBase):
+    pass
+
+
+class MeterTest(base.MeterTest, ShardedEngineTestBase):
+    pass
+
+
+class RawSampleTest(base.RawSampleTest, ShardedEngineTestBase):
+    pass
+
+
+class StatisticsTest(base.StatisticsTest, ShardedEngineTestBase):
+    pass
+
+
+class CounterDataTypeTest(base.CounterDataTypeTest, ShardedEngineTestBase):
+    pass
+
+
+class AlarmTest(base.AlarmTest, ShardedEngineTestBase):
+    pass
+
+
+class ExpirerTest(ShardedEngineTestBase):
+
+    def test_clear_expired_metering_data(self):
+        timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2,
+                                                           10, 45)
+        self.conn.clear_expired_metering_data(3 * 60)
+        f = storage.SampleFilter(meter='instance')
+        self.assertEqual(5, len(list(self.conn.get_samples(f))))
+
+
+class SQLUserTest(base.UserTest, SQLShardedEngineTestBase):
+    pass
+
+
+class SQLResourceTest(base.ResourceTest, SQLShardedEngineTestBase):
+    pass
+
+
+class SQLRawSampleTest(base.RawSampleTest, SQLShardedEngineTestBase):
+    pass
+
+
+class SQLStatisticsTest(base.StatisticsTest, SQLShardedEngineTestBase):
+    pass
+
+
+class EventTestBase(base.EventTestBase):
+    database_connection = 'sharded://'
+
+    def setUp(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        cfg.CONF.set_override('shard_connections', make_shards(path, 3),
+                              group='database')
+        super(EventTestBase, self).setUp()
+
+
+class GetEventTest(base.GetEventTest, EventTestBase):
+    pass
+
+
+class ShardingTest(ShardedEngineTestBase):
+
+    def _shard_samples(self, url):
+        return list(self.conn.shards[url].get_samples(storage.SampleFilter()))
+
+    def test_samples_spread_by_resource(self):
+        found = 0
+        used = 0
+        for url in self.shards:
+            samples = self._shard_samples(url)
+            for s in samples:
+                self.assertEqual(url,
+                                 self.conn.ring.get_node(s.resource_id))
+            found += len(samples)
+            used += bool(samples)
+        self.assertEqual(len(self.msgs), found)
+        self.assertTrue(used > 1)
+
+    def test_get_samples_merged_in_order(self):
+        samples = list(self.conn.get_samples(storage.SampleFilter()))
+        self.assertEqual(len(self.msgs), len(samples))
+        keys = [(s.timestamp, s.message_id) for s in samples]
+        self.assertEqual(sorted(keys, reverse=True), keys)
+
+    def test_get_samples_limit(self):
+        samples = list(self.conn.get_samples(storage.SampleFilter(), 3))
+        self.assertEqual(
+            sorted((m['timestamp'] for m in self.msgs), reverse=True)[:3],
+            [s.timestamp for s in samples])
+
+    def test_batch_failure_records_each_sample(self):
+        msgs = []
+        for i in range(4):
+            c = sample.Sample(
+                'batch', sample.TYPE_GAUGE, unit='', volume=i,
+                user_id='user-id', project_id='project-id',
+                resource_id='resource-batch-%d' % i,
+                timestamp=datetime.datetime(2012, 7, 2, 10, i),
+                resource_metadata={}, source='test')
+            msgs.append(rpc.meter_message_from_counter(
+                c, cfg.CONF.publisher_rpc.metering_secret))
+        patches = [mock.patch.object(conn, 'record_metering_data_batch',
+                                     side_effect=Exception('boom'))
+                   for conn in self.conn.shards.values()]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.conn.record_metering_data_batch(msgs)
+        self.assertEqual([0, 1, 2, 3], sorted(
+            x.counter_volume for x in self.conn.get_samples(
+                storage.SampleFilter(meter='batch'))))
+
+    def test_get_samples_streamed(self):
+        cfg.CONF.set_override('sample_fetch_size', 1, group='database')
+        read = []
+
+        def counting(get_samples):
+            def wrapper(*args, **kwargs):
+                for s in get_samples(*args, **kwargs):
+                    read.append(s)
+                    yield s
+            return wrapper
+
+        for conn in self.conn.shards.values():
+            patch = mock.patch.object(conn, 'get_samples',
+                                      counting(conn.get_samples))
+            patch.start()
+            self.addCleanup(patch.stop)
+        samples = self.conn.get_samples(storage.SampleFilter())
+        # Only the first sample of each shard is read at once.
+        self.assertTrue(len(read) <= len(self.shards))
+        self.assertEqual(2, len(list(itertools.islice(samples, 2))))
+        self.assertTrue(len(read) <= len(self.shards) + 2)
+        self.assertEqual(len(self.msgs), len(list(samples)) + 2)
+        self.assertEqual(len(self.msgs), len(read))
+
+    def test_unsupported_shard(self):
+        for url in ('sharded://', 'sqlite://'):
+            cfg.CONF.set_override('shard_connections', [url],
+                                  group='database')
+            self.assertRaises(RuntimeError, impl_sharded.Connection,
+                              cfg.CONF)
+
+
+class SQLShardingTest(SQLShardedEngineTestBase):
+
+    def test_page_equal_timestamps(self):
+        timestamp = datetime.datetime(2012, 7, 2, 10, 0)
+        # The resources of the samples alternate between the shards.
+        resources = ('resource-tie-%d' % i for i in itertools.count())
+        for i in range(8):
+            url = self.shards[i % 2]
+            resource = next(r for r in resources
+                            if self.conn.ring.get_node(r) == url)
+            c = sample.Sample(
+                'tie', sample.TYPE_GAUGE, unit='', volume=i,
+                user_id='user-id', project_id='project-id',
+                resource_id=resource,
+                timestamp=timestamp, resource_metadata={}, source='test')
+            msg = rpc.meter_message_from_counter(
+                c, cfg.CONF.publisher_rpc.metering_secret)
+            if i % 3 == 0:
+                # Not a canonical uuid, kept as text by the SQL driver.
+                msg['message_id'] = 'message-%d' % i
+            self.conn.record_metering_data(msg)
+        for url in self.shards:
+            self.assertTrue(list(self.conn.shards[url].get_samples(
+                storage.SampleFilter(meter='tie'))))
+
+        expected = list(self.conn.get_samples(
+            storage.SampleFilter(meter='tie')))
+        self.assertEqual(8, len(expected))
+        keys = [self.conn.sample_order_key(s) for s in expected]
+        self.assertEqual(sorted(keys, reverse=True), keys)
+        pages = []
+        f = storage.SampleFilter(meter='tie')
+        while True:
+            page = list(self.conn.get_samples(f, limit=3))
+            if not page:
+                break
+            pages.extend(page)
+            f = storage.SampleFilter(meter='tie',
+                                     marker_timestamp=page[-1].timestamp,
+                                     marker_message_id=page[-1].message_id)
+        self.assertEqual([s.message_id for s in expected],
+                         [s.message_id for s in pages])
+
+
+class RebalanceTest(ShardedEngineTestBase):
+
+    def test_copy_shards(self):
+        targets = make_shards(self.path, 4, prefix='new')
+        self.assertEqual(len(self.msgs), impl_sharded.copy_shards(
+            cfg.CONF, self.shards, targets))
+
+        cfg.CONF.set_override('shard_connections', targets,
+                              group='database')
+        conn = impl_sharded.Connection(cfg.CONF)
+        for url in targets:
+            for s in conn.shards[url].get_samples(storage.SampleFilter()):
+                self.assertEqual(url, conn.ring.get_node(s.resource_id))
+        self.assertEqual(
+            [(s.timestamp, s.message_id)
+             for s in self.conn.get_samples(storage.SampleFilter())],
+            [(s.timestamp, s.message_id)
+             for s in conn.get_samples(storage.SampleFilter())])
+        conn.clear()
+
+    def test_copy_shards_since(self):
+        targets = make_shards(self.path, 4, prefix='new')
+        impl_sharded.copy_shards(cfg.CONF, self.shards, targets)
+        # Recorded while the first copy ran.
+        c = sample.Sample(
+            'late', sample.TYPE_GAUGE, unit='', volume=1,
+            user_id='user-id', project_id='project-id',
+            resource_id='resource-late', timestamp=timeutils.utcnow(),
+            resource_metadata={}, source='test')
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+        since = min(m['timestamp'] for m in self.msgs)
+        self.assertEqual(1, impl_sharded.copy_shards(
+            cfg.CONF, self.shards, targets, since))
+
+        cfg.CONF.set_override('shard_connections', targets,
+                              group='database')
+        conn = impl_sharded.Connection(cfg.CONF)
+        self.assertEqual(
+            [s.message_id
+             for s in self.conn.get_samples(storage.SampleFilter())],
+            [s.message_id for s in conn.get_samples(storage.SampleFilter())])
+        conn.clear()
+
+
+class TestHashRing(tests_base.TestCase):
+
+    def test_stable(self):
+        ring = impl_sharded.HashRing(['a', 'b', 'c'])
+        other = impl_sharded.HashRing(['c', 'a', 'b'])
+        for i in range(100):
+            self.assertEqual(ring.get_node(str(i)), other.get_node(str(i)))
+
+    def test_add_node(self):
+        ring = impl_sharded.HashRing(['a', 'b', 'c'])
+        bigger = impl_sharded.HashRing(['a', 'b', 'c', 'd'])
+        moved = 0
+        for i in range(1000):
+            node = bigger.get_node(str(i))
+            if node != ring.get_node(str(i)):
+                self.assertEqual('d', node)
+                moved += 1
+        self.assertTrue(100 < moved < 400)
+
+    def test_unicode(self):
+        ring = impl_sharded.HashRing(['a', 'b'])
+        self.assertEqual(ring.get_node('r\xc3\xa9'), ring.get_node(u'r\xe9'))
@@ -22,6 +22,28 @@
   the tests.
 
 """
+import datetime
+import uuid
+
+from mock import MagicMock
+from oslo.config import cfg
+from sqlalchemy import event
+
+from ceilometer.openstack.common.db.sqlalchemy import session
+from ceilometer.openstack.common import timeutils
+from ceilometer.publisher import rpc
+from ceilometer import sample
+from ceilometer import storage
+from ceilometer.storage import impl_sqlalchemy
+from ceilometer.storage.sqlalchemy.models import ExpirerCheckpoint
+from ceilometer.storage.sqlalchemy.models import MetaText
+from ceilometer.storage.sqlalchemy.models import MeterDefinition
+from ceilometer.storage.sqlalchemy.models import MeterMetadata
+from ceilometer.storage.sqlalchemy.models import MeterRollup
+from ceilometer.storage.sqlalchemy.models import MeterSource
+from ceilometer.storage.sqlalchemy.models import MeterSummary
+from ceilometer.storage.sqlalchemy.models import Resource
+from ceilometer.storage.sqlalchemy.models import User
 from ceilometer.storage.sqlalchemy.models import table_args
 from tests.storage import base
 
@@ -54,6 +76,649 @@ class StatisticsTest(base.StatisticsTest, SQLAlchemyEngineTestBase):
     pass
 
 
+class ExpirerTest(SQLAlchemyEngineTestBase):
+
+    def setUp(self):
+        super(ExpirerTest, self).setUp()
+        cfg.CONF.set_override('expirer_batch_size', 2, group='database')
+        cfg.CONF.set_override('expirer_batch_delay', 0, group='database')
+        timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2,
+                                                           10, 45)
+
+    def test_batches(self):
+        self.conn.clear_expired_metering_data(3 * 60)
+        f = storage.SampleFilter(meter='instance')
+        self.assertEqual(5, len(list(self.conn.get_samples(f))))
+        self.assertEqual(5, len(list(self.conn.get_users())))
+        self.assertEqual(5, len(list(self.conn.get_projects())))
+        self.assertEqual(5, len(list(self.conn.get_resources())))
+        s = session.get_session()
+        self.assertEqual(0, s.query(ExpirerCheckpoint).count())
+
+    def test_resume_from_checkpoint(self):
+        s = session.get_session()
+        with s.begin():
+            s.add(ExpirerCheckpoint(table_name='meter', last_id=1 << 30))
+        self.conn.clear_expired_metering_data(3 * 60)
+        # Every id is before the checkpoint, nothing is left to expire.
+        f = storage.SampleFilter(meter='instance')
+        self.assertEqual(11, len(list(self.conn.get_samples(f))))
+        self.assertEqual(0, s.query(ExpirerCheckpoint).count())
+
+
+class MetaQueryTest(SQLAlchemyEngineTestBase):
+
+    def prepare_data(self):
+        super(MetaQueryTest, self).prepare_data()
+        c = sample.Sample(
+            'instance',
+            sample.TYPE_GAUGE,
+            unit='instance',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id='resource-id-typed',
+            timestamp=datetime.datetime(2012, 7, 2, 10, 42),
+            resource_metadata={'image': {'name': 'ubuntu'},
+                               'vcpus': 2,
+                               'autostart': True,
+                               'ports': [80, 443]},
+            source='test',
+        )
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def _get_samples(self, metaquery):
+        f = storage.SampleFilter(meter='instance', metaquery=metaquery)
+        return list(self.conn.get_samples(f))
+
+    def test_get_samples(self):
+        results = self._get_samples({'metadata.tag': 'self.counter'})
+        self.assertEqual(2, len(results))
+
+    def test_get_samples_nested(self):
+        results = self._get_samples({'metadata.image.name': 'ubuntu'})
+        self.assertEqual(['resource-id-typed'],
+                         [r.resource_id for r in results])
+
+    def test_get_samples_typed(self):
+        for value in ('2', '2.0'):
+            results = self._get_samples({'metadata.vcpus': value})
+            self.assertEqual(1, len(results))
+        self.assertEqual(
+            1, len(self._get_samples({'metadata.autostart': 'true'})))
+        self.assertEqual(
+            [], self._get_samples({'metadata.autostart': 'false'}))
+
+    def test_get_resources(self):
+        resources = list(self.conn.get_resources(
+            metaquery={'metadata.tag': 'self.counter2'}))
+        self.assertEqual(['resource-id-alternate'],
+                         [r.resource_id for r in resources])
+
+    def test_get_meter_statistics(self):
+        f = storage.SampleFilter(meter='instance',
+                                 metaquery={'metadata.tag': 'self.counter'})
+        results = list(self.conn.get_meter_statistics(f))
+        self.assertEqual(2, results[0].count)
+
+    def test_not_indexed(self):
+        cfg.CONF.set_override('metadata_index_keys', ['display_name'],
+                              group='database')
+        self.assertRaises(NotImplementedError, self._get_samples,
+                          {'metadata.tag': 'self.counter'})
+
+
+class PeriodStatisticsTest(SQLAlchemyEngineTestBase):
+
+    def prepare_data(self):
+        start = datetime.datetime(2012, 9, 25, 10, 0, 0, 250000)
+        for i in range(50):
+            c = sample.Sample(
+                'volume.size',
+                sample.TYPE_GAUGE,
+                unit='GiB',
+                volume=i % 7,
+                user_id='user-id',
+                project_id='project-id',
+                resource_id='resource-id-%d' % (i % 3),
+                timestamp=start + datetime.timedelta(seconds=37 * i),
+                resource_metadata={'display_name': 'volume-%d' % (i % 2)},
+                source='test',
+            )
+            self.conn.record_metering_data(rpc.meter_message_from_counter(
+                c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def _get_statistics(self, period, **kwargs):
+        f = storage.SampleFilter(meter='volume.size', **kwargs)
+        return [s.as_dict() for s in
+                self.conn.get_meter_statistics(f, period)]
+
+    def _check(self, period, **kwargs):
+        raw_queries = []
+        get_raw_aggregate = self.conn._get_raw_aggregate
+
+        def count_raw_queries(sample_filter, raw_range):
+            raw_queries.append(raw_range)
+            return get_raw_aggregate(sample_filter, raw_range)
+        self.stubs.Set(self.conn, '_get_raw_aggregate', count_raw_queries)
+        grouped = self._get_statistics(period, **kwargs)
+        # At most the one of the whole time range, to find the first
+        # sample.
+        self.assertTrue(len(raw_queries) <= 1)
+        self.stubs.Set(impl_sqlalchemy, 'MAX_RAW_QUERIES', 1 << 30)
+        self.assertEqual(self._get_statistics(period, **kwargs), grouped)
+        self.assertTrue(len(raw_queries) > len(grouped))
+        return grouped
+
+    def test_unaligned_start(self):
+        stats = self._check(60,
+                            start=datetime.datetime(2012, 9, 25, 10, 0, 30),
+                            end=datetime.datetime(2012, 9, 25, 11))
+        self.assertEqual(datetime.datetime(2012, 9, 25, 10, 0, 30),
+                         stats[0]['period_start'])
+        self.assertEqual(49, sum(s['count'] for s in stats))
+
+    def test_first_sample_start(self):
+        stats = self._check(45)
+        self.assertEqual(datetime.datetime(2012, 9, 25, 10, 0, 0, 250000),
+                         stats[0]['period_start'])
+        self.assertEqual(50, sum(s['count'] for s in stats))
+
+    def test_metaquery(self):
+        stats = self._get_statistics(
+            120, metaquery={'metadata.display_name': 'volume-0'})
+        self.assertEqual(25, sum(s['count'] for s in stats))
+
+
+class DimensionCacheTest(SQLAlchemyEngineTestBase):
+
+    def setUp(self):
+        super(DimensionCacheTest, self).setUp()
+        self.recorded = []
+        record_dimensions = impl_sqlalchemy._record_dimensions
+
+        def _record_dimensions(s, data):
+            self.recorded.append(data['resource_id'])
+            return record_dimensions(s, data)
+        self.stubs.Set(impl_sqlalchemy, '_record_dimensions',
+                       _record_dimensions)
+
+    def _record(self, resource_id='resource-id', minutes=0, **kwargs):
+        c = sample.Sample(
+            'instance',
+            sample.TYPE_GAUGE,
+            unit='instance',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id=resource_id,
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata=kwargs.get('metadata',
+                                         {'display_name': 'test-server'}),
+            source='test',
+        )
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def test_known_dimensions(self):
+        self._record()
+        self._record(minutes=1)
+        self.assertEqual(['resource-id'], self.recorded)
+        self._record(resource_id='resource-id-new')
+        self.assertEqual(['resource-id', 'resource-id-new'], self.recorded)
+        f = storage.SampleFilter(meter='instance',
+                                 start=datetime.datetime(2012, 7, 2, 11),
+                                 end=datetime.datetime(2012, 7, 2, 12))
+        samples = list(self.conn.get_samples(f))
+        self.assertEqual(3, len(samples))
+        self.assertEqual(['test'] * 3, [s.source for s in samples])
+        self.assertEqual(
+            ['resource-id', 'resource-id-new'],
+            sorted(r.resource_id for r in self.conn.get_resources(
+                start_timestamp=datetime.datetime(2012, 7, 2, 11),
+                end_timestamp=datetime.datetime(2012, 7, 2, 12))))
+
+    def test_metadata_changed(self):
+        self._record()
+        self._record(minutes=1, metadata={'display_name': 'renamed'})
+        self.assertEqual(['resource-id'], self.recorded)
+        row = session.get_session().query(Resource).get('resource-id')
+        self.assertEqual({'display_name': 'renamed'}, row.resource_metadata)
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 1),
+                         row.last_sample_timestamp)
+
+    def test_last_sample_timestamp(self):
+        self._record()
+        self._record(minutes=5)
+        s = session.get_session()
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 0),
+                         s.query(User).get('user-id').last_sample_timestamp)
+        self._record(minutes=11)
+        s.expire_all()
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 11),
+                         s.query(User).get('user-id').last_sample_timestamp)
+        self.assertEqual(
+            datetime.datetime(2012, 7, 2, 11, 11),
+            s.query(Resource).get('resource-id').last_sample_timestamp)
+
+    def test_clear_resets(self):
+        self._record()
+        self.conn.clear()
+        self._record(minutes=1)
+        self.assertEqual(['resource-id', 'resource-id'], self.recorded)
+        self.assertIsNotNone(session.get_session().query(User).get('user-id'))
+
+    def test_disabled(self):
+        cfg.CONF.set_override('dimension_cache_size', 0, group='database')
+        self.conn.clear()
+        self._record()
+        self._record(minutes=1)
+        self.assertEqual(['resource-id', 'resource-id'], self.recorded)
+
+
+class MeterSummaryTest(SQLAlchemyEngineTestBase):
+
+    def _record(self, minutes=0, name='cpu', user_id='user-id',
+                metadata={'display_name': 'test-server'}):
+        c = sample.Sample(
+            name,
+            sample.TYPE_GAUGE,
+            unit='ns',
+            volume=1,
+            user_id=user_id,
+            project_id='project-id',
+            resource_id='resource-summary',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata=metadata,
+            source='test',
+        )
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def _summaries(self):
+        return session.get_session().query(MeterSummary).filter(
+            MeterSummary.resource_id == 'resource-summary').order_by(
+                MeterSummary.counter_name).all()
+
+    @staticmethod
+    def _metadata(summary):
+        return session.get_session().query(MeterMetadata).get(
+            summary.metadata_id).resource_metadata
+
+    def _resource(self):
+        resources = list(self.conn.get_resources(
+            resource='resource-summary'))
+        self.assertEqual(1, len(resources))
+        return resources[0]
+
+    def test_maintained(self):
+        self._record(minutes=5)
+        self._record(minutes=1, metadata={'display_name': 'old'})
+        self._record(minutes=3, name='memory')
+        cpu, memory = self._summaries()
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 1),
+                         cpu.first_timestamp)
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 5),
+                         cpu.last_timestamp)
+        # The sample recorded late does not replace the latest one.
+        self.assertEqual({'display_name': 'test-server'},
+                         self._metadata(cpu))
+        self.assertEqual('memory', memory.counter_name)
+
+        resource = self._resource()
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 1),
+                         resource.first_sample_timestamp)
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 5),
+                         resource.last_sample_timestamp)
+        self.assertEqual(['cpu', 'memory'],
+                         [m.counter_name for m in resource.meter])
+
+    def test_metadata_changed(self):
+        self._record()
+        self._record(minutes=1, metadata={'display_name': 'renamed'})
+        cpu, = self._summaries()
+        self.assertEqual({'display_name': 'renamed'}, self._metadata(cpu))
+        self.assertEqual('renamed', self._resource().metadata['display_name'])
+        self.assertEqual(1, len(list(self.conn.get_meters(
+            resource='resource-summary',
+            metaquery={'metadata.display_name': 'renamed'}))))
+        self.assertEqual([], list(self.conn.get_meters(
+            resource='resource-summary',
+            metaquery={'metadata.display_name': 'test-server'})))
+
+    def test_owner_changed(self):
+        self._record()
+        self._record(minutes=1, user_id='user-new')
+        self.assertEqual(2, len(self._summaries()))
+        self.assertEqual('user-new', self._resource().user_id)
+        meters = list(self.conn.get_meters(resource='resource-summary'))
+        self.assertEqual(['user-new'], [m.user_id for m in meters])
+        self.assertEqual([], list(self.conn.get_meters(
+            resource='resource-summary', user='user-id')))
+        resources = list(self.conn.get_resources(
+            resource='resource-summary', user='user-id'))
+        self.assertEqual([datetime.datetime(2012, 7, 2, 11)],
+                         [r.last_sample_timestamp for r in resources])
+
+    def test_expired(self):
+        self._record(minutes=1)
+        self._record(minutes=5)
+        self._record(minutes=2, name='memory')
+        timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2,
+                                                           11, 3)
+        self.conn.clear_expired_metering_data(0)
+        cpu, = self._summaries()
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 5),
+                         cpu.first_timestamp)
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 5),
+                         cpu.last_timestamp)
+
+    def test_expired_batches(self):
+        cfg.CONF.set_override('expirer_batch_size', 1, group='database')
+        cfg.CONF.set_override('expirer_batch_delay', 0, group='database')
+        for name in ('cpu', 'disk', 'memory'):
+            self._record(minutes=1, name=name)
+            self._record(minutes=5, name=name)
+        self._record(minutes=4, name='network')
+        timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2,
+                                                           11, 3)
+        self.conn.clear_expired_metering_data(0)
+        self.assertEqual(
+            [('cpu', 5), ('disk', 5), ('memory', 5), ('network', 4)],
+            [(x.counter_name, x.first_timestamp.minute)
+             for x in self._summaries()])
+        self.assertEqual(0, session.get_session().query(
+            ExpirerCheckpoint).count())
+
+
+class RecordBatchTest(SQLAlchemyEngineTestBase):
+
+    def _message(self, minutes=0, volume=1, resource_id='resource-batch',
+                 metadata={'display_name': 'test-server'}):
+        c = sample.Sample(
+            'cpu',
+            sample.TYPE_GAUGE,
+            unit='ns',
+            volume=volume,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id=resource_id,
+            timestamp=(datetime.datetime(2012, 7, 2, 11) +
+                       datetime.timedelta(minutes=minutes)),
+            resource_metadata=metadata,
+            source='test',
+        )
+        return rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret)
+
+    def setUp(self):
+        super(RecordBatchTest, self).setUp()
+        self.statements = []
+        # The listener cannot be removed, it stops recording at cleanup.
+        event.listen(session.get_session().get_bind(),
+                     'before_cursor_execute', self._before_execute)
+        self.addCleanup(setattr, self, 'statements', None)
+
+    def _before_execute(self, conn, cursor, statement, *args):
+        if self.statements is not None:
+            self.statements.append(statement)
+
+    def _count_statements(self, table, func, *args):
+        del self.statements[:]
+        func(*args)
+        return len([s for s in self.statements if table in s])
+
+    @staticmethod
+    def _rollups(resolution):
+        return session.get_session().query(MeterRollup).filter(
+            MeterRollup.counter_name == 'cpu',
+            MeterRollup.resolution == resolution).order_by(
+                MeterRollup.bucket_start).all()
+
+    def test_rollups(self):
+        self.conn.record_metering_data_batch([self._message(1, 2),
+                                              self._message(2, 4)])
+        self.conn.record_metering_data_batch([self._message(3, 1),
+                                              self._message(61, 8)])
+        hour, next_hour = self._rollups(3600)
+        self.assertEqual((3, 7, 1, 4),
+                         (hour.count, hour.sum, hour.min, hour.max))
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 1),
+                         hour.first_timestamp)
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 3),
+                         hour.last_timestamp)
+        self.assertEqual((1, 8), (next_hour.count, next_hour.sum))
+        day, = self._rollups(86400)
+        self.assertEqual((4, 15, 1, 8),
+                         (day.count, day.sum, day.min, day.max))
+        self.assertEqual(4, len(self._rollups(60)))
+
+    def test_summaries(self):
+        self.conn.record_metering_data_batch([
+            self._message(5),
+            self._message(1, metadata={'display_name': 'old'}),
+        ])
+        self.conn.record_metering_data_batch([
+            self._message(3, metadata={'display_name': 'late'}),
+            self._message(0),
+        ])
+        summary, = session.get_session().query(MeterSummary).filter(
+            MeterSummary.resource_id == 'resource-batch').all()
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 0),
+                         summary.first_timestamp)
+        self.assertEqual(datetime.datetime(2012, 7, 2, 11, 5),
+                         summary.last_timestamp)
+        self.assertEqual({'display_name': 'test-server'},
+                         session.get_session().query(MeterMetadata).get(
+                             summary.metadata_id).resource_metadata)
+
+    def test_statements_per_batch(self):
+        # One query of the existing rollups, one insert of the missing
+        # ones and one update of the others, whatever the batch size.
+        for minutes, expected in ((0, 2), (0, 2), (1, 3)):
+            samples = [self._message(minutes, resource_id='resource-%d' % i)
+                       for i in range(10)]
+            self.assertEqual(expected, self._count_statements(
+                'meter_rollup', self.conn.record_metering_data_batch,
+                samples))
+        samples = [self._message(2, resource_id='resource-%d' % i)
+                   for i in range(10)]
+        self.assertEqual(2, self._count_statements(
+            'meter_summary', self.conn.record_metering_data_batch, samples))
+        self.assertEqual(40, sum(r.count for r in self._rollups(3600)))
+
+    def test_failed_sample(self):
+        broken = self._message(2)
+        del broken['counter_volume']
+        self.conn.record_metering_data_batch([self._message(1), broken,
+                                              self._message(3)])
+        self.assertEqual(2, len(list(self.conn.get_samples(
+            storage.SampleFilter(resource='resource-batch')))))
+        hour, = self._rollups(3600)
+        self.assertEqual(2, hour.count)
+
+
+class CompactMeterTest(SQLAlchemyEngineTestBase):
+
+    def _record(self, name='cpu', source='test', minutes=0, message={}):
+        c = sample.Sample(
+            name,
+            sample.TYPE_GAUGE,
+            unit='ns',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id='resource-compact',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata={},
+            source=source,
+        )
+        msg = rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret)
+        msg.update(message)
+        self.conn.record_metering_data(msg)
+        return msg
+
+    def _check_dictionaries(self):
+        self._record()
+        self._record(source='other')
+        self._record(name='memory')
+        self._record()
+        s = session.get_session()
+        self.assertEqual(2, s.query(MeterDefinition).filter(
+            MeterDefinition.counter_name.in_(['cpu', 'memory'])).count())
+        self.assertEqual(2, s.query(MeterSource).filter(
+            MeterSource.name.in_(['test', 'other'])).count())
+        samples = list(self.conn.get_samples(storage.SampleFilter(
+            resource='resource-compact')))
+        self.assertEqual(['cpu', 'cpu', 'cpu', 'memory'],
+                         sorted(x.counter_name for x in samples))
+        self.assertEqual(['other', 'test', 'test', 'test'],
+                         sorted(x.source for x in samples))
+        self.assertEqual(set(['ns']), set(x.counter_unit for x in samples))
+
+    def test_dictionaries(self):
+        self._check_dictionaries()
+
+    def test_dictionaries_uncached(self):
+        cfg.CONF.set_override('dimension_cache_size', 0, group='database')
+        self.conn.clear()
+        self._check_dictionaries()
+
+    def test_message_packed(self):
+        msg = self._record()
+        packed = session.get_session().execute(
+            'SELECT message_id, message_signature FROM meter').fetchone()
+        self.assertEqual(16, len(packed[0]))
+        self.assertEqual(32, len(packed[1]))
+        s, = self.conn.get_samples(storage.SampleFilter(
+            resource='resource-compact'))
+        self.assertEqual(msg['message_id'], s.message_id)
+        self.assertEqual(msg['message_signature'], s.message_signature)
+
+    def test_message_not_canonical(self):
+        self._record()
+        self._record(minutes=1, message={
+            'message_id': 'my-message-1',
+            'message_signature': 'not-a-digest'})
+        upper = self._record(minutes=2, message={
+            'message_id': str(uuid.uuid1()).upper()})
+        samples = list(self.conn.get_samples(storage.SampleFilter(
+            resource='resource-compact')))
+        self.assertEqual([upper['message_id'], 'my-message-1'],
+                         [x.message_id for x in samples[:2]])
+        self.assertEqual('not-a-digest', samples[1].message_signature)
+        f = storage.SampleFilter(
+            resource='resource-compact',
+            marker_timestamp=datetime.datetime(2012, 7, 2, 11, 1),
+            marker_message_id='my-message-1')
+        self.assertEqual([samples[2].message_id],
+                         [x.message_id for x in self.conn.get_samples(f)])
+
+
+class MeterMetadataTest(SQLAlchemyEngineTestBase):
+
+    def _record(self, minutes=0, metadata={'display_name': 'test-server'}):
+        c = sample.Sample(
+            'cpu',
+            sample.TYPE_GAUGE,
+            unit='ns',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id='resource-metadata',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minutes),
+            resource_metadata=metadata,
+            source='test',
+        )
+        self.conn.record_metering_data(rpc.meter_message_from_counter(
+            c, cfg.CONF.publisher_rpc.metering_secret))
+
+    def _metadata_ids(self, metadata):
+        return [row.id for row in session.get_session().query(
+            MeterMetadata).all() if row.resource_metadata == metadata]
+
+    def test_shared(self):
+        self._record()
+        self._record(minutes=1)
+        # The metadata unknown to the dimension cache is looked up.
+        self.conn._reset_dimensions()
+        self._record(minutes=2)
+        self._record(minutes=3, metadata={'display_name': 'renamed'})
+        metadata_id, = self._metadata_ids({'display_name': 'test-server'})
+        # The metadata is indexed once.
+        self.assertEqual(1, session.get_session().query(MetaText).filter(
+            MetaText.id == metadata_id).count())
+        f = storage.SampleFilter(meter='cpu', resource='resource-metadata')
+        self.assertEqual(['renamed', 'test-server', 'test-server',
+                          'test-server'],
+                         [x.resource_metadata['display_name']
+                          for x in self.conn.get_samples(f)])
+        f = storage.SampleFilter(
+            meter='cpu', resource='resource-metadata',
+            metaquery={'metadata.display_name': 'test-server'})
+        self.assertEqual(3, len(list(self.conn.get_samples(f))))
+
+    def test_expired(self):
+        self._record()
+        self._record(minutes=5, metadata={'display_name': 'renamed'})
+        expired, = self._metadata_ids({'display_name': 'test-server'})
+        timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2,
+                                                           11, 3)
+        self.conn.clear_expired_metering_data(0)
+        s = session.get_session()
+        self.assertIsNone(s.query(MeterMetadata).get(expired))
+        self.assertEqual(0, s.query(MetaText).filter(
+            MetaText.id == expired).count())
+        self.assertEqual(1, len(self._metadata_ids(
+            {'display_name': 'renamed'})))
+
+
+class ReplicaTest(SQLAlchemyEngineTestBase):
+
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        self.conn.replica = MagicMock()
+        self.slave_sessions = []
+        get_session = session.get_session
+
+        def get_session_on_primary(slave_session=False, **kwargs):
+            self.slave_sessions.append(slave_session)
+            return get_session(**kwargs)
+        self.stubs.Set(session, 'get_session', get_session_on_primary)
+
+    def test_reads_from_replica(self):
+        self.conn.replica.is_usable.return_value = True
+        f = storage.SampleFilter(meter='instance')
+        self.assertTrue(list(self.conn.get_samples(f)))
+        self.assertTrue(list(self.conn.get_meter_statistics(f)))
+        self.assertTrue(list(self.conn.get_resources()))
+        self.assertTrue(self.slave_sessions)
+        self.assertTrue(all(self.slave_sessions))
+
+    def test_reads_from_primary(self):
+        self.conn.replica.is_usable.return_value = False
+        f = storage.SampleFilter(meter='instance')
+        self.assertTrue(list(self.conn.get_samples(f)))
+        self.assertTrue(list(self.conn.get_resources()))
+        self.assertTrue(self.slave_sessions)
+        self.assertFalse(any(self.slave_sessions))
+
+    def test_writes_to_primary(self):
+        self.conn.replica.is_usable.return_value = True
+        list(self.conn.get_alarms())
+        self.conn.record_metering_data(self.msg1)
+        self.assertTrue(self.slave_sessions)
+        self.assertFalse(any(self.slave_sessions))
+
+    def test_replica_configured(self):
+        self.assertIsNone(impl_sqlalchemy.Connection(cfg.CONF).replica)
+        cfg.CONF.set_override('slave_connection', 'sqlite://',
+                              group='database')
+        self.assertIsNotNone(impl_sqlalchemy.Connection(cfg.CONF).replica)
+
+
 class CounterDataTypeTest(base.CounterDataTypeTest, SQLAlchemyEngineTestBase):
     pass
 
@@ -0,0 +1,107 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/impl_tsdb.py
+"""
+
+import datetime
+
+from oslo.config import cfg
+
+from ceilometer.openstack.common import timeutils
+from ceilometer import storage
+from tests.storage import base
+
+
+class TSDBEngineTestBase(base.DBTestBase):
+
+    @property
+    def database_connection(self):
+        return 'tsdb://' + self.tempdir.path
+
+
+class SealedTSDBEngineTestBase(TSDBEngineTestBase):
+    """Checkpoint the write-ahead log often, so that most of the samples
+    are read from chunks.
+    """
+
+    def setUp(self):
+        cfg.CONF.set_override('tsdb_chunk_size', 2, group='database')
+        cfg.CONF.set_override('tsdb_wal_size', 3, group='database')
+        super(SealedTSDBEngineTestBase, self).setUp()
+
+
+class UserTest(base.UserTest, TSDBEngineTestBase):
+    pass
+
+
+class ProjectTest(base.ProjectTest, TSDBEngineTestBase):
+    pass
+
+
+class ResourceTest(base.ResourceTest, TSDBEngineTestBase):
+    pass
+
+
+class SealedResourceTest(base.ResourceTest, SealedTSDBEngineTestBase):
+    pass
+
+
+class MeterTest(base.MeterTest, TSDBEngineTestBase):
+    pass
+
+
+class RawSampleTest(base.RawSampleTest, TSDBEngineTestBase):
+    pass
+
+
+class SealedRawSampleTest(base.RawSampleTest, SealedTSDBEngineTestBase):
+    pass
+
+
+class StatisticsTest(base.StatisticsTest, TSDBEngineTestBase):
+    pass
+
+
+class SealedStatisticsTest(base.StatisticsTest, SealedTSDBEngineTestBase):
+    pass
+
+
+class CounterDataTypeTest(base.CounterDataTypeTest, TSDBEngineTestBase):
+    pass
+
+
+class AlarmTest(base.AlarmTest, TSDBEngineTestBase):
+    pass
+
+
+class ExpirerTest(SealedTSDBEngineTestBase):
+
+    def test_clear_expired_metering_data(self):
+        timeutils.utcnow.override_time = datetime.datetime(2012, 7, 2,
+                                                           10, 45)
+        self.conn.clear_expired_metering_data(3 * 60)
+        f = storage.SampleFilter(meter='instance')
+        self.assertEqual(5, len(list(self.conn.get_samples(f))))
+        self.assertEqual(5, len(list(self.conn.get_resources())))
+
+
+class EventTestBase(base.EventTestBase):
+
+    @property
+    def database_connection(self):
+        return 'tsdb://' + self.tempdir.path
+
+
+class GetEventTest(base.GetEventTest, EventTestBase):
+    pass
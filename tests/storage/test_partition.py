@@ -0,0 +1,112 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/sqlalchemy/partition.py
+"""
+
+import datetime
+
+from mock import MagicMock
+from mock import patch
+
+from ceilometer.storage.sqlalchemy import partition
+from ceilometer.tests import base as tests_base
+
+
+class TestBounds(tests_base.TestCase):
+
+    def test_period_start(self):
+        ts = datetime.datetime(2013, 8, 22, 10, 12)
+        self.assertEqual(datetime.datetime(2013, 8, 22),
+                         partition.period_start(ts, 'day'))
+        # A Monday
+        self.assertEqual(datetime.datetime(2013, 8, 19),
+                         partition.period_start(ts, 'week'))
+
+    def test_make_bounds(self):
+        self.assertEqual(
+            [datetime.datetime(2013, 8, 2),
+             datetime.datetime(2013, 8, 3),
+             datetime.datetime(2013, 8, 4)],
+            partition.make_bounds(datetime.datetime(2013, 8, 1, 5),
+                                  datetime.datetime(2013, 8, 3),
+                                  'day'))
+
+    def test_partition_definitions(self):
+        self.assertEqual(
+            "PARTITION p20130802 VALUES LESS THAN ('2013-08-02 00:00:00'), "
+            "PARTITION pmax VALUES LESS THAN (MAXVALUE)",
+            partition.partition_definitions(
+                [datetime.datetime(2013, 8, 2)]))
+
+
+class TestMySQLPartitioner(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestMySQLPartitioner, self).setUp()
+        self.engine = MagicMock()
+        self.partitioner = partition.MySQLPartitioner(self.engine, 'day')
+        partitions = [('p20130801', datetime.datetime(2013, 8, 1)),
+                      ('p20130802', datetime.datetime(2013, 8, 2)),
+                      ('p20130803', datetime.datetime(2013, 8, 3)),
+                      ('pmax', None)]
+        patcher = patch.object(self.partitioner, 'get_partitions',
+                               return_value=partitions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_drop_before(self):
+        self.assertEqual(
+            ['p20130801', 'p20130802'],
+            self.partitioner.drop_before(datetime.datetime(2013, 8, 2, 5)))
+        self.engine.execute.assert_called_once_with(
+            'ALTER TABLE `meter` DROP PARTITION p20130801, p20130802')
+
+    def test_drop_before_nothing(self):
+        self.assertEqual(
+            [], self.partitioner.drop_before(datetime.datetime(2013, 7, 1)))
+        self.assertFalse(self.engine.execute.called)
+
+    def test_extend(self):
+        self.partitioner.extend(datetime.datetime(2013, 8, 2, 5))
+        statement = self.engine.execute.call_args[0][0]
+        self.assertTrue(statement.startswith(
+            'ALTER TABLE `meter` REORGANIZE PARTITION pmax INTO ('))
+        self.assertIn('PARTITION p20130804 ', statement)
+        self.assertIn('PARTITION p20130805 ', statement)
+        self.assertNotIn('PARTITION p20130806 ', statement)
+
+    def test_extend_nothing(self):
+        self.partitioner.extend(datetime.datetime(2013, 7, 31))
+        self.assertFalse(self.engine.execute.called)
+
+
+class TestGetPartitioner(tests_base.TestCase):
+
+    def test_disabled(self):
+        self.assertIsNone(partition.get_partitioner(MagicMock(), None))
+
+    def test_unsupported_dialect(self):
+        engine = MagicMock()
+        engine.name = 'sqlite'
+        self.assertIsNone(partition.get_partitioner(engine, 'day'))
+
+    def test_mysql(self):
+        engine = MagicMock()
+        engine.name = 'mysql'
+        self.assertIsInstance(partition.get_partitioner(engine, 'week'),
+                              partition.MySQLPartitioner)
+
+    def test_unknown_period(self):
+        self.assertRaises(ValueError, partition.get_partitioner,
+                          MagicMock(), 'month')
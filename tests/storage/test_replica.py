@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/sqlalchemy/replica.py
+"""
+
+from mock import MagicMock
+from mock import patch
+
+from ceilometer.storage.sqlalchemy import replica
+from ceilometer.tests import base as tests_base
+
+
+class TestReplicationLag(tests_base.TestCase):
+
+    def test_mysql(self):
+        engine = MagicMock()
+        engine.name = 'mysql'
+        engine.execute.return_value.first.return_value = {
+            'Seconds_Behind_Master': 12}
+        self.assertEqual(12, replica.get_replication_lag(engine))
+
+    def test_mysql_not_slave(self):
+        engine = MagicMock()
+        engine.name = 'mysql'
+        engine.execute.return_value.first.return_value = None
+        self.assertEqual(0, replica.get_replication_lag(engine))
+
+    def test_mysql_not_replicating(self):
+        engine = MagicMock()
+        engine.name = 'mysql'
+        engine.execute.return_value.first.return_value = {
+            'Seconds_Behind_Master': None}
+        self.assertIsNone(replica.get_replication_lag(engine))
+
+    def test_postgresql(self):
+        engine = MagicMock()
+        engine.name = 'postgresql'
+        engine.execute.return_value.scalar.return_value = 3.5
+        self.assertEqual(3.5, replica.get_replication_lag(engine))
+        engine.execute.assert_called_once_with(replica.POSTGRESQL_LAG)
+
+    def test_other(self):
+        engine = MagicMock()
+        engine.name = 'sqlite'
+        self.assertEqual(0, replica.get_replication_lag(engine))
+        self.assertFalse(engine.execute.called)
+
+
+class TestReplica(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        self.now = 1000
+        self.stubs.Set(replica, '_now', lambda: self.now)
+        self.lag = 0
+        self.stubs.Set(replica, 'get_replication_lag',
+                       lambda engine: self.lag)
+        self.replica = replica.Replica(30, check_interval=10)
+
+    @patch('ceilometer.openstack.common.db.sqlalchemy.session.get_engine')
+    def test_usable(self, get_engine):
+        self.assertTrue(self.replica.is_usable())
+        get_engine.assert_called_once_with(slave_engine=True)
+
+    @patch('ceilometer.openstack.common.db.sqlalchemy.session.get_engine')
+    def test_lagging(self, get_engine):
+        self.lag = 31
+        self.assertFalse(self.replica.is_usable())
+
+    @patch('ceilometer.openstack.common.db.sqlalchemy.session.get_engine')
+    def test_not_replicating(self, get_engine):
+        self.lag = None
+        self.assertFalse(self.replica.is_usable())
+
+    @patch('ceilometer.openstack.common.db.sqlalchemy.session.get_engine')
+    def test_unavailable(self, get_engine):
+        get_engine.side_effect = Exception('connection refused')
+        self.assertFalse(self.replica.is_usable())
+
+    @patch('ceilometer.openstack.common.db.sqlalchemy.session.get_engine')
+    def test_check_interval(self, get_engine):
+        self.assertTrue(self.replica.is_usable())
+        self.lag = 60
+        self.now += 9
+        self.assertTrue(self.replica.is_usable())
+        self.now += 1
+        self.assertFalse(self.replica.is_usable())
+        self.lag = 0
+        self.now += 5
+        self.assertFalse(self.replica.is_usable())
+        self.now += 5
+        self.assertTrue(self.replica.is_usable())
@@ -0,0 +1,132 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/rollup.py
+"""
+
+import datetime
+
+from ceilometer.storage import rollup
+from ceilometer.tests import base as tests_base
+
+
+class TestBuckets(tests_base.TestCase):
+
+    def test_floor(self):
+        self.assertEqual(
+            datetime.datetime(2013, 8, 1, 12, 0),
+            rollup.floor(datetime.datetime(2013, 8, 1, 12, 0, 17), 60))
+        self.assertEqual(
+            datetime.datetime(2013, 8, 1),
+            rollup.floor(datetime.datetime(2013, 8, 1, 12, 0, 17), 86400))
+
+    def test_ceil(self):
+        self.assertEqual(
+            datetime.datetime(2013, 8, 1, 13, 0),
+            rollup.ceil(datetime.datetime(2013, 8, 1, 12, 0, 17), 3600))
+        self.assertEqual(
+            datetime.datetime(2013, 8, 1, 12, 0),
+            rollup.ceil(datetime.datetime(2013, 8, 1, 12, 0), 3600))
+
+    def test_make_key(self):
+        self.assertEqual(
+            rollup.make_key('cpu', 'r', 'p', 'u', 's'),
+            rollup.make_key(u'cpu', u'r', u'p', u'u', u's'))
+        self.assertNotEqual(
+            rollup.make_key('cpu', 'r', 'p', 'u', None),
+            rollup.make_key('cpu', 'r', 'p', 'u', 's'))
+
+
+class TestPlan(tests_base.TestCase):
+
+    def test_no_watermark(self):
+        start = datetime.datetime(2013, 8, 1)
+        end = datetime.datetime(2013, 8, 3)
+        self.assertEqual([rollup.RawRange(start, None, end, None)],
+                         rollup.plan(start, None, end, None, None))
+
+    def test_before_watermark(self):
+        start = datetime.datetime(2013, 8, 1)
+        end = datetime.datetime(2013, 8, 3)
+        self.assertEqual([rollup.RawRange(start, None, end, None)],
+                         rollup.plan(start, None, end, None, end))
+
+    def test_ragged_edges(self):
+        self.assertEqual(
+            [rollup.RawRange(datetime.datetime(2013, 8, 1, 12, 0, 17), None,
+                             datetime.datetime(2013, 8, 1, 12, 1), 'lt'),
+             rollup.RollupRange(60,
+                                datetime.datetime(2013, 8, 1, 12, 1),
+                                datetime.datetime(2013, 8, 1, 13, 0)),
+             rollup.RollupRange(3600,
+                                datetime.datetime(2013, 8, 1, 13, 0),
+                                datetime.datetime(2013, 8, 2)),
+             rollup.RollupRange(86400,
+                                datetime.datetime(2013, 8, 2),
+                                datetime.datetime(2013, 8, 3)),
+             rollup.RollupRange(60,
+                                datetime.datetime(2013, 8, 3),
+                                datetime.datetime(2013, 8, 3, 0, 30)),
+             rollup.RawRange(datetime.datetime(2013, 8, 3, 0, 30), 'ge',
+                             datetime.datetime(2013, 8, 3, 0, 30, 5), None)],
+            rollup.plan(datetime.datetime(2013, 8, 1, 12, 0, 17), None,
+                        datetime.datetime(2013, 8, 3, 0, 30, 5), None,
+                        rollup.EPOCH))
+
+    def test_exclusive_start_inclusive_end(self):
+        start = datetime.datetime(2013, 8, 1)
+        end = datetime.datetime(2013, 8, 2)
+        ranges = rollup.plan(start, 'gt', end, 'le', rollup.EPOCH)
+        self.assertEqual(
+            rollup.RawRange(start, 'gt',
+                            datetime.datetime(2013, 8, 1, 0, 1), 'lt'),
+            ranges[0])
+        self.assertEqual(rollup.RawRange(end, 'ge', end, 'le'), ranges[-1])
+
+    def test_within_a_bucket(self):
+        start = datetime.datetime(2013, 8, 1, 0, 0, 10)
+        end = datetime.datetime(2013, 8, 1, 0, 0, 50)
+        self.assertEqual([rollup.RawRange(start, None, end, None)],
+                         rollup.plan(start, None, end, None, rollup.EPOCH))
+
+    def test_unbounded_with_watermark(self):
+        watermark = datetime.datetime(2013, 8, 2)
+        self.assertEqual(
+            [rollup.RawRange(None, None, watermark, 'lt'),
+             rollup.RollupRange(86400, watermark, None)],
+            rollup.plan(None, None, None, None, watermark))
+
+
+class TestAggregate(tests_base.TestCase):
+
+    def test_merge(self):
+        ts1 = datetime.datetime(2013, 8, 1)
+        ts2 = datetime.datetime(2013, 8, 2)
+        a = rollup.Aggregate('ns', 2, 10, 4, 6, ts1, ts1)
+        a.merge(rollup.Aggregate('ns', 1, 2, 2, 2, ts2, ts2))
+        self.assertEqual(3, a.count)
+        self.assertEqual(12, a.sum)
+        self.assertEqual(2, a.min)
+        self.assertEqual(6, a.max)
+        self.assertEqual(4, a.avg)
+        self.assertEqual(ts1, a.tsmin)
+        self.assertEqual(ts2, a.tsmax)
+
+    def test_merge_empty(self):
+        a = rollup.Aggregate()
+        self.assertIsNone(a.avg)
+        a.merge(rollup.Aggregate())
+        self.assertEqual(0, a.count)
+        a.merge(rollup.Aggregate('ns', 1, 2, 2, 2))
+        self.assertEqual('ns', a.unit)
+        self.assertEqual(2, a.sum)
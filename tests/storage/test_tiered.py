@@ -0,0 +1,210 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/tiered.py
+"""
+
+import datetime
+
+from mock import MagicMock
+from oslo.config import cfg
+
+from ceilometer.openstack.common import timeutils
+from ceilometer import storage
+from ceilometer.storage import models
+from ceilometer.storage import tiered
+from ceilometer.tests import base as tests_base
+
+NOW = datetime.datetime(2013, 8, 1, 12, 0)
+
+
+def make_data(minutes_ago, volume=1, meter='cpu', resource='resource-id'):
+    return {'source': 'test',
+            'counter_name': meter,
+            'counter_type': 'gauge',
+            'counter_unit': '%',
+            'counter_volume': volume,
+            'user_id': 'user-id',
+            'project_id': 'project-id',
+            'resource_id': resource,
+            'timestamp': NOW - datetime.timedelta(minutes=minutes_ago),
+            'resource_metadata': {'flavor': {'name': 'm1.tiny'}},
+            'message_id': '%s-%s' % (meter, minutes_ago),
+            'message_signature': 'signature'}
+
+
+class TestHotWindow(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestHotWindow, self).setUp()
+        self.hot = tiered.HotWindow()
+        for minutes_ago in (3, 1, 2):
+            self.hot.add(make_data(minutes_ago))
+        self.hot.add(make_data(2, meter='memory'))
+
+    def test_find(self):
+        found = self.hot.find(storage.SampleFilter(meter='cpu'))
+        self.assertEqual(['cpu-1', 'cpu-2', 'cpu-3'],
+                         [d['message_id'] for d in found])
+
+    def test_find_filters(self):
+        f = storage.SampleFilter(start=NOW - datetime.timedelta(minutes=2),
+                                 metaquery={'metadata.flavor.name':
+                                            'm1.tiny'})
+        self.assertEqual(['cpu-1', 'memory-2', 'cpu-2'],
+                         [d['message_id'] for d in self.hot.find(f)])
+        f = storage.SampleFilter(metaquery={'metadata.flavor.name': 'other'})
+        self.assertEqual([], self.hot.find(f))
+
+    def test_add_duplicate(self):
+        self.hot.add(make_data(1))
+        self.assertEqual(4, len(self.hot))
+
+    def test_evict(self):
+        self.hot.evict(NOW - datetime.timedelta(minutes=2))
+        self.assertEqual(['cpu-1', 'memory-2', 'cpu-2'],
+                         [d['message_id'] for d in
+                          self.hot.find(storage.SampleFilter())])
+        self.assertEqual(3, len(self.hot))
+
+
+class TestTieredConnection(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestTieredConnection, self).setUp()
+        timeutils.utcnow.override_time = NOW
+        self.addCleanup(timeutils.clear_time_override)
+        self.persistent = [make_data(90), make_data(70), make_data(50)]
+        self.conn = MagicMock()
+        self.conn.get_samples.side_effect = self.get_samples
+        # The window is of an hour
+        self.tiered = tiered.TieredConnection(self.conn, 3600,
+                                              refresh_interval=10,
+                                              late_arrival=60)
+
+    def get_samples(self, sample_filter, limit=None):
+        found = [tiered.make_sample(d) for d in self.persistent
+                 if tiered.match(d, sample_filter)]
+        found.sort(key=lambda s: s.timestamp, reverse=True)
+        return found[:limit] if limit else found
+
+    def record(self, data):
+        self.persistent.append(data)
+        self.tiered.record_metering_data(data)
+
+    def test_recent_samples_from_memory(self):
+        f = storage.SampleFilter(start=NOW - datetime.timedelta(minutes=30))
+        self.assertEqual([], list(self.tiered.get_samples(f)))
+        self.record(make_data(10))
+        self.assertEqual(['cpu-10'], [s.message_id for s in
+                                      self.tiered.get_samples(f)])
+        # Only the window was loaded from the persistent connection.
+        self.assertEqual(1, self.conn.get_samples.call_count)
+
+    def test_recent_samples_batch(self):
+        f = storage.SampleFilter(start=NOW - datetime.timedelta(minutes=30))
+        self.assertEqual([], list(self.tiered.get_samples(f)))
+        self.tiered.record_metering_data_batch([make_data(10),
+                                                make_data(20)])
+        self.conn.record_metering_data_batch.assert_called_once_with(
+            [make_data(10), make_data(20)])
+        self.assertEqual(['cpu-10', 'cpu-20'], [s.message_id for s in
+                                                self.tiered.get_samples(f)])
+
+    def test_straddling_samples(self):
+        self.record(make_data(10))
+        self.assertEqual(['cpu-10', 'cpu-50', 'cpu-70', 'cpu-90'],
+                         [s.message_id for s in self.tiered.get_samples(
+                             storage.SampleFilter(meter='cpu'))])
+        before = self.conn.get_samples.call_args[0][0]
+        self.assertEqual(NOW - datetime.timedelta(hours=1), before.end)
+        self.assertEqual('lt', before.end_timestamp_op)
+
+    def test_limit_from_memory(self):
+        self.assertEqual(['cpu-50'],
+                         [s.message_id for s in self.tiered.get_samples(
+                             storage.SampleFilter(), limit=1)])
+        # The window was loaded, and was enough.
+        self.assertEqual(1, self.conn.get_samples.call_count)
+
+    def test_refresh(self):
+        f = storage.SampleFilter()
+        list(self.tiered.get_samples(f, limit=1))
+        # Recorded by another process
+        self.persistent.append(make_data(0))
+        self.assertEqual('cpu-50', next(self.tiered.get_samples(f)).message_id)
+        timeutils.advance_time_seconds(10)
+        self.assertEqual('cpu-0', next(self.tiered.get_samples(f)).message_id)
+
+    def test_late_sample_from_database(self):
+        f = storage.SampleFilter()
+        list(self.tiered.get_samples(f, limit=1))
+        # Recorded by another process long after its timestamp
+        self.persistent.append(make_data(30))
+        timeutils.advance_time_seconds(10)
+        self.assertEqual(['cpu-30', 'cpu-50', 'cpu-70', 'cpu-90'],
+                         [s.message_id for s in self.tiered.get_samples(f)])
+        self.assertEqual(NOW - datetime.timedelta(seconds=60),
+                         self.tiered.horizon)
+
+    def test_window_slides(self):
+        list(self.tiered.get_samples(storage.SampleFilter(), limit=1))
+        self.assertEqual(1, len(self.tiered.hot))
+        timeutils.advance_time_seconds(15 * 60)
+        self.tiered.get_samples(storage.SampleFilter(), limit=1).next()
+        self.assertEqual(0, len(self.tiered.hot))
+
+    def test_statistics_from_memory(self):
+        self.record(make_data(10, volume=2))
+        self.record(make_data(5, volume=4))
+        f = storage.SampleFilter(meter='cpu',
+                                 start=NOW - datetime.timedelta(minutes=15))
+        stats = self.tiered.get_meter_statistics(f, period=600)
+        self.assertEqual([1, 1], [s.count for s in stats])
+        self.assertEqual([2, 4], [s.max for s in stats])
+        self.assertEqual(NOW - datetime.timedelta(minutes=5),
+                         stats[1].period_start)
+        self.assertFalse(self.conn.get_meter_statistics.called)
+
+    def test_statistics_straddling(self):
+        self.record(make_data(40, volume=3))
+        self.conn.get_meter_statistics.return_value = [models.Statistics(
+            unit='%', count=2, min=1, max=1, avg=1, sum=2, period=0,
+            period_start=NOW - datetime.timedelta(minutes=90),
+            period_end=NOW - datetime.timedelta(minutes=70),
+            duration=1200,
+            duration_start=NOW - datetime.timedelta(minutes=90),
+            duration_end=NOW - datetime.timedelta(minutes=70))]
+        stats = self.tiered.get_meter_statistics(
+            storage.SampleFilter(meter='cpu'))
+        self.assertEqual(1, len(stats))
+        self.assertEqual(4, stats[0].count)
+        self.assertEqual(6, stats[0].sum)
+        self.assertEqual(3, stats[0].max)
+        self.assertEqual(NOW - datetime.timedelta(minutes=90),
+                         stats[0].duration_start)
+        self.assertEqual(NOW - datetime.timedelta(minutes=40),
+                         stats[0].duration_end)
+
+
+class TestGetTieredConnection(tests_base.TestCase):
+
+    def test_disabled(self):
+        conn = MagicMock()
+        self.assertIs(conn, tiered.get_tiered_connection(conn, cfg.CONF))
+
+    def test_enabled(self):
+        cfg.CONF.set_override('hot_window', 7200, group='database')
+        conn = tiered.get_tiered_connection(MagicMock(), cfg.CONF)
+        self.assertIsInstance(conn, tiered.TieredConnection)
+        self.assertEqual(datetime.timedelta(hours=2), conn.window)
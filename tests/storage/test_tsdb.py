@@ -0,0 +1,139 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/tsdb
+"""
+
+import os
+
+from ceilometer.storage.tsdb import encoding
+from ceilometer.storage.tsdb import store
+from ceilometer.tests import base as tests_base
+
+
+class TestEncoding(tests_base.TestCase):
+
+    def test_timestamps(self):
+        timestamps = [1375358400000000, 1375358460000000, 1375358520000000,
+                      1375358520000001, 1375358400000000]
+        data = encoding.encode_timestamps(timestamps)
+        self.assertEqual(timestamps,
+                         encoding.decode_timestamps(bytearray(data), 5))
+
+    def test_regular_timestamps(self):
+        timestamps = [1375358400000000 + i * 60000000 for i in range(100)]
+        data = encoding.encode_timestamps(timestamps)
+        # Past the first two, a delta-of-delta of 0 takes a byte.
+        self.assertEqual(98, len(data) - len(encoding.encode_timestamps(
+            timestamps[:2])))
+
+    def test_floats(self):
+        values = [0.0, 1.5, 1.5, -3.25, 1e300, 42.0, 42.0, 0.1]
+        data = encoding.encode_floats(values)
+        self.assertEqual(values, encoding.decode_floats(bytearray(data),
+                                                        len(values)))
+
+    def test_constant_floats(self):
+        data = encoding.encode_floats([7.0] * 10)
+        self.assertEqual('\0' * 9, data[-9:])
+
+    def test_runs(self):
+        values = [1, 1, 1, 300, 0, 0, 1]
+        data = encoding.encode_runs(values)
+        self.assertEqual(values, encoding.decode_runs(bytearray(data), 7))
+
+    def test_strings(self):
+        values = [u'a', u'', u'\xe9t\xe9']
+        data = encoding.encode_strings(values)
+        self.assertEqual(values, encoding.decode_strings(bytearray(data), 3))
+
+
+class TestStore(tests_base.TestCase):
+
+    def setUp(self):
+        super(TestStore, self).setUp()
+        self.path = self.tempdir.path
+        self.store = store.Store(self.path, chunk_size=4, wal_size=10)
+        self.store.create()
+
+    @staticmethod
+    def row(timestamp, volume, metadata=None):
+        return store.Row(timestamp, float(volume), 'gauge', 'B', 'user',
+                         'project', 'source', metadata or {'a': 1},
+                         'message-%d' % timestamp, 'signature')
+
+    def append(self, count):
+        for i in range(count):
+            self.store.append('cpu', 'resource-%d' % (i % 2),
+                              self.row(1000 + i, i, {'a': i // 10}))
+
+    def samples(self, s, **kwargs):
+        return sorted((r.timestamp, r.volume)
+                      for v in s.scan(**kwargs) for r in v.rows())
+
+    def test_checkpoint(self):
+        self.append(25)
+        self.assertTrue(self.store.index)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'wal.2')))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'wal.0')))
+        expected = [(1000 + i, float(i)) for i in range(25)]
+        self.assertEqual(expected, self.samples(self.store, meter='cpu'))
+
+    def test_second_reader(self):
+        self.append(25)
+        reader = store.Store(self.path, chunk_size=4, wal_size=10)
+        expected = [(1000 + i, float(i)) for i in range(25)]
+        self.assertEqual(expected, self.samples(reader, meter='cpu'))
+        self.store.append('cpu', 'resource-0', self.row(2000, 1))
+        self.assertEqual(expected + [(2000, 1.0)],
+                         self.samples(reader, meter='cpu'))
+
+    def test_scan_filters(self):
+        self.append(25)
+        self.assertEqual([], self.store.scan(meter='memory'))
+        # The project of the samples of the head is left to the caller.
+        self.assertEqual([None, None],
+                         [v.entry for v in self.store.scan(project='other')])
+        for v in self.store.scan(meter='cpu', start=1020):
+            self.assertTrue(v.tmax >= 1020)
+        self.assertEqual([(1000 + i, float(i)) for i in range(0, 25, 2)],
+                         self.samples(self.store, resource='resource-0'))
+
+    def test_metadata_versions(self):
+        self.append(25)
+        versions = set(r.metadata for v in self.store.scan()
+                       for r in v.rows())
+        self.assertEqual([{u'a': 0}, {u'a': 0}, {u'a': 1}, {u'a': 1},
+                          {u'a': 2}, {u'a': 2}],
+                         [self.store.metadata[v] for v in sorted(versions)])
+
+    def test_expire(self):
+        self.append(25)
+        self.assertEqual(10, self.store.expire(1010))
+        self.assertEqual([(1000 + i, float(i)) for i in range(10, 25)],
+                         self.samples(self.store))
+        # The versions of the expired samples only are gone.
+        self.assertEqual([{u'a': 1}, {u'a': 1}, {u'a': 2}, {u'a': 2}],
+                         [self.store.metadata[v]
+                          for v in sorted(self.store.metadata)])
+        reader = store.Store(self.path, chunk_size=4, wal_size=10)
+        self.assertEqual(self.samples(self.store), self.samples(reader))
+
+    def test_truncated_wal(self):
+        self.append(5)
+        wal = os.path.join(self.path, self.store.manifest['wal'])
+        with open(wal, 'r+b') as f:
+            f.truncate(os.path.getsize(wal) - 3)
+        reader = store.Store(self.path, chunk_size=4, wal_size=10)
+        self.assertEqual([(1000 + i, float(i)) for i in range(4)],
+                         self.samples(reader))
@@ -18,14 +18,26 @@
 # under the License.
 
 import httplib2
+import imp
 import json
+import os
 import random
 import socket
+import StringIO
 import subprocess
 import time
 
+import mock
+
 from ceilometer.tests import base
 
+# The modules used by the tool register their command line options when
+# they are imported, which must happen before the tests parse them.
+bench_storage = imp.load_source(
+    'bench_storage',
+    os.path.join(os.path.dirname(__file__), '..', 'tools',
+                 'bench_storage.py'))
+
 
 class BinTestCase(base.TestCase):
     def setUp(self):
@@ -45,6 +57,36 @@ class BinTestCase(base.TestCase):
                                  "--config-file=%s" % self.tempfile])
         self.assertEqual(subp.wait(), 0)
 
+    def test_run_replay(self):
+        with open(self.tempfile, 'a') as tmp:
+            tmp.write("[collector]\n")
+            tmp.write("journal_path=%s\n" % self.tempdir.path)
+        subp = subprocess.Popen(['ceilometer-replay',
+                                 "--config-file=%s" % self.tempfile])
+        self.assertEqual(subp.wait(), 0)
+
+
+class BinBenchStorageTestCase(base.TestCase):
+
+    def test_default_urls(self):
+        out = StringIO.StringIO()
+        with mock.patch('sys.stdout', out):
+            with mock.patch('sys.stderr', StringIO.StringIO()):
+                self.assertEqual(0, bench_storage.main([
+                    '--days', '1', '--resources', '2', '--meters', '1',
+                    '--interval', '240', '--iterations', '1', '--json']))
+        results = json.loads(out.getvalue())
+        self.assertEqual(['hbase://__test__', 'sqlite://'],
+                         sorted(results))
+        for url, reports in results.iteritems():
+            load = reports[0]
+            self.assertEqual('record_metering_data', load['operation'])
+            self.assertEqual(12, load['items'])
+            expire = reports[-1]
+            self.assertEqual('clear_expired_metering_data',
+                             expire['operation'])
+            self.assertEqual(url == 'sqlite://', expire['supported'])
+
 
 class BinSendCounterTestCase(base.TestCase):
     def setUp(self):
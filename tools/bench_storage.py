@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Command line tool for benchmarking the ceilometer storage drivers.
+
+A multi-tenant dataset is generated from a seed, so every run and every
+driver gets the same samples. It is loaded into each database given on
+the command line, then the queries made by the API and the expirer are
+timed. The default databases need no external service:
+
+    python tools/bench_storage.py --days 2 sqlite:// hbase://__test__
+
+The operations a driver does not implement are reported as unsupported.
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+
+from oslo.config import cfg
+
+from ceilometer.openstack.common import timeutils
+from ceilometer.publisher import rpc
+from ceilometer import sample
+from ceilometer import storage
+
+
+UNITS = [('gauge', '%'), ('cumulative', 'ns'), ('delta', 'B'),
+         ('gauge', 'instance')]
+
+
+class Dataset(object):
+    """Description of a reproducible dataset of samples."""
+
+    def __init__(self, seed, projects, users, resources, meters, days,
+                 interval, metadata_keys, metadata_cardinality,
+                 metadata_size):
+        self.seed = seed
+        self.days = days
+        self.interval = interval
+        self.metadata_keys = metadata_keys
+        self.metadata_cardinality = metadata_cardinality
+        self.metadata_size = metadata_size
+        self.end = datetime.datetime(2013, 8, 1)
+        self.start = self.end - datetime.timedelta(days=days)
+
+        rand = random.Random(seed)
+        self.projects = ['project-%d' % i for i in range(projects)]
+        self.users = dict((p, ['%s-user-%d' % (p, i) for i in range(users)])
+                          for p in self.projects)
+        self.resources = []
+        for i in range(resources):
+            project = rand.choice(self.projects)
+            self.resources.append(('resource-%d' % i, project,
+                                   rand.choice(self.users[project])))
+        self.meters = []
+        for i in range(meters):
+            counter_type, unit = UNITS[i % len(UNITS)]
+            self.meters.append(('meter-%d' % i, counter_type, unit))
+
+    def __len__(self):
+        return (len(self.resources) * len(self.meters) *
+                self.days * 24 * 60 // self.interval)
+
+    def _metadata(self, rand):
+        padding = 'x' * self.metadata_size
+        return dict(('key%d' % i,
+                     'value%d-%s' % (rand.randrange(
+                         self.metadata_cardinality), padding))
+                    for i in range(self.metadata_keys))
+
+    def samples(self):
+        """Yield the messages of the dataset, in chronological order."""
+        rand = random.Random(self.seed)
+        secret = cfg.CONF.publisher_rpc.metering_secret
+        step = datetime.timedelta(minutes=self.interval)
+        timestamp = self.start
+        while timestamp < self.end:
+            for resource_id, project_id, user_id in self.resources:
+                for name, counter_type, unit in self.meters:
+                    s = sample.Sample(
+                        name=name,
+                        type=counter_type,
+                        unit=unit,
+                        volume=rand.randint(0, 1000),
+                        user_id=user_id,
+                        project_id=project_id,
+                        resource_id=resource_id,
+                        timestamp=timestamp,
+                        resource_metadata=self._metadata(rand),
+                        source='bench',
+                    )
+                    yield rpc.meter_message_from_counter(s, secret)
+            timestamp += step
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Timer(object):
+    """Latencies of one operation."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.items = 0
+        self.supported = True
+
+    def time(self, func, *args, **kwargs):
+        start = time.time()
+        # The drivers may return generators, consume them.
+        result = func(*args, **kwargs)
+        if result is not None and not isinstance(result, (int, long)):
+            self.items += len(list(result))
+        self.latencies.append(time.time() - start)
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        total = sum(latencies)
+        return {
+            'operation': self.name,
+            'supported': self.supported,
+            'calls': len(latencies),
+            'items': self.items,
+            'total': total,
+            'per_second': len(latencies) / total if total else None,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        }
+
+
+def load(conn, dataset, batch_size):
+    """Record the samples of the dataset, timing them batch_size at once."""
+    timer = Timer('record_metering_data')
+    if batch_size > 1:
+        timer.name += ' x%d' % batch_size
+
+    def record(batch):
+        for data in batch:
+            conn.record_metering_data(data)
+
+    batch = []
+    for data in dataset.samples():
+        batch.append(data)
+        if len(batch) >= batch_size:
+            timer.time(record, batch)
+            timer.items += len(batch)
+            batch = []
+    if batch:
+        timer.time(record, batch)
+        timer.items += len(batch)
+    return timer
+
+
+def run_queries(conn, dataset, iterations, rand):
+    """Time the query mix of the API, with random parameters."""
+    timers = {}
+
+    def timed(name, func, *args, **kwargs):
+        timers.setdefault(name, Timer(name)).time(func, *args, **kwargs)
+
+    day = datetime.timedelta(days=1)
+    for i in range(iterations):
+        meter = rand.choice(dataset.meters)[0]
+        resource_id, project_id, user_id = rand.choice(dataset.resources)
+        end = dataset.end - datetime.timedelta(
+            hours=rand.randrange(max(1, (dataset.days - 1) * 24)))
+
+        timed('get_samples meter limit=100', conn.get_samples,
+              storage.SampleFilter(meter=meter), limit=100)
+        timed('get_samples resource day', conn.get_samples,
+              storage.SampleFilter(meter=meter, resource=resource_id,
+                                   start=end - day, end=end))
+        timed('get_meter_statistics', conn.get_meter_statistics,
+              storage.SampleFilter(meter=meter, project=project_id))
+        timed('get_meter_statistics period=3600',
+              conn.get_meter_statistics,
+              storage.SampleFilter(meter=meter, project=project_id,
+                                   start=end - day, end=end),
+              period=3600)
+        timed('get_resources project', conn.get_resources,
+              project=project_id)
+        timed('get_meters project', conn.get_meters, project=project_id)
+    return sorted(timers.values(), key=lambda t: t.name)
+
+
+def expire(conn, dataset):
+    """Time the expiration of the first half of the dataset."""
+    timer = Timer('clear_expired_metering_data')
+    # The expirer counts from now, not from the end of the dataset.
+    timeutils.set_time_override(dataset.end)
+    try:
+        timer.time(conn.clear_expired_metering_data,
+                   dataset.days * 24 * 3600 // 2)
+    except NotImplementedError:
+        timer.supported = False
+    finally:
+        timeutils.clear_time_override()
+    return timer
+
+
+def print_report(url, reports, out):
+    out.write('%s\n' % url)
+    out.write('  %-36s %6s %8s %9s %9s %9s %9s\n' % (
+        'operation', 'calls', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms'))
+    for r in reports:
+        if not r['supported']:
+            out.write('  %-36s unsupported\n' % r['operation'])
+            continue
+        out.write('  %-36s %6d %8.1f %9.2f %9.2f %9.2f %9.2f\n' % (
+            r['operation'], r['calls'], r['per_second'] or 0,
+            r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000,
+            r['max'] * 1000))
+
+
+def main(argv=None):
+    cfg.CONF([], project='ceilometer')
+
+    parser = argparse.ArgumentParser(
+        description='benchmark the storage drivers',
+    )
+    parser.add_argument(
+        '--seed',
+        default=42,
+        type=int,
+        help='seed of the generated dataset',
+    )
+    parser.add_argument(
+        '--projects',
+        default=5,
+        type=int,
+        help='number of projects',
+    )
+    parser.add_argument(
+        '--users',
+        default=2,
+        type=int,
+        help='number of users per project',
+    )
+    parser.add_argument(
+        '--resources',
+        default=20,
+        type=int,
+        help='number of resources',
+    )
+    parser.add_argument(
+        '--meters',
+        default=4,
+        type=int,
+        help='number of meters per resource',
+    )
+    parser.add_argument(
+        '--days',
+        default=2,
+        type=int,
+        help='number of days of samples',
+    )
+    parser.add_argument(
+        '--interval',
+        default=10,
+        type=int,
+        help='the period between samples, in minutes',
+    )
+    parser.add_argument(
+        '--metadata-keys',
+        default=5,
+        type=int,
+        help='number of metadata keys of each sample',
+    )
+    parser.add_argument(
+        '--metadata-cardinality',
+        default=10,
+        type=int,
+        help='number of distinct values of each metadata key',
+    )
+    parser.add_argument(
+        '--metadata-size',
+        default=16,
+        type=int,
+        help='number of padding bytes of each metadata value',
+    )
+    parser.add_argument(
+        '--batch-size',
+        default=1,
+        type=int,
+        help='number of samples recorded per timed load operation',
+    )
+    parser.add_argument(
+        '--iterations',
+        default=20,
+        type=int,
+        help='number of times the query mix is run',
+    )
+    parser.add_argument(
+        '--no-expire',
+        action='store_true',
+        help='do not time the expirer',
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='print the results as JSON',
+    )
+    parser.add_argument(
+        'url',
+        nargs='*',
+        default=['sqlite://', 'hbase://__test__'],
+        help='database connection URLs',
+    )
+    args = parser.parse_args(argv)
+
+    dataset = Dataset(args.seed, args.projects, args.users, args.resources,
+                      args.meters, args.days, args.interval,
+                      args.metadata_keys, args.metadata_cardinality,
+                      args.metadata_size)
+    sys.stderr.write('Dataset of %d samples\n' % len(dataset))
+
+    results = {}
+    for url in args.url:
+        cfg.CONF.set_override('connection', url, group='database')
+        conn = storage.get_connection(cfg.CONF)
+        conn.upgrade()
+        conn.clear()
+
+        sys.stderr.write('Loading %s\n' % url)
+        timers = [load(conn, dataset, args.batch_size)]
+        sys.stderr.write('Querying %s\n' % url)
+        timers.extend(run_queries(conn, dataset, args.iterations,
+                                  random.Random(args.seed)))
+        if not args.no_expire:
+            timers.append(expire(conn, dataset))
+        results[url] = [t.report() for t in timers]
+        conn.clear()
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        for url in args.url:
+            print_report(url, results[url], sys.stdout)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())